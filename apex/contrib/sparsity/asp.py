@@ -1,6 +1,6 @@
 import types
 import torch
-from .sparse_masklib import create_mask
+from .sparse_masklib import create_mask, pack_mask, unpack_mask
 from .permutation_lib import Permutation
 
 torchvision_imported=True
@@ -10,6 +10,14 @@ except ImportError:
     print("[ASP][Warning] torchvision cannot be imported.")
     torchvision_imported=False
 
+multi_tensor_mask_available=False
+try:
+    import amp_C
+    from apex.multi_tensor_apply import multi_tensor_applier
+    multi_tensor_mask_available=hasattr(amp_C, 'multi_tensor_mask')
+except ImportError:
+    multi_tensor_mask_available=False
+
 import json
 import os
 import string
@@ -32,6 +40,7 @@ class ASP:
     __sparse_parameters = []
     __calculate_mask = None
     __allow_permutation = True
+    __compact_mask = False
     __all_parameters = []
     __save_permutation_graph = False
     __permutation_output_dir = ''
@@ -42,7 +51,7 @@ class ASP:
              whitelist=[torch.nn.Linear, torch.nn.Conv1d, torch.nn.Conv2d, torch.nn.Conv3d], 
              allowed_layer_names=None, disallowed_layer_names=[],
              allow_recompute_mask=False, custom_layer_dict={},
-             allow_permutation=True):
+             allow_permutation=True, compact_mask=False):
         """Call this method to modify your model to take advantage of sparse matrix multiplication.
         Note that this call alone only augments the model with additional buffers needed for sparse MMA,
         it does not enable use of sparse MMA. 
@@ -76,6 +85,9 @@ class ASP:
                                    Pruned weights are stored in CPU memory, hence this option does not increase GPU memory usage.
           custom_layer_dict        Dictionary of additional layer paremeters to sparsify. e.g. {CustomLinear: ['weight']}
           allow_permutation        If True, allow the input channel permutation to ease the influence of weight pruning.
+          compact_mask             If True, masks are stored bit-packed (a 4-bit index per group of 4 weights, in uint8) and expanded
+                                   on the fly, and pruned weights only keep the dropped values. Needs masks that prune exactly half
+                                   of the weights, like the 2:4 patterns.
           
           [Future] Support for allow_recompute_mask can be removed, it is not part of sparse inference recipe.
         """
@@ -83,6 +95,7 @@ class ASP:
         cls.__model = model
         cls.__verbosity = verbosity
         cls.__allow_permutation = allow_permutation
+        cls.__compact_mask = compact_mask
 
         if isinstance(mask_calculator, str):
             def create_mask_from_pattern(param):
@@ -144,10 +157,15 @@ class ASP:
                         print("[ASP] Sparsifying %s::%s of size=%s and type=%s for sparsity" % (module_name, p_name, str(p.size()), str(p.dtype)))
                     
                     mask = torch.ones_like(p).bool()
+                    if cls.__compact_mask:
+                        mask = pack_mask(mask)
                     buffname = p_name.split(".")[-1] # buffer names cannot contain "."
                     module.register_buffer('__%s_mma_mask' % buffname, mask)
                     if allow_recompute_mask:
-                        pruned = torch.zeros_like(p).cpu()
+                        if cls.__compact_mask: # only the dropped half of the weights
+                            pruned = torch.zeros(p.numel() // 2, dtype=p.dtype)
+                        else:
+                            pruned = torch.zeros_like(p).cpu()
                         module.register_buffer('__%s_mma_pruned_p' % buffname, pruned)
                     else:
                         pruned = None
@@ -159,6 +177,44 @@ class ASP:
         for name, sparse_module in eligible_modules(model, tuple(whitelist), allowed_layer_names, disallowed_layer_names):
             add_sparse_attributes(name, sparse_module)
 
+    @classmethod
+    def __expand_mask(cls, mask, p):
+        """Return the mask of p as a bool tensor of the shape of p, expanding it if it is stored compact."""
+        if cls.__compact_mask:
+            return unpack_mask(mask, p.shape)
+        return mask
+
+    @classmethod
+    def __restore_pruned(cls, p, mask, pruned):
+        """Put the pruned weights back into p, mask being the (expanded) mask they were pruned with."""
+        if cls.__compact_mask:
+            p.masked_scatter_(~mask, pruned.to(p.device))
+        else:
+            p.add_(pruned.to(p.device))
+
+    @classmethod
+    def __apply_masks(cls, tensors, masks):
+        """Multiply every tensor by its mask in place.
+        Dense masks are applied with one fused multi-tensor call per (dtype, device) bucket,
+        compact masks are expanded one tensor at a time so that they never all exist in expanded form."""
+        if cls.__compact_mask:
+            for tensor, mask in zip(tensors, masks):
+                tensor.mul_(unpack_mask(mask, tensor.shape))
+            return
+
+        buckets = {}
+        for tensor, mask in zip(tensors, masks):
+            fusable = tensor.is_contiguous() and mask.is_contiguous() and mask.dtype == torch.bool
+            bucket_tensors, bucket_masks = buckets.setdefault((tensor.dtype, tensor.device, fusable), ([], []))
+            bucket_tensors.append(tensor)
+            bucket_masks.append(mask)
+        for (dtype, device, fusable), (bucket_tensors, bucket_masks) in buckets.items():
+            if fusable and multi_tensor_mask_available and device.type == 'cuda' and dtype in (torch.float32, torch.float16, torch.bfloat16):
+                noop_flag = torch.zeros(1, dtype=torch.int, device=device)
+                multi_tensor_applier(amp_C.multi_tensor_mask, noop_flag, [bucket_tensors, bucket_masks])
+            else:
+                torch._foreach_mul_(bucket_tensors, bucket_masks)
+
     @classmethod
     def already_init_asp_model(cls):
         """Call this method to check whether ASP has been initialized already.
@@ -188,15 +244,16 @@ class ASP:
         def __step(opt_self, *args, **kwargs):
             # prune gradients before step method
             with torch.no_grad():
-                for module_name, module, p_name, p, mask, pruned in cls.__sparse_parameters:
-                    if p.grad is not None: #thx pjudd
-                        p.grad.mul_(mask)
+                grads_and_masks = [(p.grad, mask) for module_name, module, p_name, p, mask, pruned in cls.__sparse_parameters if p.grad is not None] #thx pjudd
+                if grads_and_masks:
+                    cls.__apply_masks(*zip(*grads_and_masks))
             # call original optimizer step method
             rval = opt_self.__step(*args, **kwargs)
             # prune parameters after step method
             with torch.no_grad():
-                for module_name, module, p_name, p, mask, pruned in cls.__sparse_parameters:
-                    p.mul_(mask)
+                if cls.__sparse_parameters:
+                    cls.__apply_masks([p for module_name, module, p_name, p, mask, pruned in cls.__sparse_parameters],
+                                      [mask for module_name, module, p_name, p, mask, pruned in cls.__sparse_parameters])
             return rval
         cls.__optimizer.step = types.MethodType(__step, cls.__optimizer)
 
@@ -239,19 +296,28 @@ class ASP:
                 # Finally, permutation search and off-line permutation is done, give the model back to ASP to generate the normal structured sparse mask
 
             for module_name, module, p_name, p, mask, pruned in cls.__sparse_parameters:
-                if mask.sum() < mask.numel(): # when recalculating masks
+                dense_mask = cls.__expand_mask(mask, p)
+                if dense_mask.sum() < dense_mask.numel(): # when recalculating masks
                     # restore dense parameter if allow_recompute_mask is enabled
                     assert (pruned is not None), "Unable to restore dense parameter because allow_recompute_mask == False"
-                    p.add_(pruned.cuda())
+                    cls.__restore_pruned(p, dense_mask, pruned)
 
-                mask.set_(cls.__calculate_mask(p))
+                dense_mask = cls.__calculate_mask(p)
+                if cls.__compact_mask:
+                    assert (dense_mask.sum() * 2 == dense_mask.numel()), "compact_mask needs masks that prune exactly half of the weights, like 2:4"
+                    mask.copy_(pack_mask(dense_mask))
+                else:
+                    mask.set_(dense_mask)
 
                 if pruned is not None: # stow away pruned weights to cpu
-                    pruned.set_((p * (~mask)).cpu())
+                    if cls.__compact_mask:
+                        pruned.copy_(p.masked_select(~dense_mask))
+                    else:
+                        pruned.set_((p * (~dense_mask)).cpu())
 
-                p.mul_(mask) # in-place multiplication, so pruned weights are 0-values, hence checkpoint will have 0s for pruned weights
+                p.mul_(dense_mask) # in-place multiplication, so pruned weights are 0-values, hence checkpoint will have 0s for pruned weights
                 if cls.__verbosity >= 2:
-                    print("[ASP] Enabled %.2f%% sparsity for %s::%s of size=%s and type=%s" % (100.0-100.0*mask.sum()/mask.numel(), module_name, p_name, str(p.size()), str(p.dtype)))
+                    print("[ASP] Enabled %.2f%% sparsity for %s::%s of size=%s and type=%s" % (100.0-100.0*dense_mask.sum()/dense_mask.numel(), module_name, p_name, str(p.size()), str(p.dtype)))
 
     @classmethod
     def restore_pruned_weights(cls):
@@ -260,10 +326,11 @@ class ASP:
         """
         with torch.no_grad():
             for module_name, module, p_name, p, mask, pruned in cls.__sparse_parameters:
-                if mask.sum() < mask.numel():
+                dense_mask = cls.__expand_mask(mask, p)
+                if dense_mask.sum() < dense_mask.numel():
                     assert (pruned is not None), "Unable to restore dense parameter because allow_recompute_mask == False"
-                    p.add_(pruned.cuda())
-                    mask.fill_(1)
+                    cls.__restore_pruned(p, dense_mask, pruned)
+                    mask.fill_(255 if cls.__compact_mask else 1)
                     pruned.zero_()
                     if cls.__verbosity >= 2:
                         print("[ASP] Disabled sparsity for %s::%s (dense weights restored)" % (module_name, p_name))
@@ -276,8 +343,9 @@ class ASP:
         total,sp100,sp50 = 0,0,0
         for module_name, module, p_name, p, mask, pruned in cls.__sparse_parameters:
             total += 1
-            mask_sum = mask.sum()
-            mask_numel = mask.numel()
+            dense_mask = cls.__expand_mask(mask, p)
+            mask_sum = dense_mask.sum()
+            mask_numel = dense_mask.numel()
             if mask_sum == mask_numel:
                 sp100 += 1
             elif mask_sum*2 == mask_numel:
@@ -310,3 +378,10 @@ class ASP:
 
         Permutation.set_permutation_saving_params(allow_permutation, save_permutation_graph, permutation_output_dir)
 
+    @classmethod
+    def set_permutation_search_params(cls, parallel_search=False, num_search_workers=None, search_time_budget=None):
+        """This function is used to set the parallel permutation search related parameters inside of the Permutation class.
+        With parallel_search=True, independent layer groups are searched concurrently in num_search_workers processes,
+        and each group search stops after search_time_budget seconds (if not None)."""
+        Permutation.set_parallel_search_params(parallel_search, num_search_workers, search_time_budget)
+
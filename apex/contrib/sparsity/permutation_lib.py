@@ -3,8 +3,14 @@ import torch
 import json
 import string
 import time
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 try:
     from .permutation_search_kernels import accelerated_search_for_good_permutation, sum_after_2_to_4
+    from .permutation_search_kernels import exhaustive_search
+    from .permutation_search_kernels.exhaustive_search import generate_all_unique_combinations
     print("[ASP][Info] permutation_search_kernels can be imported.")
 except ImportError:
     print("[ASP][Warning] permutation_search_kernels cannot be imported.")
@@ -15,6 +21,12 @@ def convert_fx_node_name(fx_node_name):
     converted_fx_node_name = converted_fx_node_name.replace('_', '.')
     return converted_fx_node_name
 
+punctuation_table = str.maketrans('', '', string.punctuation)
+def convert_module_name(module_name):
+    # Inception-V3, module_name: Conv2d_2a_3x3.conv, node_name: conv2d.1a.3x3.conv
+    converted_module_name = module_name.translate(punctuation_table).lower()
+    return converted_module_name
+
 def get_node_parent_children(fx_node):
     # get node parent list, and convert node name to module name
     node_parent_name_converted = []
@@ -38,6 +50,30 @@ def get_node_parent_children(fx_node):
         node_children_name_converted.append('None')
     return node_parent_name_converted, node_children_name_converted
 
+def init_search_worker(permutation_cache_dir, unique_permutation_lists):
+    """Worker initializer of the parallel permutation search: use the cache directory of the parent process and its unique permutation lists.
+    Lists backed by a cache file are passed as None and memory-mapped from the file, the others (if the cache could not be written) are passed as arrays.
+    """
+    exhaustive_search.set_permutation_cache_dir(permutation_cache_dir)
+    for (C, M), unique_permutations in unique_permutation_lists.items():
+        if unique_permutations is None:
+            generate_all_unique_combinations(C, M)
+        else:
+            exhaustive_search.master_unique_permutation_list[(C, M)] = unique_permutations
+
+def search_matrix_group_in_shared_memory(shm_name, shape, dtype, search_options, seed):
+    """Worker entry point of the parallel permutation search: run accelerated_search_for_good_permutation on a matrix_group shared by the parent process."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        matrix_group = torch.from_numpy(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+        # seed per group, so the result does not depend on which worker picks the group up
+        np.random.seed(seed)
+        permutation_sequence = accelerated_search_for_good_permutation(matrix_group, options=search_options)
+        del matrix_group
+    finally:
+        shm.close()
+    return [int(c) for c in permutation_sequence]
+
 
 class Permutation:
     __model = None
@@ -46,6 +82,12 @@ class Permutation:
     __all_parameters = []
     __save_permutation_graph = False
     __permutation_output_dir = ''
+    __identical_seed = 1
+    __parallel_search = False
+    __num_search_workers = None
+    __search_time_budget = None
+    __parameter_index = None
+    __parameter_index_key = None
 
     @classmethod
     def set_permutation_params_from_asp(cls, model, sparse_parameters, all_parameters):
@@ -58,6 +100,7 @@ class Permutation:
     @classmethod
     def set_identical_seed(cls, identical_seed=1):
         print("\n[set_identical_seed] Set the identical seed: {:} for all GPUs to make sure the same results generated in permutation search".format(identical_seed))
+        cls.__identical_seed = identical_seed
         torch.manual_seed(identical_seed)
         torch.cuda.manual_seed_all(identical_seed)
         import numpy as np
@@ -78,6 +121,49 @@ class Permutation:
         cls.__permutation_output_dir = permutation_output_dir
         print("[set_permutation_saving_param]\t Permutation graphs saving dir: {}".format(cls.__permutation_output_dir))
 
+    @classmethod
+    def set_parallel_search_params(cls, parallel_search=False, num_search_workers=None, search_time_budget=None):
+        """This function is used to set the parallel permutation search related parameters.
+        parallel_search         If True, independent unique_siblings groups are searched concurrently in a process pool.
+        num_search_workers      Number of worker processes, defaults to os.cpu_count().
+        search_time_budget      Per unique_siblings group search time budget in seconds, None means no budget.
+        """
+        print("\n[set_parallel_search_params] Set parallel permutation search related parameters")
+        cls.__parallel_search = parallel_search
+        print("[set_parallel_search_params]\t Parallel search: {}".format(cls.__parallel_search))
+        cls.__num_search_workers = num_search_workers
+        print("[set_parallel_search_params]\t Number of search workers: {}".format(cls.__num_search_workers if cls.__num_search_workers is not None else os.cpu_count()))
+        cls.__search_time_budget = search_time_budget
+        print("[set_parallel_search_params]\t Search time budget per group: {}".format(cls.__search_time_budget))
+
+    @classmethod
+    def build_parameter_index(cls):
+        """This function is used to index cls.__sparse_parameters and cls.__all_parameters by module name and by converted module name.
+        ASP fills the parameter lists after set_permutation_params_from_asp, so the index is rebuilt whenever their sizes change."""
+        parameter_index_key = (id(cls.__sparse_parameters), len(cls.__sparse_parameters), id(cls.__all_parameters), len(cls.__all_parameters))
+        if cls.__parameter_index_key != parameter_index_key:
+            parameter_index = {'sparse': {}, 'sparse_converted': {}, 'all': {}, 'all_converted': {}}
+            for position, (module_name, module, p_name, p, mask, pruned) in enumerate(cls.__sparse_parameters):
+                parameter_index['sparse'].setdefault(module_name, []).append(position)
+                parameter_index['sparse_converted'].setdefault(convert_module_name(module_name), []).append(position)
+            for position, (module_name, module, p_name, p) in enumerate(cls.__all_parameters):
+                parameter_index['all'].setdefault(module_name, []).append(position)
+                parameter_index['all_converted'].setdefault(convert_module_name(module_name), []).append(position)
+            cls.__parameter_index = parameter_index
+            cls.__parameter_index_key = parameter_index_key
+        return cls.__parameter_index
+
+    @classmethod
+    def find_node_parameters(cls, node_name, parameters='sparse', match_converted_names=True):
+        """This function is used to find the items of cls.__sparse_parameters (parameters='sparse') or cls.__all_parameters (parameters='all') of a node, in their original order.
+        A module matches the node by its name, by its name in the distributed model ('module.' prefix), or, with match_converted_names, by its converted name."""
+        parameter_index = cls.build_parameter_index()
+        positions = set(parameter_index[parameters].get(node_name, [])) | set(parameter_index[parameters].get('module.' + node_name, []))
+        if match_converted_names:
+            positions |= set(parameter_index[parameters + '_converted'].get(convert_module_name(node_name), []))
+        parameter_list = cls.__sparse_parameters if parameters == 'sparse' else cls.__all_parameters
+        return [parameter_list[position] for position in sorted(positions)]
+
     @classmethod
     def apply_offline_permutation(cls, model, fx_graph):
         """This function is used to offline permutation for each node according to the the whole network graph built with Torch.FX."""
@@ -133,7 +219,7 @@ class Permutation:
         """Call this method to transfer the sparse mask to all-one dense mask."""
         with torch.no_grad():
             for module_name, module, p_name, p, mask, pruned in cls.__sparse_parameters:
-                mask.fill_(1)
+                mask.fill_(255 if mask.dtype == torch.uint8 else 1)    # compact masks are bit-packed in uint8
 
     @classmethod
     def fetch_C_permutation_sequence_value(cls, node_name, fx_graph):
@@ -172,23 +258,18 @@ class Permutation:
             return False
         is_node_in_sparse_parameters = False
         success_permutation = False
-        for module_name, module, p_name, p, mask, pruned in cls.__sparse_parameters:
-            processed_module_name = ''.join(c for c in module_name if c not in string.punctuation).lower()
-            processed_node_name = ''.join(c for c in node_name if c not in string.punctuation).lower()
-            distributed_node_name = 'module.' + node_name
-            processed_distributed_node_name = 'module.' + processed_node_name
-            if (module_name == node_name) or (module_name == distributed_node_name) or (processed_module_name == processed_node_name) or (processed_module_name == processed_distributed_node_name):    # Inception-V3, module_name: Conv2d_2a_3x3.conv, node_name: conv2d.1a.3x3.conv
-                print("[apply_permutation_in_C_dim] find the node: \'{:}\' in cls.__sparse_parameters, succeed to apply permutation in C dim.".format(node_name))
-                is_node_in_sparse_parameters = True
-                temp_weight = torch.zeros_like(p)
-                temp_weight.copy_(p[:, permutation_sequence, ...])
-                p.data.copy_(temp_weight)
-                success_permutation = True
+        for module_name, module, p_name, p, mask, pruned in cls.find_node_parameters(node_name):
+            print("[apply_permutation_in_C_dim] find the node: \'{:}\' in cls.__sparse_parameters, succeed to apply permutation in C dim.".format(node_name))
+            is_node_in_sparse_parameters = True
+            temp_weight = torch.zeros_like(p)
+            temp_weight.copy_(p[:, permutation_sequence, ...])
+            p.data.copy_(temp_weight)
+            success_permutation = True
         if is_node_in_sparse_parameters == False:
             # A special case: if the node itself not in sparse_module_names but one of its real_siblings in sparse_module_names, then the node will not do the permutation search, but it may need to apply the offline permutation in C dim according to the searched permutation sequence from its real_siblings in sparse_module_names
             try:
-                for module_name_from_all_parameters, module_from_all_parameters, p_name_from_all_parameters, p_from_all_parameters in cls.__all_parameters:
-                    if ((node_name == module_name_from_all_parameters) or ('module.' + node_name == module_name_from_all_parameters)) and p_name_from_all_parameters == "weight":
+                for module_name_from_all_parameters, module_from_all_parameters, p_name_from_all_parameters, p_from_all_parameters in cls.find_node_parameters(node_name, parameters='all', match_converted_names=False):
+                    if p_name_from_all_parameters == "weight":
                         print("[apply_permutation_in_C_dim] cannot find the node: \'{:}\' in cls.__sparse_parameters, but can find in cls.__all_parameters.".format(node_name))
                         temp_weight = torch.zeros_like(p_from_all_parameters)
                         temp_weight.copy_(p_from_all_parameters[:, permutation_sequence, ...])
@@ -209,23 +290,18 @@ class Permutation:
             return False
         is_node_in_all_parameters = False
         success_permutation = False
-        for module_name, module, p_name, p in cls.__all_parameters:
-            processed_module_name = ''.join(c for c in module_name if c not in string.punctuation).lower()
-            processed_node_name = ''.join(c for c in node_name if c not in string.punctuation).lower()
-            distributed_node_name = 'module.' + node_name
-            processed_distributed_node_name = 'module.' + processed_node_name
-            if (module_name == node_name) or (module_name == distributed_node_name) or (processed_module_name == processed_node_name) or (processed_module_name == processed_distributed_node_name):    # Inception-V3, module_name: Conv2d_2a_3x3.conv, node_name: conv2d.1a.3x3.conv
-                print("[apply_permutation_in_K_dim] find the node: \'{:}\' with \'{:}\' in cls.__all_parameters, may succeed to apply permutation in K dim.".format(node_name, p_name))
-                is_node_in_all_parameters = True
-                temp_weight = torch.zeros_like(p)
-                if p.shape[0] != len(permutation_sequence):
-                    print("[apply_permutation_in_K_dim][warning] the node: \'{:}\' with shape: \'{:}\', cannot match the size of permutation sequence with len: \'{:}\', fail to apply permutation in K dim.".format(node_name, p.shape, len(permutation_sequence)))
-                    success_permutation = False
-                else:
-                    print("[apply_permutation_in_K_dim] the node: \'{:}\' with shape: \'{:}\', can match the size of permutation sequence with len: \'{:}\', succeed to apply permutation in K dim.".format(node_name, p.shape, len(permutation_sequence)))
-                    temp_weight.copy_(p[permutation_sequence, ...])
-                    p.data.copy_(temp_weight)
-                    success_permutation = True
+        for module_name, module, p_name, p in cls.find_node_parameters(node_name, parameters='all'):
+            print("[apply_permutation_in_K_dim] find the node: \'{:}\' with \'{:}\' in cls.__all_parameters, may succeed to apply permutation in K dim.".format(node_name, p_name))
+            is_node_in_all_parameters = True
+            temp_weight = torch.zeros_like(p)
+            if p.shape[0] != len(permutation_sequence):
+                print("[apply_permutation_in_K_dim][warning] the node: \'{:}\' with shape: \'{:}\', cannot match the size of permutation sequence with len: \'{:}\', fail to apply permutation in K dim.".format(node_name, p.shape, len(permutation_sequence)))
+                success_permutation = False
+            else:
+                print("[apply_permutation_in_K_dim] the node: \'{:}\' with shape: \'{:}\', can match the size of permutation sequence with len: \'{:}\', succeed to apply permutation in K dim.".format(node_name, p.shape, len(permutation_sequence)))
+                temp_weight.copy_(p[permutation_sequence, ...])
+                p.data.copy_(temp_weight)
+                success_permutation = True
         if is_node_in_all_parameters == False:
             print("[apply_permutation_in_K_dim] cannot find the node: \'{:}\' in cls.__all_parameters, fail to apply permutation in K dim.".format(node_name))
             success_permutation = False
@@ -271,6 +347,7 @@ class Permutation:
         unique_siblings_groups = fx_graph.get('unique_siblings').get('name')
         unique_siblings_groups_module_type = fx_graph.get('unique_siblings').get('module_type')
         unique_siblings_groups_permutation_sequence = []
+        pending_searches = []    # (index in unique_siblings_groups, matrix_group, search_options) for the parallel search
         item_index = 0
         for unique_siblings_group in unique_siblings_groups:    # loop through all unique siblings groups that must share a permutation sequence
             print("\n[search_for_good_permutation] this unique_siblings_group has {:} real siblings: \'{:}\', with module type: \'{:}\'.".format(len(unique_siblings_group), unique_siblings_group, unique_siblings_groups_module_type[item_index]))
@@ -283,33 +360,28 @@ class Permutation:
                 print("[search_for_good_permutation] try to merge the weight for node: \'{:}\', with module type: \'{:}\'.".format(node_name, node_module_type))
                 is_node_in_sparse_parameters = False
                 node_weight = torch.zeros(0)
-                for module_name, module, p_name, p, mask, pruned in cls.__sparse_parameters:
-                    processed_module_name = ''.join(c for c in module_name if c not in string.punctuation).lower()
-                    processed_node_name = ''.join(c for c in node_name if c not in string.punctuation).lower()
-                    distributed_node_name = 'module.' + node_name
-                    processed_distributed_node_name = 'module.' + processed_node_name
-                    if (module_name == node_name) or (module_name == distributed_node_name) or (processed_module_name == processed_node_name) or (processed_module_name == processed_distributed_node_name):    # Inception-V3, module_name: Conv2d_2a_3x3.conv, node_name: conv2d.1a.3x3.conv
-                        module_type_from_sparse_parameters = str(type(module))    # e.g. <class 'torch.nn.modules.conv.Conv2d'>
-                        module_type_from_sparse_parameters = module_type_from_sparse_parameters[8:-2]
-                        print("[search_for_good_permutation] find the node: \'{:}\' in cls.__sparse_parameters, module type match: \'{:}\'.".format(node_name, node_module_type==module_type_from_sparse_parameters))
-                        is_node_in_sparse_parameters = True
-                        node_weight = torch.zeros_like(p)
-                        node_weight.copy_(p)
-                        # Need to handle the concat for layers with different R & S
-                        shape = node_weight.shape
-                        # 1d-tensor
-                        if len(shape) == 1:
-                            node_weight = node_weight.view(1, shape[0])
-                        # 2d-tensor (in, out)
-                        elif len(shape) == 2:
-                            node_weight = node_weight.view(shape[0], shape[1])
-                        # 3d-tensor (batch, in, out)
-                        elif len(shape) == 3:
-                            node_weight = node_weight.view(shape[0]*shape[1], shape[2])
-                        # 4d-tensor (in, out, h, w)
-                        elif len(shape) == 4:
-                            # convs
-                            node_weight = node_weight.permute(2,3,0,1).contiguous().view(shape[2]*shape[3]*shape[0], shape[1])
+                for module_name, module, p_name, p, mask, pruned in cls.find_node_parameters(node_name):
+                    module_type_from_sparse_parameters = str(type(module))    # e.g. <class 'torch.nn.modules.conv.Conv2d'>
+                    module_type_from_sparse_parameters = module_type_from_sparse_parameters[8:-2]
+                    print("[search_for_good_permutation] find the node: \'{:}\' in cls.__sparse_parameters, module type match: \'{:}\'.".format(node_name, node_module_type==module_type_from_sparse_parameters))
+                    is_node_in_sparse_parameters = True
+                    node_weight = torch.zeros_like(p)
+                    node_weight.copy_(p)
+                    # Need to handle the concat for layers with different R & S
+                    shape = node_weight.shape
+                    # 1d-tensor
+                    if len(shape) == 1:
+                        node_weight = node_weight.view(1, shape[0])
+                    # 2d-tensor (in, out)
+                    elif len(shape) == 2:
+                        node_weight = node_weight.view(shape[0], shape[1])
+                    # 3d-tensor (batch, in, out)
+                    elif len(shape) == 3:
+                        node_weight = node_weight.view(shape[0]*shape[1], shape[2])
+                    # 4d-tensor (in, out, h, w)
+                    elif len(shape) == 4:
+                        # convs
+                        node_weight = node_weight.permute(2,3,0,1).contiguous().view(shape[2]*shape[3]*shape[0], shape[1])
 
                 if is_node_in_sparse_parameters == False:
                     print("[search_for_good_permutation] cannot find the node: \'{:}\' in cls.__sparse_parameters, no need to merge its weight for permutation.".format(node_name))
@@ -386,31 +458,100 @@ class Permutation:
                 search_options['improvement_threshold'] = 1e-9
                 print("[search_for_good_permutation] Change to Progressive Channel Swap Search with {} seconds limitation, because the {} is too large and will leading too long permutation search time with Exhaustive Search.".format(search_options['progressive_search_time_limit'], input_channel_num))
 
+            # limit the search time spent on a single unique_siblings_group
+            if cls.__search_time_budget is not None:
+                if search_options.get('strategy', 'exhaustive') == 'progressive channel swap':
+                    search_options['progressive_search_time_limit'] = min(search_options['progressive_search_time_limit'], cls.__search_time_budget)
+                else:
+                    search_options['search_time_limit'] = cls.__search_time_budget
+
+            if cls.__parallel_search:
+                # leave a placeholder, the search result is merged back in the same order after all searches are finished
+                print("[search_for_good_permutation] queue this unique_siblings_group for the parallel permutation search.")
+                pending_searches.append((len(unique_siblings_groups_permutation_sequence), matrix_group, search_options))
+                unique_siblings_groups_permutation_sequence.append(None)
+                continue
+
             start_time_accelerated_search_for_good_permutation = time.perf_counter()
-            permutation_sequence = accelerated_search_for_good_permutation(matrix_group, options=search_options)
+            permutation_sequence = cls.search_matrix_group(len(unique_siblings_groups_permutation_sequence), matrix_group, search_options)
             duration_accelerated_search_for_good_permutation = time.perf_counter() - start_time_accelerated_search_for_good_permutation
             print("[search_for_good_permutation] Take {:.4f} seconds to finish accelerated_search_for_good_permutation function.".format(duration_accelerated_search_for_good_permutation))
             unique_siblings_groups_permutation_sequence.append(permutation_sequence)
+
+        if len(pending_searches) > 0:
+            searched_permutation_sequences = cls.parallel_search_for_good_permutation(pending_searches)
+            for group_index, permutation_sequence in searched_permutation_sequences:
+                unique_siblings_groups_permutation_sequence[group_index] = permutation_sequence
         fx_graph['unique_siblings']['permutation_sequence'] = unique_siblings_groups_permutation_sequence
 
         if cls.__save_permutation_graph:
             cls.save_graph_to_json(fx_graph, save_dumped_graph_path_with_name=os.path.join(cls.__permutation_output_dir, './model_graph_search_for_good_permutation.json'))    # save the intermediate graph as JSON file for debugging
         return fx_graph
 
+    @classmethod
+    def search_matrix_group(cls, group_index, matrix_group, search_options):
+        """This function is used to search for the good permutation sequence of one unique_siblings group in the current process.
+        The random state is seeded per group the same way as in the parallel search, so both modes find the same permutation sequences.
+        """
+        np.random.seed(cls.__identical_seed + group_index)
+        return accelerated_search_for_good_permutation(matrix_group, options=search_options)
+
+    @classmethod
+    def parallel_search_for_good_permutation(cls, pending_searches):
+        """This function is used to search for the good permutation sequences of independent unique_siblings groups in a process pool.
+        Each matrix_group is shared with the workers through shared memory, and the results are returned in the order of pending_searches,
+        so the merged permutation sequences are deterministic no matter which worker finishes first.
+        """
+        num_search_workers = cls.__num_search_workers if cls.__num_search_workers is not None else os.cpu_count()
+        num_search_workers = max(1, min(num_search_workers, len(pending_searches)))
+        print("\n[parallel_search_for_good_permutation] Search for the good permutation sequence of {:} unique_siblings groups with {:} worker processes.".format(len(pending_searches), num_search_workers))
+        start_time_parallel_search = time.perf_counter()
+        # fill the on-disk unique permutation cache once here, instead of letting every worker generate it concurrently
+        unique_permutation_lists = {}
+        for group_index, matrix_group, search_options in pending_searches:
+            stripe_group_size = search_options.get('stripe_group_size', 8)    # same default as accelerated_search_for_good_permutation
+            if search_options.get('strategy', 'exhaustive') != 'exhaustive' or stripe_group_size >= matrix_group.size()[1]:
+                continue
+            window_sizes = [stripe_group_size]
+            if stripe_group_size == 12 and matrix_group.size()[1] > 512:    # Exhaustive_Search fixes up the two halves with a window of 8
+                window_sizes.append(8)
+            for window_size in window_sizes:
+                unique_permutations = generate_all_unique_combinations(window_size, 4)
+                unique_permutation_lists[(window_size, 4)] = None if isinstance(unique_permutations, np.memmap) else unique_permutations
+        shared_matrix_groups = []
+        searched_permutation_sequences = []
+        try:
+            # 'spawn' keeps the workers away from any CUDA context of the parent process
+            with ProcessPoolExecutor(max_workers=num_search_workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=init_search_worker, initargs=(exhaustive_search.permutation_cache_dir, unique_permutation_lists)) as executor:
+                futures = []
+                for group_index, matrix_group, search_options in pending_searches:
+                    matrix = matrix_group.cpu().detach().float().numpy()
+                    shm = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+                    shared_matrix_groups.append(shm)
+                    np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=shm.buf)[...] = matrix
+                    futures.append(executor.submit(search_matrix_group_in_shared_memory, shm.name, matrix.shape, matrix.dtype.str, search_options, cls.__identical_seed + group_index))
+
+                for (group_index, matrix_group, search_options), future in zip(pending_searches, futures):
+                    try:
+                        permutation_sequence = future.result()
+                    except Exception as e:
+                        raise RuntimeError("[parallel_search_for_good_permutation] the permutation search of unique_siblings group {:} failed".format(group_index)) from e
+                    searched_permutation_sequences.append((group_index, permutation_sequence))
+        finally:
+            for shm in shared_matrix_groups:
+                shm.close()
+                shm.unlink()
+        duration_parallel_search = time.perf_counter() - start_time_parallel_search
+        print("[parallel_search_for_good_permutation] Take {:.4f} seconds to finish the parallel permutation search.".format(duration_parallel_search))
+        return searched_permutation_sequences
+
     @classmethod
     def init_permutation_flag(cls, fx_graph):
         """This function is used to init the permutation flag for each node according to the whole network graph built with Torch.FX."""
         print("\n[init_permutation_flag] Init the permutation flag for each node according to the whole network graph built with Torch.FX")
-        sparse_module_names = []
-        processed_sparse_module_names = []    # Inception-V3, module_name: Conv2d_2a_3x3.conv, node_name: conv2d.1a.3x3.conv
-        for module_name, module, p_name, p, mask, pruned in cls.__sparse_parameters:
-            sparse_module_names.append(module_name)
-            processed_module_name = ''.join(c for c in module_name if c not in string.punctuation).lower()
-            processed_sparse_module_names.append(processed_module_name)
         for node_name in fx_graph.keys():
-            processed_node_name = ''.join(c for c in node_name if c not in string.punctuation).lower()
-            distributed_node_name = 'module.' + node_name
-            processed_distributed_node_name = 'module.' + processed_node_name
+            is_node_in_sparse_parameters = len(cls.find_node_parameters(node_name)) > 0
             node_module_type = fx_graph.get(node_name).get('module_type')
             if node_module_type in ['torch.nn.modules.conv.Conv2d', 'torch.nn.modules.linear.Linear']:
                 node_parents = fx_graph.get(node_name).get('parents')
@@ -421,10 +562,7 @@ class Permutation:
                 is_node_real_children_in_sparse_parameters = False
                 is_node_real_children_has_group_conv = False
                 for real_child_item in node_real_children:
-                    processed_real_child_item = ''.join(c for c in real_child_item if c not in string.punctuation).lower()
-                    distributed_real_child_item = 'module.' + real_child_item
-                    processed_distributed_real_child_item = 'module.' + processed_real_child_item
-                    if (real_child_item in sparse_module_names) or (processed_real_child_item in processed_sparse_module_names) or (distributed_real_child_item in sparse_module_names) or (processed_distributed_real_child_item in processed_sparse_module_names):
+                    if len(cls.find_node_parameters(real_child_item)) > 0:
                         is_node_real_children_in_sparse_parameters = True
                     if (fx_graph.get(real_child_item).get('groups_param') not in ['None', '1']):
                         is_node_real_children_has_group_conv = True
@@ -436,11 +574,11 @@ class Permutation:
                     if (fx_graph.get(real_parent_item).get('groups_param') not in ['None', '1']):
                         is_node_real_parents_has_group_conv = True
                 # If the node itself is in sparse_module_names or one of its real_children in sparse_module_names, then it may need the offline permutation
-                if ((node_name in sparse_module_names) or (processed_node_name in processed_sparse_module_names) or (distributed_node_name in sparse_module_names) or (processed_distributed_node_name in processed_sparse_module_names)) or (is_node_real_children_in_sparse_parameters == True):
+                if (is_node_in_sparse_parameters == True) or (is_node_real_children_in_sparse_parameters == True):
                     if node_groups_param not in ['None', '1']:
                         # for Group Conv, disable the permutation in 'C' and 'K' dim
                         fx_graph[node_name]['permutation_type'] = 'None'
-                    elif ('x' in node_parents) or ((node_name not in sparse_module_names) and (processed_node_name not in processed_sparse_module_names) and (distributed_node_name not in sparse_module_names) and (processed_distributed_node_name not in processed_sparse_module_names)):
+                    elif ('x' in node_parents) or (is_node_in_sparse_parameters == False):
                         # for the first (due to it is connected to 'x' node or itself is not in sparse_module_names) or not NVIDIA's TC compatiable Conv/FC, only permutate the K direction
                         if is_node_real_children_has_group_conv == False:
                             fx_graph[node_name]['permutation_type'] = 'K'
@@ -481,10 +619,7 @@ class Permutation:
                 node_real_children = fx_graph.get(node_name).get('real_children')
                 is_node_real_children_in_sparse_parameters = False
                 for real_child_item in node_real_children:
-                    processed_real_child_item = ''.join(c for c in real_child_item if c not in string.punctuation).lower()
-                    distributed_real_child_item = 'module.' + real_child_item
-                    processed_distributed_real_child_item = 'module.' + processed_real_child_item
-                    if (real_child_item in sparse_module_names) or (processed_real_child_item in processed_sparse_module_names) or (distributed_real_child_item in sparse_module_names) or (processed_distributed_real_child_item in processed_sparse_module_names):
+                    if len(cls.find_node_parameters(real_child_item)) > 0:
                         is_node_real_children_in_sparse_parameters = True
                 # Firstly, we should make sure the BN is not in the last (due to it is connected to a FC/Conv node which is not in sparse_module_names), then:
                 # If the real_parents of BN node are in sparse_module_names, then it may need the offline permutation
@@ -557,6 +692,7 @@ class Permutation:
         print("\n[extract_all_unique_siblings] Extract all unique siblings for the whole network graph built with Torch.FX")
         all_unique_siblings_name = []
         all_unique_siblings_module_type = []
+        all_unique_siblings_node_names = set()    # the node names already included in one of the unique_siblings_name lists
         for node_name in fx_graph.keys():
             fx_graph[node_name]['node_type'] = 'network_node'    # use the 'node_type' to divide the real nodes apart from the auxiliary info node, like 'unique_siblings' node
             node_module_type = fx_graph.get(node_name).get('module_type')
@@ -573,15 +709,13 @@ class Permutation:
                     node_real_siblings_module_type_with_node_itself.insert(0, node_module_type)
                     all_unique_siblings_name.append(node_real_siblings_with_node_itself)
                     all_unique_siblings_module_type.append(node_real_siblings_module_type_with_node_itself)
+                    all_unique_siblings_node_names.update(node_real_siblings_with_node_itself)
             else:
                 print("[extract_all_unique_siblings] node_name: \'{:}\', node module type: \'{:}\', has {:} real siblings: \'{:}\'.".format(node_name, node_module_type, len(node_real_siblings), node_real_siblings))
                 # for the two duplicated siblings lists, the node names included should be the same.
                 # If the node name is already included in one of the unique_siblings_name list, which means the real_siblings of this node is duplicated with the unique_siblings_name list.
                 # Otherwise, we should insert the [real_siblings + node_name] as a new unique_siblings_name list.
-                has_include_siblings = False
-                for unique_siblings_item in all_unique_siblings_name:
-                    if node_name in unique_siblings_item:
-                        has_include_siblings = True
+                has_include_siblings = node_name in all_unique_siblings_node_names
                 if has_include_siblings == False:
                     # direct insert will change the real_siblings info for the node in the fx_graph
                     node_real_siblings_with_node_itself = node_real_siblings.copy()
@@ -590,6 +724,7 @@ class Permutation:
                     node_real_siblings_module_type_with_node_itself.insert(0, node_module_type)
                     all_unique_siblings_name.append(node_real_siblings_with_node_itself)
                     all_unique_siblings_module_type.append(node_real_siblings_module_type_with_node_itself)
+                    all_unique_siblings_node_names.update(node_real_siblings_with_node_itself)
 
         fx_graph['unique_siblings'] = {}
         fx_graph['unique_siblings']['name'] = all_unique_siblings_name
@@ -626,11 +761,13 @@ class Permutation:
 
             # remove the duplicated real siblings
             exclusive_node_real_siblings_name = []
+            visited_node_real_siblings_name = set()
             exclusive_node_real_siblings_module_type = []
             item_index = 0
             duplicated_real_siblings = 0
             for item in node_real_siblings_name:
-                if item not in exclusive_node_real_siblings_name:
+                if item not in visited_node_real_siblings_name:
+                    visited_node_real_siblings_name.add(item)
                     exclusive_node_real_siblings_name.append(item)
                     exclusive_node_real_siblings_module_type.append(node_real_siblings_module_type[item_index])
                 else:
@@ -646,9 +783,9 @@ class Permutation:
         return fx_graph
 
     @classmethod
-    def recursive_find_real_children(cls, node_name, fx_graph):
+    def recursive_find_real_children(cls, node_name, fx_graph, real_children_cache=None):
         """This function is used to recursively find the real children for each node according to the whole network graph built with Torch.FX.
-        Used as the sub-function of find_real_children.
+        Used as the sub-function of find_real_children, real_children_cache memoizes the (real children, module types) of the visited nodes.
         """
         node_real_children_name = []
         node_real_children_module_type = []
@@ -675,8 +812,12 @@ class Permutation:
                     has_visit_children_num = has_visit_children_num + 1
             if len(sub_node_need_recursive_search) > 0:
                 for sub_node in sub_node_need_recursive_search:
-                    if fx_graph.get(sub_node).get('real_children') == []:
-                        sub_node_real_children_name, sub_node_real_children_module_type = cls.recursive_find_real_children(sub_node, fx_graph)
+                    if (real_children_cache is not None) and (sub_node in real_children_cache):
+                        sub_node_real_children_name, sub_node_real_children_module_type = real_children_cache[sub_node]
+                    elif fx_graph.get(sub_node).get('real_children') == []:
+                        sub_node_real_children_name, sub_node_real_children_module_type = cls.recursive_find_real_children(sub_node, fx_graph, real_children_cache)
+                        if real_children_cache is not None:
+                            real_children_cache[sub_node] = (sub_node_real_children_name, sub_node_real_children_module_type)
                     else:
                         # if the sub_node already find the 'real_children', no need to do recursive search
                         sub_node_real_children_name = fx_graph.get(sub_node).get('real_children')
@@ -698,6 +839,12 @@ class Permutation:
             reversible_fx_graph_keys = fx_graph.keys()
         else:    # 'dict_keys' object is not reversible in previous of Python 3.8
             reversible_fx_graph_keys = list(fx_graph.keys())
+        # index the nodes by their real parents once, instead of scanning the whole graph for each Conv/FC node
+        nodes_by_real_parent = {}
+        for other_node_name in fx_graph.keys():
+            for real_parent_item in fx_graph.get(other_node_name).get('real_parents'):
+                nodes_by_real_parent.setdefault(real_parent_item, []).append(other_node_name)
+        real_children_cache = {}
         for node_name in reversed(reversible_fx_graph_keys):    # as the optimization, we need to find the real children from back to front, to use the already saved 'real_children'
             node_real_children_name = []
             node_real_children_module_type = []
@@ -705,12 +852,12 @@ class Permutation:
             node_module_type = fx_graph.get(node_name).get('module_type')
             if node_module_type not in ['torch.nn.modules.conv.Conv2d', 'torch.nn.modules.linear.Linear']:
                 print("\n[find_real_children] node_name: \'{:}\', node module type: \'{:}\', children num: {:}, recursive to find real children.".format(node_name, node_module_type, len(node_children)))
-                node_real_children_name, node_real_children_module_type = cls.recursive_find_real_children(node_name, fx_graph)
+                node_real_children_name, node_real_children_module_type = cls.recursive_find_real_children(node_name, fx_graph, real_children_cache)
             else:    # Quick method, but cannot get the real children for no-need-permutataion layers like BN
                 print("\n[find_real_children] node_name: \'{:}\', node module type: \'{:}\', children num: {:}, can directly find real children.".format(node_name, node_module_type, len(node_children)))
                 # if the node is in the 'real_parents' list of the other node, then the other node is the real children for this node
-                for other_node_name in fx_graph.keys():
-                    if (other_node_name != node_name) and (node_name in fx_graph.get(other_node_name).get('real_parents')):
+                for other_node_name in nodes_by_real_parent.get(node_name, []):
+                    if other_node_name != node_name:
                         child_module_type = fx_graph.get(other_node_name).get('module_type')
                         if child_module_type in ['torch.nn.modules.conv.Conv2d', 'torch.nn.modules.linear.Linear']:
                             print("[find_real_children] node_name: \'{:}\', has one real child: \'{:}\', its real child module type: \'{:}\'.".format(node_name, other_node_name, child_module_type))
@@ -719,11 +866,13 @@ class Permutation:
 
             # remove the duplicated real children
             exclusive_node_real_children_name = []
+            visited_node_real_children_name = set()
             exclusive_node_real_children_module_type = []
             item_index = 0
             duplicated_real_children = 0
             for item in node_real_children_name:
-                if item not in exclusive_node_real_children_name:
+                if item not in visited_node_real_children_name:
+                    visited_node_real_children_name.add(item)
                     exclusive_node_real_children_name.append(item)
                     exclusive_node_real_children_module_type.append(node_real_children_module_type[item_index])
                 else:
@@ -733,6 +882,7 @@ class Permutation:
                 print("[find_real_children] node_name: \'{:}\', remove {:} duplicated real children.".format(node_name, duplicated_real_children))
             fx_graph[node_name]['real_children'] = exclusive_node_real_children_name
             fx_graph[node_name]['real_children_module_type'] = exclusive_node_real_children_module_type
+            real_children_cache[node_name] = (exclusive_node_real_children_name, exclusive_node_real_children_module_type)
 
         if cls.__save_permutation_graph:
             cls.save_graph_to_json(fx_graph, save_dumped_graph_path_with_name=os.path.join(cls.__permutation_output_dir, './model_graph_find_real_children.json'))    # save the intermediate graph as JSON file for debugging
@@ -773,12 +923,14 @@ class Permutation:
 
             # remove the duplicated real parents
             exclusive_node_real_parents_name = []
+            visited_node_real_parents_name = set()
             exclusive_node_real_parents_module_type = []
             exclusive_node_real_parents_groups_param = []
             item_index = 0
             duplicated_real_parents = 0
             for item in node_real_parents_name:
-                if item not in exclusive_node_real_parents_name:
+                if item not in visited_node_real_parents_name:
+                    visited_node_real_parents_name.add(item)
                     exclusive_node_real_parents_name.append(item)
                     exclusive_node_real_parents_module_type.append(node_real_parents_module_type[item_index])
                     exclusive_node_real_parents_groups_param.append(fx_graph.get(item).get('groups_param'))
@@ -1,6 +1,7 @@
 import numpy as np
 from .permutation_utilities import *
 from .exhaustive_search import Exhaustive_Search
+from .channel_swap import Channel_Swap
 
 def accelerated_search_for_good_permutation(matrix_group, options=None):
     """This function is used to call the permutation search CUDA kernels.
@@ -29,8 +30,10 @@ def accelerated_search_for_good_permutation(matrix_group, options=None):
             options['stripe_group_size'] = 8
         if 'escape_attempts' not in options:
             options['escape_attempts'] = 100
+        if 'search_time_limit' not in options:    # no time limit by default, search until converged
+            options['search_time_limit'] = None
     elif options['strategy'] == 'progressive channel swap':
-        # just swaps meaningful channels, keeping the good swaps, until the search time limit expires.
+        # greedily applies the best channel swaps of the whole matrix, until no swap improves it or the search time limit expires.
         if 'progressive_search_time_limit' not in options:
             options['progressive_search_time_limit'] = 60
         if 'improvement_threshold' not in options:
@@ -38,24 +41,9 @@ def accelerated_search_for_good_permutation(matrix_group, options=None):
 
     # execute the requested strategy
     if options['strategy'] == 'exhaustive':
-        result, duration, permutation_sequence = Exhaustive_Search(result, stripe_group_size=options['stripe_group_size'], escape_attempts=options['escape_attempts'])
+        result, duration, permutation_sequence = Exhaustive_Search(result, stripe_group_size=options['stripe_group_size'], escape_attempts=options['escape_attempts'], time_limit=options['search_time_limit'])
     elif options['strategy'] == 'progressive channel swap':
-        real_swap_num = 0
-        start_time = time.perf_counter()
-        while time.perf_counter() - start_time < options['progressive_search_time_limit']:
-            src = np.random.randint(result.shape[1])
-            dst = np.random.randint(result.shape[1])
-            src_group = int(src/4)
-            dst_group = int(dst/4)
-            if src_group == dst_group:    # channel swapping within a stripe does nothing
-                continue
-            new_sum, improvement = try_swap(result, dst, src)
-            if improvement > options['improvement_threshold']:
-                result[...,[src,dst]] = result[...,[dst,src]]
-                permutation_sequence[src], permutation_sequence[dst] = permutation_sequence[dst], permutation_sequence[src]
-                real_swap_num += 1
-        duration = time.perf_counter() - start_time
-        print("\tFinally swap {} channel pairs until the search time limit expires.".format(real_swap_num))
+        result, duration, permutation_sequence = Channel_Swap(result, time_limit=options['progressive_search_time_limit'], improvement_threshold=options['improvement_threshold'])
     elif options['strategy'] == 'user defined':    # need to get the permutated matrix (result) by applying customized permutation search function
         print("[accelerated_search_for_good_permutation] Use the user customized permutation search function!")
     else:
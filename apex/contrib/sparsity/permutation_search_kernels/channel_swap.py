@@ -0,0 +1,114 @@
+import numpy as np
+import time
+import torch
+
+################################################################################################################
+# Progressive channel swap
+#   - score every swap of two channels (columns) from different stripes at once, as a C x C gain matrix
+#   - apply the best swaps that touch disjoint stripes in each round, their gains are independent of each other
+#   - after a round, only the gain matrix rows and columns of the touched stripes need to be refreshed
+################################################################################################################
+
+group_width = 4
+# for the column at position k of a stripe, the positions of the other columns in that stripe
+other_positions = torch.tensor([[c for c in range(group_width) if c != k] for k in range(group_width)])
+
+# magnitude kept by each of the given stripes after 2:4 pruning
+def stripe_scores(magnitudes, stripes):
+    columns = (stripes.unsqueeze(1) * group_width + torch.arange(group_width, device=magnitudes.device)).view(-1)
+    groups = magnitudes[:, columns].view(magnitudes.shape[0], -1, group_width)
+    return groups.topk(2, dim=-1).values.sum(dim=(0, 2))
+
+# scores[k, m] = magnitude kept by the stripe of columns[k] after 2:4 pruning, if columns[k] was replaced by candidates[m]
+#   with a >= b >= c being the other columns of the stripe, {a, b, c, x} keeps a + max(x, b) = a + (x + b + |x - b|) / 2,
+#   so the sum over the rows is an L1 distance between the columns b and x
+def swap_scores(magnitudes, columns, candidates):
+    others = (columns // group_width).unsqueeze(1) * group_width + other_positions.to(magnitudes.device)[columns % group_width]
+    top_2 = magnitudes[:, others].topk(2, dim=-1).values    # (rows, columns, 2)
+    a, b = top_2[..., 0], top_2[..., 1]
+    x = magnitudes[:, candidates]
+    distances = torch.cdist(b.t().contiguous().unsqueeze(0), x.t().contiguous().unsqueeze(0), p=1).squeeze(0)
+    return a.sum(dim=0).unsqueeze(1) + 0.5 * (b.sum(dim=0).unsqueeze(1) + x.sum(dim=0).unsqueeze(0) + distances)
+
+# gain[k, m] of swapping columns[k] with column m, for every column m
+def swap_gains(scores, column_base, columns, same_stripe):
+    gains = scores[columns, :] + scores[:, columns].t() - column_base[columns].unsqueeze(1) - column_base.unsqueeze(0)
+    return gains.masked_fill_(same_stripe[columns], float('-inf'))
+
+# entry point for the progressive channel swap search
+def Channel_Swap(matrix, time_limit=60, improvement_threshold=1e-9, permutation=None, max_swaps_per_round=None, device=None):
+    start_time = time.perf_counter()
+    num_columns = matrix.shape[1]
+    if permutation is None:
+        permutation = [c for c in range(num_columns)]
+    if num_columns % group_width != 0 or num_columns <= group_width:
+        print(f"Matrix has {num_columns} columns, which cannot be split into several stripes of {group_width}: skipping the channel swap search")
+        return np.copy(matrix), time.perf_counter() - start_time, permutation
+
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    magnitudes = torch.from_numpy(np.abs(np.asarray(matrix, dtype=np.float64))).to(device)
+    num_stripes = num_columns // group_width
+    if max_swaps_per_round is None:
+        max_swaps_per_round = num_stripes // 2
+    all_columns = torch.arange(num_columns, device=device)
+    column_stripe = all_columns // group_width
+    same_stripe = column_stripe.unsqueeze(1) == column_stripe.unsqueeze(0)
+    permutation = torch.tensor(permutation, dtype=torch.long, device=device)
+
+    # one batched pass for the full gain matrix
+    stripe_base = stripe_scores(magnitudes, torch.arange(num_stripes, device=device))
+    scores = swap_scores(magnitudes, all_columns, all_columns)
+    gains = swap_gains(scores, stripe_base[column_stripe], all_columns, same_stripe)
+    # every swap is in the gain matrix twice: only keep it in the upper triangle, in place
+    gains.masked_fill_(all_columns.unsqueeze(1) >= all_columns.unsqueeze(0), float('-inf'))
+
+    rounds = 0
+    total_swaps = 0
+    converged = False
+    while time.perf_counter() - start_time < time_limit:
+        # best candidates first; only keep swaps whose stripes are not touched by a better swap of this round
+        num_candidates = min(4 * max_swaps_per_round, num_columns * num_columns)
+        values, indices = gains.view(-1).topk(num_candidates)
+        swaps = []
+        used_stripes = set()
+        for value, index in zip(values.tolist(), indices.tolist()):
+            if value <= improvement_threshold or len(swaps) >= max_swaps_per_round:
+                break
+            src, dst = divmod(index, num_columns)
+            src_stripe, dst_stripe = src // group_width, dst // group_width
+            if src_stripe in used_stripes or dst_stripe in used_stripes:
+                continue
+            used_stripes.update((src_stripe, dst_stripe))
+            swaps.append((src, dst))
+        if len(swaps) == 0:
+            converged = True
+            break
+
+        # apply the swaps to the magnitudes and the permutation
+        src = torch.tensor([s for s, d in swaps], dtype=torch.long, device=device)
+        dst = torch.tensor([d for s, d in swaps], dtype=torch.long, device=device)
+        swapped = torch.cat((src, dst))
+        exchanged = torch.cat((dst, src))
+        magnitudes[:, swapped] = magnitudes[:, exchanged]
+        permutation[swapped] = permutation[exchanged]
+
+        # refresh the touched stripes: their base, their rows of the scores, and the score columns of the swapped positions
+        touched_stripes = torch.tensor(sorted(used_stripes), dtype=torch.long, device=device)
+        touched_columns = (touched_stripes.unsqueeze(1) * group_width + torch.arange(group_width, device=device)).view(-1)
+        stripe_base[touched_stripes] = stripe_scores(magnitudes, touched_stripes)
+        scores[touched_columns, :] = swap_scores(magnitudes, touched_columns, all_columns)
+        scores[:, swapped] = swap_scores(magnitudes, all_columns, swapped)
+        touched_gains = swap_gains(scores, stripe_base[column_stripe], touched_columns, same_stripe)
+        upper = touched_columns.unsqueeze(1) < all_columns.unsqueeze(0)
+        lower = touched_columns.unsqueeze(1) > all_columns.unsqueeze(0)
+        gains[touched_columns, :] = touched_gains.masked_fill(~upper, float('-inf'))
+        gains[:, touched_columns] = touched_gains.masked_fill(~lower, float('-inf')).t()
+
+        rounds += 1
+        total_swaps += len(swaps)
+
+    duration = time.perf_counter() - start_time
+    print(f"Channel swap search applied {total_swaps} swaps in {rounds} rounds in {duration:.2f} seconds, {'converged' if converged else 'stopped at the time limit'}")
+    permutation = permutation.tolist()
+    return matrix[:, permutation], duration, permutation
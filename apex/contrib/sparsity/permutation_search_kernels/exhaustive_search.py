@@ -56,23 +56,70 @@ def generate_unique_combinations(built_permutation, remaining_columns, full_perm
                 # remove the most recent column and put it back on the remaining column list where we found it (sorted)
                 remaining_columns.insert(c, built_permutation.pop(-1))
 
-import pickle
-import os.path
-from os import path
+import os
+import tempfile
+#############################################################
+# on-disk cache of unique permutations
+#   - one memory-mapped (num_permutations, C) uint8 array of column indices per (C, M)
+#   - loaded lazily, and the mapped pages are shared by every process that searches with the same window
+#############################################################
+permutation_cache_dir = os.environ.get("APEX_PERMUTATION_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "apex", "permutation_search"))
 master_unique_permutation_list = {}
+
+# set the directory of the on-disk cache; permutation lists already loaded in this process are kept
+def set_permutation_cache_dir(cache_dir):
+    global permutation_cache_dir
+    permutation_cache_dir = cache_dir
+
+def permutation_cache_path(C, M):
+    return os.path.join(permutation_cache_dir, f"unique_permutations_C{C}_M{M}.npy")
+
+# write to a temporary file first and rename it, so concurrent readers never see a partial file
+def save_unique_combinations(C, M, unique_permutations):
+    try:
+        os.makedirs(permutation_cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=permutation_cache_dir, suffix=".npy.tmp")
+        try:
+            with os.fdopen(fd, "wb") as cache:
+                np.save(cache, unique_permutations)
+            os.replace(tmp_path, permutation_cache_path(C, M))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return True
+    except OSError as e:
+        print(f"Could not write the unique permutations of ({C},{M}) to {permutation_cache_dir}: {e}")
+        return False
+
+# map a cached list, or return None if it is missing or does not hold the expected (num_permutations, C) uint8 array
+def load_unique_combinations(C, M):
+    cache_path = permutation_cache_path(C, M)
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        unique_permutations = np.load(cache_path, mmap_mode="r")
+    except (OSError, ValueError) as e:
+        print(f"Could not read the unique permutations of ({C},{M}) from {cache_path}: {e}, regenerating them")
+        return None
+    expected_shape = (predict_unique_combinations(C, M), C)
+    if unique_permutations.dtype != np.uint8 or unique_permutations.shape != expected_shape or \
+            (unique_permutations.size > 0 and (unique_permutations.max() >= C or np.any(unique_permutations[:, 0] != 0))):
+        print(f"The unique permutations of ({C},{M}) in {cache_path} are not a valid uint8 array of shape {expected_shape}, regenerating them")
+        return None
+    return unique_permutations
+
 def generate_all_unique_combinations(C, M, must_use_all_groups = False):
     global master_unique_permutation_list
-    if len(master_unique_permutation_list) == 0 and path.exists("master_list.pkl"):
-        with open("master_list.pkl","rb") as cache:
-            master_unique_permutation_list = pickle.load(cache)
-
     if (C,M) not in master_unique_permutation_list:
-        full_permutation_list = []
-        generate_unique_combinations([0], [c for c in range(1,C)], full_permutation_list, M)
-        master_unique_permutation_list[(C,M)] = full_permutation_list
-
-        with open("master_list.pkl", "wb") as cache:
-            pickle.dump(master_unique_permutation_list, cache)
+        unique_permutations = load_unique_combinations(C, M)
+        if unique_permutations is None:
+            full_permutation_list = []
+            generate_unique_combinations([0], [c for c in range(1,C)], full_permutation_list, M)
+            assert(C <= 256)    # column indices are stored as uint8
+            unique_permutations = np.asarray(full_permutation_list, dtype=np.uint8).reshape(-1, C)
+            if save_unique_combinations(C, M, unique_permutations):
+                unique_permutations = np.load(permutation_cache_path(C, M), mmap_mode="r")
+        master_unique_permutation_list[(C,M)] = unique_permutations
 
     unique_permutations = master_unique_permutation_list[(C,M)]
 
@@ -90,7 +137,8 @@ def predict_unique_combinations(C, M):
 #################################################################
 
 # exhaustively search the entire matrix
-def search_matrix(matrix, group_width):
+#   base_sum can be provided by callers that already track the magnitude of the unpermuted matrix
+def search_matrix(matrix, group_width, base_sum=None):
     # give up quickly if we'd go on forever
     prediction = predict_unique_combinations(matrix.shape[1], group_width)
     best_permutation = [c for c in range(matrix.shape[1])]
@@ -103,16 +151,24 @@ def search_matrix(matrix, group_width):
 
     # found them, now try them
     best_improvement = 0.0
-    base_sum = sum_after_2_to_4(matrix)
-    for i in range(1,len(full_permutation_list)):
-        permutation = full_permutation_list[i]
-        permuted = matrix[:, permutation]
-        cur_improvement = sum_after_2_to_4(permuted) - base_sum
-
-        if (cur_improvement > best_improvement):
-            best_improvement = cur_improvement
-            best_permutation = permutation
+    if base_sum is None:
+        base_sum = sum_after_2_to_4(matrix)
+    if not use_gpu():    # score every candidate in bulk with the vectorized CPU engine
+        improvements = sum_after_2_to_4_batched(matrix, full_permutation_list[1:]) - base_sum
+        if len(improvements) > 0 and improvements.max() > best_improvement:
+            best_improvement = improvements.max()
+            best_permutation = full_permutation_list[1 + int(np.argmax(improvements))]
+    else:
+        for i in range(1,len(full_permutation_list)):
+            permutation = full_permutation_list[i]
+            permuted = matrix[:, permutation]
+            cur_improvement = sum_after_2_to_4(permuted) - base_sum
+
+            if (cur_improvement > best_improvement):
+                best_improvement = cur_improvement
+                best_permutation = permutation
     seconds = time.perf_counter() - start_time
+    best_permutation = [int(c) for c in best_permutation]    # rows of the cached list are uint8, which torch would treat as a mask
     return matrix[:, best_permutation], seconds, best_permutation, best_improvement
 
 
@@ -121,13 +177,16 @@ def search_matrix(matrix, group_width):
 #############
 
 # gather stripes from a larger matrix into a single matrix
-def collect_stripes(matrix, stripes, group_width):
-    subset = np.zeros((matrix.shape[0], len(stripes)*group_width))
-    #print("[Debug][collect_stripes] matrix shape info: {}".format(matrix.shape))
-    #print("[Debug][collect_stripes] subset info: {}, {}, {}".format(matrix.shape[0], len(stripes), group_width))
-    for s,stripe in enumerate(stripes):
-        #print("[Debug][collect_stripes] s: {}, stripe: {}".format(s, stripe))
-        subset[...,s*group_width:s*group_width+group_width] = matrix[...,stripe*group_width:stripe*group_width+group_width]
+#   if a preallocated buffer is given, the stripes are gathered into (a view of) it instead of a new matrix
+def collect_stripes(matrix, stripes, group_width, out=None):
+    columns = (np.asarray(stripes, dtype=np.int64)[:, np.newaxis] * group_width + np.arange(group_width)).reshape(-1)
+    if out is None:
+        return matrix[:, columns]
+    subset = out[:, :len(columns)]
+    if subset.dtype == matrix.dtype and subset.flags.c_contiguous:
+        np.take(matrix, columns, axis=1, out=subset)
+    else:
+        subset[...] = matrix[:, columns]
     return subset
 
 # apply the stripe group permutation to the entire permutation
@@ -167,9 +226,50 @@ def generate_stripe_groups(num_stripes, window_size):
 # When calling the Exhaustive_Search in E2E search, the stripe_set will not be reset as None.
 stripe_set = None
 stripe_set_config = None
+# stripe -> indices of the stripe groups (in stripe_set) that contain it
+stripe_membership = None
+# incremental scoring state: the magnitude each stripe keeps after 2:4 pruning, and the float32 gather buffer
+stripe_baselines = None
+stripe_buffer = None
+
+# magnitude kept by each stripe after 2:4 pruning, for the stripes listed (or all of them)
+def compute_stripe_baselines(matrix, group_width, stripes=None):
+    if stripes is not None:
+        matrix = collect_stripes(matrix, stripes, group_width)
+    kept = top_2_of_4_sums(matrix.astype(np.float32, copy=False))    # (rows, stripes * group_width/4)
+    return kept.reshape(matrix.shape[0], -1, int(group_width/4)).sum(axis=(0, 2), dtype=np.float64)
+
+# only the stripes touched by the last applied permutations need a new baseline
+def update_stripe_baselines(matrix, group_width, used_stripes):
+    global stripe_baselines
+    num_stripes = int(matrix.shape[1] / group_width)
+    if stripe_baselines is None or len(stripe_baselines) != num_stripes:
+        stripe_baselines = compute_stripe_baselines(matrix, group_width)
+    elif len(used_stripes) > 0:
+        touched = np.unique(np.asarray(used_stripes, dtype=np.int64))
+        stripe_baselines[touched] = compute_stripe_baselines(matrix, group_width, touched)
+    return stripe_baselines
+
+# reuse the same float32 buffer to gather every stripe group
+def get_stripe_buffer(rows, columns):
+    global stripe_buffer
+    if stripe_buffer is None or stripe_buffer.shape[0] != rows or stripe_buffer.shape[1] < columns:
+        stripe_buffer = np.empty((rows, columns), dtype=np.float32)
+    return stripe_buffer
+
+# remaining seconds before a deadline, or None if there is no deadline
+def time_left(deadline):
+    if deadline is None:
+        return None
+    return max(deadline - time.perf_counter(), 0.)
+
+def past_deadline(deadline):
+    return deadline is not None and time.perf_counter() > deadline
+
 # build the stripe map
-def build_stripe_map(matrix, group_width, window_size, stripe_map, stripe_ids, perm_map, used_stripes):
-    global stripe_set, stripe_set_config
+#   deadline: stop updating stripe groups once time.perf_counter() passes it, the map is then only partially updated
+def build_stripe_map(matrix, group_width, window_size, stripe_map, stripe_ids, perm_map, used_stripes, deadline=None):
+    global stripe_set, stripe_set_config, stripe_membership
     #print("[Debug][build_stripe_map] Now the stripe_set value is: {}".format(stripe_set))
 
     window_size = int(window_size / group_width)
@@ -177,41 +277,48 @@ def build_stripe_map(matrix, group_width, window_size, stripe_map, stripe_ids, p
     if stripe_set is None or stripe_set_config is None or stripe_set_config != (group_width, window_size):
         num_stripes = int(matrix.shape[1] / group_width)
         assert(group_width * num_stripes == matrix.shape[1])
-        stripe_set = generate_stripe_groups(num_stripes, window_size)
+        # keep a fixed order so that stripe group indices stay valid across calls
+        stripe_set = sorted(generate_stripe_groups(num_stripes, window_size))
         #print("[Debug][build_stripe_map] Update stripe_set value as: {}".format(stripe_set))
         stripe_set_config = (group_width, window_size)
+        stripe_membership = [[] for _ in range(num_stripes)]
+        for i,s in enumerate(stripe_set):
+            for stripe in s:
+                stripe_membership[stripe].append(i)
+
+    # pre-populate if we're building fresh, otherwise only the groups containing a used stripe need an update
+    if len(stripe_map) < len(stripe_set):
+        for i in range(len(stripe_map), len(stripe_set)):
+            stripe_ids.append(list(stripe_set[i]))
+            stripe_map.append(0.)
+            perm_map.append([c for c in range(group_width * window_size)])
+        groups_to_update = range(len(stripe_set))
+    else:
+        groups_to_update = sorted(set(i for stripe in used_stripes for i in stripe_membership[stripe]))
 
     # step through each, update the stripe_map/stripe_ids if necessary
     updates = 0
     use_cuda = use_gpu()
     gpu_list = []
     gpu_groups = []
-    for i,s in enumerate(stripe_set):
-        sg = [] # build the group of stripes, check if any members changed
-        need_update = i >= len(stripe_map)
-        for stripe in s:
-            sg.append(stripe)
-            if stripe in used_stripes:
-                need_update = True
-
-        # pre-populate if we're building fresh
-        if i >= len(stripe_map):
-            stripe_ids.append(sg)
-            stripe_map.append(0.)
-            perm_map.append([c for c in range(group_width * window_size)])
-
-        # update entries if needed (only stripe_map and perm_map)
-        if need_update:
-            updates += 1
-
-            if not use_cuda:    # do the work here if using the CPU
-                subset = collect_stripes(matrix, sg, group_width)
-                sub_result, sub_duration, permutation, improvement = search_matrix(subset, group_width)
-                stripe_map[i] = improvement
-                perm_map[i] = permutation
-            else:               # otherwise, just track the work needed to farm off to the GPU
-                gpu_groups.append(sg)
-                gpu_list.append(i)
+    if not use_cuda:
+        baselines = update_stripe_baselines(matrix, group_width, used_stripes)
+        buffer = get_stripe_buffer(matrix.shape[0], group_width * window_size)
+    for i in groups_to_update:
+        if past_deadline(deadline):
+            break
+        sg = stripe_ids[i]
+        updates += 1
+
+        # update entries (only stripe_map and perm_map)
+        if not use_cuda:    # do the work here if using the CPU
+            subset = collect_stripes(matrix, sg, group_width, out=buffer)
+            sub_result, sub_duration, permutation, improvement = search_matrix(subset, group_width, base_sum=baselines[sg].sum())
+            stripe_map[i] = improvement
+            perm_map[i] = permutation
+        else:               # otherwise, just track the work needed to farm off to the GPU
+            gpu_groups.append(sg)
+            gpu_list.append(i)
 
     if use_cuda: # if using the GPU, perform the work
         matrix_view = np.copy(matrix).astype(np.float32).flatten()
@@ -244,7 +351,8 @@ def build_stripe_map(matrix, group_width, window_size, stripe_map, stripe_ids, p
 # start performing stripe checks
 sm_perturbations = 0
 sm_perturbation_limit = 0
-def use_stripe_map(matrix, group_width, stripe_map, stripe_ids, perm_map, permutation):
+#   deadline: stop applying stripe groups once time.perf_counter() passes it, every applied group is still an improvement
+def use_stripe_map(matrix, group_width, stripe_map, stripe_ids, perm_map, permutation, deadline=None):
     global sm_perturbations, sm_perturbation_limit
     used_stripes = []
     stripe_groups_optimized = 0
@@ -254,6 +362,8 @@ def use_stripe_map(matrix, group_width, stripe_map, stripe_ids, perm_map, permut
     ix = np.flip(np.argsort(stripe_map)) # small to large --> large to small
 
     for i in range(len(ix)):
+        if past_deadline(deadline):
+            break
         stripe_group_id = ix[i]
         perm = perm_map[stripe_group_id].copy()
 
@@ -309,17 +419,21 @@ def use_stripe_map(matrix, group_width, stripe_map, stripe_ids, perm_map, permut
     return matrix, stripe_groups_optimized, stripe_map, stripe_ids, used_stripes, improvement, permutation
 
 # entry point for exhaustive searches - both the entire matrix, as well as stripe groups
-def Exhaustive_Search(matrix, stripe_group_size=-1, escape_attempts=0, permutation=None):
+#   time_limit (seconds): stop refining the stripe groups once it expires and return the best permutation found so far
+def Exhaustive_Search(matrix, stripe_group_size=-1, escape_attempts=0, permutation=None, time_limit=None):
     global sm_perturbation_limit, sm_perturbations
+    deadline = None if time_limit is None else time.perf_counter() + time_limit
     sm_perturbations = 0
     sm_perturbation_limit = escape_attempts
     if permutation is None:
         permutation = [c for c in range(matrix.shape[1])]
 
     # It is much safer to reset the stripe_set as None in the entry point of Exhaustive_Search
-    global stripe_set, stripe_set_config
+    global stripe_set, stripe_set_config, stripe_membership, stripe_baselines
     stripe_set = None
     stripe_set_config = None
+    stripe_membership = None
+    stripe_baselines = None
 
     # only support N:4 for now
     group_width = 4
@@ -330,10 +444,10 @@ def Exhaustive_Search(matrix, stripe_group_size=-1, escape_attempts=0, permutati
     if group_width==4 and stripe_group_size==12 and matrix.shape[1] > 512:
         stripe_split = int(matrix.shape[1]/2/group_width)
         col_split = stripe_split * group_width
-        result[:,:col_split], durationL, permutation[:col_split] = Exhaustive_Search(result[:,:col_split], stripe_group_size=stripe_group_size, escape_attempts=escape_attempts, permutation=permutation[:col_split])
-        result[:,col_split:], durationR, permutation[col_split:] = Exhaustive_Search(result[:,col_split:], stripe_group_size=stripe_group_size, escape_attempts=escape_attempts, permutation=permutation[col_split:])
+        result[:,:col_split], durationL, permutation[:col_split] = Exhaustive_Search(result[:,:col_split], stripe_group_size=stripe_group_size, escape_attempts=escape_attempts, permutation=permutation[:col_split], time_limit=time_left(deadline))
+        result[:,col_split:], durationR, permutation[col_split:] = Exhaustive_Search(result[:,col_split:], stripe_group_size=stripe_group_size, escape_attempts=escape_attempts, permutation=permutation[col_split:], time_limit=time_left(deadline))
         escape_attempts = max(escape_attempts, 100)*10
-        result,duration,permutation = Exhaustive_Search(result, stripe_group_size=8, escape_attempts=escape_attempts, permutation=permutation)
+        result,duration,permutation = Exhaustive_Search(result, stripe_group_size=8, escape_attempts=escape_attempts, permutation=permutation, time_limit=time_left(deadline))
         return result, durationL+durationR+duration, permutation
 
     # small enough to optimize the entire matrix at once
@@ -346,8 +460,8 @@ def Exhaustive_Search(matrix, stripe_group_size=-1, escape_attempts=0, permutati
         agg_improvement = 0.
         cur_total_sum = sum_after_2_to_4(result)
 
-        # in practice, this work will be cached ahead of time; doing it now.
-        # (Reading the cached list from disk can take several seconds, which shouldn't be counted against the search, but amortized over every layer in a network)
+        # load (or generate and cache on disk) the unique permutations before starting the clock.
+        # (The list is memory-mapped from the cache directory, so it is only read once and amortized over every layer in a network)
         generate_all_unique_combinations(stripe_group_size, group_width)
 
         start_time = time.perf_counter()
@@ -355,8 +469,12 @@ def Exhaustive_Search(matrix, stripe_group_size=-1, escape_attempts=0, permutati
         while True:
             #print("[Debug][Exhaustive_Search] Before entering the build_stripe_map function.")
             #print("[Debug][Exhaustive_Search] Now the stripe_set value is: {}".format(stripe_set))
-            stripe_map, stripe_ids, perm_map = build_stripe_map(result, group_width, stripe_group_size, stripe_map, stripe_ids, perm_map, used_stripes)
-            result, stripe_groups_optimized, stripe_map, stripe_ids, used_stripes, improvement, permutation = use_stripe_map(result, group_width, stripe_map, stripe_ids, perm_map, permutation)
+            stripe_map, stripe_ids, perm_map = build_stripe_map(result, group_width, stripe_group_size, stripe_map, stripe_ids, perm_map, used_stripes, deadline=deadline)
+            # out of time? a partially updated stripe map may hold stale permutations, so don't apply it
+            if past_deadline(deadline):
+                print(f"Exhaustive search hit its time limit of {time_limit:.2f} seconds before converging, keeping the best permutation found so far")
+                break
+            result, stripe_groups_optimized, stripe_map, stripe_ids, used_stripes, improvement, permutation = use_stripe_map(result, group_width, stripe_map, stripe_ids, perm_map, permutation, deadline=deadline)
 
             # converged?
             if len(used_stripes) == 0:
@@ -1,8 +1,7 @@
+import re
 import sys
 import torch
-import numpy as np
-import collections
-from itertools import permutations
+from itertools import combinations
 
 
 """ compute density (helper fn to compute % NNZs in a tensor) """
@@ -13,37 +12,33 @@ def fill(x):
 def reshape_1d(matrix, m):
     # If not a nice multiple of m, fill with zeroes.
     if matrix.shape[1] % m > 0:
-        mat = torch.cuda.FloatTensor(matrix.shape[0], matrix.shape[1] + (m-matrix.shape[1]%m)).fill_(0)
+        mat = torch.zeros(matrix.shape[0], matrix.shape[1] + (m-matrix.shape[1]%m), dtype=matrix.dtype, device=matrix.device)
         mat[:, :matrix.shape[1]] = matrix
         shape = mat.shape
         return mat.view(-1,m),shape
     else:
         return matrix.view(-1,m), matrix.shape
 
-""" return all possible m:n patterns in a 1d vector """
-valid_m4n2_1d_patterns = None
-def compute_valid_1d_patterns(m,n):
+""" return all possible m:n patterns in a 1d vector, cached per (m, n, device) """
+valid_1d_patterns = {}
+def compute_valid_1d_patterns(m,n,device='cpu'):
     # Early exit if patterns was already created.
-    global valid_m4n2_1d_patterns
+    key = (m, n, str(torch.device(device)))
+    if key in valid_1d_patterns: return valid_1d_patterns[key]
 
-    if m==4  and n==2 and valid_m4n2_1d_patterns  is not None: return valid_m4n2_1d_patterns
-    patterns = torch.zeros(m)
-    patterns[:n] = 1
-    valid_patterns = torch.tensor(list(set(permutations(patterns.tolist()))))
-    if m == 4 and n == 2: valid_m4n2_1d_patterns = valid_patterns
+    # every choice of n kept positions out of m, without enumerating all m! orderings
+    kept = torch.tensor(list(combinations(range(m), n)), dtype=torch.long).view(-1, n)
+    valid_patterns = torch.zeros(kept.shape[0], m).scatter_(1, kept, 1.0).to(device)
+    valid_1d_patterns[key] = valid_patterns
     return valid_patterns
 
 """ m:n 1d structured best """
 def mn_1d_best(matrix, m, n):
-    # Find all possible patterns.
-    patterns = compute_valid_1d_patterns(m,n).cuda()
-
-    # Find the best m:n pattern (sum of non-masked weights).
-    mask = torch.cuda.IntTensor(matrix.shape).fill_(1).view(-1,m)
+    # The best m:n pattern (sum of non-masked weights) keeps the n largest magnitudes of every m-vector.
     mat,shape = reshape_1d(matrix,m)
-    pmax = torch.argmax(torch.matmul(mat.abs(),patterns.t()), dim=1)
-    mask[:] = patterns[pmax[:]]
-    mask = mask.view(matrix.shape)
+    mask = torch.zeros(mat.shape, dtype=torch.int, device=matrix.device)
+    mask.scatter_(1, torch.topk(mat.abs(), n, dim=1, sorted=False).indices, 1)
+    mask = mask.view(shape)[:, :matrix.shape[1]].contiguous()
     return mask
 
 def m4n2_1d(mat, density):
@@ -61,86 +56,106 @@ def m4n2_1d(mat, density):
   weight tensor such that their transposed versions are also 2:4 sparse along the
   horizontal (logical) direction. Thus, with 2d pruning, weight tensors are 
   2:4 sparse along row and column directions.
+
+  All 2d functions work on every m*m block of a layer at once, on the device of the
+  weight tensor. Rows and columns that do not fill a complete block are left dense.
  """
 
+""" reshape the complete m*m blocks of a matrix: (h,w) -> (h/m, w/m, m*m) """
+def reshape_2d(matrix, m):
+    rows, cols = (matrix.shape[0] // m) * m, (matrix.shape[1] // m) * m
+    mat = matrix[:rows, :cols].reshape(rows // m, m, cols // m, m).permute(0, 2, 1, 3)
+    return mat.reshape(rows // m, cols // m, m * m)
+
+""" inverse of reshape_2d: scatter (h/m, w/m, m*m) blocks into a dense (h,w) mask initialized with ones """
+def reshape_2d_inv(blocks, m, shape, dtype=torch.int):
+    mask = torch.ones(shape, dtype=dtype, device=blocks.device)
+    h, w = blocks.shape[0], blocks.shape[1]
+    mask[:h*m, :w*m] = blocks.view(h, w, m, m).permute(0, 2, 1, 3).reshape(h*m, w*m).to(dtype)
+    return mask
+
 """ m:n 2d structured pruning: greedy method to select mask """
 def mn_2d_greedy(matrix, m, n):
-    # Convert to numpy
-    mat = matrix.cpu().detach().numpy()
-    mask = np.ones(mat.shape, dtype=int)
-
-    rowCount = int(mat.shape[0]/m) * m
-    colCount = int(mat.shape[1]/m) * m
-    for rowStartIdx in range(0, rowCount, m):
-        rowEndIdx = rowStartIdx + m
-        for colStartIdx in range(0, colCount, m):
-            colEndIdx = colStartIdx + m
-            matrixSub = np.absolute(np.squeeze(mat[rowStartIdx:rowEndIdx, colStartIdx:colEndIdx]))
-            maskSub = np.squeeze(mask[rowStartIdx:rowEndIdx, colStartIdx:colEndIdx])
-            maskSub.fill(0.0)
-            matrixVecView = matrixSub.reshape(-1)
-            maskVecView   = maskSub.reshape(-1)
-            linearIdx = np.argsort(matrixVecView)
-            matrixIdx = [(int(x/m), x % m) for x in linearIdx]
-            rowCounter = collections.Counter()
-            colCounter = collections.Counter()
-            for currIdx in range(len(linearIdx) - 1, -1, -1):
-                currMatrixEntry = matrixIdx[currIdx]
-                if (rowCounter[currMatrixEntry[0]] == n) or (colCounter[currMatrixEntry[1]] == n):
-                    continue
-                #end if
-                maskSub[currMatrixEntry[0], currMatrixEntry[1]] = 1.0
-                rowCounter[currMatrixEntry[0]] += 1
-                colCounter[currMatrixEntry[1]] += 1
-
-    return torch.tensor(mask.cuda())
+    blocks = reshape_2d(matrix, m).abs()
+    h, w = blocks.shape[0], blocks.shape[1]
+    blocks = blocks.reshape(h * w, m * m)
+
+    # visit the entries of every block from the largest to the smallest magnitude (ties: larger index first),
+    # and keep an entry while both its row and its column hold fewer than n kept entries
+    order = torch.sort(blocks, dim=1, stable=True).indices.flip(1)
+    block_mask = torch.zeros_like(blocks, dtype=torch.int)
+    row_count = torch.zeros(h * w, m, dtype=torch.int, device=matrix.device)
+    col_count = torch.zeros(h * w, m, dtype=torch.int, device=matrix.device)
+    for step in range(m * m):
+        idx = order[:, step:step+1]
+        row, col = idx // m, idx % m
+        keep = (row_count.gather(1, row) < n) & (col_count.gather(1, col) < n)
+        keep_int = keep.to(torch.int)
+        block_mask.scatter_(1, idx, keep_int)
+        row_count.scatter_add_(1, row, keep_int)
+        col_count.scatter_add_(1, col, keep_int)
+
+    return reshape_2d_inv(block_mask.view(h, w, m * m), m, matrix.shape)
 
 def m4n2_2d_greedy(mat, density):
     return mn_2d_greedy(mat, 4, 2)
 
-""" return all possible m:n patterns in a mxn block. """
-valid_m4n2_2d_patterns = None
-def compute_valid_2d_patterns(m,n):
+""" return all possible m:n patterns in a mxn block, cached per (m, n, device). """
+valid_2d_patterns = {}
+def compute_valid_2d_patterns(m,n,device='cpu'):
     # Early exit if patterns was already created.
-    global valid_m4n2_2d_patterns
-    if valid_m4n2_2d_patterns is not None: return valid_m4n2_2d_patterns
-
-    patterns = torch.zeros(m)
-    patterns[:n] = 1
-    patterns = list(set(permutations(patterns.tolist())))
-    patterns = patterns + patterns
-    patterns = torch.empty(list(set(permutations(patterns,m))))
-
-    valid = ((patterns.sum(dim=1) <= n).sum(dim=1) == m).nonzero().view(-1)
-    valid_patterns = torch.empty(valid.shape[0],m,m)
-    valid_patterns[:] = patterns[valid[:]]
-
-    if m == 4  and n == 2: valid_m4n2_2d_patterns  = valid_patterns
+    key = (m, n, str(torch.device(device)))
+    if key in valid_2d_patterns: return valid_2d_patterns[key]
+
+    # build the blocks one row at a time, dropping partial blocks as soon as a column holds more than n entries
+    row_patterns = compute_valid_1d_patterns(m, n)
+    patterns = row_patterns.unsqueeze(1)
+    for row in range(1, m):
+        patterns = torch.cat([
+            patterns.unsqueeze(1).expand(-1, row_patterns.shape[0], -1, -1),
+            row_patterns.view(1, -1, 1, m).expand(patterns.shape[0], -1, -1, -1),
+        ], dim=2).reshape(-1, row + 1, m)
+        patterns = patterns[(patterns.sum(dim=1) <= n).all(dim=1)]
+
+    valid_patterns = patterns.to(device)
+    valid_2d_patterns[key] = valid_patterns
     return valid_patterns
 
 """ m:n 2d structured pruning: exhaustive method to select best mask """
-def mn_2d_best(matrix, m, n):
+def mn_2d_best(matrix, m, n, max_blocks_per_chunk=1<<16):
     # Find all possible patterns.
-    patterns = compute_valid_2d_patterns(m,n).cuda()
-
-    # Find the best m:n pattern (sum of non-masked weights).
-    mask = torch.cuda.IntTensor(matrix.shape).fill_(1)
-    mat = reshape_2d(matrix,m,m).abs()
-    pmax = torch.argmax(torch.matmul(mat,patterns.view(patterns.shape[0],m*m).t()), dim=2)
-
-    # Copy best m:n patterns into mask.
-    mat = mat.view(mat.shape[0]*mat.shape[1],-1)
-    pmax = pmax.view(pmax.shape[0]*pmax.shape[1]).unsqueeze(1).expand(-1,mat.shape[1])
-    patterns = patterns.view(patterns.shape[0],patterns.shape[1]*patterns.shape[2])
-    mat = torch.gather(patterns,0,pmax)
-    mat = reshape_2d_inv(mat.view(matrix.shape[0]//m,matrix.shape[1]//m,m,m))
-    mask.copy_(mat.type(mask.type()))
-    return mask
+    patterns = compute_valid_2d_patterns(m, n, matrix.device)
+    patterns = patterns.view(patterns.shape[0], m*m).to(matrix.dtype)
+
+    # Find the best m:n pattern (sum of non-masked weights), a bounded number of blocks at a time.
+    blocks = reshape_2d(matrix, m).abs()
+    h, w = blocks.shape[0], blocks.shape[1]
+    blocks = blocks.reshape(h * w, m * m)
+    block_mask = torch.empty_like(blocks)
+    for start in range(0, blocks.shape[0], max_blocks_per_chunk):
+        chunk = blocks[start:start+max_blocks_per_chunk]
+        pmax = torch.argmax(torch.matmul(chunk, patterns.t()), dim=1)
+        block_mask[start:start+max_blocks_per_chunk] = patterns[pmax]
+
+    return reshape_2d_inv(block_mask.view(h, w, m * m), m, matrix.shape)
 
 def m4n2_2d_best(mat, density):
     return mn_2d_best(mat, 4, 2)
 
 
+""" resolve a pattern name: one of the functions above, or any 'm<M>n<N>_1d', 'm<M>n<N>_2d_greedy', 'm<M>n<N>_2d_best' """
+def get_mask_func(pattern):
+    func = getattr(sys.modules[__name__], pattern, None)
+    if func is not None:
+        return func
+    match = re.fullmatch(r"m(\d+)n(\d+)_(1d|2d_greedy|2d_best)", pattern)
+    assert match is not None, "Unknown sparse mask pattern: %s" % pattern
+    m, n, method = int(match.group(1)), int(match.group(2)), match.group(3)
+    assert 0 < n <= m, "Invalid sparse mask pattern %s: n must be in [1, m]" % pattern
+    mn_func = {"1d": mn_1d_best, "2d_greedy": mn_2d_greedy, "2d_best": mn_2d_best}[method]
+    return lambda mat, density: mn_func(mat, m, n)
+
+
 """ returns a sparse mask """
 def create_mask(tensor, pattern="m4n2_1d", density=0.5):
     # Reshape tensor and mask.
@@ -151,19 +166,19 @@ def create_mask(tensor, pattern="m4n2_1d", density=0.5):
     # 1d-tensor
     if len(shape) == 1:
         t = t.view(1, shape[0])
-        func = getattr(sys.modules[__name__], pattern, None)
+        func = get_mask_func(pattern)
         mask = func(t, density)
         return mask.view(shape).type(ttype)
     # 2d-tensor (in, out)
     elif len(shape) == 2:
         t = t.view(shape[0], shape[1])
-        func = getattr(sys.modules[__name__], pattern, None)
+        func = get_mask_func(pattern)
         mask = func(t, density)
         return mask.view(shape).type(ttype)
     # 3d-tensor (batch, in, out)
     elif len(shape) == 3:
         t = t.view(shape[0]*shape[1], shape[2])
-        func = getattr(sys.modules[__name__], pattern, None)
+        func = get_mask_func(pattern)
         mask = func(t, density)
         return mask.view(shape).type(ttype)
     # 4d-tensor (in, out, h, w)
@@ -177,8 +192,21 @@ def create_mask(tensor, pattern="m4n2_1d", density=0.5):
         """
         # convs
         t = t.permute(2,3,0,1).contiguous().view(shape[2]*shape[3]*shape[0], shape[1])
-        func = getattr(sys.modules[__name__], pattern, None)
+        func = get_mask_func(pattern)
         mask = func(t, density)
         mask = mask.view(shape[2], shape[3], shape[0], shape[1]).permute(2,3,0,1).contiguous()      
         return mask.view(shape).type(ttype)
 
+
+""" compact masks: one bit per element, i.e. a 4-bit index per 4-element group of a row, packed into uint8 """
+def pack_mask(mask):
+    flat = mask.reshape(-1).to(torch.uint8)
+    if flat.numel() % 8 > 0:
+        flat = torch.cat((flat, flat.new_zeros(8 - flat.numel() % 8)))
+    shifts = torch.arange(8, dtype=torch.uint8, device=mask.device)
+    return (flat.view(-1, 8) << shifts).sum(dim=1, dtype=torch.uint8)
+
+def unpack_mask(packed, shape):
+    shifts = torch.arange(8, dtype=torch.uint8, device=packed.device)
+    bits = (packed.unsqueeze(1) >> shifts) & 1
+    return bits.view(-1)[:torch.Size(shape).numel()].view(shape).bool()
@@ -0,0 +1,146 @@
+import csv
+import json
+import multiprocessing
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from apex.contrib.sparsity.permutation_search_kernels import accelerated_search_for_good_permutation
+from apex.contrib.sparsity.permutation_search_kernels.exhaustive_search import generate_all_unique_combinations
+from apex.contrib.sparsity.permutation_search_kernels.permutation_utilities import sum_after_2_to_4_vectorized
+
+# Benchmark of the accelerated_search_for_good_permutation strategies:
+#   every strategy config is run on every matrix of the corpus, each run in a fresh process so that its peak memory can be measured,
+#   and the wall time, peak memory and magnitude retained after 2:4 pruning are written to a JSON and a CSV report.
+
+# weight as the permutation search sees it: (K, C), (K, C, R, S) -> (R*S*K, C)
+def as_search_matrix(weight):
+    if weight.dim() == 4:
+        return weight.permute(2, 3, 0, 1).contiguous().view(-1, weight.size()[1])
+    return weight.view(-1, weight.size()[-1])
+
+def synthetic_weight(distribution, shape, generator):
+    if distribution == 'gaussian':
+        return torch.randn(shape, generator=generator)
+    if distribution == 'laplace':    # heavy-tailed, few large weights per stripe
+        uniform = torch.rand(shape, generator=generator) - 0.5
+        return -torch.sign(uniform) * torch.log1p(-2.0 * uniform.abs())
+    if distribution == 'channel_scaled':    # input channels with very different magnitudes, where permutations help most
+        scales = torch.exp(torch.randn(shape[1], generator=generator))
+        return torch.randn(shape, generator=generator) * scales.view([1, -1] + [1] * (len(shape) - 2))
+    raise ValueError("unknown distribution: {}".format(distribution))
+
+def build_corpus(args):
+    corpus = []
+    generator = torch.Generator().manual_seed(args.seed)
+    for distribution in args.distributions:
+        for channels in args.channel_counts:
+            corpus.append(("synthetic_{}_C{}".format(distribution, channels), as_search_matrix(synthetic_weight(distribution, (args.synthetic_rows, channels), generator))))
+    for name, shape in args.real_shapes:
+        corpus.append((name, as_search_matrix(synthetic_weight('channel_scaled', shape, generator))))
+    if args.checkpoint is not None:
+        state_dict = torch.load(args.checkpoint, map_location='cpu')
+        state_dict = state_dict.get('state_dict', state_dict)
+        for name, weight in state_dict.items():
+            if torch.is_tensor(weight) and weight.dim() in (2, 4) and weight.size()[1] % 16 == 0 and weight.size()[1] <= args.max_checkpoint_channels:
+                corpus.append((name, as_search_matrix(weight.float())))
+    return corpus
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+def run_search(matrix, options, seed):
+    """Run one search in the current (fresh) process and measure it."""
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    rss_before = peak_rss_mb()
+    start_time = time.perf_counter()
+    permutation = accelerated_search_for_good_permutation(torch.from_numpy(matrix), options=dict(options))
+    wall_time = time.perf_counter() - start_time
+    rss_after = peak_rss_mb()
+
+    total_magnitude = np.abs(matrix).sum(dtype=np.float64)
+    return {
+        'wall_time_s': wall_time,
+        'peak_rss_mb': rss_after,
+        'peak_rss_increase_mb': rss_after - rss_before,
+        'peak_cuda_mb': torch.cuda.max_memory_allocated() / (1024.0 * 1024.0) if torch.cuda.is_available() else 0.0,
+        'retained_magnitude_pct': 100.0 * sum_after_2_to_4_vectorized(matrix[:, permutation]) / total_magnitude,
+        'baseline_retained_magnitude_pct': 100.0 * sum_after_2_to_4_vectorized(matrix) / total_magnitude,
+        'valid_permutation': sorted(permutation) == list(range(matrix.shape[1])),
+    }
+
+def config_name(options):
+    return ",".join("{}={}".format(key, value) for key, value in options.items())
+
+def main(args):
+    corpus = build_corpus(args)
+
+    # the unique permutations of each exhaustive search window are generated once, outside of the measured runs
+    for options in args.strategies:
+        if options['strategy'] == 'exhaustive':
+            generate_all_unique_combinations(options.get('stripe_group_size', 8), 4)
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for matrix_name, matrix in corpus:
+        matrix = matrix.detach().cpu().float().numpy()
+        for options in args.strategies:
+            if options['strategy'] == 'exhaustive' and options.get('stripe_group_size', 8) > matrix.shape[1]:
+                continue
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                measurement = executor.submit(run_search, matrix, options, args.seed).result()
+            result = {'matrix': matrix_name, 'rows': matrix.shape[0], 'channels': matrix.shape[1], 'config': config_name(options)}
+            result.update(measurement)
+            results.append(result)
+            print("[permutation_search_benchmark] {:<40} {:>6}x{:<5} {:<70} {:9.2f}s, peak rss +{:8.1f} MB, retained {:.3f}% (unpermuted {:.3f}%)".format(
+                matrix_name, result['rows'], result['channels'], result['config'], result['wall_time_s'], result['peak_rss_increase_mb'],
+                result['retained_magnitude_pct'], result['baseline_retained_magnitude_pct']))
+
+    if len(results) == 0:
+        raise ValueError("[permutation_search_benchmark] no search was run: the corpus is empty or every strategy was skipped, check the matrix sizes and the strategies")
+
+    with open(args.json_report, 'w') as f:
+        json.dump({'seed': args.seed, 'results': results}, f, indent=2)
+    with open(args.csv_report, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+    print("[permutation_search_benchmark] wrote {} results to {} and {}".format(len(results), args.json_report, args.csv_report))
+
+if __name__ == '__main__':
+    class Args:
+        seed = 1
+        # synthetic matrices
+        distributions = ['gaussian', 'laplace', 'channel_scaled']
+        channel_counts = [32, 64, 128, 256]
+        synthetic_rows = 512
+        # real-shaped matrices: ResNet-50 convs and BERT-large FC layers, (K, C, R, S) or (K, C)
+        real_shapes = [
+            ('resnet50_layer1_conv2', (64, 64, 3, 3)),
+            ('resnet50_layer3_conv2', (256, 256, 3, 3)),
+            ('resnet50_layer4_conv1', (512, 2048, 1, 1)),
+            ('bert_large_fc1', (4096, 1024)),
+            ('bert_large_fc2', (1024, 4096)),
+        ]
+        # optionally add the weights of a trained checkpoint to the corpus
+        checkpoint = None
+        max_checkpoint_channels = 4096
+        strategies = [
+            {'strategy': 'exhaustive', 'stripe_group_size': 8, 'escape_attempts': 0, 'search_time_limit': 600},
+            {'strategy': 'exhaustive', 'stripe_group_size': 8, 'escape_attempts': 100, 'search_time_limit': 600},
+            {'strategy': 'exhaustive', 'stripe_group_size': 12, 'escape_attempts': 0, 'search_time_limit': 600},
+            {'strategy': 'progressive channel swap', 'progressive_search_time_limit': 10, 'improvement_threshold': 1e-9},
+            {'strategy': 'progressive channel swap', 'progressive_search_time_limit': 60, 'improvement_threshold': 1e-9},
+        ]
+        json_report = 'permutation_search_benchmark.json'
+        csv_report = 'permutation_search_benchmark.csv'
+    args = Args()
+
+    main(args)
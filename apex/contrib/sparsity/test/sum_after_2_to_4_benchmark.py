@@ -0,0 +1,61 @@
+import time
+
+import numpy as np
+from apex.contrib.sparsity.permutation_search_kernels.permutation_utilities import (
+    apply_2_to_4_reference,
+    apply_2_to_4_vectorized,
+    sum_after_2_to_4_batched,
+    sum_after_2_to_4_reference,
+    sum_after_2_to_4_vectorized,
+)
+
+def time_it(func, *args, repeats=1):
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        result = func(*args)
+    return result, (time.perf_counter() - start_time) / repeats
+
+def benchmark_sum_and_apply(args, rows, columns):
+    matrix = np.random.randn(rows, columns).astype(np.float32)
+
+    ref_sum, ref_time = time_it(sum_after_2_to_4_reference, matrix)
+    vec_sum, vec_time = time_it(sum_after_2_to_4_vectorized, matrix, repeats=args.repeats)
+    assert np.isclose(ref_sum, vec_sum, rtol=1e-5), "sum_after_2_to_4 mismatch: {} vs {}".format(ref_sum, vec_sum)
+    print("[sum_after_2_to_4] {:>5}x{:<5} reference: {:9.4f}s, vectorized: {:9.6f}s, speedup: {:8.1f}x".format(rows, columns, ref_time, vec_time, ref_time / vec_time))
+
+    ref_pruned, ref_time = time_it(apply_2_to_4_reference, np.copy(matrix))
+    vec_pruned, vec_time = time_it(apply_2_to_4_vectorized, np.copy(matrix))
+    assert np.array_equal(ref_pruned, vec_pruned), "apply_2_to_4 mismatch"
+    print("[apply_2_to_4]     {:>5}x{:<5} reference: {:9.4f}s, vectorized: {:9.6f}s, speedup: {:8.1f}x".format(rows, columns, ref_time, vec_time, ref_time / vec_time))
+
+def benchmark_batched(args, rows, columns):
+    matrix = np.random.randn(rows, columns).astype(np.float32)
+    permutations = np.stack([np.random.permutation(columns) for _ in range(args.num_permutations)])
+
+    start_time = time.perf_counter()
+    looped = np.array([sum_after_2_to_4_vectorized(matrix[:, permutation]) for permutation in permutations])
+    looped_time = time.perf_counter() - start_time
+
+    batched, batched_time = time_it(sum_after_2_to_4_batched, matrix, permutations)
+    assert np.allclose(looped, batched, rtol=1e-5), "sum_after_2_to_4_batched mismatch"
+    print("[sum_after_2_to_4_batched] {:>5}x{:<5} {} permutations, one call per permutation: {:9.4f}s, batched: {:9.4f}s, speedup: {:6.1f}x".format(rows, columns, args.num_permutations, looped_time, batched_time, looped_time / batched_time))
+
+def main(args):
+    np.random.seed(args.seed)
+    for rows, columns in args.shapes:
+        benchmark_sum_and_apply(args, rows, columns)
+    for rows, columns in args.batched_shapes:
+        benchmark_batched(args, rows, columns)
+
+if __name__ == '__main__':
+    class Args:
+        seed = 1
+        repeats = 10
+        # real-shaped matrices: (K*R*S, C) for ResNet-50 convs and a transformer FC layer
+        shapes = [(64*9, 64), (256, 256), (512*9, 512), (1024, 4096)]
+        # window-sized stripe groups, as scored by the exhaustive search
+        batched_shapes = [(2048, 8), (2048, 12)]
+        num_permutations = 5775
+    args = Args()
+
+    main(args)
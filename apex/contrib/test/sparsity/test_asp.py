@@ -0,0 +1,147 @@
+import unittest
+
+import torch
+
+from apex.contrib.sparsity import ASP
+from apex.contrib.sparsity import asp as asp_module
+from apex.contrib.sparsity.sparse_masklib import unpack_mask
+
+
+def reset_asp():
+    """ASP keeps its state in class attributes, start every test from scratch"""
+    ASP._ASP__model = None
+    ASP._ASP__optimizer = None
+    ASP._ASP__sparse_parameters = []
+    ASP._ASP__all_parameters = []
+    ASP._ASP__calculate_mask = None
+    ASP._ASP__compact_mask = False
+
+
+def build_model():
+    return torch.nn.Sequential(torch.nn.Linear(32, 64), torch.nn.ReLU(), torch.nn.Linear(64, 16))
+
+
+class CompactMaskTest(unittest.TestCase):
+
+    def setUp(self):
+        reset_asp()
+        torch.manual_seed(1234)
+        self.dense_weights = [p.detach().clone() for p in build_model().parameters()]
+
+    def tearDown(self):
+        reset_asp()
+
+    def prune(self, compact_mask):
+        """Prune a fresh copy of the same model, return it with its sparse weights, expanded masks and pruned buffers"""
+        reset_asp()
+        torch.manual_seed(1234)
+        model = build_model()
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        ASP.init_model_for_pruning(model, mask_calculator="m4n2_1d", verbosity=0, allow_recompute_mask=True,
+                                   allow_permutation=False, compact_mask=compact_mask)
+        ASP.init_optimizer_for_pruning(optimizer)
+        ASP.compute_sparse_masks()
+        return model, optimizer, self.masks(model)
+
+    def masks(self, model):
+        masks = []
+        for layer in (model[0], model[2]):
+            mask = getattr(layer, '__weight_mma_mask')
+            masks.append(unpack_mask(mask, layer.weight.shape) if mask.dtype == torch.uint8 else mask)
+        return masks
+
+    def test_compact_masks_match_dense_masks(self):
+        dense_model, _, dense_masks = self.prune(compact_mask=False)
+        compact_model, _, compact_masks = self.prune(compact_mask=True)
+        for layer in (compact_model[0], compact_model[2]):
+            mask = getattr(layer, '__weight_mma_mask')
+            self.assertEqual(mask.dtype, torch.uint8)
+            self.assertEqual(mask.numel(), layer.weight.numel() // 8)
+            # only the dropped half of the weights is kept
+            self.assertEqual(getattr(layer, '__weight_mma_pruned_p').numel(), layer.weight.numel() // 2)
+        for dense_mask, compact_mask in zip(dense_masks, compact_masks):
+            self.assertTrue(torch.equal(dense_mask, compact_mask))
+            self.assertEqual(compact_mask.sum().item() * 2, compact_mask.numel())
+        for dense_p, compact_p in zip(dense_model.parameters(), compact_model.parameters()):
+            self.assertTrue(torch.equal(dense_p, compact_p))
+        self.assertTrue(ASP.is_sparsity_enabled())
+
+    def test_optimizer_step_applies_compact_masks(self):
+        model, optimizer, masks = self.prune(compact_mask=True)
+        model(torch.randn(8, 32)).pow(2).sum().backward()
+        optimizer.step()
+        for layer, mask in zip((model[0], model[2]), masks):
+            self.assertEqual(layer.weight[~mask].abs().sum().item(), 0.0)
+
+    def test_restore_and_recompute_round_trip(self):
+        model, _, masks = self.prune(compact_mask=True)
+        ASP.restore_pruned_weights()
+        self.assertFalse(ASP.is_sparsity_enabled())
+        for p, dense_p in zip(model.parameters(), self.dense_weights):
+            self.assertTrue(torch.equal(p, dense_p))
+        for mask in self.masks(model):
+            self.assertTrue(mask.all())
+
+        ASP.compute_sparse_masks()
+        self.assertTrue(ASP.is_sparsity_enabled())
+        for mask, recomputed_mask in zip(masks, self.masks(model)):
+            self.assertTrue(torch.equal(mask, recomputed_mask))
+
+        # recomputing the masks while sparsity is enabled restores the dense weights first
+        ASP.compute_sparse_masks()
+        ASP.restore_pruned_weights()
+        for p, dense_p in zip(model.parameters(), self.dense_weights):
+            self.assertTrue(torch.equal(p, dense_p))
+
+
+class ApplyMasksTest(unittest.TestCase):
+
+    def setUp(self):
+        reset_asp()
+        torch.manual_seed(1234)
+
+    def tearDown(self):
+        reset_asp()
+
+    def make_tensors(self, device, dtype):
+        """Tensors with NaN and Inf under both mask values, one of them not contiguous, and their bool masks"""
+        tensors = [torch.randn(64, 32, device=device, dtype=dtype), torch.randn(3, 7, device=device, dtype=dtype),
+                   torch.randn(32, 64, device=device, dtype=dtype).t()]
+        masks = [torch.rand(t.shape, device=device) > 0.5 for t in tensors]
+        for tensor, mask in zip(tensors, masks):
+            tensor[0, 0], tensor[0, 1], tensor[1, 0], tensor[1, 1] = float('nan'), float('inf'), float('nan'), float('-inf')
+            mask[0, 0], mask[0, 1], mask[1, 0], mask[1, 1] = True, True, False, False
+        return tensors, masks
+
+    def check_against_mul(self, device, dtype):
+        tensors, masks = self.make_tensors(device, dtype)
+        expected = [t.clone().mul_(m) for t, m in zip(tensors, masks)]
+        ASP._ASP__apply_masks(tensors, masks)
+        for tensor, expected_tensor in zip(tensors, expected):
+            torch.testing.assert_close(tensor, expected_tensor, rtol=0, atol=0, equal_nan=True)
+            # NaN and Inf under a false mask become NaN, as with mul_
+            self.assertTrue(tensor[1, 0].isnan().item() and tensor[1, 1].isnan().item())
+
+    def test_foreach_fallback_matches_mul(self):
+        for dtype in (torch.float32, torch.float64, torch.bfloat16):
+            with self.subTest(dtype=dtype):
+                self.check_against_mul('cpu', dtype)
+
+    @unittest.skipUnless(torch.cuda.is_available() and asp_module.multi_tensor_mask_available,
+                         "requires CUDA and amp_C.multi_tensor_mask")
+    def test_multi_tensor_mask_kernel_matches_mul(self):
+        for dtype in (torch.float32, torch.float16, torch.bfloat16):
+            with self.subTest(dtype=dtype):
+                self.check_against_mul('cuda', dtype)
+                # large enough for several chunks and blocks, with a size that is not a multiple of ILP
+                tensors = [torch.randn(2 ** 16 + 3, device='cuda', dtype=dtype), torch.randn(1 << 20, device='cuda', dtype=dtype)]
+                masks = [torch.rand(t.shape, device='cuda') > 0.5 for t in tensors]
+                expected = [t.clone().mul_(m) for t, m in zip(tensors, masks)]
+                asp_module.multi_tensor_applier(asp_module.amp_C.multi_tensor_mask,
+                                                torch.zeros(1, dtype=torch.int, device='cuda'), [tensors, masks])
+                for tensor, expected_tensor in zip(tensors, expected):
+                    torch.testing.assert_close(tensor, expected_tensor, rtol=0, atol=0, equal_nan=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
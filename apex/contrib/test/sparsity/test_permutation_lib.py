@@ -0,0 +1,108 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import torch
+
+from apex.contrib.sparsity.permutation_lib import Permutation
+from apex.contrib.sparsity.permutation_search_kernels import exhaustive_search
+
+
+CONV = 'torch.nn.modules.conv.Conv2d'
+BN = 'torch.nn.modules.batchnorm.BatchNorm2d'
+RELU = 'torch.nn.modules.activation.ReLU'
+
+
+def graph_node(parents, children, module_type):
+    return {'parents': parents, 'children': children, 'fx_op': 'call_module', 'module_type': module_type, 'groups_param': '1' if module_type == CONV else 'None'}
+
+
+class PermutationGraphLookupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.modules = {name: torch.nn.Conv2d(8, 8, 1) for name in ['conv1', 'layer1.0.conv2', 'Mixed_5b.branch1x1.conv']}
+        self.sparse_parameters = [(name, module, 'weight', module.weight, None, None) for name, module in self.modules.items()]
+        self.all_parameters = [(name, module, p_name, p) for name, module in self.modules.items() for p_name, p in module.named_parameters()]
+        Permutation.set_permutation_params_from_asp(None, self.sparse_parameters, self.all_parameters)
+
+    def test_find_node_parameters(self):
+        self.assertEqual([item[0] for item in Permutation.find_node_parameters('conv1')], ['conv1'])
+        self.assertEqual([item[0] for item in Permutation.find_node_parameters('layer1.0.conv2')], ['layer1.0.conv2'])
+        # fx node names use '.' instead of '_'
+        self.assertEqual([item[0] for item in Permutation.find_node_parameters('mixed.5b.branch1x1.conv')], ['Mixed_5b.branch1x1.conv'])
+        self.assertEqual(Permutation.find_node_parameters('mixed.5b.branch1x1.conv', parameters='all', match_converted_names=False), [])
+        self.assertEqual([item[2] for item in Permutation.find_node_parameters('conv1', parameters='all')], ['weight', 'bias'])
+        self.assertEqual(Permutation.find_node_parameters('conv3'), [])
+
+    def test_find_node_parameters_after_update(self):
+        # ASP appends to the parameter lists after handing them over
+        module = torch.nn.Conv2d(8, 8, 1)
+        self.sparse_parameters.append(('module.conv3', module, 'weight', module.weight, None, None))
+        self.assertIs(Permutation.find_node_parameters('conv3')[0][1], module)
+
+    def test_find_real_relatives(self):
+        fx_graph = {
+            'conv1': graph_node(['x'], ['bn1'], CONV),
+            'bn1': graph_node(['conv1'], ['relu'], BN),
+            'relu': graph_node(['bn1'], ['conv2', 'conv3'], RELU),
+            'conv2': graph_node(['relu'], ['add'], CONV),
+            'conv3': graph_node(['relu'], ['add'], CONV),
+            'add': {'parents': ['conv2', 'conv3'], 'children': ['conv4'], 'fx_op': 'call_function'},
+            'conv4': graph_node(['add'], ['output'], CONV),
+        }
+        fx_graph = Permutation.find_real_parents(fx_graph)
+        fx_graph = Permutation.find_real_children(fx_graph)
+        fx_graph = Permutation.find_real_siblings(fx_graph)
+        fx_graph = Permutation.extract_all_unique_siblings(fx_graph)
+        self.assertEqual(fx_graph['conv4']['real_parents'], ['conv2', 'conv3'])
+        self.assertEqual(fx_graph['conv1']['real_children'], ['conv2', 'conv3'])
+        self.assertEqual(fx_graph['bn1']['real_children'], ['conv2', 'conv3'])
+        self.assertEqual(fx_graph['conv2']['real_siblings'], ['conv3'])
+        self.assertEqual(fx_graph['unique_siblings']['name'], [['conv1'], ['conv2', 'conv3'], ['conv4']])
+
+
+class ParallelPermutationSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        # the workers must use the cache directory set in this process, not the one from the environment
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.env_cache_dir = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {'APEX_PERMUTATION_CACHE_DIR': self.env_cache_dir.name})
+        self.env.start()
+        self.old_cache_dir = exhaustive_search.permutation_cache_dir
+        exhaustive_search.set_permutation_cache_dir(self.cache_dir.name)
+        exhaustive_search.master_unique_permutation_list.clear()
+        Permutation.set_parallel_search_params(parallel_search=True, num_search_workers=2)
+        torch.manual_seed(0)
+        self.options = {'strategy': 'exhaustive', 'stripe_group_size': 8, 'escape_attempts': 10}
+        self.matrix_groups = [torch.randn(16, 32) for _ in range(3)]
+
+    def tearDown(self):
+        Permutation.set_parallel_search_params()
+        exhaustive_search.master_unique_permutation_list.clear()
+        exhaustive_search.set_permutation_cache_dir(self.old_cache_dir)
+        self.env.stop()
+        self.env_cache_dir.cleanup()
+        self.cache_dir.cleanup()
+
+    def test_parallel_matches_serial(self):
+        pending_searches = [(i, m, dict(self.options)) for i, m in enumerate(self.matrix_groups)]
+        parallel = Permutation.parallel_search_for_good_permutation(pending_searches)
+        self.assertEqual([group_index for group_index, _ in parallel], [0, 1, 2])
+        for (group_index, permutation_sequence), matrix_group in zip(parallel, self.matrix_groups):
+            serial = Permutation.search_matrix_group(group_index, matrix_group, dict(self.options))
+            self.assertEqual(permutation_sequence, [int(c) for c in serial])
+            self.assertEqual(sorted(permutation_sequence), list(range(32)))
+        self.assertEqual(os.listdir(self.cache_dir.name), ['unique_permutations_C8_M4.npy'])
+        self.assertEqual(os.listdir(self.env_cache_dir.name), [])
+
+    def test_worker_failure_is_raised(self):
+        # 30 columns do not split into stripes of 4 columns
+        pending_searches = [(0, self.matrix_groups[0], dict(self.options)), (1, torch.randn(16, 30), dict(self.options))]
+        with self.assertRaisesRegex(RuntimeError, "unique_siblings group 1 failed"):
+            Permutation.parallel_search_for_good_permutation(pending_searches)
+
+
+if __name__ == "__main__":
+    unittest.main()
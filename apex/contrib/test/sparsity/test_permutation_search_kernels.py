@@ -0,0 +1,189 @@
+import os
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import torch
+
+from apex.contrib.sparsity.permutation_search_kernels import exhaustive_search
+from apex.contrib.sparsity.permutation_search_kernels.channel_swap import (
+    Channel_Swap,
+    stripe_scores,
+    swap_gains,
+    swap_scores,
+)
+from apex.contrib.sparsity.permutation_search_kernels.exhaustive_search import (
+    collect_stripes,
+    compute_stripe_baselines,
+    Exhaustive_Search,
+    generate_all_unique_combinations,
+    predict_unique_combinations,
+    set_permutation_cache_dir,
+)
+from apex.contrib.sparsity.permutation_search_kernels.permutation_utilities import (
+    apply_2_to_4_reference,
+    apply_2_to_4_vectorized,
+    sum_after_2_to_4_batched,
+    sum_after_2_to_4_reference,
+    sum_after_2_to_4_vectorized,
+    try_swap,
+)
+
+
+class VectorizedTwoToFourTest(unittest.TestCase):
+
+    def setUp(self, seed=1234):
+        np.random.seed(seed)
+
+    def test_sum_after_2_to_4(self):
+        for rows, columns in [(1, 4), (7, 16), (64, 128)]:
+            matrix = np.random.randn(rows, columns).astype(np.float32)
+            np.testing.assert_allclose(
+                sum_after_2_to_4_vectorized(matrix),
+                sum_after_2_to_4_reference(matrix),
+                rtol=1e-5,
+            )
+
+    def test_apply_2_to_4(self):
+        matrix = np.random.randn(32, 64).astype(np.float32)
+        # ties must be broken the same way as the reference implementation
+        matrix[0, :4] = 1.0
+        expected = apply_2_to_4_reference(np.copy(matrix))
+        actual = apply_2_to_4_vectorized(np.copy(matrix))
+        np.testing.assert_array_equal(actual, expected)
+        self.assertTrue(((actual.reshape(32, 16, 4) != 0).sum(axis=-1) <= 2).all())
+
+    def test_apply_2_to_4_non_contiguous(self):
+        matrix = np.random.randn(16, 32).astype(np.float32)
+        expected = apply_2_to_4_reference(np.copy(matrix[:, 8:24]))
+        apply_2_to_4_vectorized(matrix[:, 8:24])
+        np.testing.assert_array_equal(matrix[:, 8:24], expected)
+
+    def test_sum_after_2_to_4_batched(self):
+        matrix = np.random.randn(48, 12).astype(np.float32)
+        permutations = np.stack([np.random.permutation(12) for _ in range(37)])
+        expected = [sum_after_2_to_4_reference(matrix[:, permutation]) for permutation in permutations]
+        for batch_size in [None, 1, 5]:
+            actual = sum_after_2_to_4_batched(matrix, permutations, batch_size=batch_size)
+            np.testing.assert_allclose(actual, expected, rtol=1e-5)
+
+
+class IncrementalStripeScoringTest(unittest.TestCase):
+
+    def setUp(self, seed=1234):
+        np.random.seed(seed)
+
+    def test_collect_stripes_into_buffer(self):
+        matrix = np.random.randn(16, 64).astype(np.float32)
+        buffer = np.empty((16, 12), dtype=np.float32)
+        expected = collect_stripes(matrix, [1, 5, 9], 4)
+        np.testing.assert_array_equal(collect_stripes(matrix, [1, 5, 9], 4, out=buffer), expected)
+        np.testing.assert_array_equal(collect_stripes(matrix.astype(np.float64), [1, 5], 4, out=buffer), expected[:, :8])
+
+    def test_stripe_baselines(self):
+        matrix = np.random.randn(32, 64).astype(np.float32)
+        expected = [sum_after_2_to_4_reference(matrix[:, s*4:s*4+4]) for s in range(16)]
+        np.testing.assert_allclose(compute_stripe_baselines(matrix, 4), expected, rtol=1e-5)
+        np.testing.assert_allclose(compute_stripe_baselines(matrix, 4, [3, 7]), [expected[3], expected[7]], rtol=1e-5)
+
+    def test_exhaustive_search_improves_magnitude(self):
+        matrix = np.random.randn(64, 32).astype(np.float32)
+        result, duration, permutation = Exhaustive_Search(matrix, stripe_group_size=8, escape_attempts=10)
+        self.assertEqual(sorted(permutation), list(range(32)))
+        np.testing.assert_array_equal(result, matrix[:, permutation])
+        self.assertGreaterEqual(sum_after_2_to_4_vectorized(result), sum_after_2_to_4_vectorized(matrix))
+
+    def test_exhaustive_search_time_limit(self):
+        matrix = np.random.RandomState(0).rand(32, 1024).astype(np.float32)
+        generate_all_unique_combinations(8, 4)    # don't count generating the unique permutations against the limit
+        start_time = time.perf_counter()
+        result, duration, permutation = Exhaustive_Search(matrix, stripe_group_size=8, escape_attempts=100, time_limit=0.5)
+        elapsed = time.perf_counter() - start_time
+        # the deadline is checked for every stripe group, not only after a whole pass over all of them
+        self.assertLess(elapsed, 2.0)
+        self.assertEqual(sorted(permutation), list(range(1024)))
+        np.testing.assert_array_equal(result, matrix[:, permutation])
+        self.assertGreaterEqual(sum_after_2_to_4_vectorized(result), sum_after_2_to_4_vectorized(matrix))
+
+
+
+class ChannelSwapTest(unittest.TestCase):
+
+    def setUp(self, seed=1234):
+        np.random.seed(seed)
+
+    def test_swap_gains_match_try_swap(self):
+        matrix = np.random.randn(24, 16).astype(np.float32)
+        magnitudes = torch.from_numpy(np.abs(matrix)).double()
+        columns = torch.arange(16)
+        column_stripe = columns // 4
+        gains = swap_gains(
+            swap_scores(magnitudes, columns, columns),
+            stripe_scores(magnitudes, torch.arange(4))[column_stripe],
+            columns,
+            column_stripe.unsqueeze(1) == column_stripe.unsqueeze(0),
+        )
+        for src in range(16):
+            for dst in range(16):
+                if src // 4 == dst // 4:
+                    self.assertEqual(gains[src, dst].item(), float('-inf'))
+                else:
+                    new_sum, improvement = try_swap(np.copy(matrix), dst, src)
+                    self.assertAlmostEqual(gains[src, dst].item(), improvement, places=4)
+
+    def test_channel_swap_converges(self):
+        matrix = np.random.randn(64, 64).astype(np.float32)
+        result, duration, permutation = Channel_Swap(matrix, time_limit=60, device="cpu")
+        self.assertEqual(sorted(permutation), list(range(64)))
+        np.testing.assert_array_equal(result, matrix[:, permutation])
+        self.assertGreater(sum_after_2_to_4_vectorized(result), sum_after_2_to_4_vectorized(matrix))
+        # a converged permutation has no improving swap left
+        for src in range(64):
+            for dst in range(src // 4 * 4 + 4, 64):
+                new_sum, improvement = try_swap(np.copy(result), dst, src)
+                self.assertLessEqual(improvement, 1e-4)
+
+
+class UniquePermutationCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.old_cache_dir = exhaustive_search.permutation_cache_dir
+        set_permutation_cache_dir(self.cache_dir.name)
+        exhaustive_search.master_unique_permutation_list.clear()
+
+    def tearDown(self):
+        exhaustive_search.master_unique_permutation_list.clear()
+        set_permutation_cache_dir(self.old_cache_dir)
+        self.cache_dir.cleanup()
+
+    def test_generate_and_reload(self):
+        generated = generate_all_unique_combinations(12, 4)
+        self.assertEqual(generated.shape, (predict_unique_combinations(12, 4), 12))
+        self.assertEqual(generated.dtype, np.uint8)
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir.name, "unique_permutations_C12_M4.npy")))
+
+        # a fresh process only maps the file from disk
+        exhaustive_search.master_unique_permutation_list.clear()
+        reloaded = generate_all_unique_combinations(12, 4)
+        self.assertIsInstance(reloaded, np.memmap)
+        np.testing.assert_array_equal(reloaded, generated)
+
+    def test_invalid_cache_file_is_regenerated(self):
+        expected = generate_all_unique_combinations(8, 4).copy()
+        cache_path = os.path.join(self.cache_dir.name, "unique_permutations_C8_M4.npy")
+        for invalid in [np.zeros((3, 8), dtype=np.uint8), expected.astype(np.int64), np.full_like(expected, 9)]:
+            np.save(cache_path, invalid)
+            exhaustive_search.master_unique_permutation_list.clear()
+            np.testing.assert_array_equal(generate_all_unique_combinations(8, 4), expected)
+            np.testing.assert_array_equal(np.load(cache_path), expected)
+
+        with open(cache_path, "wb") as f:
+            f.write(b"not a npy file")
+        exhaustive_search.master_unique_permutation_list.clear()
+        np.testing.assert_array_equal(generate_all_unique_combinations(8, 4), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import collections
+import unittest
+
+import numpy as np
+import torch
+
+from apex.contrib.sparsity.sparse_masklib import (
+    compute_valid_2d_patterns,
+    create_mask,
+    mn_2d_best,
+    mn_2d_greedy,
+    pack_mask,
+    reshape_2d,
+    unpack_mask,
+)
+
+
+def reference_2d_greedy(mat, m, n):
+    """Per-block loop implementation of the greedy 2d mask"""
+    mask = np.ones(mat.shape, dtype=int)
+    for row in range(0, mat.shape[0] // m * m, m):
+        for col in range(0, mat.shape[1] // m * m, m):
+            block = np.abs(mat[row:row+m, col:col+m])
+            block_mask = mask[row:row+m, col:col+m]
+            block_mask.fill(0)
+            row_counter, col_counter = collections.Counter(), collections.Counter()
+            for idx in np.argsort(block.reshape(-1))[::-1]:
+                r, c = idx // m, idx % m
+                if row_counter[r] == n or col_counter[c] == n:
+                    continue
+                block_mask[r, c] = 1
+                row_counter[r] += 1
+                col_counter[c] += 1
+    return mask
+
+
+class SparseMaskLibTest(unittest.TestCase):
+
+    def setUp(self, seed=1234):
+        torch.manual_seed(seed)
+        self.devices = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+
+    def assert_2d_structured(self, mask, m, n):
+        blocks = reshape_2d(mask, m).reshape(-1, m, m)
+        self.assertTrue((blocks.sum(dim=1) <= n).all())
+        self.assertTrue((blocks.sum(dim=2) <= n).all())
+
+    def test_valid_2d_patterns(self):
+        patterns = compute_valid_2d_patterns(4, 2)
+        self.assertEqual(patterns.shape, (90, 4, 4))
+        self.assertTrue((patterns.sum(dim=1) == 2).all())
+        self.assertTrue((patterns.sum(dim=2) == 2).all())
+        self.assertIs(compute_valid_2d_patterns(4, 2), patterns)
+
+    def test_2d_greedy_matches_reference(self):
+        for m, n in [(4, 2), (8, 3)]:
+            matrix = torch.randn(66, 130)
+            expected = reference_2d_greedy(matrix.numpy(), m, n)
+            for device in self.devices:
+                mask = mn_2d_greedy(matrix.to(device), m, n)
+                np.testing.assert_array_equal(mask.cpu().numpy(), expected)
+
+    def test_2d_best(self):
+        matrix = torch.randn(64, 130)
+        for device in self.devices:
+            best = mn_2d_best(matrix.to(device), 4, 2).cpu()
+            greedy = mn_2d_greedy(matrix.to(device), 4, 2).cpu()
+            self.assert_2d_structured(best, 4, 2)
+            self.assertTrue(best[:, 128:].all())
+            self.assertGreaterEqual((matrix.abs() * best).sum(), (matrix.abs() * greedy).sum())
+
+    def test_create_mask_arbitrary_mn(self):
+        weight = torch.randn(32, 48, 3, 3)
+        for pattern, m, n in [("m4n2_1d", 4, 2), ("m8n4_1d", 8, 4), ("m4n2_2d_greedy", 4, 2), ("m8n2_2d_greedy", 8, 2), ("m4n1_2d_best", 4, 1)]:
+            mask = create_mask(weight, pattern)
+            self.assertEqual(mask.shape, weight.shape)
+            flat = mask.permute(2, 3, 0, 1).reshape(-1, 48)
+            self.assertTrue((flat.reshape(-1, m).sum(dim=1) <= n).all())
+
+    def test_pack_unpack_mask(self):
+        for shape in [(16, 32), (8, 16, 3, 3), (5, 3)]:
+            for device in self.devices:
+                mask = torch.rand(shape, device=device) > 0.5
+                packed = pack_mask(mask)
+                self.assertEqual(packed.dtype, torch.uint8)
+                self.assertEqual(packed.numel(), (mask.numel() + 7) // 8)
+                self.assertTrue(torch.equal(unpack_mask(packed, shape), mask))
+
+
+if __name__ == "__main__":
+    unittest.main()
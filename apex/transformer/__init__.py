@@ -2,6 +2,7 @@ from apex.transformer import amp
 from apex.transformer import functional
 from apex.transformer import parallel_state
 from apex.transformer import pipeline_parallel
+from apex.transformer import rank_mapping
 from apex.transformer import tensor_parallel
 from apex.transformer import utils
 from apex.transformer.enums import LayerType
@@ -14,6 +15,7 @@ __all__ = [
     "functional",
     "parallel_state",
     "pipeline_parallel",
+    "rank_mapping",
     "tensor_parallel",
     "utils",
     # enums.py
@@ -1,8 +1,10 @@
+from apex.transformer._data._batchsampler import MegatronPretrainingBucketedSampler
 from apex.transformer._data._batchsampler import MegatronPretrainingRandomSampler
 from apex.transformer._data._batchsampler import MegatronPretrainingSampler
 
 
 __all__ = [
+    "MegatronPretrainingBucketedSampler",
     "MegatronPretrainingRandomSampler",
     "MegatronPretrainingSampler",
 ]
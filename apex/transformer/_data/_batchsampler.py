@@ -3,6 +3,7 @@
 Implementations are based on https://github.com/NVIDIA/Megatron-LM/blob/bcd605f8570ebeeb0436c115ebbfafc3c5a40ae5/megatron/data/data_samplers.py.
 """  # NOQA
 import abc
+from typing import Iterator, List, Optional, Sequence, Union
 
 import torch
 
@@ -10,6 +11,7 @@ import torch
 __all__ = [
     "MegatronPretrainingSampler",
     "MegatronPretrainingRandomSampler",
+    "MegatronPretrainingBucketedSampler",
 ]
 
 
@@ -34,6 +36,19 @@ class _Base:
     def local_minibatch_size(self) -> None:
         ...
 
+    def _sort_by_sequence_length(self, batch: Union[List[int], torch.Tensor]) -> Union[List[int], torch.Tensor]:
+        """Order a local minibatch from the longest to the shortest sample if `sequence_lengths` is given.
+
+        This keeps the samples of similar lengths together when the local minibatch is packed into
+        microbatches under a token budget, see :class:`apex.transformer.microbatches.TokenBudgetNumMicroBatches`.
+        """
+        if self.sequence_lengths is None:
+            return batch
+        if isinstance(batch, torch.Tensor):
+            lengths = torch.tensor([self.sequence_lengths[idx] for idx in batch.tolist()])
+            return batch[torch.argsort(lengths, descending=True, stable=True)]
+        return sorted(batch, key=lambda idx: self.sequence_lengths[idx], reverse=True)
+
 
 class MegatronPretrainingSampler(_Base):
 
@@ -45,6 +60,8 @@ class MegatronPretrainingSampler(_Base):
         data_parallel_rank: int,
         data_parallel_size: int,
         drop_last: bool = True,
+        *,
+        sequence_lengths: Optional[Sequence[int]] = None,
     ):
         # Sanity checks.
         if total_samples <= 0:
@@ -65,6 +82,7 @@ class MegatronPretrainingSampler(_Base):
         self.data_parallel_size = data_parallel_size
         self.local_minibatch_times_data_parallel_size = self._local_minibatch_size * data_parallel_size
         self.drop_last = drop_last
+        self.sequence_lengths = sequence_lengths
 
     def __len__(self):
         return self.total_samples
@@ -90,13 +108,13 @@ class MegatronPretrainingSampler(_Base):
             batch.append(idx)
             if len(batch) == self.local_minibatch_size:
                 start_idx, end_idx = self.get_start_end_idx()
-                yield batch[start_idx:end_idx]
+                yield self._sort_by_sequence_length(batch[start_idx:end_idx])
                 batch = []
 
         # Check the last partial batch and see drop_last is set
         if len(batch) > 0 and not self.drop_last:
             start_idx, end_idx = self.get_start_end_idx()
-            yield batch[start_idx:end_idx]
+            yield self._sort_by_sequence_length(batch[start_idx:end_idx])
 
 
 class MegatronPretrainingRandomSampler(_Base):
@@ -112,6 +130,15 @@ class MegatronPretrainingRandomSampler(_Base):
             `local_minibatch_size = global_batch_size / data_parallel_size`.
         data_parallel_rank:
         data_parallel_size:
+        sequence_lengths: Optional. The sequence length of each data sample. If given, each local
+            minibatch is ordered from the longest to the shortest sample.
+        vectorized: If :obj:`True`, local minibatches are sliced out of the permutation as
+            ``torch.LongTensor`` instead of being built as Python lists, and resuming from
+            `consumed_samples` does not materialize the permutation of the samples already consumed.
+        permutation_chunk_size: Optional. Only used if `vectorized` is :obj:`True`. If given, the
+            permutation of each epoch is generated one chunk of this many samples at a time: the order of
+            the chunks is shuffled, then the samples within each chunk, so that only the current chunk
+            is held in memory. Note that this yields a different order than the default full permutation.
     """
 
     def __init__(
@@ -121,6 +148,10 @@ class MegatronPretrainingRandomSampler(_Base):
         local_minibatch_size: int,
         data_parallel_rank: int,
         data_parallel_size: int,
+        *,
+        sequence_lengths: Optional[Sequence[int]] = None,
+        vectorized: bool = False,
+        permutation_chunk_size: Optional[int] = None,
     ) -> None:
         if total_samples <= 0:
             raise ValueError(f"no sample to consume: total_samples of {total_samples}")
@@ -132,6 +163,8 @@ class MegatronPretrainingRandomSampler(_Base):
             raise ValueError(
                 f"data_parallel_rank should be smaller than data parallel size: {data_parallel_rank} < {data_parallel_size}"
             )
+        if permutation_chunk_size is not None and permutation_chunk_size <= 0:
+            raise ValueError(f"Invalid permutation_chunk_size: {permutation_chunk_size}")
         # Keep a copy of input params for later use.
         self.total_samples = total_samples
         self.consumed_samples = consumed_samples
@@ -140,6 +173,9 @@ class MegatronPretrainingRandomSampler(_Base):
         self.data_parallel_size = data_parallel_size
         self.local_minibatch_times_data_parallel_size = self._local_minibatch_size * self.data_parallel_size
         self.last_batch_size = self.total_samples % self.local_minibatch_times_data_parallel_size
+        self.sequence_lengths = sequence_lengths
+        self.vectorized = vectorized
+        self.permutation_chunk_size = permutation_chunk_size
 
     def __len__(self) -> int:
         return self.total_samples
@@ -165,6 +201,10 @@ class MegatronPretrainingRandomSampler(_Base):
         bucket_offset = current_epoch_samples // self.data_parallel_size
         start_idx = self.data_parallel_rank * bucket_size
 
+        if self.vectorized:
+            yield from self._iter_vectorized(bucket_size, bucket_offset, start_idx)
+            return
+
         g = torch.Generator()
         g.manual_seed(self.epoch)
         random_idx = torch.randperm(bucket_size, generator=g).tolist()
@@ -176,5 +216,164 @@ class MegatronPretrainingRandomSampler(_Base):
             batch.append(idx)
             if len(batch) == self.local_minibatch_size:
                 self.consumed_samples += self.local_minibatch_times_data_parallel_size
-                yield batch
+                yield self._sort_by_sequence_length(batch)
                 batch = []
+
+    def _iter_vectorized(self, bucket_size: int, bucket_offset: int, start_idx: int) -> Iterator[torch.Tensor]:
+        leftover = torch.empty((0,), dtype=torch.int64)
+        for segment in self._iter_permutation(bucket_size, bucket_offset):
+            if leftover.numel() > 0:
+                segment = torch.cat((leftover, segment))
+            num_batches = segment.numel() // self.local_minibatch_size
+            end = num_batches * self.local_minibatch_size
+            # Last batch if not complete will be dropped.
+            for batch in segment[:end].view(num_batches, self.local_minibatch_size):
+                self.consumed_samples += self.local_minibatch_times_data_parallel_size
+                yield self._sort_by_sequence_length(batch + start_idx)
+            leftover = segment[end:]
+
+    def _iter_permutation(self, bucket_size: int, bucket_offset: int) -> Iterator[torch.Tensor]:
+        """Yield the permutation of ``range(bucket_size)`` of the current epoch from ``bucket_offset`` on, in segments."""
+        if self.permutation_chunk_size is None:
+            # Same order as the list based path, so that a run can switch between the two on resumption.
+            g = torch.Generator()
+            g.manual_seed(self.epoch)
+            yield torch.randperm(bucket_size, generator=g)[bucket_offset:]
+            return
+
+        chunk_size = self.permutation_chunk_size
+        num_chunks = (bucket_size + chunk_size - 1) // chunk_size
+        g = torch.Generator()
+        g.manual_seed(self.epoch)
+        chunk_order = torch.randperm(num_chunks, generator=g)
+        chunk_sizes = torch.clamp(bucket_size - chunk_order * chunk_size, max=chunk_size)
+        chunk_ends = torch.cumsum(chunk_sizes, dim=0)
+        # Skip the chunks consumed already without generating their permutations.
+        first = int(torch.searchsorted(chunk_ends, bucket_offset, right=True))
+        offset = bucket_offset - (int(chunk_ends[first - 1]) if first > 0 else 0)
+        for chunk, size in zip(chunk_order[first:].tolist(), chunk_sizes[first:].tolist()):
+            g.manual_seed(((self.epoch + 1) << 32) + chunk)
+            yield chunk * chunk_size + torch.randperm(size, generator=g)[offset:]
+            offset = 0
+
+
+class MegatronPretrainingBucketedSampler(_Base):
+    """Megatron style Batch Sampler which groups samples of similar lengths.
+
+    Samples are assigned to buckets by their sequence lengths. Every epoch, the samples of each
+    bucket are shuffled and cut into global batches of ``local_minibatch_size * data_parallel_size``
+    samples, the samples left over by all the buckets are cut into global batches in the order of the
+    buckets, and the order of all the global batches is shuffled. Each data parallel rank takes its
+    slice of every global batch as its local minibatch, which is ordered from the longest to the
+    shortest sample. The shuffling is seeded by the epoch, so that the samples consumed so far are
+    fully determined by `consumed_samples`.
+
+    Args:
+        total_samples: The number of data samples, i.e. ``len(dataset)``.
+        consumed_samples: The number of samples already consumed in pretraining.
+        local_minibatch_size: The number of data in each batch returned from `__iter__`. Basically
+            `local_minibatch_size = global_batch_size / data_parallel_size`.
+        data_parallel_rank:
+        data_parallel_size:
+        sequence_lengths: The sequence length of each data sample, e.g. a list, a tensor, or a
+            memory-mapped NumPy array.
+        bucket_boundaries: Optional. The sorted sequence lengths at which a new bucket starts. If not
+            given, `num_buckets` buckets with roughly the same number of samples are used.
+        num_buckets: The number of buckets if `bucket_boundaries` is not given.
+    """
+
+    def __init__(
+        self,
+        total_samples: int,
+        consumed_samples: int,
+        local_minibatch_size: int,
+        data_parallel_rank: int,
+        data_parallel_size: int,
+        sequence_lengths: Sequence[int],
+        *,
+        bucket_boundaries: Optional[Sequence[int]] = None,
+        num_buckets: int = 8,
+    ) -> None:
+        if total_samples <= 0:
+            raise ValueError(f"no sample to consume: total_samples of {total_samples}")
+        if local_minibatch_size <= 0:
+            raise ValueError(f"Invalid local_minibatch_size: {local_minibatch_size}")
+        if data_parallel_size <= 0:
+            raise ValueError(f"Invalid data_parallel_size: {data_parallel_size}")
+        if data_parallel_rank >= data_parallel_size:
+            raise ValueError(
+                f"data_parallel_rank should be smaller than data parallel size: {data_parallel_rank} < {data_parallel_size}"
+            )
+        if len(sequence_lengths) < total_samples:
+            raise ValueError(
+                f"sequence_lengths should have at least total_samples elements: {len(sequence_lengths)} < {total_samples}"
+            )
+        if bucket_boundaries is None and num_buckets <= 0:
+            raise ValueError(f"Invalid num_buckets: {num_buckets}")
+        # Keep a copy of input params for later use.
+        self.total_samples = total_samples
+        self.consumed_samples = consumed_samples
+        self._local_minibatch_size = local_minibatch_size
+        self.data_parallel_rank = data_parallel_rank
+        self.data_parallel_size = data_parallel_size
+        self.local_minibatch_times_data_parallel_size = self._local_minibatch_size * self.data_parallel_size
+        self.sequence_lengths = sequence_lengths
+        self.buckets = self._build_buckets(bucket_boundaries, num_buckets)
+
+    def __len__(self) -> int:
+        return self.total_samples
+
+    @property
+    def local_minibatch_size(self) -> int:
+        return self._local_minibatch_size
+
+    @local_minibatch_size.setter
+    def local_minibatch_size(self, new_local_minibatch_size) -> None:
+        self._local_minibatch_size = new_local_minibatch_size
+        self.local_minibatch_times_data_parallel_size = self._local_minibatch_size * self.data_parallel_size
+
+    def _build_buckets(self, bucket_boundaries: Optional[Sequence[int]], num_buckets: int) -> List[torch.Tensor]:
+        """Return the indices of the samples in each non-empty bucket, from the shortest to the longest."""
+        lengths = torch.as_tensor(self.sequence_lengths[: self.total_samples], dtype=torch.int64)
+        if bucket_boundaries is None:
+            sorted_lengths = torch.sort(lengths).values
+            positions = torch.arange(1, num_buckets) * self.total_samples // num_buckets
+            boundaries = torch.unique(sorted_lengths[positions])
+        else:
+            boundaries = torch.as_tensor(bucket_boundaries, dtype=torch.int64)
+        bucket_ids = torch.bucketize(lengths, boundaries, right=True)
+        order = torch.argsort(bucket_ids, stable=True)
+        counts = torch.bincount(bucket_ids, minlength=boundaries.numel() + 1)
+        return [bucket for bucket in torch.split(order, counts.tolist()) if bucket.numel() > 0]
+
+    def _epoch_batches(self, epoch: int) -> torch.Tensor:
+        """Return the global batches of ``epoch`` as a tensor of shape ``(num_global_batches, global_batch_size)``."""
+        global_batch_size = self.local_minibatch_times_data_parallel_size
+        g = torch.Generator()
+        g.manual_seed(epoch)
+        batches, leftovers = [], []
+        for bucket in self.buckets:
+            bucket = bucket[torch.randperm(bucket.numel(), generator=g)]
+            end = bucket.numel() // global_batch_size * global_batch_size
+            batches.append(bucket[:end].view(-1, global_batch_size))
+            leftovers.append(bucket[end:])
+        # The samples left over mix neighbouring buckets. The last incomplete global batch is dropped.
+        leftovers = torch.cat(leftovers)
+        end = leftovers.numel() // global_batch_size * global_batch_size
+        batches.append(leftovers[:end].view(-1, global_batch_size))
+        batches = torch.cat(batches)
+        return batches[torch.randperm(batches.size(0), generator=g)]
+
+    def __iter__(self):
+        global_batch_size = self.local_minibatch_times_data_parallel_size
+        # Every epoch has the same number of global batches whatever the buckets.
+        active_total_samples = self.total_samples // global_batch_size * global_batch_size
+        self.epoch = self.consumed_samples // active_total_samples
+        current_epoch_samples = self.consumed_samples % active_total_samples
+
+        batches = self._epoch_batches(self.epoch)
+        start_idx = self.data_parallel_rank * self.local_minibatch_size
+        end_idx = start_idx + self.local_minibatch_size
+        for batch in batches[current_epoch_samples // global_batch_size :]:
+            self.consumed_samples += global_batch_size
+            yield self._sort_by_sequence_length(batch[start_idx:end_idx].tolist())
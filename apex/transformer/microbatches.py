@@ -15,7 +15,9 @@
 """Megatron number of micro-batches calculators."""
 from abc import ABC
 from abc import abstractmethod
-from typing import Optional, List
+from typing import Optional, List, Sequence, Tuple
+
+import torch
 
 from apex.transformer.log_util import get_transformer_logger
 
@@ -29,9 +31,24 @@ def build_num_microbatches_calculator(
     global_batch_size: int,
     micro_batch_size: int,
     data_parallel_size: int,
+    *,
+    max_tokens_per_microbatch: Optional[int] = None,
 ):
+    # Token budget micro-batches.
+    if max_tokens_per_microbatch is not None:
+        assert rampup_batch_size is None, "batch size rampup is not supported with `max_tokens_per_microbatch`"
+        num_microbatches_calculator = TokenBudgetNumMicroBatches(
+            global_batch_size, micro_batch_size, data_parallel_size, max_tokens_per_microbatch
+        )
+        if rank == 0:
+            _logger.info(
+                "will pack micro-batches of up to {} samples and {} tokens".format(
+                    micro_batch_size, max_tokens_per_microbatch
+                )
+            )
+
     # Constant num micro-batches.
-    if rampup_batch_size is None:
+    elif rampup_batch_size is None:
         num_microbatches_calculator = ConstantNumMicroBatches(
             global_batch_size, micro_batch_size, data_parallel_size
         )
@@ -85,6 +102,19 @@ class NumMicroBatchesCalculator(ABC):
     def get_current_global_batch_size(self):
         return self.current_global_batch_size
 
+    def get_microbatch_range(self, k: int) -> Tuple[int, int]:
+        """Return the start and end indices of the `k`th microbatch in a local minibatch."""
+        start = k * self.micro_batch_size
+        return start, start + self.micro_batch_size
+
+    def get_loss_divisor(self, k: int):
+        """Return the number the loss of the `k`th microbatch is divided by.
+
+        The losses of the microbatches are summed, so a microbatch whose loss is the mean over its
+        samples is weighted by its share of the samples of the local minibatch.
+        """
+        return self.num_micro_batches
+
     @abstractmethod
     def update(self, consumed_samples, consistency_check):
         pass
@@ -193,3 +223,140 @@ class RampupBatchsizeNumMicroBatches(NumMicroBatchesCalculator):
         self.num_micro_batches = (
             self.current_global_batch_size // self.micro_batch_times_data_parallel_size
         )
+
+
+class TokenBudgetNumMicroBatches(NumMicroBatchesCalculator):
+    def __init__(
+        self,
+        global_batch_size: int,
+        micro_batch_size: int,
+        data_parallel_size: int,
+        max_tokens_per_microbatch: int,
+    ):
+        """Pack the samples of variable sequence lengths into micro-batches under a token budget.
+
+        Every step, :meth:`update` takes the sequence lengths of the samples of the local minibatch
+        and splits the local minibatch, in order, into micro-batches of at most `micro_batch_size`
+        samples whose padded size, i.e. the number of samples times the longest sequence length,
+        does not exceed `max_tokens_per_microbatch`. Samples longer than the budget form
+        micro-batches on their own. Sorting the local minibatch by sequence length, e.g. by passing
+        `sequence_lengths` to the batch samplers, minimizes the padding.
+
+        The number of micro-batches varies from step to step but is kept consistent across data
+        parallel ranks. Ranks which need fewer micro-batches split their largest ones.
+
+        As micro-batches hold different numbers of samples, the loss of each micro-batch is weighted
+        by its share of the samples of the local minibatch, see :meth:`get_loss_divisor`, and the
+        batch dimension of the tensors communicated between pipeline stages varies, so the pipeline
+        schedules have to be run with ``variable_seq_lengths=True``.
+
+        Until the first :meth:`update` with sequence lengths, the local minibatch is split into
+        micro-batches of `micro_batch_size` samples.
+
+        Arguments:
+            global_batch_size: global batch size in samples
+            micro_batch_size: maximum number of samples in a micro-batch
+            data_parallel_size: data parallel size.
+            max_tokens_per_microbatch: maximum number of tokens in a micro-batch including padding.
+        """
+        micro_batch_times_data_parallel = micro_batch_size * data_parallel_size
+        assert global_batch_size % micro_batch_times_data_parallel == 0, (
+            "global batch size ({}) is not divisible by micro batch size ({})"
+            " times data parallel size ({})".format(
+                global_batch_size, micro_batch_size, data_parallel_size
+            )
+        )
+        assert max_tokens_per_microbatch > 0
+        self.current_global_batch_size = global_batch_size
+        self.micro_batch_size = micro_batch_size
+        self.data_parallel_size = data_parallel_size
+        self.max_tokens_per_microbatch = max_tokens_per_microbatch
+        self.local_minibatch_size = global_batch_size // data_parallel_size
+
+        self.microbatch_ranges = [
+            (start, start + micro_batch_size) for start in range(0, self.local_minibatch_size, micro_batch_size)
+        ]
+        self.num_micro_batches = len(self.microbatch_ranges)
+        self.num_tokens = 0
+        self.num_padded_tokens = 0
+
+    def get_microbatch_range(self, k: int) -> Tuple[int, int]:
+        return self.microbatch_ranges[k]
+
+    def get_loss_divisor(self, k: int) -> float:
+        start, end = self.microbatch_ranges[k]
+        return self.local_minibatch_size / (end - start)
+
+    @property
+    def padding_ratio(self) -> float:
+        """The fraction of padding tokens in the micro-batches of the last update."""
+        if self.num_padded_tokens == 0:
+            return 0.0
+        return 1.0 - self.num_tokens / self.num_padded_tokens
+
+    def _padded_tokens(self, sequence_lengths: Sequence[int], start: int, end: int) -> int:
+        return (end - start) * max(sequence_lengths[start:end])
+
+    def _pack(self, sequence_lengths: Sequence[int]) -> List[Tuple[int, int]]:
+        ranges = []
+        start, longest = 0, 0
+        for end, sequence_length in enumerate(sequence_lengths):
+            longest = max(longest, sequence_length)
+            num_samples = end - start + 1
+            if num_samples > 1 and (
+                num_samples > self.micro_batch_size or num_samples * longest > self.max_tokens_per_microbatch
+            ):
+                ranges.append((start, end))
+                start, longest = end, sequence_length
+        ranges.append((start, len(sequence_lengths)))
+        return ranges
+
+    def _split(self, sequence_lengths: Sequence[int], ranges: List[Tuple[int, int]], num_micro_batches: int):
+        while len(ranges) < num_micro_batches:
+            index = max(
+                (i for i, (start, end) in enumerate(ranges) if end - start > 1),
+                key=lambda i: self._padded_tokens(sequence_lengths, *ranges[i]),
+            )
+            start, end = ranges[index]
+            middle = (start + end) // 2
+            ranges[index:index + 1] = [(start, middle), (middle, end)]
+        return ranges
+
+    def _max_across_data_parallel_group(self, value: int) -> int:
+        # n.b. Imported here as `parallel_state` is not needed by the other calculators.
+        from apex.transformer import parallel_state
+
+        if self.data_parallel_size == 1 or not torch.distributed.is_initialized():
+            return value
+        group = parallel_state.get_data_parallel_group()
+        device = "cpu" if torch.distributed.get_backend(group) == "gloo" else torch.cuda.current_device()
+        tensor = torch.tensor([value], dtype=torch.int64, device=device)
+        torch.distributed.all_reduce(tensor, op=torch.distributed.ReduceOp.MAX, group=group)
+        return int(tensor.item())
+
+    def update(self, consumed_samples, consistency_check, sequence_lengths: Optional[Sequence[int]] = None):
+        """Update the micro-batches for the local minibatch of the next step.
+
+        Arguments:
+            consumed_samples: number of samples consumed so far. Not used.
+            consistency_check: if True, check that `sequence_lengths` covers the local minibatch.
+            sequence_lengths: sequence lengths of the samples of this rank's local minibatch in order.
+                If None, the micro-batches of the previous step are kept.
+        """
+        if sequence_lengths is None:
+            return
+        sequence_lengths = [int(sequence_length) for sequence_length in sequence_lengths]
+        if consistency_check:
+            assert len(sequence_lengths) == self.local_minibatch_size, (
+                "expected the sequence lengths of {} samples but got {}".format(
+                    self.local_minibatch_size, len(sequence_lengths)
+                )
+            )
+        ranges = self._pack(sequence_lengths)
+        num_micro_batches = self._max_across_data_parallel_group(len(ranges))
+        self.microbatch_ranges = self._split(sequence_lengths, ranges, num_micro_batches)
+        self.num_micro_batches = num_micro_batches
+        self.num_tokens = sum(sequence_lengths)
+        self.num_padded_tokens = sum(
+            self._padded_tokens(sequence_lengths, start, end) for start, end in self.microbatch_ranges
+        )
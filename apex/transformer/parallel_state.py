@@ -21,6 +21,9 @@ import warnings
 import torch
 
 from apex.transformer.log_util import get_transformer_logger
+from apex.transformer.rank_mapping import RankLayout
+from apex.transformer.rank_mapping import RankMapper
+from apex.transformer.rank_mapping import build_rank_layout
 
 
 _logger = get_transformer_logger(__name__)
@@ -72,6 +75,11 @@ _DECODER_RELATIVE_POSITION_EMBEDDING_GLOBAL_RANKS = None
 # rank when broadcasting from the first or last pipeline stage
 _PIPELINE_GLOBAL_RANKS = None
 
+# Lists of global ranks of the tensor model parallel and data parallel groups, which are
+# not contiguous when a rank mapper or a non-default order is used.
+_TENSOR_MODEL_PARALLEL_GLOBAL_RANKS = None
+_DATA_PARALLEL_GLOBAL_RANKS = None
+
 
 def is_unitialized():
     """Useful for code segments that may be accessed with or without mpu initialization"""
@@ -86,7 +94,10 @@ def initialize_model_parallel(
     *,
     default_backend: Optional[str] = None,
     p2p_backend: Optional[str] = None,
-) -> None:
+    order: Optional[str] = None,
+    rank_mapper: Optional[RankMapper] = None,
+    dry_run: bool = False,
+) -> Optional[RankLayout]:
     """
     Initialize model data parallel groups.
 
@@ -100,6 +111,16 @@ def initialize_model_parallel(
             If :obj:`None`, the backend specified in `torch.distributed.init_process_group` will be used.
         p2p_backend: Backend of process groups for pipeline model parallel.
             If :obj:`None`, the backend specified in `torch.distributed.init_process_group` will be used.
+        order: The order of the parallel dimensions from the fastest to the slowest varying one,
+            "tp-dp-pp" or "tp-pp-dp". If :obj:`None`, `rank_mapper` selects it, which is "tp-dp-pp"
+            for the default mapper.
+        rank_mapper: A :class:`apex.transformer.rank_mapping.RankMapper` deciding which global rank
+            holds each position of the layout, e.g. a
+            :class:`apex.transformer.rank_mapping.TopologyAwareRankMapper` to keep tensor model
+            parallel groups inside a node whatever the order of the ranks across nodes.
+        dry_run: If :obj:`True`, print the groups and return their
+            :class:`apex.transformer.rank_mapping.RankLayout` without creating any process group.
+            `torch.distributed` does not need to be initialized if `rank_mapper` knows the world size.
 
     .. note::
         `torch_ucc <https://github.com/facebookresearch/torch_ucc>`_ is
@@ -119,8 +140,30 @@ def initialize_model_parallel(
     Note that for efficiency, the caller should make sure adjacent ranks
     are on the same DGX box. For example if we are using 2 DGX-1 boxes
     with a total of 16 GPUs, rank 0 to 7 belong to the first box and
-    ranks 8 to 15 belong to the second box.
+    ranks 8 to 15 belong to the second box. Otherwise, pass a
+    :class:`apex.transformer.rank_mapping.TopologyAwareRankMapper`.
+    With the "tp-pp-dp" order, the pipeline groups above become
+    [g0, g2, g4, g6], [g1, g3, g5, g7], [g8, g10, g12, g14], [g9, g11, g13, g15]
+    and each of them fits in one DGX-1 box.
     """
+    if dry_run:
+        if torch.distributed.is_initialized():
+            world_size = torch.distributed.get_world_size()
+        elif rank_mapper is not None and rank_mapper.world_size is not None:
+            world_size = rank_mapper.world_size
+        else:
+            raise RuntimeError("`dry_run` requires either `torch.distributed` to be initialized or a `rank_mapper` with a world size")
+        layout = build_rank_layout(
+            world_size,
+            min(tensor_model_parallel_size_, world_size),
+            min(pipeline_model_parallel_size_, world_size),
+            order=order,
+            rank_mapper=rank_mapper,
+        )
+        if not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0:
+            print(layout, flush=True)
+        return layout
+
     # Get world size and rank. Ensure some consistencies.
     assert torch.distributed.is_initialized()
     assert default_backend is None or default_backend in ("nccl", "ucc")
@@ -156,9 +199,16 @@ def initialize_model_parallel(
             "> initializing data parallel with size {}".format(data_parallel_size)
         )
 
-    num_tensor_model_parallel_groups: int = world_size // tensor_model_parallel_size
-    num_pipeline_model_parallel_groups: int = world_size // pipeline_model_parallel_size
-    num_data_parallel_groups: int = world_size // data_parallel_size
+    layout = build_rank_layout(
+        world_size,
+        tensor_model_parallel_size,
+        pipeline_model_parallel_size,
+        order=order,
+        rank_mapper=rank_mapper,
+    )
+    if torch.distributed.get_rank() == 0:
+        _logger.info("> rank layout with order {}".format(layout.order))
+        _logger.debug(str(layout))
 
     if virtual_pipeline_model_parallel_size_ is not None:
         # n.b. (eqy) This check was inherited from Megatron-LM, need to revisit
@@ -183,47 +233,39 @@ def initialize_model_parallel(
 
     # Build the data-parallel groups.
     global _DATA_PARALLEL_GROUP
+    global _DATA_PARALLEL_GLOBAL_RANKS
     assert _DATA_PARALLEL_GROUP is None, "data parallel group is already initialized"
-    all_data_parallel_group_ranks = []
-    for i in range(pipeline_model_parallel_size):
-        start_rank = i * num_pipeline_model_parallel_groups
-        end_rank = (i + 1) * num_pipeline_model_parallel_groups
-        for j in range(tensor_model_parallel_size):
-            ranks = range(start_rank + j, end_rank, tensor_model_parallel_size)
-            all_data_parallel_group_ranks.append(list(ranks))
-            group = torch.distributed.new_group(ranks, backend=default_backend)
-            if rank in ranks:
-                _DATA_PARALLEL_GROUP = group
+    for ranks in layout.data_parallel_groups:
+        group = torch.distributed.new_group(ranks, backend=default_backend)
+        if rank in ranks:
+            _DATA_PARALLEL_GROUP = group
+            _DATA_PARALLEL_GLOBAL_RANKS = ranks
 
     # Build the model-parallel groups.
     global _MODEL_PARALLEL_GROUP
     assert _MODEL_PARALLEL_GROUP is None, "model parallel group is already initialized"
-    for i in range(data_parallel_size):
-        ranks = [
-            data_parallel_group_ranks[i]
-            for data_parallel_group_ranks in all_data_parallel_group_ranks
-        ]
+    for ranks in layout.model_parallel_groups:
         group = torch.distributed.new_group(ranks, backend=default_backend)
         if rank in ranks:
             _MODEL_PARALLEL_GROUP = group
 
     # Build the tensor model-parallel groups.
     global _TENSOR_MODEL_PARALLEL_GROUP
+    global _TENSOR_MODEL_PARALLEL_GLOBAL_RANKS
     assert (
         _TENSOR_MODEL_PARALLEL_GROUP is None
     ), "tensor model parallel group is already initialized"
-    for i in range(num_tensor_model_parallel_groups):
-        ranks = list(
-            range(i * tensor_model_parallel_size, (i + 1) * tensor_model_parallel_size)
-        )
+    for ranks in layout.tensor_model_parallel_groups:
         group = torch.distributed.new_group(ranks, backend=default_backend)
         if rank in ranks:
             _TENSOR_MODEL_PARALLEL_GROUP = group
+            _TENSOR_MODEL_PARALLEL_GLOBAL_RANKS = ranks
 
     # Build the pipeline model-parallel groups and embedding groups
     # (first and last rank in each pipeline model-parallel group).
     global _PIPELINE_MODEL_PARALLEL_GROUP
     global _PIPELINE_GLOBAL_RANKS
+    global _MPU_PIPELINE_MODEL_PARALLEL_RANK
     assert (
         _PIPELINE_MODEL_PARALLEL_GROUP is None
     ), "pipeline model parallel group is already initialized"
@@ -242,12 +284,14 @@ def initialize_model_parallel(
     assert _ENCODER_RELATIVE_POSITION_EMBEDDING_GROUP is None or \
            _DECODER_RELATIVE_POSITION_EMBEDDING_GROUP is None, \
         'relative position embedding group is already initialized'
-    for i in range(num_pipeline_model_parallel_groups):
-        ranks = range(i, world_size, num_pipeline_model_parallel_groups)
+    for ranks in layout.pipeline_model_parallel_groups:
         group = torch.distributed.new_group(ranks, backend=p2p_backend)
         if rank in ranks:
             _PIPELINE_MODEL_PARALLEL_GROUP = group
             _PIPELINE_GLOBAL_RANKS = ranks
+            # The stages of a pipeline are not in ascending order of global rank with every rank
+            # mapper, while `new_group` numbers the ranks of the group in that order.
+            _MPU_PIPELINE_MODEL_PARALLEL_RANK = ranks.index(rank)
         # Setup embedding group (to exchange gradients between
         # first and last stages).
         encoder_relative_position_embedding_ranks = None
@@ -584,13 +628,25 @@ def set_virtual_pipeline_model_parallel_world_size(size):
 def get_tensor_model_parallel_src_rank():
     """Calculate the global rank corresponding to the first local rank
     in the tensor model parallel group."""
+    if _TENSOR_MODEL_PARALLEL_GLOBAL_RANKS is not None:
+        return _TENSOR_MODEL_PARALLEL_GLOBAL_RANKS[0]
     global_rank = torch.distributed.get_rank()
     local_world_size = get_tensor_model_parallel_world_size()
     return (global_rank // local_world_size) * local_world_size
 
 
+def get_tensor_model_parallel_global_ranks():
+    """Return the global ranks of the tensor model parallel group, by tensor model parallel rank."""
+    if _TENSOR_MODEL_PARALLEL_GLOBAL_RANKS is not None:
+        return _TENSOR_MODEL_PARALLEL_GLOBAL_RANKS
+    src_rank = get_tensor_model_parallel_src_rank()
+    return list(range(src_rank, src_rank + get_tensor_model_parallel_world_size()))
+
+
 def get_data_parallel_src_rank():
     """Calculate the global rank corresponding to the first local rank in the data parallel group."""
+    if _DATA_PARALLEL_GLOBAL_RANKS is not None:
+        return _DATA_PARALLEL_GLOBAL_RANKS[0]
     global_rank = torch.distributed.get_rank()
     data_parallel_size: int = get_data_parallel_world_size()
     num_data_parallel_groups = torch.distributed.get_world_size() // data_parallel_size
@@ -673,6 +729,10 @@ def destroy_model_parallel():
     _MPU_TENSOR_MODEL_PARALLEL_RANK = None
     global _MPU_PIPELINE_MODEL_PARALLEL_RANK
     _MPU_PIPELINE_MODEL_PARALLEL_RANK = None
+    global _TENSOR_MODEL_PARALLEL_GLOBAL_RANKS
+    _TENSOR_MODEL_PARALLEL_GLOBAL_RANKS = None
+    global _DATA_PARALLEL_GLOBAL_RANKS
+    _DATA_PARALLEL_GLOBAL_RANKS = None
 
 
 # Used to warn when the UCC is specified.
@@ -1,8 +1,10 @@
+from apex.transformer.pipeline_parallel.activation_offload import ActivationOffloadManager
 from apex.transformer.pipeline_parallel.schedules import get_forward_backward_func
 from apex.transformer.pipeline_parallel.schedules.common import build_model
 
 
 __all__ = [
+    "ActivationOffloadManager",
     "get_forward_backward_func",
     "build_model",
 ]
@@ -1,4 +1,5 @@
 import time
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import torch
 
@@ -48,34 +49,215 @@ class _Timer:
         return elapsed_
 
 
+class _EventTimer:
+    """Timer which does not synchronize the device.
+
+    If CUDA is in use, :meth:`start` and :meth:`stop` record CUDA events on the current stream and
+    the intervals are only resolved by :meth:`elapsed`, i.e. when the timers are logged or written.
+    Otherwise, they read :func:`time.perf_counter_ns`, which is exact for synchronous CPU work.
+
+    Args:
+        name: The name of the timer.
+        max_pending: The number of unresolved intervals above which the ones already completed
+            by the device are resolved in :meth:`stop`, which bounds the number of live events.
+    """
+
+    def __init__(self, name, max_pending=1024):
+        self.name_ = name
+        self.elapsed_ = 0.0
+        self.started_ = False
+        self.max_pending = max_pending
+        self._use_cuda: Optional[bool] = None
+        self._start = None
+        self._pending: List[Tuple["torch.cuda.Event", "torch.cuda.Event"]] = []
+        self._free_events: List["torch.cuda.Event"] = []
+
+    def _new_event(self):
+        if self._free_events:
+            return self._free_events.pop()
+        return torch.cuda.Event(enable_timing=True)
+
+    def start(self):
+        """Start the timer."""
+        assert not self.started_, "timer has already been started"
+        if self._use_cuda is None:
+            self._use_cuda = torch.cuda.is_available() and torch.cuda.is_initialized()
+        if self._use_cuda:
+            self._start = self._new_event()
+            self._start.record()
+        else:
+            self._start = time.perf_counter_ns()
+        self.started_ = True
+
+    def stop(self):
+        """Stop the timer."""
+        assert self.started_, "timer is not started"
+        if self._use_cuda:
+            end = self._new_event()
+            end.record()
+            self._pending.append((self._start, end))
+            if len(self._pending) > self.max_pending:
+                self._resolve(block=False)
+        else:
+            self.elapsed_ += (time.perf_counter_ns() - self._start) / 1e9
+        self._start = None
+        self.started_ = False
+
+    def _resolve(self, block=True):
+        """Add the intervals whose events completed to the elapsed time, waiting for all of them if ``block``."""
+        num_resolved = 0
+        for start, end in self._pending:
+            if not block and not end.query():
+                break
+            end.synchronize()
+            self.elapsed_ += start.elapsed_time(end) / 1000.0
+            self._free_events.extend((start, end))
+            num_resolved += 1
+        del self._pending[:num_resolved]
+
+    def reset(self):
+        """Reset timer."""
+        for start, end in self._pending:
+            self._free_events.extend((start, end))
+        self._pending.clear()
+        if self._start is not None and self._use_cuda:
+            self._free_events.append(self._start)
+        self._start = None
+        self.elapsed_ = 0.0
+        self.started_ = False
+
+    def elapsed(self, reset=True):
+        """Calculate the elapsed time."""
+        started_ = self.started_
+        # If the timing in progress, end it first.
+        if self.started_:
+            self.stop()
+        self._resolve()
+        # Get the elapsed time.
+        elapsed_ = self.elapsed_
+        # Reset the elapsed time
+        if reset:
+            self.reset()
+        # If timing was in progress, set it back.
+        if started_:
+            self.start()
+        return elapsed_
+
+
+class _DummyTimer:
+    """Timer returned by disabled :class:`_Timers`, which does nothing."""
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def reset(self):
+        pass
+
+    def elapsed(self, reset=True):
+        return 0.0
+
+
+_DUMMY_TIMER = _DummyTimer()
+
+
 class _Timers:
-    """Group of timers."""
+    """Group of timers.
+
+    Args:
+        use_events: If :obj:`True`, use :class:`_EventTimer`, which does not synchronize the device,
+            instead of :class:`_Timer`.
+        enabled: If :obj:`False`, every timer is a no-op and :meth:`log` and :meth:`write` do nothing.
+            Can be changed at any time through the `enabled` attribute.
+    """
 
-    def __init__(self):
+    def __init__(self, *, use_events=False, enabled=True):
         self.timers = {}
+        self.use_events = use_events
+        self.enabled = enabled
 
     def __call__(self, name):
+        if not self.enabled:
+            return _DUMMY_TIMER
         if name not in self.timers:
-            self.timers[name] = _Timer(name)
+            self.timers[name] = _EventTimer(name) if self.use_events else _Timer(name)
         return self.timers[name]
 
-    def write(self, names, writer, iteration, normalizer=1.0, reset=False):
-        """Write timers to a tensorboard writer"""
+    def _aggregate(self, names: Sequence[str], reset: bool) -> Dict[str, Tuple[float, float, float]]:
+        """Return the min, max, and mean elapsed time of each timer across ranks with a single all-gather.
+
+        Every rank has to call this. Timers a rank does not have are left out of its statistics.
+        """
+        elapsed = torch.tensor(
+            [self.timers[name].elapsed(reset=reset) if name in self.timers else float("nan") for name in names],
+            dtype=torch.float64,
+        )
+        if torch.distributed.is_initialized():
+            world_size = torch.distributed.get_world_size()
+            if torch.distributed.get_backend() != "gloo":
+                elapsed = elapsed.to(torch.cuda.current_device())
+            gathered = torch.empty(world_size * len(names), dtype=elapsed.dtype, device=elapsed.device)
+            torch.distributed._all_gather_base(gathered, elapsed)
+            elapsed = gathered.view(world_size, len(names)).cpu()
+        else:
+            elapsed = elapsed.view(1, len(names))
+        valid = ~torch.isnan(elapsed)
+        min_elapsed = torch.where(valid, elapsed, torch.full_like(elapsed, float("inf"))).min(dim=0).values
+        max_elapsed = torch.where(valid, elapsed, torch.full_like(elapsed, float("-inf"))).max(dim=0).values
+        mean_elapsed = torch.nanmean(elapsed, dim=0)
+        return {
+            name: (min_value, max_value, mean_value)
+            for name, min_value, max_value, mean_value in zip(
+                names, min_elapsed.tolist(), max_elapsed.tolist(), mean_elapsed.tolist()
+            )
+        }
+
+    def write(self, names, writer, iteration, normalizer=1.0, reset=False, *, aggregate=False):
+        """Write timers to a tensorboard writer
+
+        If ``aggregate``, every rank has to call this, and the mean, min, and max across ranks are
+        written on the ranks whose ``writer`` is not :obj:`None`.
+        """
         # currently when using add_scalars,
         # torch.utils.add_scalars makes each timer its own run, which
         # polutes the runs list, so we just add each as a scalar
         assert normalizer > 0.0
+        if not self.enabled:
+            return
+        if aggregate:
+            stats = self._aggregate(names, reset)
+            if writer is None:
+                return
+            for name in names:
+                min_value, max_value, mean_value = stats[name]
+                writer.add_scalar(name + "-time", mean_value / normalizer, iteration)
+                writer.add_scalar(name + "-time-min", min_value / normalizer, iteration)
+                writer.add_scalar(name + "-time-max", max_value / normalizer, iteration)
+            return
         for name in names:
             value = self.timers[name].elapsed(reset=reset) / normalizer
             writer.add_scalar(name + "-time", value, iteration)
 
-    def log(self, names, normalizer=1.0, reset=True):
-        """Log a group of timers."""
+    def log(self, names, normalizer=1.0, reset=True, *, aggregate=False):
+        """Log a group of timers.
+
+        If ``aggregate``, every rank has to call this, and the mean, min, and max across ranks are logged.
+        """
         assert normalizer > 0.0
+        if not self.enabled:
+            return
         string = "time (ms)"
-        for name in names:
-            elapsed_time = self.timers[name].elapsed(reset=reset) * 1000.0 / normalizer
-            string += " | {}: {:.2f}".format(name, elapsed_time)
+        if aggregate:
+            stats = self._aggregate(names, reset)
+            for name in names:
+                min_value, max_value, mean_value = (value * 1000.0 / normalizer for value in stats[name])
+                string += " | {}: {:.2f} (min {:.2f}, max {:.2f})".format(name, mean_value, min_value, max_value)
+        else:
+            for name in names:
+                elapsed_time = self.timers[name].elapsed(reset=reset) * 1000.0 / normalizer
+                string += " | {}: {:.2f}".format(name, elapsed_time)
         if torch.distributed.is_initialized():
             if torch.distributed.get_rank() == (torch.distributed.get_world_size() - 1):
                 print(string, flush=True)
@@ -0,0 +1,264 @@
+"""Offload activations of in-flight microbatches to host memory.
+
+In 1F1B pipeline schedules, the activations of every microbatch which has run its forward but not
+its backward stay on the device. The first stage keeps up to ``pipeline_model_parallel_size`` of
+them. :class:`ActivationOffloadManager` copies them to host memory in the background once their
+forward is over, and copies them back ahead of the matching backward.
+"""
+import collections
+import contextlib
+from typing import Deque, Dict, Iterator, Optional, Sequence, Tuple, Union
+
+import torch
+
+from apex.transformer.log_util import get_transformer_logger
+from apex.transformer.pipeline_parallel.p2p_communication import FutureTensor
+
+
+__all__ = ["ActivationOffloadManager", "stash_activations", "restore_activations"]
+
+
+_logger = get_transformer_logger(__name__)
+
+
+_InputTensors = Union[None, torch.Tensor, FutureTensor, Sequence[Union[None, torch.Tensor, FutureTensor]]]
+
+
+class _OffloadedTensor:
+    """A tensor kept for backward which may live in host memory.
+
+    If ``leaf`` is given, its ``.data`` is released on offload and restored on reload instead.
+    """
+
+    __slots__ = ("tensor", "host_tensor", "leaf", "device", "event")
+
+    def __init__(self, tensor: torch.Tensor, leaf: Optional[torch.Tensor] = None) -> None:
+        self.tensor: Optional[torch.Tensor] = tensor
+        self.host_tensor: Optional[torch.Tensor] = None
+        self.leaf = leaf
+        self.device = tensor.device
+        self.event = None
+
+    @property
+    def nbytes(self) -> int:
+        tensor = self.tensor if self.tensor is not None else self.host_tensor
+        return tensor.numel() * tensor.element_size()
+
+
+class _StashedActivations:
+    """The tensors one microbatch keeps for its backward."""
+
+    def __init__(self, input_tensors: Sequence[torch.Tensor]) -> None:
+        self.tensors: Dict[Tuple, _OffloadedTensor] = {
+            ("input", i): _OffloadedTensor(t.detach(), leaf=t) for i, t in enumerate(input_tensors)
+        }
+        self.offloaded = False
+        self.reloading = False
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.nbytes for t in self.tensors.values())
+
+
+class ActivationOffloadManager:
+    """Move the activations of stashed microbatches to host memory and prefetch them for backward.
+
+    Activations are captured with :func:`torch.autograd.graph.saved_tensors_hooks` while the forward
+    of a microbatch runs inside :meth:`stash`. The tensors received from the previous stage are
+    offloaded as well by temporarily swapping their ``.data``, which keeps them usable as the leaves
+    whose ``.grad`` is sent back. Parameters and tensors smaller than ``min_offload_numel`` stay on
+    the device.
+
+    The copies run on a side stream into pinned host buffers when the activations live on a CUDA
+    device, and synchronously otherwise, so that the manager works the same on CPU.
+
+    Args:
+        memory_budget: The number of bytes of stashed activations allowed to stay on the device.
+            Once the budget is exceeded, the most recently stashed microbatch, i.e. the one whose
+            backward comes last, is offloaded. If :obj:`None`, every stashed microbatch is offloaded.
+        prefetch_distance: The number of microbatches after the one about to run backward which
+            are copied back to the device in advance.
+        min_offload_numel: Tensors with fewer elements are never offloaded.
+    """
+
+    def __init__(
+        self,
+        memory_budget: Optional[int] = None,
+        prefetch_distance: int = 1,
+        *,
+        min_offload_numel: int = 1024,
+    ) -> None:
+        if prefetch_distance < 0:
+            raise ValueError(f"`prefetch_distance` must be non-negative but got {prefetch_distance}")
+        self.memory_budget = memory_budget
+        self.prefetch_distance = prefetch_distance
+        self.min_offload_numel = min_offload_numel
+        self._stashed: Deque[_StashedActivations] = collections.deque()
+        self._current: Optional[_StashedActivations] = None
+        self._streams: Dict[torch.device, "torch.cuda.Stream"] = {}
+        self.offloaded_bytes = 0
+        self.reloaded_bytes = 0
+        self.peak_resident_bytes = 0
+
+    @property
+    def resident_bytes(self) -> int:
+        """The number of bytes of stashed activations currently on the device."""
+        return sum(stashed.nbytes for stashed in self._stashed if not stashed.offloaded or stashed.reloading)
+
+    def __len__(self) -> int:
+        return len(self._stashed)
+
+    @contextlib.contextmanager
+    def stash(self, input_tensors: _InputTensors) -> Iterator[None]:
+        """Capture the activations of the forward run in this context as one stashed microbatch.
+
+        The activations are offloaded when the context exits if the memory budget is exceeded.
+
+        Args:
+            input_tensors: The tensors received from the previous stage, which are kept as leaves
+                until the backward of this microbatch.
+        """
+        if self._current is not None:
+            raise RuntimeError("`stash` cannot be nested")
+        if not isinstance(input_tensors, (list, tuple)):
+            input_tensors = [input_tensors]
+        input_tensors = [t.get() if isinstance(t, FutureTensor) else t for t in input_tensors]
+        input_tensors = [t for t in input_tensors if isinstance(t, torch.Tensor)]
+        self._current = _StashedActivations(
+            [t for t in input_tensors if t.numel() >= self.min_offload_numel]
+        )
+        try:
+            with torch.autograd.graph.saved_tensors_hooks(self._pack, self._unpack):
+                yield
+        finally:
+            stashed, self._current = self._current, None
+        self._stashed.append(stashed)
+        if self.memory_budget is None or self.resident_bytes > self.memory_budget:
+            self._offload(stashed)
+        self.peak_resident_bytes = max(self.peak_resident_bytes, self.resident_bytes)
+
+    @contextlib.contextmanager
+    def restore(self) -> Iterator[None]:
+        """Make the activations of the oldest stashed microbatch available for the backward run in this context."""
+        if not self._stashed:
+            raise RuntimeError("There are no stashed activations to restore")
+        for stashed in list(self._stashed)[: self.prefetch_distance + 1]:
+            self._reload(stashed)
+        stashed = self._stashed[0]
+        self._wait(stashed)
+        self.peak_resident_bytes = max(self.peak_resident_bytes, self.resident_bytes)
+        try:
+            yield
+        finally:
+            self._stashed.popleft()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "stashed": len(self._stashed),
+            "resident_bytes": self.resident_bytes,
+            "peak_resident_bytes": self.peak_resident_bytes,
+            "offloaded_bytes": self.offloaded_bytes,
+            "reloaded_bytes": self.reloaded_bytes,
+        }
+
+    def _pack(self, tensor: torch.Tensor) -> Union[torch.Tensor, _OffloadedTensor]:
+        # Parameters, the tensors received from the previous stage, and views of them are not activations.
+        base = tensor if tensor._base is None else tensor._base
+        if (base.is_leaf and base.requires_grad) or tensor.numel() < self.min_offload_numel:
+            return tensor
+        # Autograd often saves the same tensor for several ops, so copy it only once.
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+        saved_tensor = self._current.tensors.get(key)
+        if saved_tensor is None:
+            saved_tensor = self._current.tensors[key] = _OffloadedTensor(tensor.detach())
+        return saved_tensor
+
+    def _unpack(self, packed: Union[torch.Tensor, _OffloadedTensor]) -> torch.Tensor:
+        if isinstance(packed, torch.Tensor):
+            return packed
+        if packed.tensor is None:
+            # The backward of a microbatch ran outside of `restore`.
+            self._reload_tensor(packed)
+        self._wait_tensor(packed)
+        return packed.tensor
+
+    def _stream(self, device: torch.device):
+        if device.type != "cuda":
+            return None
+        if device not in self._streams:
+            self._streams[device] = torch.cuda.Stream(device=device)
+        return self._streams[device]
+
+    def _offload(self, stashed: _StashedActivations) -> None:
+        for saved_tensor in stashed.tensors.values():
+            self._offload_tensor(saved_tensor)
+        stashed.offloaded = True
+        _logger.debug(f"offloaded {stashed.nbytes} bytes")
+
+    def _offload_tensor(self, saved_tensor: _OffloadedTensor) -> None:
+        tensor = saved_tensor.tensor
+        stream = self._stream(tensor.device)
+        saved_tensor.host_tensor = torch.empty(
+            tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=stream is not None
+        )
+        if stream is None:
+            saved_tensor.host_tensor.copy_(tensor)
+        else:
+            stream.wait_stream(torch.cuda.current_stream(tensor.device))
+            with torch.cuda.stream(stream):
+                saved_tensor.host_tensor.copy_(tensor, non_blocking=True)
+            # Keep the device memory from being reused until the copy is over.
+            tensor.record_stream(stream)
+        saved_tensor.tensor = None
+        if saved_tensor.leaf is not None:
+            saved_tensor.leaf.data = torch.empty((0,), dtype=tensor.dtype, device=tensor.device)
+        self.offloaded_bytes += saved_tensor.nbytes
+
+    def _reload(self, stashed: _StashedActivations) -> None:
+        if not stashed.offloaded or stashed.reloading:
+            return
+        for saved_tensor in stashed.tensors.values():
+            self._reload_tensor(saved_tensor)
+        stashed.reloading = True
+
+    def _reload_tensor(self, saved_tensor: _OffloadedTensor) -> None:
+        stream = self._stream(saved_tensor.device)
+        if stream is None:
+            saved_tensor.tensor = saved_tensor.host_tensor.to(saved_tensor.device, copy=True)
+        else:
+            with torch.cuda.stream(stream):
+                saved_tensor.tensor = saved_tensor.host_tensor.to(saved_tensor.device, non_blocking=True)
+                saved_tensor.event = torch.cuda.Event()
+                saved_tensor.event.record(stream)
+        self.reloaded_bytes += saved_tensor.nbytes
+
+    def _wait(self, stashed: _StashedActivations) -> None:
+        for saved_tensor in stashed.tensors.values():
+            self._wait_tensor(saved_tensor)
+
+    def _wait_tensor(self, saved_tensor: _OffloadedTensor) -> None:
+        if saved_tensor.event is not None:
+            current_stream = torch.cuda.current_stream(saved_tensor.device)
+            current_stream.wait_event(saved_tensor.event)
+            # The tensor was allocated on the side stream but is consumed on the current one.
+            saved_tensor.tensor.record_stream(current_stream)
+            saved_tensor.event = None
+        if saved_tensor.leaf is not None and saved_tensor.tensor is not None:
+            saved_tensor.leaf.data = saved_tensor.tensor
+
+
+def stash_activations(
+    manager: Optional[ActivationOffloadManager],
+    input_tensors: _InputTensors,
+):
+    """Return :meth:`ActivationOffloadManager.stash` of ``manager``, or a no-op context if it is :obj:`None`."""
+    if manager is None:
+        return contextlib.nullcontext()
+    return manager.stash(input_tensors)
+
+
+def restore_activations(manager: Optional[ActivationOffloadManager]):
+    """Return :meth:`ActivationOffloadManager.restore` of ``manager``, or a no-op context if it is :obj:`None`."""
+    if manager is None:
+        return contextlib.nullcontext()
+    return manager.restore()
@@ -14,9 +14,11 @@
 # limitations under the License.
 # TODO(mkozuki): Consider removing `timers`.
 
+import collections
 from functools import reduce
 import operator
-from typing import Union, Optional, Tuple
+from typing import Dict, List, Union, Optional, Tuple
+import weakref
 
 import torch
 
@@ -31,6 +33,132 @@ from apex.transformer.pipeline_parallel._timers import _Timers
 _logger = get_transformer_logger(__name__)
 
 
+def _get_p2p_device() -> torch.device:
+    """Return the device of the tensors exchanged between pipeline stages.
+
+    The gloo backend exchanges CPU tensors, the other backends tensors on the current CUDA device.
+    """
+    if torch.distributed.get_backend(parallel_state.get_pipeline_model_parallel_group()) == "gloo":
+        return torch.device("cpu")
+    return torch.device("cuda", torch.cuda.current_device())
+
+
+def _synchronize(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+_BufferKey = Tuple[Tuple[int, ...], torch.dtype, str, torch.device]
+
+
+class P2PBufferPool:
+    """Pool of the receive buffers of :func:`_communicate`.
+
+    Receive buffers are keyed by ``(shape, dtype, direction, device)`` where direction is either
+    ``"prev"`` or ``"next"``. A buffer handed out by :meth:`acquire` goes back to the pool only when
+    :meth:`release` is called with it, i.e., once the schedule has consumed the received tensor.
+    Buffers which are never released are simply garbage collected, so the pool is safe to use with
+    schedules that do not release anything.
+
+    Since the key includes the shape, dynamic sequence lengths are handled by caching one set of
+    buffers per shape. At most ``max_cached_buffers`` idle buffers are kept and the buffers of the
+    least recently used shape are evicted first.
+
+    Args:
+        max_cached_buffers: The maximum number of idle buffers kept in the pool.
+    """
+
+    def __init__(self, max_cached_buffers: int = 64) -> None:
+        self.max_cached_buffers = max_cached_buffers
+        self.hits = 0
+        self.misses = 0
+        self._num_cached = 0
+        self._cached: "collections.OrderedDict[_BufferKey, List[torch.Tensor]]" = collections.OrderedDict()
+        self._in_use: Dict[int, Tuple[weakref.ref, _BufferKey]] = {}
+
+    def acquire(
+        self,
+        shape: Shape,
+        dtype: torch.dtype,
+        direction: str,
+        device: torch.device,
+        requires_grad: bool,
+    ) -> torch.Tensor:
+        """Return an uninitialized tensor to receive into, reusing an idle buffer if possible."""
+        key = (tuple(shape), dtype, direction, device)
+        buffers = self._cached.get(key)
+        if buffers:
+            self.hits += 1
+            tensor = buffers.pop()
+            self._num_cached -= 1
+            if not buffers:
+                del self._cached[key]
+        else:
+            self.misses += 1
+            tensor = torch.empty(shape, dtype=dtype, device=device)
+        tensor.requires_grad_(requires_grad)
+        tensor_id = id(tensor)
+        self._in_use[tensor_id] = (weakref.ref(tensor, lambda _: self._in_use.pop(tensor_id, None)), key)
+        return tensor
+
+    def release(self, tensor: Optional[torch.Tensor]) -> None:
+        """Give a tensor returned by :meth:`acquire` back to the pool. Other tensors are ignored."""
+        if tensor is None:
+            return
+        entry = self._in_use.pop(id(tensor), None)
+        if entry is None or entry[0]() is not tensor:
+            return
+        key = entry[1]
+        # `backward_step` accumulates the gradient of the received tensor into `.grad`.
+        tensor.grad = None
+        self._cached.setdefault(key, []).append(tensor)
+        self._cached.move_to_end(key)
+        self._num_cached += 1
+        while self._num_cached > self.max_cached_buffers:
+            oldest_key, oldest_buffers = next(iter(self._cached.items()))
+            oldest_buffers.pop(0)
+            self._num_cached -= 1
+            if not oldest_buffers:
+                del self._cached[oldest_key]
+
+    def clear(self) -> None:
+        """Drop all idle buffers and reset the counters."""
+        self._cached.clear()
+        self._num_cached = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "cached": self._num_cached,
+            "in_use": len(self._in_use),
+        }
+
+
+_P2P_BUFFER_POOL = P2PBufferPool()
+
+
+def get_p2p_buffer_pool() -> P2PBufferPool:
+    """Return the pool of receive buffers shared by all the p2p communication functions."""
+    return _P2P_BUFFER_POOL
+
+
+def release_recv_buffers(*tensors) -> None:
+    """Return received tensors to the receive buffer pool once they have been consumed.
+
+    Accepts tensors, :class:`FutureTensor`, ``None``, and lists thereof as returned by the receive functions.
+    """
+    for tensor in tensors:
+        if isinstance(tensor, (list, tuple)):
+            release_recv_buffers(*tensor)
+        elif isinstance(tensor, FutureTensor):
+            _P2P_BUFFER_POOL.release(tensor.tensor)
+        else:
+            _P2P_BUFFER_POOL.release(tensor)
+
+
 class FutureTensor:
     def __init__(self, tensor: torch.Tensor, waitfunc):
         self.tensor = tensor
@@ -92,7 +220,7 @@ def _run_p2pops(
         ops.append(recv_next_op)
     if len(ops) > 0:
         if need_to_sync:
-            torch.cuda.synchronize()
+            _synchronize(ops[0].tensor.device)
 
         reqs = torch.distributed.batch_isend_irecv(ops)
         if async_comm:
@@ -116,6 +244,53 @@ def _run_p2pops(
     return (None, None, None, None)
 
 
+def _communicate_shapes(
+    tensor_send_next: Optional[torch.Tensor],
+    tensor_send_prev: Optional[torch.Tensor],
+    recv_prev: bool,
+    recv_next: bool,
+    ndim: int,
+) -> Tuple[Optional[List[int]], Optional[List[int]]]:
+    """Exchange the shapes of the tensors communicated with the adjacent stages.
+
+    The shape headers of both directions are batched into a single ``batch_isend_irecv`` call which
+    completes before the payload is communicated, so that receive buffers can be allocated with the
+    exact shape of the tensor sent by the peer.
+
+    Args:
+        tensor_send_next: tensor to send to next rank (no shape sent if set to None).
+        tensor_send_prev: tensor to send to prev rank (no shape sent if set to None).
+        recv_prev: boolean for whether a shape should be received from previous rank.
+        recv_next: boolean for whether a shape should be received from next rank.
+        ndim: the number of dimensions of the communicated tensors.
+
+    Returns:
+        tuple containing
+
+        - recv_prev_shape: the shape of the tensor sent by previous rank if `recv_prev` is :obj:`True`, `None` otherwise.
+        - recv_next_shape: the shape of the tensor sent by next rank if `recv_next` is :obj:`True`, `None` otherwise.
+    """
+    device = _get_p2p_device()
+
+    def shape_header(tensor: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+        if tensor is None:
+            return None
+        if tensor.dim() != ndim:
+            raise RuntimeError(f"Expected a {ndim}-D tensor to send but got a tensor of shape {tuple(tensor.shape)}")
+        return torch.tensor(tensor.shape, dtype=torch.int64, device=device)
+
+    send_prev_shape = shape_header(tensor_send_prev)
+    send_next_shape = shape_header(tensor_send_next)
+    recv_prev_shape = torch.empty(ndim, dtype=torch.int64, device=device) if recv_prev else None
+    recv_next_shape = torch.empty(ndim, dtype=torch.int64, device=device) if recv_next else None
+    _run_p2pops(send_prev_shape, send_next_shape, recv_prev_shape, recv_next_shape)
+    _synchronize(device)
+    return (
+        None if recv_prev_shape is None else recv_prev_shape.tolist(),
+        None if recv_next_shape is None else recv_next_shape.tolist(),
+    )
+
+
 # TODO(mkozuki): Check if it's possible to sunset `override_scatter_gather_tensors_in_pipeline`.
 # TODO(mkozuki): Think about if it's possible to push some logic and arguments e.g.
 # `scatter_gather_tensors_in_pipeline`, `sequence_parallel_enabled`, and
@@ -135,6 +310,7 @@ def _communicate(
     fp32_residual_connection: bool = False,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
 ) -> Tuple[Union[torch.Tensor, FutureTensor, None], Union[torch.Tensor, FutureTensor, None]]:
     """Base function for communication of tensors between stages.
 
@@ -166,6 +342,10 @@ def _communicate(
         sequence_parallel_enabled: Set to :obj:`True` if sequence parallel is enabled.
             This argument is here for consistency with Megatron-LM.
             This argument has an effect on the communication optimization, not on tensor_shape update.
+        variable_seq_lengths: Set to :obj:`True` if the shapes of the communicated tensors vary across
+            microbatches, e.g. with dynamic sequence lengths. If :obj:`True`, the shapes of the tensors
+            are exchanged before the tensors themselves and ``tensor_shape`` only determines the number
+            of dimensions.
 
     Returns:
         tuple containing
@@ -203,7 +383,7 @@ def _communicate(
     # Currently, indiscriminately this is set to `False`, which can lead to an unexpected performance regression
     # for non sequence parallel case.
     scatter_gather_tensors_in_pipeline = False
-    if scatter_gather_tensors_in_pipeline and not sequence_parallel_enabled:
+    if scatter_gather_tensors_in_pipeline and not sequence_parallel_enabled and not variable_seq_lengths:
         tensor_chunk_size = int(reduce(operator.mul, tensor_shape, 1))
         if tensor_chunk_size % tensor_parallel_size == 0:
             tensor_chunk_shape = [tensor_chunk_size // tensor_parallel_size]
@@ -227,19 +407,28 @@ def _communicate(
         # fails.
         # requires_grad = False
 
+    recv_prev_shape = recv_next_shape = tensor_chunk_shape
+    if variable_seq_lengths:
+        recv_prev_shape, recv_next_shape = _communicate_shapes(
+            tensor_send_next, tensor_send_prev, recv_prev, recv_next, len(tensor_shape)
+        )
+
+    device = _get_p2p_device()
     if recv_prev:
-        tensor_recv_prev = torch.empty(
-            tensor_chunk_shape,
-            requires_grad=requires_grad,
-            device=torch.cuda.current_device(),
-            dtype=dtype,
+        tensor_recv_prev = _P2P_BUFFER_POOL.acquire(
+            recv_prev_shape,
+            dtype,
+            "prev",
+            device,
+            requires_grad,
         )
     if recv_next:
-        tensor_recv_next = torch.empty(
-            tensor_chunk_shape,
-            requires_grad=requires_grad,
-            device=torch.cuda.current_device(),
-            dtype=dtype,
+        tensor_recv_next = _P2P_BUFFER_POOL.acquire(
+            recv_next_shape,
+            dtype,
+            "next",
+            device,
+            requires_grad,
         )
 
     # Split tensor into smaller chunks if using scatter-gather optimization.
@@ -247,6 +436,7 @@ def _communicate(
         not override_scatter_gather_tensors_in_pipeline_
         and scatter_gather_tensors_in_pipeline
         and not sequence_parallel_enabled
+        and not variable_seq_lengths
     )
     if scatter_gather_optimization_doable:
         if tensor_send_next is not None:
@@ -261,57 +451,75 @@ def _communicate(
     if async_comm:
         tensor_recv_prev_waitfunc = None
         tensor_recv_next_waitfunc = None
+        # The send requests are waited for along with the receives: gloo drops a send whose request is destroyed
+        # before it completes, and there is nothing else holding them.
+        send_reqs = [req for req in (tensor_send_prev_req, tensor_send_next_req) if req is not None]
+        if tensor_recv_prev_req is None and tensor_recv_next_req is None:
+            for req in send_reqs:
+                req.wait()
         # TODO: investigate whether this is necessary for correctness (ref: https://github.com/pytorch/pytorch/issues/38642)
         # see also: sync added for async_comm callbacks below in gather_recv_prev_wait and gather_recv_next_wait
         if tensor_recv_prev_req is not None:
             def tensor_recv_prev_wait():
                 tensor_recv_prev_req.wait()
-                torch.cuda.synchronize()
+                for req in send_reqs:
+                    req.wait()
+                _synchronize(device)
             tensor_recv_prev_waitfunc = tensor_recv_prev_wait
         if tensor_recv_next_req is not None:
             def tensor_recv_next_wait():
                 tensor_recv_next_req.wait()
-                torch.cuda.synchronize()
+                for req in send_reqs:
+                    req.wait()
+                _synchronize(device)
             tensor_recv_next_waitfunc = tensor_recv_next_wait
     else:
         # To protect against race condition when using batch_isend_irecv().
-        torch.cuda.synchronize()
+        _synchronize(device)
 
     # If using scatter-gather optimization, gather smaller chunks.
     if scatter_gather_optimization_doable:
         if not async_comm:
             if recv_prev:
+                tensor_recv_prev_chunk = tensor_recv_prev
                 tensor_recv_prev = (
-                    gather_split_1d_tensor(tensor_recv_prev)
+                    gather_split_1d_tensor(tensor_recv_prev_chunk)
                     .view(tensor_shape)
                     .requires_grad_()
                 )
+                _P2P_BUFFER_POOL.release(tensor_recv_prev_chunk)
 
             if recv_next:
+                tensor_recv_next_chunk = tensor_recv_next
                 tensor_recv_next = (
-                    gather_split_1d_tensor(tensor_recv_next)
+                    gather_split_1d_tensor(tensor_recv_next_chunk)
                     .view(tensor_shape)
                     .requires_grad_()
                 )
+                _P2P_BUFFER_POOL.release(tensor_recv_next_chunk)
         else:
             def gather_recv_prev_wait():
                 tensor_recv_prev_req.wait()
                 # From @Deepak's PR https://github.com/NVIDIA/Megatron-LM/commit/27fc468964064eeb33b703c9a0b2af938d80dd14
                 # A sync seems to be needed before gather otherwise losses jump around e.g., in run_gpt_minimal_test
-                torch.cuda.synchronize()
-                return (
+                _synchronize(device)
+                gathered = (
                     gather_split_1d_tensor(tensor_recv_prev)
                     .view(tensor_shape)
                     .requires_grad_()
                 )
+                _P2P_BUFFER_POOL.release(tensor_recv_prev)
+                return gathered
             def gather_recv_next_wait():
                 tensor_recv_next_req.wait()
-                torch.cuda.synchronize()
-                return (
+                _synchronize(device)
+                gathered = (
                     gather_split_1d_tensor(tensor_recv_next)
                     .view(tensor_shape)
                     .requires_grad_()
                 )
+                _P2P_BUFFER_POOL.release(tensor_recv_next)
+                return gathered
             tensor_recv_prev_waitfunc = gather_recv_prev_wait
             tensor_recv_next_waitfunc = gather_recv_next_wait
     if async_comm:
@@ -332,6 +540,7 @@ def recv_forward(
     dtype: Optional[torch.dtype] = None,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
     timers: _Timers = None,
 ) -> Union[torch.Tensor, FutureTensor, None]:
     """Receive tensor from previous rank in pipeline (forward receive)."""
@@ -349,6 +558,7 @@ def recv_forward(
         dtype_=dtype,
         async_comm=async_comm,
         sequence_parallel_enabled=sequence_parallel_enabled,
+        variable_seq_lengths=variable_seq_lengths,
     )
     # if timers is not None:
     #     timers("forward-recv").stop()
@@ -361,6 +571,7 @@ def recv_backward(
     dtype: Optional[torch.dtype] = None,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
     timers: _Timers = None,
 ) -> Union[torch.Tensor, FutureTensor, None]:
     """Receive tensor from next rank in pipeline (backward receive)."""
@@ -377,6 +588,7 @@ def recv_backward(
         dtype_=dtype,
         async_comm=async_comm,
         sequence_parallel_enabled=sequence_parallel_enabled,
+        variable_seq_lengths=variable_seq_lengths,
     )
     # if timers is not None:
     #     timers("backward-recv").stop()
@@ -391,6 +603,7 @@ def send_forward(
     dtype: Optional[torch.dtype] = None,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
     timers: _Timers = None,
 ) -> None:
     """Send tensor to next rank in pipeline (forward send)."""
@@ -408,6 +621,7 @@ def send_forward(
         dtype_=dtype,
         async_comm=async_comm,
         sequence_parallel_enabled=sequence_parallel_enabled,
+        variable_seq_lengths=variable_seq_lengths,
     )
     # if timers is not None:
     #     timers("forward-send").stop()
@@ -420,6 +634,7 @@ def send_backward(
     dtype: Optional[torch.dtype] = None,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
     timers: _Timers = None,
 ) -> None:
     """Send tensor to previous rank in pipeline (backward send)."""
@@ -436,6 +651,7 @@ def send_backward(
         dtype_=dtype,
         async_comm=async_comm,
         sequence_parallel_enabled=sequence_parallel_enabled,
+        variable_seq_lengths=variable_seq_lengths,
     )
     # if timers is not None:
     #     timers("backward-send").stop()
@@ -448,6 +664,7 @@ def send_forward_recv_backward(
     dtype: Optional[torch.dtype] = None,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
     timers: _Timers = None,
 ) -> Union[torch.Tensor, FutureTensor, None]:
     """Batched send and recv with next rank in pipeline."""
@@ -464,6 +681,7 @@ def send_forward_recv_backward(
         dtype_=dtype,
         async_comm=async_comm,
         sequence_parallel_enabled=sequence_parallel_enabled,
+        variable_seq_lengths=variable_seq_lengths,
     )
     # if timers is not None:
     #     timers("forward-send-backward-recv").stop()
@@ -477,6 +695,7 @@ def send_backward_recv_forward(
     dtype: Optional[torch.dtype] = None,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
     timers: _Timers = None,
 ) -> Union[torch.Tensor, FutureTensor, None]:
     """Batched send and recv with previous rank in pipeline."""
@@ -493,6 +712,7 @@ def send_backward_recv_forward(
         dtype_=dtype,
         async_comm=async_comm,
         sequence_parallel_enabled=sequence_parallel_enabled,
+        variable_seq_lengths=variable_seq_lengths,
     )
     # if timers is not None:
     #     timers("backward-send-forward-recv").stop()
@@ -507,6 +727,7 @@ def send_forward_recv_forward(
     dtype: Optional[torch.dtype] = None,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
     timers: _Timers = None,
 ) -> Union[torch.Tensor, FutureTensor]:
     """Batched recv from previous rank and send to next rank in pipeline."""
@@ -521,6 +742,7 @@ def send_forward_recv_forward(
         dtype_=dtype,
         async_comm=async_comm,
         sequence_parallel_enabled=sequence_parallel_enabled,
+        variable_seq_lengths=variable_seq_lengths,
     )
     # if timers is not None:
     #     timers("forward-send-forward-recv").stop()
@@ -535,6 +757,7 @@ def send_backward_recv_backward(
     dtype: Optional[torch.dtype] = None,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
     timers: _Timers = None,
 ) -> Union[torch.Tensor, FutureTensor]:
     """Batched recv from next rank and send to previous rank in pipeline."""
@@ -549,6 +772,7 @@ def send_backward_recv_backward(
         dtype_=dtype,
         async_comm=async_comm,
         sequence_parallel_enabled=sequence_parallel_enabled,
+        variable_seq_lengths=variable_seq_lengths,
     )
     # if timers is not None:
     #     timers("backward-send-backward-recv").stop()
@@ -565,6 +789,7 @@ def send_forward_backward_recv_forward_backward(
     dtype: Optional[torch.dtype] = None,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
     timers: _Timers = None,
 ) -> Tuple[Union[torch.Tensor, FutureTensor], Union[torch.Tensor, FutureTensor]]:
     """Batched send and recv with previous and next ranks in pipeline."""
@@ -579,6 +804,7 @@ def send_forward_backward_recv_forward_backward(
         dtype_=dtype,
         async_comm=async_comm,
         sequence_parallel_enabled=sequence_parallel_enabled,
+        variable_seq_lengths=variable_seq_lengths,
     )
     # if timers is not None:
     #     timers("forward-backward-send-forward-backward-recv").stop()
@@ -9,6 +9,9 @@ from apex.transformer.pipeline_parallel.schedules.fwd_bwd_pipelining_with_interl
 from apex.transformer.pipeline_parallel.schedules.fwd_bwd_pipelining_without_interleaving import (
     forward_backward_pipelining_without_interleaving,
 )
+from apex.transformer.pipeline_parallel.schedules.fwd_bwd_pipelining_with_split_backward import (
+    forward_backward_pipelining_with_split_backward,
+)
 
 __all__ = [
     "get_forward_backward_func",
@@ -20,10 +23,15 @@ class ExperimentalWarning(Warning):
 
 
 def get_forward_backward_func(
-    virtual_pipeline_model_parallel_size, pipeline_model_parallel_size,
+    virtual_pipeline_model_parallel_size, pipeline_model_parallel_size, *, split_backward=False,
 ):
     if parallel_state.get_pipeline_model_parallel_world_size() > 1:
-        if virtual_pipeline_model_parallel_size is not None:
+        if split_backward:
+            if virtual_pipeline_model_parallel_size is not None:
+                msg = "split backward schedule does not support virtual pipeline model parallel"
+                raise RuntimeError(msg)
+            forward_backward_func = forward_backward_pipelining_with_split_backward
+        elif virtual_pipeline_model_parallel_size is not None:
             if get_num_microbatches() % pipeline_model_parallel_size != 0:
                 msg = "number of microbatches is not divisible by pipeline-parallel size when using interleaved schedule"
                 raise RuntimeError(msg)
@@ -7,7 +7,7 @@ from apex.normalization.fused_layer_norm import FusedLayerNorm
 from apex.transformer import parallel_state
 from apex.transformer.enums import ModelType
 from apex.transformer.pipeline_parallel.p2p_communication import FutureTensor
-from apex.transformer.pipeline_parallel.utils import get_num_microbatches
+from apex.transformer.pipeline_parallel.utils import get_microbatch_loss_divisor
 from apex.transformer.pipeline_parallel.utils import listify_model
 from apex.transformer.pipeline_parallel.utils import unwrap_model
 from apex.transformer.pipeline_parallel.utils import get_model_type
@@ -213,7 +213,7 @@ def free_output_tensor(
     if isinstance(output_tensors, torch.Tensor):
         output_tensors = [output_tensors]
     for output_tensor in output_tensors:
-        output_tensor.data = torch.cuda.FloatTensor([0])
+        output_tensor.data = torch.empty((1,), device=output_tensor.device, dtype=output_tensor.dtype)
 
 
 def custom_backward(output: torch.Tensor, grad_output: Optional[torch.Tensor]) -> None:
@@ -300,7 +300,8 @@ def forward_step(
         if parallel_state.is_pipeline_last_stage():
             output_tensor = loss_func(output_tensor)
             loss, loss_reduced = output_tensor
-            output_tensor = loss / get_num_microbatches()
+            # `losses_reduced` has one entry per microbatch already run, i.e. its length is the index of this one.
+            output_tensor = loss / get_microbatch_loss_divisor(len(losses_reduced))
             losses_reduced.append(loss_reduced)
     # timers("forward-compute").stop()
 
@@ -36,6 +36,7 @@ def _forward_backward_pipelining_with_interleaving(
     deallocate_pipeline_outputs: bool = False,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
     **kwargs,
 ) -> List[Union[torch.Tensor, Sequence[torch.Tensor]]]:
     """Run interleaved 1F1B schedule with communication between pipeline stages as needed.
@@ -70,6 +71,10 @@ def _forward_backward_pipelining_with_interleaving(
         sequence_parallel_enabled: Set to :obj:`True` for this function to handle sequence length.
             When :obj:`True`, the sequence length on each tensor model parallel rank is updated
             to :math:`original\_sequence\_length / tensor\_model\_parallel\_world\_size`.
+        variable_seq_lengths: Set to :obj:`True` if the sequence length varies across microbatches,
+            or their number of samples, as with the microbatch calculator built with ``max_tokens_per_microbatch``.
+            When :obj:`True`, the shapes of activations and gradients are exchanged between stages
+            before the tensors themselves, so microbatches do not need to be padded to ``tensor_shape``.
 
     Returns:
         a list of loss `torch.Tensor`s if the last stage, empty list otherwise.
@@ -180,7 +185,7 @@ def _forward_backward_pipelining_with_interleaving(
 
         # if forward-only, no need to save tensors for a backward pass
         if forward_only:
-            input_tensors[model_chunk_id].pop()
+            p2p_communication.release_recv_buffers(input_tensors[model_chunk_id].pop())
             output_tensors[model_chunk_id].pop()
 
         return output_tensor
@@ -208,6 +213,7 @@ def _forward_backward_pipelining_with_interleaving(
             grad_scaler=grad_scaler,
             deallocate_pipeline_outputs=deallocate_pipeline_outputs,
         )
+        p2p_communication.release_recv_buffers(input_tensor, output_tensor_grad)
 
         return input_tensor_grad
 
@@ -221,6 +227,7 @@ def _forward_backward_pipelining_with_interleaving(
             dtype=dtype,
             async_comm=async_comm,
             sequence_parallel_enabled=sequence_parallel_enabled,
+            variable_seq_lengths=variable_seq_lengths,
         )
     )
     _logger.info("Warmup phase")
@@ -269,6 +276,7 @@ def _forward_backward_pipelining_with_interleaving(
                 dtype=dtype,
                 async_comm=async_comm,
                 sequence_parallel_enabled=sequence_parallel_enabled,
+                variable_seq_lengths=variable_seq_lengths,
             )
             output_tensor_grads[num_model_chunks - 1].append(output_tensor_grad)
         else:
@@ -280,6 +288,7 @@ def _forward_backward_pipelining_with_interleaving(
                 dtype=dtype,
                 async_comm=async_comm,
                 sequence_parallel_enabled=sequence_parallel_enabled,
+                variable_seq_lengths=variable_seq_lengths,
             )
         input_tensors[next_forward_model_chunk_id].append(input_tensor)
         free_output_tensor(output_tensor, deallocate_pipeline_outputs)
@@ -365,6 +374,7 @@ def _forward_backward_pipelining_with_interleaving(
             dtype=dtype,
             async_comm=async_comm,
             sequence_parallel_enabled=sequence_parallel_enabled,
+            variable_seq_lengths=variable_seq_lengths,
         )
         free_output_tensor(output_tensor, deallocate_pipeline_outputs)
 
@@ -387,6 +397,7 @@ def _forward_backward_pipelining_with_interleaving(
                     dtype=dtype,
                     async_comm=async_comm,
                     sequence_parallel_enabled=sequence_parallel_enabled,
+                    variable_seq_lengths=variable_seq_lengths,
                 )
             )
         for k in range(num_microbatches_remaining, num_microbatches):
@@ -409,6 +420,7 @@ def _forward_backward_pipelining_with_interleaving(
                     dtype=dtype,
                     async_comm=async_comm,
                     sequence_parallel_enabled=sequence_parallel_enabled,
+                    variable_seq_lengths=variable_seq_lengths,
                 )
             )
 
@@ -0,0 +1,344 @@
+from typing import Union, List, Optional, Sequence
+import warnings
+
+import torch
+
+from apex.transformer import parallel_state
+from apex.transformer.pipeline_parallel import p2p_communication
+from apex.transformer.pipeline_parallel.p2p_communication import FutureTensor
+from apex.transformer.pipeline_parallel.utils import get_kth_microbatch
+from apex.transformer.pipeline_parallel.utils import listify_model
+from apex.transformer.pipeline_parallel.utils import get_num_microbatches
+from apex.transformer.pipeline_parallel.utils import get_model_type
+from apex.transformer.pipeline_parallel.schedules.common import Batch
+from apex.transformer.pipeline_parallel.schedules.common import FwdStepFunc
+from apex.transformer.pipeline_parallel.schedules.common import backward_step
+from apex.transformer.pipeline_parallel.schedules.common import forward_step
+from apex.transformer.pipeline_parallel.schedules.common import free_output_tensor
+from apex.transformer.pipeline_parallel.schedules.fwd_bwd_pipelining_without_interleaving import (
+    get_tensor_shapes,
+    recv_forward,
+    recv_backward,
+    send_forward,
+    send_backward,
+    send_forward_recv_backward,
+    send_backward_recv_forward,
+)
+from apex.transformer.tensor_parallel.layers import WeightGradStore
+from apex.transformer.log_util import get_transformer_logger
+
+
+__all__ = ["forward_backward_pipelining_with_split_backward"]
+
+
+_logger = get_transformer_logger(__name__)
+
+
+def forward_backward_pipelining_with_split_backward(
+    forward_step_func: FwdStepFunc,
+    batch: Optional[Batch],
+    model: Union[torch.nn.Module, List[torch.nn.Module]],
+    *,
+    forward_only: bool,
+    tensor_shape: Optional[Union[List[int], torch.Size]] = None,
+    decoder_sequence_length: Optional[int] = None,
+    dtype: Optional[torch.dtype] = None,
+    grad_scaler: Optional[torch.cuda.amp.GradScaler] = None,
+    disable_autocast: bool = False,
+    deallocate_pipeline_outputs: bool = False,
+    async_comm: bool = False,
+    sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
+    **kwargs,
+) -> List[Union[torch.Tensor, Sequence[torch.Tensor]]]:
+    """Run non-interleaved 1F1B schedule with the backward pass split into input and weight gradients.
+
+    This schedule follows :func:`forward_backward_pipelining_without_interleaving` but runs each
+    ``backward_step`` inside :meth:`WeightGradStore.defer`, so that the tensor parallel linear layers
+    only compute the gradient with respect to their input. That gradient is sent to the previous stage
+    right away and the queued weight gradient GEMMs run afterwards, while this stage would otherwise wait
+    for the next tensor to arrive. In the steady phase, the exchange with the previous stage is therefore
+    always issued asynchronously and only waited for by the next forward step. This takes the weight
+    gradients off the critical path of the cooldown phase, which shrinks the pipeline bubble from
+    ``(p - 1) * (F + B + W)`` to ``(p - 1) * (F + B)`` without keeping more activations alive than 1F1B.
+
+    Only the weights of :class:`ColumnParallelLinear` and :class:`RowParallelLinear` are deferred.
+    The deferred gradients are accumulated into ``main_grad`` or ``grad`` directly, so gradient
+    reductions driven by autograd hooks would miss them. A ``model`` wrapped in
+    :class:`torch.nn.parallel.DistributedDataParallel` is rejected; reduce the gradients after this
+    function instead.
+
+    Args:
+        forward_step_func: A function which takes a minibatch and model as its arguments and
+            returns model's forward output and the loss function.
+            The loss function is supposed to take one `torch.Tensor` and
+            return a `torch.Tensor` of loss and a dictionary of `str` and `torch.Tensor`.
+        batch: A minibatch, i.e., a list of `torch.Tensor`'s.
+        model: A `torch.nn.Module` or a list of `torch.nn.Module`.
+
+    Keyword args:
+        forward_only:
+        tensor_shape: Shape of tensor. The tensor is expected to be 3D and its order of dimension
+            is supposed to be ``(sequence, batch, hidden)``.
+        dtype: dtype used in p2p communication. If ``None`` (default value),
+            torch.float32 will be used even if ``autocast`` is enabled.
+        grad_scaler:
+        disable_autocast:
+        deallocate_pipeline_outputs: If :obj:`True`, free the data of the output tensor of
+            each pipeline stage. Experimental.
+        sequence_parallel_enabled: Set to :obj:`True` for this function to handle sequence length.
+            When :obj:`True`, the sequence length on each tensor model parallel rank is updated
+            to :math:`original\_sequence\_length / tensor\_model\_parallel\_world\_size`.
+        variable_seq_lengths: Set to :obj:`True` if the sequence length varies across microbatches,
+            or their number of samples, as with the microbatch calculator built with ``max_tokens_per_microbatch``.
+            When :obj:`True`, the shapes of activations and gradients are exchanged between stages
+            before the tensors themselves, so microbatches do not need to be padded to ``tensor_shape``.
+
+    Returns:
+        a list of loss `torch.Tensor`s if the last stage, empty list otherwise.
+    """
+    if deallocate_pipeline_outputs:
+        warnings.warn(
+            "`deallocate_pipeline_outputs` is experimental and subject to change. "
+            "This option is not recommended."
+        )
+
+    model: List[torch.nn.Module] = listify_model(model)
+    if len(model) != 1:
+        msg = f"`model` is expected be a `nn.Module`, but {type(model)}"
+        raise RuntimeError(msg)
+    model: torch.nn.Module = model[0]
+    if not forward_only and isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        msg = (
+            "`forward_backward_pipelining_with_split_backward` defers weight gradients past the autograd hooks of "
+            "`DistributedDataParallel`, which would reduce stale gradients. Pass the unwrapped module and "
+            "reduce the gradients after the schedule."
+        )
+        raise RuntimeError(msg)
+
+    # Compute number of warmup microbatches.
+    num_microbatches: int = get_num_microbatches()
+    num_warmup_microbatches: int = (
+        parallel_state.get_pipeline_model_parallel_world_size() - parallel_state.get_pipeline_model_parallel_rank() - 1
+    )
+    num_warmup_microbatches: int = min(num_warmup_microbatches, num_microbatches)
+    num_microbatches_remaining: int = num_microbatches - num_warmup_microbatches
+
+    model_type = get_model_type(model)
+    rank: int = parallel_state.get_pipeline_model_parallel_rank()
+    recv_tensor_shapes: List[List[int]] = get_tensor_shapes(
+        rank - 1,
+        model_type,
+        tensor_shape=tensor_shape,
+        decoder_sequence_length=decoder_sequence_length,
+        sequence_parallel_enabled=sequence_parallel_enabled,
+    )
+    send_tensor_shapes: List[List[int]] = get_tensor_shapes(
+        rank,
+        model_type,
+        tensor_shape=tensor_shape,
+        decoder_sequence_length=decoder_sequence_length,
+        sequence_parallel_enabled=sequence_parallel_enabled,
+    )
+
+    _logger.info(
+        f"num_microbatches: {num_microbatches}, "
+        f"num_warmup_microbatches: {num_warmup_microbatches}, "
+        f"num_microbatches_remaining: {num_microbatches_remaining}"
+    )
+
+    def input_grad_step(input_tensor, output_tensor, output_tensor_grad):
+        with WeightGradStore.defer():
+            return backward_step(
+                input_tensor,
+                output_tensor,
+                output_tensor_grad,
+                model_type=model_type,
+                grad_scaler=grad_scaler,
+                deallocate_pipeline_outputs=deallocate_pipeline_outputs,
+            )
+
+    # Input, output tensors only need to be saved when doing backward passes
+    input_tensors: List[Union[None, torch.Tensor]] = []
+    output_tensors: List[Union[None, torch.Tensor]] = []
+    losses_reduced: List[Union[None, torch.Tensor]] = []
+    ###################################################################################################################
+    # Run warmup forward passes.
+    ###################################################################################################################
+    _logger.info("Warmup")
+    for i in range(num_warmup_microbatches):
+        _logger.debug(f"warmup iter: {i} / {num_warmup_microbatches}")
+        _logger.debug("receive fwd")
+        input_tensor = recv_forward(
+            tensor_shapes=recv_tensor_shapes,
+            dtype=dtype,
+            async_comm=async_comm,
+            sequence_parallel_enabled=sequence_parallel_enabled,
+            variable_seq_lengths=variable_seq_lengths,
+        )
+        cur_microbatch: Optional[torch.Tensor] = get_kth_microbatch(batch, i)
+        output_tensor = forward_step(
+            forward_step_func,
+            cur_microbatch,
+            model,
+            input_tensor,
+            losses_reduced,
+            dtype,
+            disable_autocast,
+        )
+        _logger.debug("send fwd")
+        send_forward(
+            output_tensor,
+            tensor_shapes=send_tensor_shapes,
+            dtype=dtype,
+            async_comm=async_comm,
+            sequence_parallel_enabled=sequence_parallel_enabled,
+            variable_seq_lengths=variable_seq_lengths,
+        )
+
+        if not forward_only:
+            input_tensors.append(input_tensor)
+            output_tensors.append(output_tensor)
+            free_output_tensor(output_tensor, deallocate_pipeline_outputs)
+        else:
+            p2p_communication.release_recv_buffers(input_tensor)
+
+    # Before running 1F1B, need to receive first forward tensor.
+    # If all microbatches are run in warmup / cooldown phase, then no need to
+    # receive this tensor here.
+    if num_microbatches_remaining > 0:
+        _logger.debug("recv_forward before steady state start")
+        input_tensor: List[Union[None, torch.Tensor, FutureTensor]] = recv_forward(
+            tensor_shapes=recv_tensor_shapes,
+            dtype=dtype,
+            async_comm=async_comm,
+            variable_seq_lengths=variable_seq_lengths,
+        )
+
+    ###################################################################################################################
+    # Run 1F1B in steady state.
+    ###################################################################################################################
+    _logger.info("Steady phase")
+    for i in range(num_microbatches_remaining):
+        _logger.debug(f"steady iter: {i} / {num_microbatches_remaining}")
+        last_iteration: bool = i == (num_microbatches_remaining - 1)
+
+        cur_microbatch: Optional[torch.Tensor] = get_kth_microbatch(batch, i + num_warmup_microbatches)
+        output_tensor: Union[torch.Tensor, Sequence[torch.Tensor]] = forward_step(
+            forward_step_func,
+            cur_microbatch,
+            model,
+            input_tensor,
+            losses_reduced,
+            dtype,
+            disable_autocast,
+        )
+        if forward_only:
+            _logger.debug("send fwd")
+            send_forward(
+                output_tensor,
+                tensor_shapes=send_tensor_shapes,
+                dtype=dtype,
+                async_comm=async_comm,
+                sequence_parallel_enabled=sequence_parallel_enabled,
+                variable_seq_lengths=variable_seq_lengths,
+            )
+            p2p_communication.release_recv_buffers(input_tensor)
+
+            if not last_iteration:
+                _logger.debug("receive fwd (last iteration)")
+                input_tensor = recv_forward(
+                    tensor_shapes=recv_tensor_shapes,
+                    dtype=dtype,
+                    async_comm=async_comm,
+                    sequence_parallel_enabled=sequence_parallel_enabled,
+                    variable_seq_lengths=variable_seq_lengths,
+                )
+
+        else:
+            _logger.debug("send fwd & receive bwd")
+            output_tensor_grad = send_forward_recv_backward(
+                output_tensor,
+                tensor_shapes=send_tensor_shapes,
+                dtype=dtype,
+                async_comm=async_comm,
+                sequence_parallel_enabled=sequence_parallel_enabled,
+                variable_seq_lengths=variable_seq_lengths,
+            )
+
+            # Add input_tensor and output_tensor to end of list.
+            input_tensors.append(input_tensor)
+            output_tensors.append(output_tensor)
+            free_output_tensor(output_tensor, deallocate_pipeline_outputs)
+
+            # Pop input_tensor and output_tensor from the start of the list for the backward pass.
+            input_tensor = input_tensors.pop(0)
+            output_tensor = output_tensors.pop(0)
+
+            input_tensor_grad = input_grad_step(input_tensor, output_tensor, output_tensor_grad)
+            # The deferred weight gradient may still read the received tensors.
+            consumed_tensors = (input_tensor, output_tensor_grad)
+
+            if last_iteration:
+                input_tensor = None
+                _logger.debug("send bwd")
+                send_backward(
+                    input_tensor_grad,
+                    tensor_shapes=recv_tensor_shapes,
+                    dtype=dtype,
+                    async_comm=async_comm,
+                    sequence_parallel_enabled=sequence_parallel_enabled,
+                    variable_seq_lengths=variable_seq_lengths,
+                )
+            else:
+                # Issue the exchange without waiting for it, the weight gradient below fills the wait
+                # and the next forward step waits for the received tensor.
+                _logger.debug("send bwd and receive fwd")
+                input_tensor = send_backward_recv_forward(
+                    input_tensor_grad,
+                    tensor_shapes=recv_tensor_shapes,
+                    dtype=dtype,
+                    async_comm=True,
+                    sequence_parallel_enabled=sequence_parallel_enabled,
+                    variable_seq_lengths=variable_seq_lengths,
+                )
+            _logger.debug("weight grad")
+            WeightGradStore.pop()
+            p2p_communication.release_recv_buffers(consumed_tensors)
+    ###################################################################################################################
+    # Run cooldown backward passes.
+    ###################################################################################################################
+    _logger.info("Cooldown phase")
+    if not forward_only:
+        for i in range(num_warmup_microbatches):
+            _logger.debug(f"cooldown iter: {i} / {num_warmup_microbatches}")
+            input_tensor = input_tensors.pop(0)
+            output_tensor = output_tensors.pop(0)
+
+            _logger.debug("receive bwd")
+            output_tensor_grad = recv_backward(
+                tensor_shapes=send_tensor_shapes,
+                dtype=dtype,
+                async_comm=async_comm,
+                sequence_parallel_enabled=sequence_parallel_enabled,
+                variable_seq_lengths=variable_seq_lengths,
+            )
+
+            input_tensor_grad = input_grad_step(input_tensor, output_tensor, output_tensor_grad)
+
+            _logger.debug("send bwd")
+            send_backward(
+                input_tensor_grad,
+                tensor_shapes=recv_tensor_shapes,
+                dtype=dtype,
+                async_comm=async_comm,
+                sequence_parallel_enabled=sequence_parallel_enabled,
+                variable_seq_lengths=variable_seq_lengths,
+            )
+            # Fill the wait for the gradient of the next microbatch with this one's weight gradient.
+            _logger.debug("weight grad")
+            WeightGradStore.pop()
+            p2p_communication.release_recv_buffers(input_tensor, output_tensor_grad)
+
+    WeightGradStore.pop_all()
+    return losses_reduced
@@ -6,6 +6,9 @@ import torch
 from apex.transformer import parallel_state
 from apex.transformer.enums import ModelType
 from apex.transformer.pipeline_parallel import p2p_communication
+from apex.transformer.pipeline_parallel.activation_offload import ActivationOffloadManager
+from apex.transformer.pipeline_parallel.activation_offload import restore_activations
+from apex.transformer.pipeline_parallel.activation_offload import stash_activations
 from apex.transformer.pipeline_parallel.p2p_communication import FutureTensor
 from apex.transformer.pipeline_parallel.utils import get_kth_microbatch
 from apex.transformer.pipeline_parallel.utils import listify_model
@@ -89,6 +92,7 @@ def recv_forward(
     dtype: Optional[torch.dtype] = None,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
 ) -> List[Union[None, torch.Tensor, FutureTensor]]:
     input_tensors = []
     for tensor_shape in tensor_shapes:
@@ -101,6 +105,7 @@ def recv_forward(
                     dtype=dtype,
                     async_comm=async_comm,
                     sequence_parallel_enabled=sequence_parallel_enabled,
+                    variable_seq_lengths=variable_seq_lengths,
                 )
             )
     return input_tensors
@@ -112,6 +117,7 @@ def recv_backward(
     dtype: Optional[torch.dtype] = None,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
 ) -> List[Union[None, torch.Tensor, FutureTensor]]:
     output_tensor_grads = []
     for tensor_shape in tensor_shapes:
@@ -124,6 +130,7 @@ def recv_backward(
                     dtype=dtype,
                     async_comm=async_comm,
                     sequence_parallel_enabled=sequence_parallel_enabled,
+                    variable_seq_lengths=variable_seq_lengths,
                 )
             )
     return output_tensor_grads
@@ -136,6 +143,7 @@ def send_forward(
     dtype: Optional[torch.dtype] = None,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
 ) -> None:
     if not isinstance(output_tensors, list):
         output_tensors = [output_tensors]
@@ -148,6 +156,7 @@ def send_forward(
             dtype=dtype,
             async_comm=async_comm,
             sequence_parallel_enabled=sequence_parallel_enabled,
+            variable_seq_lengths=variable_seq_lengths,
         )
 
 
@@ -158,6 +167,7 @@ def send_backward(
     dtype: Optional[torch.dtype] = None,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
 ) -> None:
     if not isinstance(input_tensor_grads, list):
         input_tensor_grads = [input_tensor_grads]
@@ -170,6 +180,7 @@ def send_backward(
             dtype=dtype,
             async_comm=async_comm,
             sequence_parallel_enabled=sequence_parallel_enabled,
+            variable_seq_lengths=variable_seq_lengths,
         )
 
 
@@ -180,6 +191,7 @@ def send_forward_recv_backward(
     dtype: Optional[torch.dtype] = None,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
 ) -> List[Union[None, torch.Tensor, FutureTensor]]:
     if not isinstance(output_tensors, list):
         output_tensors = [output_tensors]
@@ -194,6 +206,7 @@ def send_forward_recv_backward(
             dtype=dtype,
             async_comm=async_comm,
             sequence_parallel_enabled=sequence_parallel_enabled,
+            variable_seq_lengths=variable_seq_lengths,
         )
         output_tensor_grads.append(output_tensor_grad)
     return output_tensor_grads
@@ -206,6 +219,7 @@ def send_backward_recv_forward(
     dtype: Optional[torch.dtype] = None,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
 ) -> List[Union[None, torch.Tensor, FutureTensor]]:
     if not isinstance(input_tensor_grads, list):
         input_tensor_grads = [input_tensor_grads]
@@ -220,6 +234,7 @@ def send_backward_recv_forward(
             dtype=dtype,
             async_comm=async_comm,
             sequence_parallel_enabled=sequence_parallel_enabled,
+            variable_seq_lengths=variable_seq_lengths,
         )
         input_tensors.append(input_tensor)
     return input_tensors
@@ -239,6 +254,8 @@ def forward_backward_pipelining_without_interleaving(
     deallocate_pipeline_outputs: bool = False,
     async_comm: bool = False,
     sequence_parallel_enabled: bool = False,
+    variable_seq_lengths: bool = False,
+    activation_offload_manager: Optional[ActivationOffloadManager] = None,
     **kwargs,
 ) -> List[Union[torch.Tensor, Sequence[torch.Tensor]]]:
     """Run non-interleaved 1F1B schedule, with communication between pipeline stages.
@@ -269,6 +286,12 @@ def forward_backward_pipelining_without_interleaving(
         sequence_parallel_enabled: Set to :obj:`True` for this function to handle sequence length.
             When :obj:`True`, the sequence length on each tensor model parallel rank is updated
             to :math:`original\_sequence\_length / tensor\_model\_parallel\_world\_size`.
+        variable_seq_lengths: Set to :obj:`True` if the sequence length varies across microbatches,
+            or their number of samples, as with the microbatch calculator built with ``max_tokens_per_microbatch``.
+            When :obj:`True`, the shapes of activations and gradients are exchanged between stages
+            before the tensors themselves, so microbatches do not need to be padded to ``tensor_shape``.
+        activation_offload_manager: If given, the activations of the microbatches waiting for their
+            backward are offloaded to host memory and prefetched back by this manager.
 
     Returns:
         a list of loss `torch.Tensor`s if the last stage, empty list otherwise.
@@ -334,17 +357,19 @@ def forward_backward_pipelining_without_interleaving(
             dtype=dtype,
             async_comm=async_comm,
             sequence_parallel_enabled=sequence_parallel_enabled,
+            variable_seq_lengths=variable_seq_lengths,
         )
         cur_microbatch: Optional[torch.Tensor] = get_kth_microbatch(batch, i)
-        output_tensor = forward_step(
-            forward_step_func,
-            cur_microbatch,
-            model,
-            input_tensor,
-            losses_reduced,
-            dtype,
-            disable_autocast,
-        )
+        with stash_activations(None if forward_only else activation_offload_manager, input_tensor):
+            output_tensor = forward_step(
+                forward_step_func,
+                cur_microbatch,
+                model,
+                input_tensor,
+                losses_reduced,
+                dtype,
+                disable_autocast,
+            )
         _logger.debug("send fwd")
         send_forward(
             output_tensor,
@@ -352,19 +377,27 @@ def forward_backward_pipelining_without_interleaving(
             dtype=dtype,
             async_comm=async_comm,
             sequence_parallel_enabled=sequence_parallel_enabled,
+            variable_seq_lengths=variable_seq_lengths,
         )
 
         if not forward_only:
             input_tensors.append(input_tensor)
             output_tensors.append(output_tensor)
             free_output_tensor(output_tensor, deallocate_pipeline_outputs)
+        else:
+            p2p_communication.release_recv_buffers(input_tensor)
 
     # Before running 1F1B, need to receive first forward tensor.
     # If all microbatches are run in warmup / cooldown phase, then no need to
     # receive this tensor here.
     if num_microbatches_remaining > 0:
         _logger.debug("recv_forward before steady state start")
-        input_tensor: List[Union[None, torch.Tensor, FutureTensor]] = recv_forward(tensor_shapes=recv_tensor_shapes, dtype=dtype, async_comm=async_comm)
+        input_tensor: List[Union[None, torch.Tensor, FutureTensor]] = recv_forward(
+            tensor_shapes=recv_tensor_shapes,
+            dtype=dtype,
+            async_comm=async_comm,
+            variable_seq_lengths=variable_seq_lengths,
+        )
 
     ###################################################################################################################
     # Run 1F1B in steady state.
@@ -375,15 +408,16 @@ def forward_backward_pipelining_without_interleaving(
         last_iteration: bool = i == (num_microbatches_remaining - 1)
 
         cur_microbatch: Optional[torch.Tensor] = get_kth_microbatch(batch, i + num_warmup_microbatches)
-        output_tensor: Union[torch.Tensor, Sequence[torch.Tensor]] = forward_step(
-            forward_step_func,
-            cur_microbatch,
-            model,
-            input_tensor,
-            losses_reduced,
-            dtype,
-            disable_autocast,
-        )
+        with stash_activations(None if forward_only else activation_offload_manager, input_tensor):
+            output_tensor: Union[torch.Tensor, Sequence[torch.Tensor]] = forward_step(
+                forward_step_func,
+                cur_microbatch,
+                model,
+                input_tensor,
+                losses_reduced,
+                dtype,
+                disable_autocast,
+            )
         if forward_only:
             _logger.debug("send fwd")
             send_forward(
@@ -392,7 +426,9 @@ def forward_backward_pipelining_without_interleaving(
                 dtype=dtype,
                 async_comm=async_comm,
                 sequence_parallel_enabled=sequence_parallel_enabled,
+                variable_seq_lengths=variable_seq_lengths,
             )
+            p2p_communication.release_recv_buffers(input_tensor)
 
             if not last_iteration:
                 _logger.debug("receive fwd (last iteration)")
@@ -401,6 +437,7 @@ def forward_backward_pipelining_without_interleaving(
                     dtype=dtype,
                     async_comm=async_comm,
                     sequence_parallel_enabled=sequence_parallel_enabled,
+                    variable_seq_lengths=variable_seq_lengths,
                 )
 
         else:
@@ -411,6 +448,7 @@ def forward_backward_pipelining_without_interleaving(
                 dtype=dtype,
                 async_comm=async_comm,
                 sequence_parallel_enabled=sequence_parallel_enabled,
+                variable_seq_lengths=variable_seq_lengths,
             )
 
             # Add input_tensor and output_tensor to end of list.
@@ -422,14 +460,16 @@ def forward_backward_pipelining_without_interleaving(
             input_tensor = input_tensors.pop(0)
             output_tensor = output_tensors.pop(0)
 
-            input_tensor_grad = backward_step(
-                input_tensor,
-                output_tensor,
-                output_tensor_grad,
-                model_type=model_type,
-                grad_scaler=grad_scaler,
-                deallocate_pipeline_outputs=deallocate_pipeline_outputs,
-            )
+            with restore_activations(activation_offload_manager):
+                input_tensor_grad = backward_step(
+                    input_tensor,
+                    output_tensor,
+                    output_tensor_grad,
+                    model_type=model_type,
+                    grad_scaler=grad_scaler,
+                    deallocate_pipeline_outputs=deallocate_pipeline_outputs,
+                )
+            p2p_communication.release_recv_buffers(input_tensor, output_tensor_grad)
 
             if last_iteration:
                 input_tensor = None
@@ -440,6 +480,7 @@ def forward_backward_pipelining_without_interleaving(
                     dtype=dtype,
                     async_comm=async_comm,
                     sequence_parallel_enabled=sequence_parallel_enabled,
+                    variable_seq_lengths=variable_seq_lengths,
                 )
             else:
                 _logger.debug("send bwd and receive fwd")
@@ -449,6 +490,7 @@ def forward_backward_pipelining_without_interleaving(
                     dtype=dtype,
                     async_comm=async_comm,
                     sequence_parallel_enabled=sequence_parallel_enabled,
+                    variable_seq_lengths=variable_seq_lengths,
                 )
     ###################################################################################################################
     # Run cooldown backward passes.
@@ -466,16 +508,19 @@ def forward_backward_pipelining_without_interleaving(
                 dtype=dtype,
                 async_comm=async_comm,
                 sequence_parallel_enabled=sequence_parallel_enabled,
+                variable_seq_lengths=variable_seq_lengths,
             )
 
-            input_tensor_grad = backward_step(
-                input_tensor,
-                output_tensor,
-                output_tensor_grad,
-                model_type=model_type,
-                grad_scaler=grad_scaler,
-                deallocate_pipeline_outputs=deallocate_pipeline_outputs,
-            )
+            with restore_activations(activation_offload_manager):
+                input_tensor_grad = backward_step(
+                    input_tensor,
+                    output_tensor,
+                    output_tensor_grad,
+                    model_type=model_type,
+                    grad_scaler=grad_scaler,
+                    deallocate_pipeline_outputs=deallocate_pipeline_outputs,
+                )
+            p2p_communication.release_recv_buffers(input_tensor, output_tensor_grad)
 
             _logger.debug("send bwd")
             send_backward(
@@ -484,6 +529,7 @@ def forward_backward_pipelining_without_interleaving(
                 dtype=dtype,
                 async_comm=async_comm,
                 sequence_parallel_enabled=sequence_parallel_enabled,
+                variable_seq_lengths=variable_seq_lengths,
             )
 
     return losses_reduced
@@ -0,0 +1,547 @@
+"""Offline discrete-event simulator of the pipeline parallel schedules.
+
+This module replays the warmup, 1F1B and cooldown logic of
+:func:`forward_backward_no_pipelining`, :func:`forward_backward_pipelining_without_interleaving`
+and :func:`_forward_backward_pipelining_with_interleaving` without running any model or
+communication, so that pipeline / virtual pipeline sizes and microbatch counts can be sized
+on a machine without GPUs.
+
+Each pipeline rank is turned into the exact sequence of ``forward_step``, ``backward_step`` and
+``p2p_communication`` calls the corresponding schedule would issue. Compute ops take the given
+per-stage cost. Communication ops behave like the blocking ``batch_isend_irecv`` of
+``_communicate``: every send is matched with the receive the peer posts for it, a transfer
+starts once both sides have posted it and takes ``p2p_latency + tensor_bytes / p2p_bandwidth``,
+and the op finishes when all of its transfers have finished.
+
+All times are in milliseconds.
+"""
+import argparse
+import json
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+
+__all__ = [
+    "ScheduleEvent",
+    "ScheduleSimulationResult",
+    "simulate_pipeline_schedule",
+]
+
+
+Cost = Union[float, Sequence[float]]
+
+
+@dataclass
+class ScheduleEvent:
+    """One op on the timeline of a pipeline rank."""
+
+    rank: int
+    name: str
+    category: str
+    start: float
+    end: float
+    microbatch: Optional[int] = None
+    model_chunk: Optional[int] = None
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+@dataclass
+class ScheduleSimulationResult:
+    """Outcome of :func:`simulate_pipeline_schedule`.
+
+    Attributes:
+        schedule: Name of the schedule function :func:`get_forward_backward_func` would pick.
+        makespan: Time until the last rank finishes.
+        bubble_fraction: Fraction of the ``pipeline_model_parallel_size * makespan`` device time
+            not spent in ``forward_step`` / ``backward_step``.
+        rank_bubble_fractions: The same fraction per pipeline rank.
+        peak_activations_in_flight: Per pipeline rank, the maximum number of (microbatch, model chunk)
+            forward outputs kept alive for their backward pass at the same time.
+        timelines: Per pipeline rank, the compute and communication events in issue order.
+    """
+
+    schedule: str
+    pipeline_model_parallel_size: int
+    virtual_pipeline_model_parallel_size: Optional[int]
+    num_microbatches: int
+    makespan: float
+    bubble_fraction: float
+    rank_bubble_fractions: List[float]
+    peak_activations_in_flight: List[int]
+    timelines: List[List[ScheduleEvent]] = field(repr=False)
+
+    def to_chrome_trace(self) -> Dict:
+        """Return the timelines in the Chrome trace event format (``chrome://tracing``, Perfetto)."""
+        trace_events = []
+        for rank in range(self.pipeline_model_parallel_size):
+            trace_events.append(
+                {"name": "thread_name", "ph": "M", "pid": 0, "tid": rank, "args": {"name": f"pipeline rank {rank}"}}
+            )
+        for timeline in self.timelines:
+            for event in timeline:
+                args = {}
+                if event.microbatch is not None:
+                    args["microbatch"] = event.microbatch
+                if event.model_chunk is not None:
+                    args["model_chunk"] = event.model_chunk
+                trace_events.append(
+                    {
+                        "name": event.name,
+                        "cat": event.category,
+                        "ph": "X",
+                        "pid": 0,
+                        "tid": event.rank,
+                        # trace timestamps are in microseconds
+                        "ts": event.start * 1e3,
+                        "dur": event.duration * 1e3,
+                        "args": args,
+                    }
+                )
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def save_chrome_trace(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+
+
+@dataclass
+class _Compute:
+    name: str
+    microbatch: int
+    model_chunk: int
+
+
+@dataclass
+class _Communicate:
+    name: str
+    send_peers: List[int]
+    recv_peers: List[int]
+
+
+def _no_pipelining_ops(num_microbatches: int, forward_only: bool) -> List[List[Union[_Compute, _Communicate]]]:
+    ops = []
+    for i in range(num_microbatches):
+        ops.append(_Compute("forward_step", i, 0))
+        if not forward_only:
+            ops.append(_Compute("backward_step", i, 0))
+    return [ops]
+
+
+def _pipelining_without_interleaving_ops(
+    rank: int, pipeline_model_parallel_size: int, num_microbatches: int, forward_only: bool,
+) -> List[Union[_Compute, _Communicate]]:
+    """Mirror of ``forward_backward_pipelining_without_interleaving`` for one pipeline rank."""
+    prev_rank, next_rank = rank - 1, rank + 1
+    is_first_stage = rank == 0
+    is_last_stage = rank == pipeline_model_parallel_size - 1
+
+    def recv_forward():
+        return [] if is_first_stage else [_Communicate("recv_forward", [], [prev_rank])]
+
+    def recv_backward():
+        return [] if is_last_stage else [_Communicate("recv_backward", [], [next_rank])]
+
+    def send_forward():
+        return [] if is_last_stage else [_Communicate("send_forward", [next_rank], [])]
+
+    def send_backward():
+        return [] if is_first_stage else [_Communicate("send_backward", [prev_rank], [])]
+
+    def send_forward_recv_backward():
+        return [] if is_last_stage else [_Communicate("send_forward_recv_backward", [next_rank], [next_rank])]
+
+    def send_backward_recv_forward():
+        return [] if is_first_stage else [_Communicate("send_backward_recv_forward", [prev_rank], [prev_rank])]
+
+    num_warmup_microbatches = min(pipeline_model_parallel_size - rank - 1, num_microbatches)
+    num_microbatches_remaining = num_microbatches - num_warmup_microbatches
+
+    ops = []
+    for i in range(num_warmup_microbatches):
+        ops += recv_forward()
+        ops.append(_Compute("forward_step", i, 0))
+        ops += send_forward()
+
+    if num_microbatches_remaining > 0:
+        ops += recv_forward()
+
+    for i in range(num_microbatches_remaining):
+        last_iteration = i == (num_microbatches_remaining - 1)
+        ops.append(_Compute("forward_step", i + num_warmup_microbatches, 0))
+        if forward_only:
+            ops += send_forward()
+            if not last_iteration:
+                ops += recv_forward()
+        else:
+            ops += send_forward_recv_backward()
+            ops.append(_Compute("backward_step", i, 0))
+            if last_iteration:
+                ops += send_backward()
+            else:
+                ops += send_backward_recv_forward()
+
+    if not forward_only:
+        for i in range(num_warmup_microbatches):
+            ops += recv_backward()
+            ops.append(_Compute("backward_step", num_microbatches_remaining + i, 0))
+            ops += send_backward()
+    return ops
+
+
+def _pipelining_with_interleaving_ops(
+    rank: int,
+    pipeline_model_parallel_size: int,
+    num_model_chunks: int,
+    num_microbatches_per_chunk: int,
+    forward_only: bool,
+) -> List[Union[_Compute, _Communicate]]:
+    """Mirror of ``_forward_backward_pipelining_with_interleaving`` for one pipeline rank."""
+    # p2p ops of the interleaved schedule wrap around: the last rank sends to the first one and vice versa.
+    prev_rank = (rank - 1) % pipeline_model_parallel_size
+    next_rank = (rank + 1) % pipeline_model_parallel_size
+    is_first_rank = rank == 0
+    is_last_rank = rank == pipeline_model_parallel_size - 1
+
+    def is_first_stage(model_chunk_id):
+        return is_first_rank and model_chunk_id == 0
+
+    def is_last_stage(model_chunk_id):
+        return is_last_rank and model_chunk_id == num_model_chunks - 1
+
+    def communicate(name, send_next, send_prev, recv_prev, recv_next):
+        # same op order as `_run_p2pops`
+        send_peers = ([prev_rank] if send_prev else []) + ([next_rank] if send_next else [])
+        recv_peers = ([prev_rank] if recv_prev else []) + ([next_rank] if recv_next else [])
+        if not send_peers and not recv_peers:
+            return []
+        return [_Communicate(name, send_peers, recv_peers)]
+
+    def get_model_chunk_id(microbatch_id, forward):
+        microbatch_id_in_group = microbatch_id % (pipeline_model_parallel_size * num_model_chunks)
+        model_chunk_id = microbatch_id_in_group // pipeline_model_parallel_size
+        if not forward:
+            model_chunk_id = num_model_chunks - model_chunk_id - 1
+        return model_chunk_id
+
+    def get_microbatch_in_chunk(microbatch_id):
+        group, microbatch_id_in_group = divmod(microbatch_id, pipeline_model_parallel_size * num_model_chunks)
+        return group * pipeline_model_parallel_size + microbatch_id_in_group % pipeline_model_parallel_size
+
+    def forward_step(microbatch_id):
+        return _Compute(
+            "forward_step", get_microbatch_in_chunk(microbatch_id), get_model_chunk_id(microbatch_id, forward=True))
+
+    def backward_step(microbatch_id):
+        return _Compute(
+            "backward_step", get_microbatch_in_chunk(microbatch_id), get_model_chunk_id(microbatch_id, forward=False))
+
+    num_microbatches = num_microbatches_per_chunk * num_model_chunks
+    all_warmup_microbatches = False
+    if forward_only:
+        num_warmup_microbatches = num_microbatches
+    elif num_microbatches_per_chunk == pipeline_model_parallel_size:
+        num_warmup_microbatches = num_microbatches
+        all_warmup_microbatches = True
+    else:
+        num_warmup_microbatches = (pipeline_model_parallel_size - rank - 1) * 2
+        num_warmup_microbatches += (num_model_chunks - 1) * pipeline_model_parallel_size
+        num_warmup_microbatches = min(num_warmup_microbatches, num_microbatches)
+    num_microbatches_remaining = num_microbatches - num_warmup_microbatches
+
+    ops = []
+    # virtual pipeline rank 0 is set before the first `recv_forward`
+    if not is_first_stage(0):
+        ops.append(_Communicate("recv_forward", [], [prev_rank]))
+    virtual_rank = 0
+
+    for k in range(num_warmup_microbatches):
+        ops.append(forward_step(k))
+        virtual_rank = get_model_chunk_id(k, forward=True)
+
+        next_forward_model_chunk_id = get_model_chunk_id(k + 1, forward=True)
+        recv_prev = True
+        if is_first_rank and next_forward_model_chunk_id == 0:
+            recv_prev = False
+        if k == (num_microbatches - 1):
+            recv_prev = False
+        send_next = not is_last_stage(virtual_rank)
+
+        if k == (num_warmup_microbatches - 1) and not forward_only and not all_warmup_microbatches:
+            ops += communicate(
+                "send_forward_backward_recv_forward_backward",
+                send_next=send_next, send_prev=False, recv_prev=recv_prev, recv_next=not is_last_rank,
+            )
+        else:
+            ops += communicate(
+                "send_forward_recv_forward", send_next=send_next, send_prev=False, recv_prev=recv_prev, recv_next=False,
+            )
+
+    for k in range(num_microbatches_remaining):
+        forward_k = k + num_warmup_microbatches
+        backward_k = k
+        ops.append(forward_step(forward_k))
+        ops.append(backward_step(backward_k))
+
+        forward_model_chunk_id = get_model_chunk_id(forward_k, forward=True)
+        backward_model_chunk_id = get_model_chunk_id(backward_k, forward=False)
+        virtual_rank = backward_model_chunk_id
+        send_next = not is_last_stage(forward_model_chunk_id)
+        send_prev = not is_first_stage(backward_model_chunk_id)
+
+        recv_prev = True
+        if is_first_rank:
+            # First stage is ahead of last stage by (pipeline_parallel_size - 1).
+            next_forward_model_chunk_id = get_model_chunk_id(
+                forward_k - (pipeline_model_parallel_size - 1), forward=True)
+            if next_forward_model_chunk_id == (num_model_chunks - 1):
+                recv_prev = False
+        recv_next = True
+        if is_last_rank:
+            # Last stage is ahead of first stage by (pipeline_parallel_size - 1).
+            next_backward_model_chunk_id = get_model_chunk_id(
+                backward_k - (pipeline_model_parallel_size - 1), forward=False)
+            if next_backward_model_chunk_id == 0:
+                recv_next = False
+        if k == (num_microbatches_remaining - 1):
+            recv_prev = False
+
+        ops += communicate(
+            "send_forward_backward_recv_forward_backward",
+            send_next=send_next, send_prev=send_prev, recv_prev=recv_prev, recv_next=recv_next,
+        )
+
+    if not forward_only:
+        if all_warmup_microbatches and not is_last_stage(virtual_rank):
+            ops.append(_Communicate("recv_backward", [], [next_rank]))
+        for k in range(num_microbatches_remaining, num_microbatches):
+            ops.append(backward_step(k))
+            # the input of the first stage is not a received tensor, so it has no gradient to send
+            send_prev = not is_first_stage(get_model_chunk_id(k, forward=False))
+            next_backward_model_chunk_id = get_model_chunk_id(k + 1, forward=False)
+            recv_next = True
+            if is_last_rank and next_backward_model_chunk_id == (num_model_chunks - 1):
+                recv_next = False
+            if k == (num_microbatches - 1):
+                recv_next = False
+            ops += communicate(
+                "send_backward_recv_backward", send_next=False, send_prev=send_prev, recv_prev=False, recv_next=recv_next,
+            )
+    return ops
+
+
+def _as_stage_costs(cost: Cost, num_stages: int, name: str) -> List[float]:
+    if isinstance(cost, (int, float)):
+        return [float(cost)] * num_stages
+    cost = [float(c) for c in cost]
+    if len(cost) != num_stages:
+        msg = f"`{name}` must be a number or have one entry per pipeline stage ({num_stages}), but has {len(cost)}"
+        raise ValueError(msg)
+    return cost
+
+
+def simulate_pipeline_schedule(
+    pipeline_model_parallel_size: int,
+    num_microbatches: int,
+    forward_cost: Cost,
+    backward_cost: Cost,
+    *,
+    virtual_pipeline_model_parallel_size: Optional[int] = None,
+    p2p_latency: float = 0.0,
+    p2p_bandwidth: Optional[float] = None,
+    tensor_bytes: int = 0,
+    forward_only: bool = False,
+) -> ScheduleSimulationResult:
+    """Simulate the schedule :func:`get_forward_backward_func` picks for the given parallel sizes.
+
+    Args:
+        pipeline_model_parallel_size: Number of pipeline ranks.
+        num_microbatches: Number of microbatches per global batch, i.e. ``get_num_microbatches()``.
+        forward_cost: Time of one ``forward_step`` of one microbatch. Either a single number or one
+            number per pipeline stage. With a virtual pipeline, stage ``model_chunk_id * pipeline_model_parallel_size + rank``
+            is model chunk ``model_chunk_id`` of pipeline rank ``rank``.
+        backward_cost: Time of one ``backward_step``, in the same layout as ``forward_cost``.
+
+    Keyword args:
+        virtual_pipeline_model_parallel_size: Number of model chunks per pipeline rank of the interleaved schedule.
+        p2p_latency: Latency of one point-to-point transfer.
+        p2p_bandwidth: Point-to-point bandwidth in GB/s. If :obj:`None`, transfers only cost ``p2p_latency``.
+        tensor_bytes: Size of the activation (and gradient) sent between stages, e.g.
+            ``seq_length * micro_batch_size * hidden_size * dtype_size``.
+        forward_only: Simulate the schedule without backward passes.
+
+    Returns:
+        :class:`ScheduleSimulationResult`
+    """
+    if pipeline_model_parallel_size < 1 or num_microbatches < 1:
+        raise ValueError("`pipeline_model_parallel_size` and `num_microbatches` must be positive")
+
+    if pipeline_model_parallel_size > 1:
+        if virtual_pipeline_model_parallel_size is not None:
+            if num_microbatches % pipeline_model_parallel_size != 0:
+                msg = "number of microbatches is not divisible by pipeline-parallel size when using interleaved schedule"
+                raise RuntimeError(msg)
+            schedule = "_forward_backward_pipelining_with_interleaving"
+            num_model_chunks = virtual_pipeline_model_parallel_size
+            ops = [
+                _pipelining_with_interleaving_ops(
+                    rank, pipeline_model_parallel_size, num_model_chunks, num_microbatches, forward_only)
+                for rank in range(pipeline_model_parallel_size)
+            ]
+        else:
+            schedule = "forward_backward_pipelining_without_interleaving"
+            num_model_chunks = 1
+            ops = [
+                _pipelining_without_interleaving_ops(rank, pipeline_model_parallel_size, num_microbatches, forward_only)
+                for rank in range(pipeline_model_parallel_size)
+            ]
+    else:
+        if virtual_pipeline_model_parallel_size not in (None, 1):
+            raise RuntimeError("`forward_backward_no_pipelining` expects a single model chunk")
+        schedule = "forward_backward_no_pipelining"
+        num_model_chunks = 1
+        ops = _no_pipelining_ops(num_microbatches, forward_only)
+
+    num_stages = pipeline_model_parallel_size * num_model_chunks
+    costs = {
+        "forward_step": _as_stage_costs(forward_cost, num_stages, "forward_cost"),
+        "backward_step": _as_stage_costs(backward_cost, num_stages, "backward_cost"),
+    }
+    transfer_time = p2p_latency
+    if p2p_bandwidth is not None:
+        transfer_time += tensor_bytes / (p2p_bandwidth * 1e6)
+
+    timelines = _run(ops, costs, transfer_time)
+
+    makespan = max((timeline[-1].end for timeline in timelines if timeline), default=0.0)
+    rank_bubble_fractions = []
+    peak_activations_in_flight = []
+    for timeline in timelines:
+        busy = sum(event.duration for event in timeline if event.category == "compute")
+        rank_bubble_fractions.append(1.0 - busy / makespan if makespan > 0 else 0.0)
+        in_flight = peak = 0
+        if not forward_only:
+            for event in timeline:
+                if event.name == "forward_step":
+                    in_flight += 1
+                    peak = max(peak, in_flight)
+                elif event.name == "backward_step":
+                    in_flight -= 1
+        peak_activations_in_flight.append(peak)
+
+    return ScheduleSimulationResult(
+        schedule=schedule,
+        pipeline_model_parallel_size=pipeline_model_parallel_size,
+        virtual_pipeline_model_parallel_size=virtual_pipeline_model_parallel_size,
+        num_microbatches=num_microbatches,
+        makespan=makespan,
+        bubble_fraction=sum(rank_bubble_fractions) / len(rank_bubble_fractions),
+        rank_bubble_fractions=rank_bubble_fractions,
+        peak_activations_in_flight=peak_activations_in_flight,
+        timelines=timelines,
+    )
+
+
+def _run(
+    ops: List[List[Union[_Compute, _Communicate]]], costs: Dict[str, List[float]], transfer_time: float,
+) -> List[List[ScheduleEvent]]:
+    num_ranks = len(ops)
+
+    # Match the n-th send from `src` to `dst` with the n-th receive `dst` posts for `src`.
+    sends: Dict[Tuple[int, int], List[int]] = {}
+    recvs: Dict[Tuple[int, int], List[int]] = {}
+    for rank, rank_ops in enumerate(ops):
+        for index, op in enumerate(rank_ops):
+            if isinstance(op, _Communicate):
+                for peer in op.send_peers:
+                    sends.setdefault((rank, peer), []).append(index)
+                for peer in op.recv_peers:
+                    recvs.setdefault((peer, rank), []).append(index)
+    peer_ops: Dict[Tuple[int, int], List[Tuple[int, int]]] = {}
+    for (src, dst) in set(sends) | set(recvs):
+        send_indices, recv_indices = sends.get((src, dst), []), recvs.get((src, dst), [])
+        if len(send_indices) != len(recv_indices):
+            msg = f"{len(send_indices)} sends from rank {src} to rank {dst} but {len(recv_indices)} receives"
+            raise RuntimeError(msg)
+        for send_index, recv_index in zip(send_indices, recv_indices):
+            peer_ops.setdefault((src, send_index), []).append((dst, recv_index))
+            peer_ops.setdefault((dst, recv_index), []).append((src, send_index))
+
+    timelines: List[List[ScheduleEvent]] = [[] for _ in range(num_ranks)]
+    clocks = [0.0] * num_ranks
+    next_op = [0] * num_ranks
+    post_times: Dict[Tuple[int, int], float] = {}
+    while True:
+        progress = False
+        for rank in range(num_ranks):
+            while next_op[rank] < len(ops[rank]):
+                index = next_op[rank]
+                op = ops[rank][index]
+                start = clocks[rank]
+                if isinstance(op, _Compute):
+                    stage = op.model_chunk * num_ranks + rank
+                    end = start + costs[op.name][stage]
+                    timelines[rank].append(
+                        ScheduleEvent(rank, op.name, "compute", start, end, op.microbatch, op.model_chunk))
+                else:
+                    post_times[(rank, index)] = start
+                    peers = peer_ops[(rank, index)]
+                    if any(peer not in post_times for peer in peers):
+                        break
+                    end = max([start] + [max(start, post_times[peer]) + transfer_time for peer in peers])
+                    timelines[rank].append(ScheduleEvent(rank, op.name, "p2p", start, end))
+                clocks[rank] = end
+                next_op[rank] += 1
+                progress = True
+        if all(next_op[rank] == len(ops[rank]) for rank in range(num_ranks)):
+            return timelines
+        if not progress:
+            blocked = {rank: ops[rank][next_op[rank]].name for rank in range(num_ranks) if next_op[rank] < len(ops[rank])}
+            raise RuntimeError(f"schedule deadlocks, blocked ranks: {blocked}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate apex.transformer pipeline schedules without GPUs.")
+    parser.add_argument("--pipeline-model-parallel-size", type=int, nargs="+", required=True)
+    parser.add_argument("--virtual-pipeline-model-parallel-size", type=int, nargs="+", default=[None])
+    parser.add_argument("--num-microbatches", type=int, nargs="+", required=True)
+    parser.add_argument("--forward-cost", type=float, required=True, help="forward time of the whole model per microbatch (ms)")
+    parser.add_argument("--backward-cost", type=float, required=True, help="backward time of the whole model per microbatch (ms)")
+    parser.add_argument("--p2p-latency", type=float, default=0.0, help="ms")
+    parser.add_argument("--p2p-bandwidth", type=float, default=None, help="GB/s")
+    parser.add_argument("--tensor-bytes", type=int, default=0)
+    parser.add_argument("--chrome-trace", type=str, default=None, help="save the trace of the last configuration")
+    args = parser.parse_args()
+
+    result = None
+    print(f"{'pp':>4} {'vpp':>4} {'microbatches':>12} {'makespan (ms)':>14} {'bubble':>8} {'peak activations':>16}")
+    for pipeline_model_parallel_size in args.pipeline_model_parallel_size:
+        for virtual_pipeline_model_parallel_size in args.virtual_pipeline_model_parallel_size:
+            num_stages = pipeline_model_parallel_size * (virtual_pipeline_model_parallel_size or 1)
+            for num_microbatches in args.num_microbatches:
+                try:
+                    result = simulate_pipeline_schedule(
+                        pipeline_model_parallel_size,
+                        num_microbatches,
+                        args.forward_cost / num_stages,
+                        args.backward_cost / num_stages,
+                        virtual_pipeline_model_parallel_size=virtual_pipeline_model_parallel_size,
+                        p2p_latency=args.p2p_latency,
+                        p2p_bandwidth=args.p2p_bandwidth,
+                        tensor_bytes=args.tensor_bytes,
+                    )
+                except RuntimeError as e:
+                    print(f"{pipeline_model_parallel_size:>4} {str(virtual_pipeline_model_parallel_size):>4} {num_microbatches:>12} skipped: {e}")
+                    continue
+                print(
+                    f"{pipeline_model_parallel_size:>4} {str(virtual_pipeline_model_parallel_size):>4} {num_microbatches:>12} "
+                    f"{result.makespan:>14.3f} {result.bubble_fraction:>8.3f} {max(result.peak_activations_in_flight):>16}"
+                )
+    if args.chrome_trace is not None and result is not None:
+        result.save_chrome_trace(args.chrome_trace)
+
+
+if __name__ == "__main__":
+    main()
@@ -61,12 +61,15 @@ def setup_microbatch_calculator(
         global_batch_size: int,
         micro_batch_size: int,
         data_parallel_size: int,
+        *,
+        max_tokens_per_microbatch: Optional[int] = None,
 ) -> None:
     global _GLOBAL_NUM_MICROBATCHES_CALCULATOR
     _ensure_var_is_not_initialized(_GLOBAL_NUM_MICROBATCHES_CALCULATOR, 'num microbatches calculator')
 
     _GLOBAL_NUM_MICROBATCHES_CALCULATOR = build_num_microbatches_calculator(
-        rank, rampup_batch_size, global_batch_size, micro_batch_size, data_parallel_size)
+        rank, rampup_batch_size, global_batch_size, micro_batch_size, data_parallel_size,
+        max_tokens_per_microbatch=max_tokens_per_microbatch)
 
 
 def _reconfigure_microbatch_calculator(
@@ -75,6 +78,8 @@ def _reconfigure_microbatch_calculator(
         global_batch_size: int,
         micro_batch_size: int,
         data_parallel_size: int,
+        *,
+        max_tokens_per_microbatch: Optional[int] = None,
 ) -> None:
     if torch.distributed.get_rank() == 0:
         import warnings
@@ -82,7 +87,8 @@ def _reconfigure_microbatch_calculator(
     global _GLOBAL_NUM_MICROBATCHES_CALCULATOR
 
     _GLOBAL_NUM_MICROBATCHES_CALCULATOR = build_num_microbatches_calculator(
-        rank, rampup_batch_size, global_batch_size, micro_batch_size, data_parallel_size)
+        rank, rampup_batch_size, global_batch_size, micro_batch_size, data_parallel_size,
+        max_tokens_per_microbatch=max_tokens_per_microbatch)
 
 
 def get_micro_batch_size():
@@ -93,12 +99,26 @@ def get_num_microbatches():
     return _GLOBAL_NUM_MICROBATCHES_CALCULATOR.get()
 
 
+def get_microbatch_loss_divisor(k):
+    """Return the number the loss of the `k`th microbatch is divided by before the backward pass."""
+    return _GLOBAL_NUM_MICROBATCHES_CALCULATOR.get_loss_divisor(k)
+
+
 def get_current_global_batch_size():
     return _GLOBAL_NUM_MICROBATCHES_CALCULATOR.get_current_global_batch_size()
 
 
-def update_num_microbatches(consumed_samples, consistency_check=True):
-    _GLOBAL_NUM_MICROBATCHES_CALCULATOR.update(consumed_samples, consistency_check)
+def update_num_microbatches(consumed_samples, consistency_check=True, sequence_lengths=None):
+    """Update the number of microbatches for the next step.
+
+    ``sequence_lengths`` are the sequence lengths of the samples of the local minibatch of the next
+    step, which the calculator built with ``max_tokens_per_microbatch`` packs into microbatches.
+    """
+    if sequence_lengths is None:
+        _GLOBAL_NUM_MICROBATCHES_CALCULATOR.update(consumed_samples, consistency_check)
+    else:
+        _GLOBAL_NUM_MICROBATCHES_CALCULATOR.update(
+            consumed_samples, consistency_check, sequence_lengths=sequence_lengths)
 
 
 # note (mkozuki): Comment out in favor of `get_kth_microbatch`
@@ -124,12 +144,11 @@ def get_kth_microbatch(batch: Optional[List[torch.Tensor]], k: int) -> List[torc
 
     This function creates a list of `k`th microbatches from a list of local minibatches.
     `a local minibatch` consists of `global_batch_size / data_parallel_size` samples.
+    With ``max_tokens_per_microbatch``, microbatches consist of varying numbers of samples.
     """
     if batch is None:
         return batch
-    micro_batch_size = get_micro_batch_size()
-    start = k * micro_batch_size
-    end = start + micro_batch_size
+    start, end = _GLOBAL_NUM_MICROBATCHES_CALCULATOR.get_microbatch_range(k)
     microbatch = list()
     for x in batch:
         size = x.size(0)
@@ -143,11 +162,11 @@ def get_autoresume():
     return _GLOBAL_AUTORESUME
 
 
-def _set_timers():
+def _set_timers(*, use_events: bool = False, enabled: bool = True):
     """Initialize timers."""
     global _GLOBAL_TIMERS
     _ensure_var_is_not_initialized(_GLOBAL_TIMERS, "timers")
-    _GLOBAL_TIMERS = _Timers()
+    _GLOBAL_TIMERS = _Timers(use_events=use_events, enabled=enabled)
 
 
 def get_timers():
@@ -0,0 +1,299 @@
+# coding=utf-8
+# Copyright (c) 2021-22, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Assignment of global ranks to tensor, pipeline, and data parallel groups.
+
+A layout is built in two steps. The parallel order, e.g. ``"tp-dp-pp"``, lists the parallel
+dimensions from the fastest to the slowest varying one and places every (tensor, data, pipeline)
+coordinate at a position. A :class:`RankMapper` then decides which global rank sits at each position.
+:class:`RankMapper` keeps global ranks in order, which is the historical behavior of
+:func:`apex.transformer.parallel_state.initialize_model_parallel`, while
+:class:`TopologyAwareRankMapper` groups the ranks by node so that tensor model parallel groups never
+span two nodes, and picks the order with the fewest cross-node pipeline hops.
+"""
+import collections
+import dataclasses
+import socket
+from typing import Dict, Hashable, List, Mapping, Optional, Sequence, Tuple, Union
+
+import torch
+
+from apex.transformer.log_util import get_transformer_logger
+
+
+__all__ = [
+    "PARALLEL_ORDERS",
+    "RankLayout",
+    "RankMapper",
+    "TopologyAwareRankMapper",
+    "build_rank_layout",
+]
+
+
+_logger = get_transformer_logger(__name__)
+
+
+# The supported orders of the parallel dimensions, from the fastest to the slowest varying one.
+PARALLEL_ORDERS = ("tp-dp-pp", "tp-pp-dp")
+
+
+@dataclasses.dataclass
+class RankLayout:
+    """The global ranks of every model and data parallel group.
+
+    Attributes:
+        order: The order of the parallel dimensions the layout was built with.
+        tensor_model_parallel_groups: The ranks of each tensor model parallel group, in ascending order
+            as :func:`torch.distributed.new_group` numbers them.
+        pipeline_model_parallel_groups: The ranks of each pipeline model parallel group, by stage. With a
+            :class:`RankMapper` that reorders the ranks, they are not necessarily in ascending order.
+        data_parallel_groups: The ranks of each data parallel group, in ascending order.
+        model_parallel_groups: The ranks of each model parallel group, i.e. one model replica.
+    """
+
+    order: str
+    tensor_model_parallel_groups: List[List[int]]
+    pipeline_model_parallel_groups: List[List[int]]
+    data_parallel_groups: List[List[int]]
+    model_parallel_groups: List[List[int]]
+
+    def __str__(self) -> str:
+        lines = [f"rank layout ({self.order}):"]
+        for name, groups in (
+            ("data parallel", self.data_parallel_groups),
+            ("model parallel", self.model_parallel_groups),
+            ("tensor model parallel", self.tensor_model_parallel_groups),
+            ("pipeline model parallel", self.pipeline_model_parallel_groups),
+        ):
+            lines.append(f"  {len(groups)} {name} groups:")
+            lines.extend(f"    {group}" for group in groups)
+        return "\n".join(lines)
+
+
+class RankMapper:
+    """Decide which global rank holds each position of a layout.
+
+    The default implementation keeps global ranks in order and uses ``"tp-dp-pp"`` unless told
+    otherwise. Subclasses override :meth:`map_ranks` and optionally :meth:`select_order`.
+
+    Args:
+        world_size: Optional. The number of ranks, used when no process group is initialized, e.g.
+            to print a layout with ``dry_run``.
+    """
+
+    def __init__(self, world_size: Optional[int] = None) -> None:
+        self.world_size = world_size
+
+    def map_ranks(
+        self,
+        world_size: int,
+        tensor_model_parallel_size: int,
+        pipeline_model_parallel_size: int,
+        order: str,
+    ) -> List[int]:
+        """Return the global rank at each position, i.e. a permutation of ``range(world_size)``."""
+        return list(range(world_size))
+
+    def select_order(
+        self,
+        world_size: int,
+        tensor_model_parallel_size: int,
+        pipeline_model_parallel_size: int,
+    ) -> str:
+        """Return the parallel order to use when none is specified."""
+        return PARALLEL_ORDERS[0]
+
+
+class TopologyAwareRankMapper(RankMapper):
+    """Place the ranks of each node next to each other.
+
+    Positions are filled node by node, in the order in which nodes first appear, so that tensor
+    model parallel groups stay inside a node as long as the number of ranks of every node is a
+    multiple of the tensor model parallel size. When no order is specified, the order with the
+    fewest pipeline hops between two nodes is selected, ties going to ``"tp-dp-pp"``.
+
+    Args:
+        rank_to_node: The node of each global rank, either as a sequence indexed by rank or as a
+            mapping from rank to node. Nodes can be any hashable, e.g. host names.
+    """
+
+    def __init__(self, rank_to_node: Union[Sequence[Hashable], Mapping[int, Hashable]]) -> None:
+        if isinstance(rank_to_node, Mapping):
+            if sorted(rank_to_node) != list(range(len(rank_to_node))):
+                raise ValueError("`rank_to_node` must have exactly one node for each of the ranks 0, 1, ...")
+            rank_to_node = [rank_to_node[rank] for rank in range(len(rank_to_node))]
+        super().__init__(world_size=len(rank_to_node))
+        self.rank_to_node: List[Hashable] = list(rank_to_node)
+
+    @classmethod
+    def from_hostfile(cls, path: str) -> "TopologyAwareRankMapper":
+        """Build the mapper from a hostfile where ranks are assigned to hosts in blocks.
+
+        Each line holds a host name optionally followed by its number of ranks, as in
+        ``node0 slots=8`` or ``node0:8``. A host without a count gets one rank per line it appears
+        on. Anything after ``#`` is ignored.
+        """
+        rank_to_node = []
+        with open(path) as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
+                host, *options = line.split()
+                slots = 1
+                if ":" in host:
+                    host, slots = host.rsplit(":", 1)
+                for option in options:
+                    key, _, value = option.partition("=")
+                    if key in ("slots", "max_slots", "max-slots"):
+                        slots = value
+                        break
+                rank_to_node.extend([host] * int(slots))
+        if not rank_to_node:
+            raise ValueError(f"No host found in {path}")
+        return cls(rank_to_node)
+
+    @classmethod
+    def from_hostnames(cls, group=None) -> "TopologyAwareRankMapper":
+        """Build the mapper from the host name of every rank of the initialized process group."""
+        hostnames = [None] * torch.distributed.get_world_size(group=group)
+        torch.distributed.all_gather_object(hostnames, socket.gethostname(), group=group)
+        return cls(hostnames)
+
+    def _ranks_by_node(self) -> Dict[Hashable, List[int]]:
+        ranks_by_node: Dict[Hashable, List[int]] = collections.OrderedDict()
+        for rank, node in enumerate(self.rank_to_node):
+            ranks_by_node.setdefault(node, []).append(rank)
+        return ranks_by_node
+
+    def map_ranks(
+        self,
+        world_size: int,
+        tensor_model_parallel_size: int,
+        pipeline_model_parallel_size: int,
+        order: str,
+    ) -> List[int]:
+        if world_size != len(self.rank_to_node):
+            raise ValueError(
+                f"`world_size` ({world_size}) does not match the number of ranks of the topology ({len(self.rank_to_node)})"
+            )
+        ranks_by_node = self._ranks_by_node()
+        for node, ranks in ranks_by_node.items():
+            if len(ranks) % tensor_model_parallel_size != 0:
+                raise ValueError(
+                    f"Node {node} has {len(ranks)} ranks, which is not a multiple of "
+                    f"tensor_model_parallel_size ({tensor_model_parallel_size}), so tensor model "
+                    "parallel groups would span several nodes"
+                )
+        return [rank for ranks in ranks_by_node.values() for rank in ranks]
+
+    def select_order(
+        self,
+        world_size: int,
+        tensor_model_parallel_size: int,
+        pipeline_model_parallel_size: int,
+    ) -> str:
+        hops = {
+            order: self.cross_node_pipeline_hops(
+                build_rank_layout(
+                    world_size, tensor_model_parallel_size, pipeline_model_parallel_size, order=order, rank_mapper=self,
+                )
+            )
+            for order in PARALLEL_ORDERS
+        }
+        _logger.debug(f"cross-node pipeline hops by order: {hops}")
+        return min(PARALLEL_ORDERS, key=lambda order: hops[order])
+
+    def cross_node_pipeline_hops(self, layout: RankLayout) -> int:
+        """Count the pairs of consecutive pipeline stages on different nodes in ``layout``."""
+        return sum(
+            self.rank_to_node[prev_rank] != self.rank_to_node[next_rank]
+            for ranks in layout.pipeline_model_parallel_groups
+            for prev_rank, next_rank in zip(ranks[:-1], ranks[1:])
+        )
+
+
+def _position(order: str, coordinates: Mapping[str, int], sizes: Mapping[str, int]) -> int:
+    position, stride = 0, 1
+    for dim in order.split("-"):
+        position += coordinates[dim] * stride
+        stride *= sizes[dim]
+    return position
+
+
+def build_rank_layout(
+    world_size: int,
+    tensor_model_parallel_size: int,
+    pipeline_model_parallel_size: int,
+    *,
+    order: Optional[str] = None,
+    rank_mapper: Optional[RankMapper] = None,
+) -> RankLayout:
+    """Compute the global ranks of every model and data parallel group without creating any group.
+
+    Arguments:
+        world_size: The number of ranks.
+        tensor_model_parallel_size: The number of ranks of a tensor model parallel group.
+        pipeline_model_parallel_size: The number of stages of a pipeline model parallel group.
+    Keyword Arguments:
+        order: The order of the parallel dimensions from the fastest to the slowest varying one,
+            one of :obj:`PARALLEL_ORDERS`. If :obj:`None`, ``rank_mapper`` selects it.
+        rank_mapper: Decides which global rank holds each position. Defaults to :class:`RankMapper`,
+            which keeps global ranks in order.
+    """
+    if world_size % (tensor_model_parallel_size * pipeline_model_parallel_size) != 0:
+        raise RuntimeError(
+            f"`world_size` ({world_size}) is not divisible by tensor_model_parallel_size ({tensor_model_parallel_size}) x pipeline_model_parallel_size ({pipeline_model_parallel_size})"
+        )
+    if rank_mapper is None:
+        rank_mapper = RankMapper()
+    if order is None:
+        order = rank_mapper.select_order(world_size, tensor_model_parallel_size, pipeline_model_parallel_size)
+    if order not in PARALLEL_ORDERS:
+        raise ValueError(f"`order` must be one of {PARALLEL_ORDERS} but got {order}")
+    ranks = rank_mapper.map_ranks(world_size, tensor_model_parallel_size, pipeline_model_parallel_size, order)
+    if sorted(ranks) != list(range(world_size)):
+        raise RuntimeError(f"{type(rank_mapper).__name__} did not return a permutation of the {world_size} ranks")
+
+    sizes = {
+        "tp": tensor_model_parallel_size,
+        "pp": pipeline_model_parallel_size,
+        "dp": world_size // (tensor_model_parallel_size * pipeline_model_parallel_size),
+    }
+
+    def global_rank(tp: int, pp: int, dp: int) -> int:
+        return ranks[_position(order, {"tp": tp, "pp": pp, "dp": dp}, sizes)]
+
+    def groups(vary: str, fixed: Tuple[str, ...], by_coordinate: bool = False) -> List[List[int]]:
+        # One group per combination of the `fixed` coordinates, listed as the existing layout does.
+        # The ranks of a group are sorted unless their position matters, i.e. for the pipeline stages,
+        # since the ranks of a process group are numbered in ascending order.
+        result = []
+        for i in range(sizes[fixed[0]]):
+            for j in range(sizes[fixed[1]]):
+                group = [global_rank(**{fixed[0]: i, fixed[1]: j, vary: k}) for k in range(sizes[vary])]
+                result.append(group if by_coordinate else sorted(group))
+        return result
+
+    model_parallel_groups = [
+        [global_rank(tp, pp, dp) for pp in range(sizes["pp"]) for tp in range(sizes["tp"])]
+        for dp in range(sizes["dp"])
+    ]
+    return RankLayout(
+        order=order,
+        tensor_model_parallel_groups=groups("tp", ("pp", "dp")),
+        pipeline_model_parallel_groups=groups("pp", ("dp", "tp"), by_coordinate=True),
+        data_parallel_groups=groups("dp", ("pp", "tp")),
+        model_parallel_groups=model_parallel_groups,
+    )
@@ -15,6 +15,7 @@
 """Model parallel utility interface."""
 
 from apex.transformer.tensor_parallel.cross_entropy import vocab_parallel_cross_entropy
+from apex.transformer.tensor_parallel.cross_entropy import vocab_parallel_linear_cross_entropy
 
 from apex.transformer.tensor_parallel.data import broadcast_data
 
@@ -22,6 +23,7 @@ from apex.transformer.tensor_parallel.layers import (
     ColumnParallelLinear,
     RowParallelLinear,
     VocabParallelEmbedding,
+    WeightGradStore,
     set_tensor_model_parallel_attributes,
     set_defaults_if_not_set_tensor_model_parallel_attributes,
     copy_tensor_model_parallel_attributes,
@@ -35,6 +37,14 @@ from apex.transformer.tensor_parallel.mappings import (
     scatter_to_sequence_parallel_region,
 )
 
+from apex.transformer.tensor_parallel.recompute import (
+    RecomputeStats,
+    recompute,
+    enable_recompute_stats,
+    get_recompute_stats,
+    reset_recompute_stats,
+)
+
 from .random import (
     checkpoint,
     get_cuda_rng_tracker,
@@ -49,12 +59,14 @@ from apex.transformer.tensor_parallel.utils import split_tensor_along_last_dim
 __all__ = [
     # cross_entropy.py
     "vocab_parallel_cross_entropy",
+    "vocab_parallel_linear_cross_entropy",
     # data.py
     "broadcast_data",
     # layers.py
     "ColumnParallelLinear",
     "RowParallelLinear",
     "VocabParallelEmbedding",
+    "WeightGradStore",
     "set_tensor_model_parallel_attributes",
     "set_defaults_if_not_set_tensor_model_parallel_attributes",
     "copy_tensor_model_parallel_attributes",
@@ -64,6 +76,12 @@ __all__ = [
     "reduce_from_tensor_model_parallel_region",
     "scatter_to_tensor_model_parallel_region",
     "scatter_to_sequence_parallel_region",
+    # recompute.py
+    "RecomputeStats",
+    "recompute",
+    "enable_recompute_stats",
+    "get_recompute_stats",
+    "reset_recompute_stats",
     # random.py
     "checkpoint",
     "get_cuda_rng_tracker",
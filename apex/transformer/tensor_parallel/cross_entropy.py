@@ -12,6 +12,8 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from typing import Optional
+
 import torch
 
 from apex.transformer.parallel_state import get_tensor_model_parallel_group
@@ -98,6 +100,300 @@ class _VocabParallelCrossEntropy(torch.autograd.Function):
         return grad_input, None
 
 
-def vocab_parallel_cross_entropy(vocab_parallel_logits, target):
-    """Helper function for the cross entropy."""
-    return _VocabParallelCrossEntropy.apply(vocab_parallel_logits, target)
+def _gather_token_stats(stats: torch.Tensor) -> torch.Tensor:
+    """All-gather ``stats`` of shape ``[tokens, k]`` into ``[world_size, tokens, k]`` in one collective."""
+    world_size = get_tensor_model_parallel_world_size()
+    if world_size == 1:
+        return stats.unsqueeze(0)
+    gathered = torch.empty((world_size * stats.size(0), stats.size(1)), dtype=stats.dtype, device=stats.device)
+    torch.distributed._all_gather_base(gathered, stats.contiguous(), group=get_tensor_model_parallel_group())
+    return gathered.view((world_size,) + stats.size())
+
+
+class _ChunkedVocabParallelCrossEntropy(torch.autograd.Function):
+    """Vocab parallel cross entropy computed over slices of the tokens.
+
+    :class:`_VocabParallelCrossEntropy` allocates the softmax, a second tensor of the size of the logits,
+    in forward and keeps it for backward. Here, the forward keeps the logits themselves and the log-sum-exp
+    of each token, and the backward recomputes the softmax one chunk of tokens at a time. With
+    ``inplace_backward``, the backward overwrites the logits with their gradient so that no tensor of their
+    size is allocated, unless they are a leaf, e.g. a parameter. For each chunk, every rank computes the max,
+    sum of exponentials, target logit and sum of logits of its partition of the vocabulary, and the
+    four of them are combined after a single all-gather instead of three all-reduces.
+
+    The label smoothing follows :mod:`apex.contrib.xentropy`, i.e.
+    ``loss = (1 - label_smoothing) * (lse - logits[target]) + label_smoothing * (lse - mean(logits))``.
+    """
+
+    @staticmethod
+    def forward(ctx, vocab_parallel_logits, target, label_smoothing, chunk_size, inplace_backward):
+        # Get the partition's vocab indecies
+        get_vocab_range = VocabUtility.vocab_range_from_per_partition_vocab_size
+        partition_vocab_size = vocab_parallel_logits.size()[-1]
+        rank = get_tensor_model_parallel_rank()
+        world_size = get_tensor_model_parallel_world_size()
+        vocab_start_index, vocab_end_index = get_vocab_range(partition_vocab_size, rank, world_size)
+
+        # Create a mask of valid vocab ids (1 means it needs to be masked).
+        target_mask = (target < vocab_start_index) | (target >= vocab_end_index)
+        masked_target = target - vocab_start_index
+        masked_target[target_mask] = 0
+
+        logits_2d = vocab_parallel_logits.reshape(-1, partition_vocab_size)
+        masked_target_1d = masked_target.view(-1)
+        target_mask_1d = target_mask.view(-1)
+        num_tokens = logits_2d.size(0)
+        chunk_size = num_tokens if chunk_size is None else chunk_size
+        log_sum_exp = torch.empty(num_tokens, dtype=torch.float32, device=logits_2d.device)
+        loss = torch.empty(num_tokens, dtype=torch.float32, device=logits_2d.device)
+        for start in range(0, num_tokens, chunk_size):
+            end = min(start + chunk_size, num_tokens)
+            logits_chunk = logits_2d[start:end].float()
+            arange_1d = torch.arange(end - start, device=logits_2d.device)
+            local_max = logits_chunk.max(dim=-1)[0]
+            local_sum_exp = torch.exp(logits_chunk - local_max.unsqueeze(-1)).sum(dim=-1)
+            local_predicted_logits = logits_chunk[arange_1d, masked_target_1d[start:end]]
+            local_predicted_logits.masked_fill_(target_mask_1d[start:end], 0.0)
+            local_sum_logits = logits_chunk.sum(dim=-1)
+            stats = _gather_token_stats(
+                torch.stack([local_max, local_sum_exp, local_predicted_logits, local_sum_logits], dim=-1)
+            )
+            logits_max = stats[..., 0].max(dim=0)[0]
+            sum_exp_logits = (stats[..., 1] * torch.exp(stats[..., 0] - logits_max)).sum(dim=0)
+            predicted_logits = stats[..., 2].sum(dim=0)
+            log_sum_exp[start:end] = torch.log(sum_exp_logits) + logits_max
+            loss[start:end] = log_sum_exp[start:end] - predicted_logits
+            if label_smoothing > 0.0:
+                mean_logits = stats[..., 3].sum(dim=0) / (partition_vocab_size * world_size)
+                smoothing_loss = log_sum_exp[start:end] - mean_logits
+                loss[start:end] = (1.0 - label_smoothing) * loss[start:end] + label_smoothing * smoothing_loss
+
+        ctx.label_smoothing = label_smoothing
+        ctx.chunk_size = chunk_size
+        ctx.vocab_size = partition_vocab_size * world_size
+        ctx.logits_shape = vocab_parallel_logits.size()
+        ctx.inplace_backward = inplace_backward and not vocab_parallel_logits.is_leaf
+        ctx.save_for_backward(logits_2d, log_sum_exp, target_mask_1d, masked_target_1d)
+
+        return loss.view_as(target).to(vocab_parallel_logits.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+
+        # Retreive tensors from the forward path.
+        logits_2d, log_sum_exp, target_mask_1d, masked_target_1d = ctx.saved_tensors
+        grad_output_1d = grad_output.reshape(-1).float()
+        num_tokens = logits_2d.size(0)
+        # With `inplace_backward`, build the gradient in place of the logits, which are not needed once
+        # their chunk is done.
+        grad_2d = logits_2d if ctx.inplace_backward else torch.empty_like(logits_2d)
+        for start in range(0, num_tokens, ctx.chunk_size):
+            end = min(start + ctx.chunk_size, num_tokens)
+            # Recompute the softmax of the chunk, which is the gradient of all the inputs.
+            grad_chunk = torch.exp(logits_2d[start:end].float() - log_sum_exp[start:end].unsqueeze(-1))
+            # Add the gradient from matching classes.
+            arange_1d = torch.arange(end - start, device=grad_2d.device)
+            grad_chunk[arange_1d, masked_target_1d[start:end]] -= (
+                (1.0 - ctx.label_smoothing) * (1.0 - target_mask_1d[start:end].float())
+            )
+            if ctx.label_smoothing > 0.0:
+                grad_chunk.sub_(ctx.label_smoothing / ctx.vocab_size)
+            # Finally elementwise multiplication with the output gradients.
+            grad_chunk.mul_(grad_output_1d[start:end].unsqueeze(dim=-1))
+            grad_2d[start:end] = grad_chunk
+
+        return grad_2d.view(ctx.logits_shape), None, None, None, None
+
+
+def vocab_parallel_cross_entropy(
+    vocab_parallel_logits,
+    target,
+    label_smoothing: float = 0.0,
+    *,
+    chunk_size: Optional[int] = None,
+    inplace_backward: bool = False,
+):
+    """Helper function for the cross entropy.
+
+    Arguments:
+        vocab_parallel_logits: logits split across tensor parallel ranks along the vocab dimension.
+        target: correct vocab ids of dimension ``vocab_parallel_logits.size()[:-1]``.
+        label_smoothing: the smoothing factor, must be in range ``[0.0, 1.0)``.
+        chunk_size: Optional. If given, or if `label_smoothing` is positive, the loss is computed by
+            slices of this many tokens so that, besides the logits, only the log-sum-exp of each token
+            is kept for backward.
+        inplace_backward: If :obj:`True`, the chunked backward overwrites `vocab_parallel_logits` with
+            their gradient unless they are a leaf, instead of allocating it. The logits must then not be
+            used after the backward, e.g. by the backward of the operation which produced them.
+    """
+    if not 0.0 <= label_smoothing < 1.0:
+        raise ValueError(f"`label_smoothing` must be in [0.0, 1.0) but got {label_smoothing}")
+    if chunk_size is not None and chunk_size <= 0:
+        raise ValueError(f"`chunk_size` must be positive but got {chunk_size}")
+    if chunk_size is None and label_smoothing == 0.0:
+        return _VocabParallelCrossEntropy.apply(vocab_parallel_logits, target)
+    return _ChunkedVocabParallelCrossEntropy.apply(
+        vocab_parallel_logits, target, label_smoothing, chunk_size, inplace_backward
+    )
+
+
+class _VocabParallelLinearCrossEntropy(torch.autograd.Function):
+    """Output projection to the vocab parallel logits fused with :class:`_ChunkedVocabParallelCrossEntropy`.
+
+    The logits are computed one tile of ``chunk_size`` tokens by ``vocab_chunk_size`` vocab entries at a
+    time, and reduced right away into the per-token statistics of the cross entropy with an online
+    log-sum-exp, so that neither the logits nor their gradient are ever materialized. The backward
+    recomputes each tile of logits to accumulate the gradients of the input, weight, and bias.
+    """
+
+    @staticmethod
+    def forward(ctx, input, weight, bias, target, label_smoothing, chunk_size, vocab_chunk_size):
+        # Get the partition's vocab indecies
+        get_vocab_range = VocabUtility.vocab_range_from_per_partition_vocab_size
+        partition_vocab_size = weight.size(0)
+        rank = get_tensor_model_parallel_rank()
+        world_size = get_tensor_model_parallel_world_size()
+        vocab_start_index, vocab_end_index = get_vocab_range(partition_vocab_size, rank, world_size)
+
+        # Create a mask of valid vocab ids (1 means it needs to be masked).
+        target_mask_1d = ((target < vocab_start_index) | (target >= vocab_end_index)).view(-1)
+        masked_target_1d = (target - vocab_start_index).view(-1).masked_fill(target_mask_1d, 0)
+
+        input_2d = input.reshape(-1, input.size(-1))
+        num_tokens = input_2d.size(0)
+        log_sum_exp = torch.empty(num_tokens, dtype=torch.float32, device=input.device)
+        loss = torch.empty(num_tokens, dtype=torch.float32, device=input.device)
+        for start in range(0, num_tokens, chunk_size):
+            end = min(start + chunk_size, num_tokens)
+            local_max = torch.full((end - start,), float("-inf"), dtype=torch.float32, device=input.device)
+            local_sum_exp = torch.zeros_like(local_max)
+            local_predicted_logits = torch.zeros_like(local_max)
+            local_sum_logits = torch.zeros_like(local_max)
+            for vocab_start, logits_tile, in_tile, tile_target in _VocabParallelLinearCrossEntropy._tiles(
+                input_2d[start:end], weight, bias, masked_target_1d[start:end], target_mask_1d[start:end], vocab_chunk_size
+            ):
+                # Online log-sum-exp.
+                new_max = torch.maximum(local_max, logits_tile.max(dim=-1)[0])
+                local_sum_exp = local_sum_exp * torch.exp(local_max - new_max) + torch.exp(
+                    logits_tile - new_max.unsqueeze(-1)
+                ).sum(dim=-1)
+                local_max = new_max
+                local_predicted_logits += torch.where(
+                    in_tile, logits_tile.gather(1, tile_target.unsqueeze(-1)).squeeze(-1), 0.0
+                )
+                local_sum_logits += logits_tile.sum(dim=-1)
+            stats = _gather_token_stats(
+                torch.stack([local_max, local_sum_exp, local_predicted_logits, local_sum_logits], dim=-1)
+            )
+            logits_max = stats[..., 0].max(dim=0)[0]
+            sum_exp_logits = (stats[..., 1] * torch.exp(stats[..., 0] - logits_max)).sum(dim=0)
+            predicted_logits = stats[..., 2].sum(dim=0)
+            log_sum_exp[start:end] = torch.log(sum_exp_logits) + logits_max
+            loss[start:end] = log_sum_exp[start:end] - predicted_logits
+            if label_smoothing > 0.0:
+                mean_logits = stats[..., 3].sum(dim=0) / (partition_vocab_size * world_size)
+                smoothing_loss = log_sum_exp[start:end] - mean_logits
+                loss[start:end] = (1.0 - label_smoothing) * loss[start:end] + label_smoothing * smoothing_loss
+
+        ctx.label_smoothing = label_smoothing
+        ctx.chunk_size = chunk_size
+        ctx.vocab_chunk_size = vocab_chunk_size
+        ctx.vocab_size = partition_vocab_size * world_size
+        ctx.input_shape = input.size()
+        ctx.save_for_backward(input_2d, weight, bias, log_sum_exp, target_mask_1d, masked_target_1d)
+
+        return loss.view_as(target).to(input.dtype)
+
+    @staticmethod
+    def _tiles(input_chunk, weight, bias, masked_target, target_mask, vocab_chunk_size):
+        """Yield the vocab offset, fp32 logits, target mask, and target index of each tile of ``input_chunk``."""
+        partition_vocab_size = weight.size(0)
+        for vocab_start in range(0, partition_vocab_size, vocab_chunk_size):
+            vocab_end = min(vocab_start + vocab_chunk_size, partition_vocab_size)
+            logits_tile = torch.nn.functional.linear(
+                input_chunk,
+                weight[vocab_start:vocab_end],
+                None if bias is None else bias[vocab_start:vocab_end],
+            ).float()
+            in_tile = ~target_mask & (masked_target >= vocab_start) & (masked_target < vocab_end)
+            tile_target = (masked_target - vocab_start).clamp(0, vocab_end - vocab_start - 1)
+            yield vocab_start, logits_tile, in_tile, tile_target
+
+    @staticmethod
+    def backward(ctx, grad_output):
+
+        # Retreive tensors from the forward path.
+        input_2d, weight, bias, log_sum_exp, target_mask_1d, masked_target_1d = ctx.saved_tensors
+        grad_output_1d = grad_output.reshape(-1).float()
+        num_tokens = input_2d.size(0)
+        need_input_grad, need_weight_grad, need_bias_grad = ctx.needs_input_grad[:3]
+        grad_input = torch.zeros(input_2d.size(), dtype=torch.float32, device=input_2d.device) if need_input_grad else None
+        grad_weight = torch.zeros(weight.size(), dtype=torch.float32, device=weight.device) if need_weight_grad else None
+        grad_bias = torch.zeros(weight.size(0), dtype=torch.float32, device=weight.device) if need_bias_grad else None
+        for start in range(0, num_tokens, ctx.chunk_size):
+            end = min(start + ctx.chunk_size, num_tokens)
+            input_chunk = input_2d[start:end]
+            for vocab_start, grad_tile, in_tile, tile_target in _VocabParallelLinearCrossEntropy._tiles(
+                input_chunk, weight, bias, masked_target_1d[start:end], target_mask_1d[start:end], ctx.vocab_chunk_size
+            ):
+                vocab_end = vocab_start + grad_tile.size(1)
+                # Recompute the softmax of the tile and add the gradient from matching classes.
+                grad_tile.sub_(log_sum_exp[start:end].unsqueeze(-1)).exp_()
+                grad_tile.scatter_add_(
+                    1, tile_target.unsqueeze(-1), -(1.0 - ctx.label_smoothing) * in_tile.float().unsqueeze(-1)
+                )
+                if ctx.label_smoothing > 0.0:
+                    grad_tile.sub_(ctx.label_smoothing / ctx.vocab_size)
+                grad_tile.mul_(grad_output_1d[start:end].unsqueeze(dim=-1))
+                grad_tile = grad_tile.to(weight.dtype)
+                if need_input_grad:
+                    grad_input[start:end] += grad_tile.matmul(weight[vocab_start:vocab_end]).float()
+                if need_weight_grad:
+                    grad_weight[vocab_start:vocab_end] += grad_tile.t().matmul(input_chunk).float()
+                if need_bias_grad:
+                    grad_bias[vocab_start:vocab_end] += grad_tile.float().sum(dim=0)
+
+        if grad_input is not None:
+            # The input is shared by all the tensor parallel ranks, each of which only holds a partition of the vocab.
+            if get_tensor_model_parallel_world_size() > 1:
+                torch.distributed.all_reduce(grad_input, group=get_tensor_model_parallel_group())
+            grad_input = grad_input.to(input_2d.dtype).view(ctx.input_shape)
+        if grad_weight is not None:
+            grad_weight = grad_weight.to(weight.dtype)
+        if grad_bias is not None:
+            grad_bias = grad_bias.to(bias.dtype)
+        return grad_input, grad_weight, grad_bias, None, None, None, None
+
+
+def vocab_parallel_linear_cross_entropy(
+    input,
+    weight,
+    target,
+    bias=None,
+    label_smoothing: float = 0.0,
+    *,
+    chunk_size: int = 1024,
+    vocab_chunk_size: int = 4096,
+):
+    """Cross entropy of the vocab parallel logits ``input @ weight.t() + bias`` without materializing them.
+
+    This is equivalent to :class:`apex.transformer.tensor_parallel.ColumnParallelLinear` with
+    ``gather_output=False`` followed by :func:`vocab_parallel_cross_entropy`, but the memory the
+    forward and backward use on top of their inputs and gradients does not depend on the vocab size.
+
+    Arguments:
+        input: the hidden states, the same on all tensor parallel ranks, e.g. ``[s, b, h]``.
+        weight: the partition of the output embedding of this rank, ``[vocab / TP, h]``.
+        target: correct vocab ids of dimension ``input.size()[:-1]``.
+        bias: Optional. the partition of the output bias of this rank, ``[vocab / TP]``.
+        label_smoothing: the smoothing factor, must be in range ``[0.0, 1.0)``.
+        chunk_size: the number of tokens of each tile of logits.
+        vocab_chunk_size: the number of vocab entries of each tile of logits.
+    """
+    if not 0.0 <= label_smoothing < 1.0:
+        raise ValueError(f"`label_smoothing` must be in [0.0, 1.0) but got {label_smoothing}")
+    if chunk_size <= 0 or vocab_chunk_size <= 0:
+        raise ValueError(f"`chunk_size` and `vocab_chunk_size` must be positive but got {chunk_size} and {vocab_chunk_size}")
+    return _VocabParallelLinearCrossEntropy.apply(
+        input, weight, bias, target, label_smoothing, chunk_size, vocab_chunk_size
+    )
@@ -12,6 +12,8 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from typing import Dict, Sequence, Tuple
+
 import torch
 
 from apex.transformer.parallel_state import get_tensor_model_parallel_group
@@ -21,6 +23,19 @@ from apex.transformer.parallel_state import get_tensor_model_parallel_src_rank
 
 _MAX_DATA_DIM = 5
 
+# (keys, datatype, group) -> (key_size, key_numel, total_numel) of the calls with `static_shapes=True`.
+_KEY_SIZE_NUMEL_CACHE: Dict[Tuple, Tuple[Dict, Dict, int]] = {}
+
+
+def _get_data_device() -> torch.device:
+    """Return the device of the tensors broadcast in the tensor model parallel group.
+
+    The gloo backend broadcasts CPU tensors, the other backends tensors on the current CUDA device.
+    """
+    if torch.distributed.get_backend(get_tensor_model_parallel_group()) == "gloo":
+        return torch.device("cpu")
+    return torch.device("cuda", torch.cuda.current_device())
+
 
 def _check_data_types(keys, data, target_dtype):
     """Check that all the keys have the same target data type."""
@@ -34,50 +49,51 @@ def _check_data_types(keys, data, target_dtype):
 def _build_key_size_numel_dictionaries(keys, data):
     """Build the size on rank 0 and broadcast."""
     max_dim = _MAX_DATA_DIM
-    sizes = [0 for _ in range(max_dim) for _ in keys]
+    sizes = torch.zeros((len(keys), max_dim), dtype=torch.long)
 
     # Pack the sizes on rank zero.
     if get_tensor_model_parallel_rank() == 0:
-        offset = 0
-        for key in keys:
+        for i, key in enumerate(keys):
             assert data[key].dim() < max_dim, "you should increase MAX_DATA_DIM"
             size = data[key].size()
-            for i, s in enumerate(size):
-                sizes[i + offset] = s
-            offset += max_dim
+            sizes[i, : len(size)] = torch.tensor(size, dtype=torch.long)
 
-    # Move to GPU and broadcast.
-    sizes_cuda = torch.cuda.LongTensor(sizes)
+    # Move to the device and broadcast.
+    sizes_device = sizes.to(_get_data_device())
     torch.distributed.broadcast(
-        sizes_cuda,
+        sizes_device,
         get_tensor_model_parallel_src_rank(),
         group=get_tensor_model_parallel_group(),
     )
 
-    # Move back to cpu and unpack.
-    sizes_cpu = sizes_cuda.cpu()
+    # Move back to cpu and unpack. The size of each key ends at its first zero.
+    sizes_cpu = sizes_device.cpu()
+    ndims = torch.cumprod(sizes_cpu > 0, dim=1).sum(dim=1).tolist()
+    numels = torch.where(sizes_cpu > 0, sizes_cpu, torch.ones_like(sizes_cpu)).prod(dim=1).tolist()
+    sizes_cpu = sizes_cpu.tolist()
     key_size = {}
     key_numel = {}
-    total_numel = 0
-    offset = 0
-    for key in keys:
-        i = 0
-        size = []
-        numel = 1
-        while sizes_cpu[offset + i] > 0:
-            this_size = sizes_cpu[offset + i]
-            size.append(this_size)
-            numel *= this_size
-            i += 1
-        key_size[key] = size
-        key_numel[key] = numel
-        total_numel += numel
-        offset += max_dim
+    for i, key in enumerate(keys):
+        key_size[key] = sizes_cpu[i][: ndims[i]]
+        key_numel[key] = numels[i]
+    total_numel = sum(numels)
 
     return key_size, key_numel, total_numel
 
 
-def broadcast_data(keys, data, datatype):
+def _pack_data(keys: Sequence, data, datatype: torch.dtype, total_numel: int, device: torch.device) -> torch.Tensor:
+    """Copy the data of all the keys into one contiguous buffer on ``device``."""
+    # Staging through pinned memory lets the host to device copy run asynchronously.
+    flatten_data = torch.empty(total_numel, dtype=datatype, pin_memory=device.type == "cuda")
+    offset = 0
+    for key in keys:
+        numel = data[key].numel()
+        flatten_data.narrow(0, offset, numel).copy_(data[key].reshape(-1))
+        offset += numel
+    return flatten_data.to(device, non_blocking=True)
+
+
+def broadcast_data(keys, data, datatype, *, static_shapes: bool = False):
     """Broadcast data from rank zero of each model parallel group to the
     members of the same model parallel group.
 
@@ -86,37 +102,51 @@ def broadcast_data(keys, data, datatype):
         data: data dictionary of string keys and cpu tensor values.
         datatype: torch data type of all tensors in data associated
                   with keys.
+        static_shapes: If :obj:`True`, the sizes of the keys are assumed not to
+                  change between calls with the same keys and datatype, so that
+                  they are broadcast only once and cached.
     """
     # Build (key, size) and (key, number of elements) dictionaries along
     # with the total number of elements on all ranks.
-    key_size, key_numel, total_numel = _build_key_size_numel_dictionaries(keys, data)
+    group = get_tensor_model_parallel_group()
+    cache_key = (tuple(keys), datatype, group)
+    if static_shapes and cache_key in _KEY_SIZE_NUMEL_CACHE:
+        key_size, key_numel, total_numel = _KEY_SIZE_NUMEL_CACHE[cache_key]
+    else:
+        key_size, key_numel, total_numel = _build_key_size_numel_dictionaries(keys, data)
+        if static_shapes:
+            _KEY_SIZE_NUMEL_CACHE[cache_key] = key_size, key_numel, total_numel
+    device = _get_data_device()
     # Pack on rank zero.
     if get_tensor_model_parallel_rank() == 0:
         # Check that all keys have the same data type.
         _check_data_types(keys, data, datatype)
+        if static_shapes:
+            for key in keys:
+                assert list(data[key].size()) == key_size[key], (
+                    "{} has size {} which is different than the cached "
+                    "size {}".format(key, list(data[key].size()), key_size[key])
+                )
         # Flatten the data associated with the keys
-        flatten_data = torch.cat(
-            [data[key].contiguous().view(-1) for key in keys], dim=0
-        ).cuda()
+        flatten_data = _pack_data(keys, data, datatype, total_numel, device)
     else:
-        flatten_data = torch.empty(
-            total_numel, device=torch.cuda.current_device(), dtype=datatype
-        )
+        flatten_data = torch.empty(total_numel, device=device, dtype=datatype)
 
     # Broadcast
     torch.distributed.broadcast(
         flatten_data,
         get_tensor_model_parallel_src_rank(),
-        group=get_tensor_model_parallel_group(),
+        group=group,
     )
 
     # Unpack
     output = {}
-    offset = 0
-    for key in keys:
-        size = key_size[key]
-        numel = key_numel[key]
-        output[key] = flatten_data.narrow(0, offset, numel).view(size)
-        offset += numel
+    for key, chunk in zip(keys, torch.split(flatten_data, [key_numel[key] for key in keys])):
+        output[key] = chunk.view(key_size[key])
 
     return output
+
+
+def clear_broadcast_data_cache() -> None:
+    """Forget the sizes cached by :func:`broadcast_data` with ``static_shapes=True``."""
+    _KEY_SIZE_NUMEL_CACHE.clear()
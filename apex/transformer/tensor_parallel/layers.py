@@ -16,7 +16,10 @@
 
 # Parts of the code here are adapted from PyTorch
 # repo: https://github.com/pytorch/pytorch
-from typing import Optional, Dict, Tuple, List
+from typing import Callable, Iterator, Optional, Dict, Tuple, List
+import collections
+import contextlib
+import functools
 import warnings
 
 import torch
@@ -25,6 +28,7 @@ import torch.nn.init as init
 from torch.nn.parameter import Parameter
 
 from apex._autocast_utils import _cast_if_autocast_enabled
+from apex.transformer.parallel_state import get_tensor_model_parallel_global_ranks
 from apex.transformer.parallel_state import get_tensor_model_parallel_group
 from apex.transformer.parallel_state import get_tensor_model_parallel_rank
 from apex.transformer.parallel_state import get_tensor_model_parallel_world_size
@@ -269,6 +273,93 @@ class VocabParallelEmbedding(torch.nn.Module):
         return output
 
 
+class WeightGradStore:
+    """Queue of weight gradient GEMMs deferred by :class:`LinearWithGradAccumulationAndAsyncCommunication`.
+
+    Inside :meth:`defer`, the backward of the tensor parallel linear layers only computes the gradient
+    with respect to the input and queues the weight gradient computation instead. All the computations
+    queued by one :meth:`defer` block, e.g. one ``backward_step``, form one entry of the queue, and
+    :meth:`pop` runs the oldest entry. Deferred weight gradients are accumulated into ``weight.main_grad``
+    (``gradient_accumulation_fusion``) or ``weight.grad`` outside of autograd, so gradient reductions
+    that are triggered by autograd hooks, e.g. DDP, don't see them.
+    """
+
+    _deferring = False
+    _current = []
+    _queue = collections.deque()
+
+    @classmethod
+    def is_deferring(cls) -> bool:
+        return cls._deferring
+
+    @classmethod
+    @contextlib.contextmanager
+    def defer(cls):
+        cls._deferring = True
+        try:
+            yield
+        finally:
+            cls._deferring = False
+            cls._queue.append(cls._current)
+            cls._current = []
+
+    @classmethod
+    def put(cls, weight_grad_func) -> None:
+        cls._current.append(weight_grad_func)
+
+    @classmethod
+    def size(cls) -> int:
+        return len(cls._queue)
+
+    @classmethod
+    def pop(cls) -> None:
+        for weight_grad_func in cls._queue.popleft():
+            weight_grad_func()
+
+    @classmethod
+    def pop_all(cls) -> None:
+        while cls._queue:
+            cls.pop()
+
+
+def _compute_weight_grad(
+    total_input: torch.Tensor,
+    grad_output: torch.Tensor,
+    weight: torch.Tensor,
+    gradient_accumulation_fusion: bool,
+    use_16bit_in_wgrad_accum_fusion: bool,
+) -> Optional[torch.Tensor]:
+    if gradient_accumulation_fusion:
+        if not use_16bit_in_wgrad_accum_fusion:
+            fused_weight_gradient_mlp_cuda.wgrad_gemm_accum_fp32(
+                total_input, grad_output, weight.main_grad
+            )
+        else:
+            fused_weight_gradient_mlp_cuda.wgrad_gemm_accum_fp16(
+                total_input, grad_output, weight.main_grad
+            )
+        return None
+    return grad_output.t().matmul(total_input)
+
+
+def _deferred_weight_grad(
+    total_input: torch.Tensor,
+    grad_output: torch.Tensor,
+    weight: torch.Tensor,
+    gradient_accumulation_fusion: bool,
+    use_16bit_in_wgrad_accum_fusion: bool,
+) -> None:
+    grad_weight = _compute_weight_grad(
+        total_input, grad_output, weight, gradient_accumulation_fusion, use_16bit_in_wgrad_accum_fusion
+    )
+    if grad_weight is None:
+        return
+    if weight.grad is None:
+        weight.grad = grad_weight
+    else:
+        weight.grad.add_(grad_weight)
+
+
 class LinearWithGradAccumulationAndAsyncCommunication(torch.autograd.Function):
     """Linear layer execution with asynchronous communication and gradient accumulation fusion in backprop."""
 
@@ -362,18 +453,26 @@ class LinearWithGradAccumulationAndAsyncCommunication(torch.autograd.Function):
                 async_op=True
             )
 
-        if ctx.gradient_accumulation_fusion:
-            if not ctx.use_16bit_in_wgrad_accum_fusion:
-                fused_weight_gradient_mlp_cuda.wgrad_gemm_accum_fp32(
-                    total_input, grad_output, weight.main_grad
-                )
-            else:
-                fused_weight_gradient_mlp_cuda.wgrad_gemm_accum_fp16(
-                    total_input, grad_output, weight.main_grad
+        if WeightGradStore.is_deferring():
+            WeightGradStore.put(
+                functools.partial(
+                    _deferred_weight_grad,
+                    total_input,
+                    grad_output,
+                    weight,
+                    ctx.gradient_accumulation_fusion,
+                    ctx.use_16bit_in_wgrad_accum_fusion,
                 )
+            )
             grad_weight = None
         else:
-            grad_weight = grad_output.t().matmul(total_input)
+            grad_weight = _compute_weight_grad(
+                total_input,
+                grad_output,
+                weight,
+                ctx.gradient_accumulation_fusion,
+                ctx.use_16bit_in_wgrad_accum_fusion,
+            )
 
         grad_bias = grad_output.sum(dim=0) if use_bias else None
         if ctx.sequence_parallel_enabled:
@@ -426,6 +525,239 @@ def linear_with_grad_accumulation_and_async_allreduce_in16bit(
         return LinearWithGradAccumulationAndAsyncCommunication.apply(*args)
 
 
+def _ring_neighbors() -> Tuple[int, int]:
+    """Return the global ranks of the previous and the next rank in the tensor model parallel group."""
+    world_size = get_tensor_model_parallel_world_size()
+    rank = get_tensor_model_parallel_rank()
+    global_ranks = get_tensor_model_parallel_global_ranks()
+    return global_ranks[(rank - 1) % world_size], global_ranks[(rank + 1) % world_size]
+
+
+def _ring_shift(tensor: torch.Tensor):
+    """Send ``tensor`` to the next rank of the ring and receive the one of the previous rank asynchronously."""
+    prev_rank, next_rank = _ring_neighbors()
+    recv_buffer = torch.empty_like(tensor)
+    ops = [
+        torch.distributed.P2POp(torch.distributed.isend, tensor, next_rank, get_tensor_model_parallel_group()),
+        torch.distributed.P2POp(torch.distributed.irecv, recv_buffer, prev_rank, get_tensor_model_parallel_group()),
+    ]
+    return recv_buffer, torch.distributed.batch_isend_irecv(ops)
+
+
+def _ring_all_gather(tensor: torch.Tensor) -> Iterator[Tuple[int, torch.Tensor]]:
+    """Yield the index and the ``tensor`` of every rank of the tensor model parallel group, starting from this one.
+
+    The chunk of the next step is transferred while the caller consumes the current one.
+    """
+    world_size = get_tensor_model_parallel_world_size()
+    rank = get_tensor_model_parallel_rank()
+    current = tensor.contiguous()
+    for step in range(world_size):
+        reqs = []
+        if step < world_size - 1:
+            recv_buffer, reqs = _ring_shift(current)
+        yield (rank - step) % world_size, current
+        for req in reqs:
+            req.wait()
+        if step < world_size - 1:
+            current = recv_buffer
+
+
+def _ring_reduce_scatter(compute_chunk: Callable[[int], torch.Tensor]) -> torch.Tensor:
+    """Return the chunk of this rank of the sum of ``compute_chunk(i)`` over the tensor model parallel group.
+
+    The partial sums are passed along the ring while the next chunk is computed.
+    """
+    world_size = get_tensor_model_parallel_world_size()
+    rank = get_tensor_model_parallel_rank()
+    reqs, recv_buffer = [], None
+    for step in range(world_size):
+        # The chunk of this rank comes last so that it is fully reduced.
+        partial = compute_chunk((rank - step - 1) % world_size)
+        for req in reqs:
+            req.wait()
+        if recv_buffer is not None:
+            partial = partial + recv_buffer
+        if step < world_size - 1:
+            recv_buffer, reqs = _ring_shift(partial)
+    return partial
+
+
+def _accumulate_weight_grad(
+    grad_weight: Optional[torch.Tensor],
+    total_input: torch.Tensor,
+    grad_output: torch.Tensor,
+    weight: torch.Tensor,
+    gradient_accumulation_fusion: bool,
+    use_16bit_in_wgrad_accum_fusion: bool,
+) -> Optional[torch.Tensor]:
+    """Add the weight gradient of one chunk of the sequence to ``grad_weight``, or queue it in :class:`WeightGradStore`."""
+    # Convert the tensor shapes to 2D for execution compatibility
+    total_input = total_input.reshape(-1, total_input.shape[-1])
+    grad_output = grad_output.reshape(-1, grad_output.shape[-1])
+    if WeightGradStore.is_deferring():
+        WeightGradStore.put(
+            functools.partial(
+                _deferred_weight_grad,
+                total_input,
+                grad_output,
+                weight,
+                gradient_accumulation_fusion,
+                use_16bit_in_wgrad_accum_fusion,
+            )
+        )
+        return grad_weight
+    partial_grad_weight = _compute_weight_grad(
+        total_input, grad_output, weight, gradient_accumulation_fusion, use_16bit_in_wgrad_accum_fusion
+    )
+    if partial_grad_weight is None or grad_weight is None:
+        return partial_grad_weight
+    return grad_weight.add_(partial_grad_weight)
+
+
+class AllGatherLinearWithCollectiveMatmul(torch.autograd.Function):
+    """Sequence parallel all-gather followed by the linear layer of :class:`ColumnParallelLinear`, decomposed over a ring.
+
+    Instead of a blocking all-gather of the input before the GEMM, each rank computes the output rows of
+    one chunk of the sequence while the next chunk is passed along the ring. In backward, the
+    reduce-scatter of the input gradient and the all-gather of the input for the weight gradient are
+    decomposed the same way.
+    """
+
+    @staticmethod
+    def forward(
+        ctx,
+        input: torch.Tensor,
+        weight: torch.Tensor,
+        bias: Optional[torch.Tensor],
+        gradient_accumulation_fusion: bool,
+        use_16bit_in_wgrad_accum_fusion: bool = False,
+    ):
+        ctx.save_for_backward(input, weight)
+        ctx.use_bias = bias is not None
+        ctx.gradient_accumulation_fusion = gradient_accumulation_fusion
+        ctx.use_16bit_in_wgrad_accum_fusion = use_16bit_in_wgrad_accum_fusion
+
+        # `input` is supposed to be 3D and its order of dimension is [sequence, batch, hidden]
+        chunk_length = input.shape[0]
+        shape = list(input.shape)
+        shape[0] *= get_tensor_model_parallel_world_size()
+        shape[-1] = weight.shape[0]
+        output = torch.empty(shape, dtype=input.dtype, device=input.device)
+        for index, input_chunk in _ring_all_gather(input):
+            torch.matmul(input_chunk, weight.t(), out=output[index * chunk_length:(index + 1) * chunk_length])
+        if bias is not None:
+            output = output + bias
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, weight = ctx.saved_tensors
+        chunk_length = input.shape[0]
+
+        def grad_input_chunk(index):
+            return grad_output[index * chunk_length:(index + 1) * chunk_length].matmul(weight)
+
+        sub_grad_input = _ring_reduce_scatter(grad_input_chunk)
+
+        grad_weight = None
+        for index, input_chunk in _ring_all_gather(input):
+            grad_weight = _accumulate_weight_grad(
+                grad_weight,
+                input_chunk,
+                grad_output[index * chunk_length:(index + 1) * chunk_length],
+                weight,
+                ctx.gradient_accumulation_fusion,
+                ctx.use_16bit_in_wgrad_accum_fusion,
+            )
+
+        grad_bias = grad_output.reshape(-1, grad_output.shape[-1]).sum(dim=0) if ctx.use_bias else None
+        return sub_grad_input, grad_weight, grad_bias, None, None
+
+
+class LinearReduceScatterWithCollectiveMatmul(torch.autograd.Function):
+    """The linear layer of :class:`RowParallelLinear` followed by the sequence parallel reduce-scatter, decomposed over a ring.
+
+    Instead of a blocking reduce-scatter of the output after the GEMM, each rank computes the partial
+    output of one chunk of the sequence while the partial sums of the previous chunk are passed along
+    the ring. In backward, the all-gather of the output gradient is decomposed the same way.
+    """
+
+    @staticmethod
+    def forward(
+        ctx,
+        input: torch.Tensor,
+        weight: torch.Tensor,
+        gradient_accumulation_fusion: bool,
+        use_16bit_in_wgrad_accum_fusion: bool = False,
+    ):
+        ctx.save_for_backward(input, weight)
+        ctx.gradient_accumulation_fusion = gradient_accumulation_fusion
+        ctx.use_16bit_in_wgrad_accum_fusion = use_16bit_in_wgrad_accum_fusion
+
+        # `input` is supposed to be 3D and its order of dimension is [sequence, batch, hidden]
+        chunk_length = divide(input.shape[0], get_tensor_model_parallel_world_size())
+
+        def output_chunk(index):
+            return torch.matmul(input[index * chunk_length:(index + 1) * chunk_length], weight.t())
+
+        return _ring_reduce_scatter(output_chunk)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, weight = ctx.saved_tensors
+        chunk_length = grad_output.shape[0]
+
+        grad_input = torch.empty_like(input)
+        grad_weight = None
+        for index, grad_output_chunk in _ring_all_gather(grad_output):
+            chunk = slice(index * chunk_length, (index + 1) * chunk_length)
+            torch.matmul(grad_output_chunk, weight, out=grad_input[chunk])
+            grad_weight = _accumulate_weight_grad(
+                grad_weight,
+                input[chunk],
+                grad_output_chunk,
+                weight,
+                ctx.gradient_accumulation_fusion,
+                ctx.use_16bit_in_wgrad_accum_fusion,
+            )
+        return grad_input, grad_weight, None, None
+
+
+def all_gather_linear_with_collective_matmul(
+    input: torch.Tensor,
+    weight: torch.Tensor,
+    bias: Optional[torch.Tensor],
+    gradient_accumulation_fusion: bool,
+    use_16bit_in_wgrad_accum_fusion: bool = False,
+) -> torch.Tensor:
+    args = _cast_if_autocast_enabled(
+        input,
+        weight,
+        bias,
+        gradient_accumulation_fusion,
+        use_16bit_in_wgrad_accum_fusion,
+    )
+    with torch.amp.autocast('cuda',enabled=False):
+        return AllGatherLinearWithCollectiveMatmul.apply(*args)
+
+
+def linear_reduce_scatter_with_collective_matmul(
+    input: torch.Tensor,
+    weight: torch.Tensor,
+    gradient_accumulation_fusion: bool,
+    use_16bit_in_wgrad_accum_fusion: bool = False,
+) -> torch.Tensor:
+    args = _cast_if_autocast_enabled(
+        input,
+        weight,
+        gradient_accumulation_fusion,
+        use_16bit_in_wgrad_accum_fusion,
+    )
+    with torch.amp.autocast('cuda',enabled=False):
+        return LinearReduceScatterWithCollectiveMatmul.apply(*args)
+
+
 class ColumnParallelLinear(torch.nn.Module):
     """Linear layer with column parallelism.
 
@@ -460,6 +792,9 @@ class ColumnParallelLinear(torch.nn.Module):
         gradient_accumulation_fusion:
         accumulation_in_fp16:
         sequence_parallel_enabled:
+        collective_matmul: If :obj:`True` with `sequence_parallel_enabled`, the all-gather of the
+            input is decomposed into ring exchanges overlapped with the GEMMs of the chunks of the
+            sequence, see :class:`AllGatherLinearWithCollectiveMatmul`.
     """
 
     def __init__(
@@ -479,6 +814,7 @@ class ColumnParallelLinear(torch.nn.Module):
         gradient_accumulation_fusion=False,
         accumulation_in_fp16: bool = False,
         sequence_parallel_enabled: bool = False,
+        collective_matmul: bool = False,
     ):
         super().__init__()
 
@@ -567,6 +903,10 @@ class ColumnParallelLinear(torch.nn.Module):
 
         if self.async_tensor_model_parallel_allreduce and self.sequence_parallel_enabled:
             raise RuntimeError("`async_tensor_model_parallel_allreduce` and `sequence_parallel_enabled` cannot be enabled at the same time.")
+        if collective_matmul and not self.sequence_parallel_enabled:
+            raise RuntimeError("To enable `collective_matmul`, `sequence_parallel_enabled` must be `True`")
+        self.collective_matmul = collective_matmul
+        self.accumulation_in_fp16 = accumulation_in_fp16
 
         self._forward_impl = (
             linear_with_grad_accumulation_and_async_allreduce_in16bit
@@ -592,14 +932,23 @@ class ColumnParallelLinear(torch.nn.Module):
             input_parallel = copy_to_tensor_model_parallel_region(input_)
 
         # Matrix multiply.
-        output_parallel = self._forward_impl(
-            input=input_parallel,
-            weight=self.weight,
-            bias=bias,
-            gradient_accumulation_fusion=self.gradient_accumulation_fusion,
-            async_grad_allreduce=self.async_tensor_model_parallel_allreduce,
-            sequence_parallel_enabled=self.sequence_parallel_enabled,
-        )
+        if self.collective_matmul:
+            output_parallel = all_gather_linear_with_collective_matmul(
+                input_parallel,
+                self.weight,
+                bias,
+                self.gradient_accumulation_fusion,
+                self.accumulation_in_fp16,
+            )
+        else:
+            output_parallel = self._forward_impl(
+                input=input_parallel,
+                weight=self.weight,
+                bias=bias,
+                gradient_accumulation_fusion=self.gradient_accumulation_fusion,
+                async_grad_allreduce=self.async_tensor_model_parallel_allreduce,
+                sequence_parallel_enabled=self.sequence_parallel_enabled,
+            )
         if self.gather_output:
             # All-gather across the partitions.
             assert not self.sequence_parallel_enabled
@@ -649,6 +998,9 @@ class RowParallelLinear(torch.nn.Module):
         gradient_accumulation_fusion:
         accumulation_in_fp16:
         sequence_parallel_enabled:
+        collective_matmul: If :obj:`True` with `sequence_parallel_enabled`, the reduce-scatter of
+            the output is decomposed into ring exchanges overlapped with the GEMMs of the chunks of the
+            sequence, see :class:`LinearReduceScatterWithCollectiveMatmul`.
     """
 
     def __init__(
@@ -667,6 +1019,7 @@ class RowParallelLinear(torch.nn.Module):
         gradient_accumulation_fusion=False,
         accumulation_in_fp16: bool = False,
         sequence_parallel_enabled: bool = False,
+        collective_matmul: bool = False,
     ):
         super().__init__()
 
@@ -682,6 +1035,10 @@ class RowParallelLinear(torch.nn.Module):
         self.sequence_parallel_enabled = sequence_parallel_enabled
         if self.sequence_parallel_enabled and not self.input_is_parallel:
             raise RuntimeError("To enable `sequence_parallel_enabled`, `input_is_parallel` must be `True`")
+        if collective_matmul and not self.sequence_parallel_enabled:
+            raise RuntimeError("To enable `collective_matmul`, `sequence_parallel_enabled` must be `True`")
+        self.collective_matmul = collective_matmul
+        self.accumulation_in_fp16 = accumulation_in_fp16
 
         # as an argument to this function?
         # Parameters.
@@ -757,20 +1114,29 @@ class RowParallelLinear(torch.nn.Module):
         else:
             assert not self.sequence_parallel_enabled
             input_parallel = scatter_to_tensor_model_parallel_region(input_)
-        # Matrix multiply.
-        output_parallel = self._forward_impl(
-            input=input_parallel,
-            weight=self.weight,
-            bias=None,
-            gradient_accumulation_fusion=self.gradient_accumulation_fusion,
-            async_grad_allreduce=False,
-            sequence_parallel_enabled=False,
-        )
-        # All-reduce across all the partitions.
-        if self.sequence_parallel_enabled:
-            output_ = reduce_scatter_to_sequence_parallel_region(output_parallel)
+        if self.collective_matmul:
+            # Matrix multiply fused with the reduce-scatter across all the partitions.
+            output_ = linear_reduce_scatter_with_collective_matmul(
+                input_parallel,
+                self.weight,
+                self.gradient_accumulation_fusion,
+                self.accumulation_in_fp16,
+            )
         else:
-            output_ = reduce_from_tensor_model_parallel_region(output_parallel)
+            # Matrix multiply.
+            output_parallel = self._forward_impl(
+                input=input_parallel,
+                weight=self.weight,
+                bias=None,
+                gradient_accumulation_fusion=self.gradient_accumulation_fusion,
+                async_grad_allreduce=False,
+                sequence_parallel_enabled=False,
+            )
+            # All-reduce across all the partitions.
+            if self.sequence_parallel_enabled:
+                output_ = reduce_scatter_to_sequence_parallel_region(output_parallel)
+            else:
+                output_ = reduce_from_tensor_model_parallel_region(output_parallel)
         if not self.skip_bias_add:
             output = output_ + self.bias if self.bias is not None else output_
             output_bias = None
@@ -0,0 +1,306 @@
+# coding=utf-8
+# Copyright (c) 2021-22, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Selective activation recomputation.
+
+:func:`apex.transformer.tensor_parallel.checkpoint` recomputes a whole function, typically one or
+more transformer layers. :func:`recompute` is meant for cheap sub-blocks of a layer, e.g. the softmax
+and dropout of the core attention: only the inputs of the sub-block are kept for backward, so the
+outputs of the GEMMs around it stay saved and only the sub-block itself runs again.
+"""
+import contextlib
+import dataclasses
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+from torch.utils.checkpoint import detach_variable
+
+from apex.transformer.log_util import get_transformer_logger
+from apex.transformer.parallel_state import get_tensor_model_parallel_group
+from apex.transformer.parallel_state import get_tensor_model_parallel_world_size
+from apex.transformer.tensor_parallel.random import _set_cuda_rng_state
+from apex.transformer.tensor_parallel.random import get_cuda_rng_tracker
+from apex.transformer.utils import gather_split_1d_tensor
+from apex.transformer.utils import split_tensor_into_1d_equal_chunks
+
+try:
+    from torch.utils.flop_counter import FlopCounterMode
+except ImportError:
+    FlopCounterMode = None
+
+
+__all__ = [
+    "RecomputeStats",
+    "recompute",
+    "enable_recompute_stats",
+    "get_recompute_stats",
+    "reset_recompute_stats",
+]
+
+
+_logger = get_transformer_logger(__name__)
+
+
+@dataclasses.dataclass
+class RecomputeStats:
+    """Statistics of the sub-blocks recomputed under one name, accumulated over their backwards.
+
+    Attributes:
+        num_recomputes: The number of times the sub-blocks were recomputed.
+        saved_bytes: The bytes of activations the sub-blocks would have kept from forward to backward
+            without recomputation, not counting their inputs.
+        distributed_bytes: The bytes of inputs not kept on this rank thanks to `distribute_saved_activations`.
+        recompute_time: The seconds spent recomputing, measured after synchronizing the device if CUDA
+            is in use. This is the cost to weigh against ``saved_bytes``.
+        recompute_flops: The FLOPs spent recomputing as counted by :class:`torch.utils.flop_counter.FlopCounterMode`,
+            which only accounts for matmuls, convolutions and attention kernels, so it is 0 for e.g. softmax
+            and dropout. :obj:`None` if not available.
+    """
+
+    num_recomputes: int = 0
+    saved_bytes: int = 0
+    distributed_bytes: int = 0
+    recompute_time: float = 0.0
+    recompute_flops: Optional[int] = 0 if FlopCounterMode is not None else None
+
+
+_RECOMPUTE_STATS: Dict[str, RecomputeStats] = {}
+_TRACK_RECOMPUTE_STATS = False
+
+
+def enable_recompute_stats(enabled: bool = True) -> None:
+    """Turn on or off the collection of :class:`RecomputeStats`, which slows down recomputation."""
+    global _TRACK_RECOMPUTE_STATS
+    _TRACK_RECOMPUTE_STATS = enabled
+
+
+def get_recompute_stats() -> Dict[str, RecomputeStats]:
+    """Return the :class:`RecomputeStats` by the names given to :func:`recompute`."""
+    return {name: dataclasses.replace(stats) for name, stats in _RECOMPUTE_STATS.items()}
+
+
+def reset_recompute_stats() -> None:
+    _RECOMPUTE_STATS.clear()
+
+
+def _get_rng_states() -> Dict[str, Any]:
+    states = {
+        "cpu": torch.get_rng_state(),
+        "tracker": get_cuda_rng_tracker().get_states(),
+    }
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        states["cuda"] = torch.cuda.get_rng_state()
+    return states
+
+
+def _set_rng_states(states: Dict[str, Any]) -> None:
+    torch.set_rng_state(states["cpu"])
+    if "cuda" in states:
+        _set_cuda_rng_state(states["cuda"])
+    get_cuda_rng_tracker().set_states(states["tracker"])
+
+
+def _synchronize() -> None:
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.synchronize()
+
+
+def _get_distributable_inputs(args) -> List[bool]:
+    """Tell which tensor inputs are the same on all the ranks of the tensor model parallel group.
+
+    The chunks distributed by ``distribute_saved_activations`` are taken from the tensors of different
+    ranks, so a tensor that differs across ranks, e.g. the attention scores of the heads of each rank,
+    cannot be distributed, and neither can a tensor whose size is not a multiple of the group size. The
+    tensors are compared through a checksum of their values and positions.
+    """
+    world_size = get_tensor_model_parallel_world_size()
+    tensors = [arg for arg in args if isinstance(arg, torch.Tensor)]
+    if not tensors:
+        return []
+    checksums = []
+    for tensor in tensors:
+        data = tensor.detach().reshape(-1).double().nan_to_num()
+        positions = torch.arange(1, data.numel() + 1, dtype=data.dtype, device=data.device)
+        checksums.append(torch.stack([data.sum(), (data * positions).sum(), data.new_tensor(data.numel())]))
+    checksums = torch.stack(checksums)
+    gathered = checksums.new_empty((world_size * checksums.size(0), checksums.size(1)))
+    torch.distributed._all_gather_base(gathered, checksums, group=get_tensor_model_parallel_group())
+    gathered = gathered.view(world_size, *checksums.shape)
+    same = (gathered == gathered[0]).all(dim=2).all(dim=0).tolist()
+    return [s and tensor.numel() % world_size == 0 for s, tensor in zip(same, tensors)]
+
+
+class _SavedBytesCounter:
+    """Count the bytes autograd saves for backward, except for the given tensors."""
+
+    def __init__(self, exclude) -> None:
+        self.exclude = {t.data_ptr() for t in exclude if isinstance(t, torch.Tensor)}
+        self.seen = set()
+        self.nbytes = 0
+
+    def pack(self, tensor: torch.Tensor) -> torch.Tensor:
+        data_ptr = tensor.data_ptr()
+        if data_ptr not in self.exclude and data_ptr not in self.seen:
+            self.seen.add(data_ptr)
+            self.nbytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    def unpack(self, tensor: torch.Tensor) -> torch.Tensor:
+        return tensor
+
+
+class SelectiveRecomputeFunction(torch.autograd.Function):
+    """Run ``run_function`` without keeping its activations, and run it again in backward.
+
+    Like :class:`apex.transformer.tensor_parallel.random.CheckpointFunction`, the CPU, CUDA, and
+    :class:`apex.transformer.tensor_parallel.random.CudaRNGStatesTracker` RNG states of the forward are
+    restored for the recomputation so that e.g. dropout draws the same mask. Unlike it, every tensor
+    input can be distributed across the tensor model parallel group, and the CUDA RNG state is only
+    handled if CUDA is in use.
+    """
+
+    @staticmethod
+    def forward(ctx, run_function, name, distribute_saved_activations, *args):
+        ctx.run_function = run_function
+        ctx.name = name
+        ctx.rng_states = _get_rng_states()
+
+        with torch.no_grad():
+            outputs = run_function(*args)
+
+        # Keep only the chunk of each tensor input corresponding to the current rank.
+        ctx.input_shapes = [None] * len(args)
+        ctx.inputs = list(args)
+        tensors, distributed_bytes = [], 0
+        distributable = iter(_get_distributable_inputs(args) if distribute_saved_activations else [])
+        for i, arg in enumerate(args):
+            if not isinstance(arg, torch.Tensor):
+                continue
+            ctx.inputs[i] = None
+            if distribute_saved_activations and not next(distributable):
+                _logger.debug(f"input {i} of {name} is kept whole as it cannot be distributed across the tensor model parallel ranks")
+            elif distribute_saved_activations:
+                ctx.input_shapes[i] = arg.shape
+                chunk = split_tensor_into_1d_equal_chunks(arg.detach().contiguous()).clone()
+                distributed_bytes += (arg.numel() - chunk.numel()) * arg.element_size()
+                arg = chunk
+            tensors.append(arg)
+        ctx.distributed_bytes = distributed_bytes
+
+        # Store everything.
+        ctx.save_for_backward(*tensors)
+        return outputs
+
+    @staticmethod
+    def backward(ctx, *grad_outputs):
+        if not torch.autograd._is_checkpoint_valid():
+            raise RuntimeError(
+                "Recomputation is not compatible with .grad(), "
+                "please use .backward() if possible"
+            )
+        saved_tensors = iter(ctx.saved_tensors)
+        inputs = []
+        for arg, shape in zip(ctx.inputs, ctx.input_shapes):
+            if arg is None:
+                arg = next(saved_tensors)
+                if shape is not None:
+                    arg = gather_split_1d_tensor(arg).view(shape)
+            inputs.append(arg)
+        detached_inputs = detach_variable(tuple(inputs))
+        for detached_input, needs_grad in zip(detached_inputs, ctx.needs_input_grad[3:]):
+            if isinstance(detached_input, torch.Tensor):
+                detached_input.requires_grad = needs_grad
+
+        # Store the current states, and set the states to what it used to be before the forward pass.
+        bwd_rng_states = _get_rng_states()
+        _set_rng_states(ctx.rng_states)
+
+        # Compute the forward pass.
+        track_stats = _TRACK_RECOMPUTE_STATS and ctx.name is not None
+        saved_bytes_counter = _SavedBytesCounter(detached_inputs)
+        flop_counter = None
+        with contextlib.ExitStack() as stack:
+            if track_stats:
+                stack.enter_context(
+                    torch.autograd.graph.saved_tensors_hooks(saved_bytes_counter.pack, saved_bytes_counter.unpack)
+                )
+                if FlopCounterMode is not None:
+                    flop_counter = stack.enter_context(FlopCounterMode(display=False))
+                _synchronize()
+                start = time.perf_counter()
+            with torch.enable_grad():
+                outputs = ctx.run_function(*detached_inputs)
+            if track_stats:
+                _synchronize()
+                recompute_time = time.perf_counter() - start
+
+        # Set the states back to what it was at the start of this function.
+        _set_rng_states(bwd_rng_states)
+
+        if track_stats:
+            stats = _RECOMPUTE_STATS.setdefault(ctx.name, RecomputeStats())
+            stats.num_recomputes += 1
+            stats.saved_bytes += saved_bytes_counter.nbytes
+            stats.distributed_bytes += ctx.distributed_bytes
+            stats.recompute_time += recompute_time
+            if flop_counter is not None:
+                stats.recompute_flops += flop_counter.get_total_flops()
+
+        if isinstance(outputs, torch.Tensor):
+            outputs = (outputs,)
+        outputs_with_grad, grads_with_output = [], []
+        for output, grad_output in zip(outputs, grad_outputs):
+            if isinstance(output, torch.Tensor) and output.requires_grad:
+                outputs_with_grad.append(output)
+                grads_with_output.append(grad_output)
+        torch.autograd.backward(outputs_with_grad, grads_with_output)
+        grads = tuple(
+            inp.grad if isinstance(inp, torch.Tensor) else None
+            for inp in detached_inputs
+        )
+        return (None, None, None) + grads
+
+
+def recompute(
+    function: Callable,
+    *args,
+    name: Optional[str] = None,
+    distribute_saved_activations: bool = False,
+    sequence_parallel_enabled: bool = False,
+):
+    """Run a cheap sub-block of a model without keeping its activations for backward.
+
+    Only the inputs of ``function`` are kept, and ``function`` runs again right before its backward
+    with the RNG states of its forward.
+
+    Arguments:
+        function: The sub-block to recompute, e.g. the attention softmax and dropout.
+        args: The inputs of ``function``.
+        name: Optional. The name the :class:`RecomputeStats` of this sub-block are accumulated under,
+            e.g. one name per layer.
+        distribute_saved_activations: If :obj:`True`, each rank of the tensor model parallel group only
+            keeps its chunk of the tensor inputs, which are all-gathered for the recomputation. Only the
+            tensor inputs that are the same on all the ranks of the group are distributed, the others
+            are kept whole.
+        sequence_parallel_enabled: Whether the inputs are split along the sequence dimension across
+            the tensor model parallel group. They are then already distributed, so
+            `distribute_saved_activations` is ignored.
+    """
+    if distribute_saved_activations and sequence_parallel_enabled:
+        _logger.debug("`distribute_saved_activations` is ignored as the inputs are split by sequence parallelism")
+        distribute_saved_activations = False
+    if distribute_saved_activations and get_tensor_model_parallel_world_size() == 1:
+        distribute_saved_activations = False
+    return SelectiveRecomputeFunction.apply(function, name, distribute_saved_activations, *args)
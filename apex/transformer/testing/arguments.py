@@ -302,7 +302,7 @@ def parse_args(extra_args_provider=None, defaults={},
             'v1.10 and above (Nvidia Pytorch container >= 21.07). Current ' \
             'pytorch version is v%s.%s.' % (TORCH_MAJOR, TORCH_MINOR)
 
-    if args.recompute_granularity == 'selective':
+    if args.recompute_granularity in ('selective', 'selective_softmax'):
         assert args.recompute_method is None, \
             'recompute method is not yet supported for ' \
             'selective recomputing granularity'
@@ -497,13 +497,15 @@ def _add_training_args(parser):
                        help='recompute activation to allow for training '
                        'with larger models, sequences, and batch sizes.')
     group.add_argument('--recompute-granularity', type=str, default=None,
-                       choices=['full', 'selective'],
+                       choices=['full', 'selective', 'selective_softmax'],
                        help='Checkpoint activations to allow for training '
                        'with larger models, sequences, and batch sizes. '
-                       'It is supported at two granularities 1) full: '
+                       'It is supported at three granularities 1) full: '
                        'whole transformer layer is recomputed, '
                        '2) selective: core attention part of the transformer '
-                       'layer is recomputed.')
+                       'layer is recomputed, 3) selective_softmax: only the '
+                       'softmax and dropout of the core attention are '
+                       'recomputed, the outputs of its GEMMs stay saved.')
     group.add_argument('--distribute-saved-activations',
                        action='store_true',
                        help='If set, distribute recomputed activations '
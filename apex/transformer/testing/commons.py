@@ -86,6 +86,7 @@ class ToyParallelMLP(nn.Module):
         hidden_size: int, pre_process: bool = False, post_process: bool = False,
         *,
         sequence_parallel_enabled: bool = False,
+        use_cpu_initialization: bool = False,
         # TODO(mkozuki): Support these two?
         add_encoder: bool = False, add_decoder: bool = False,
     ) -> None:
@@ -101,7 +102,7 @@ class ToyParallelMLP(nn.Module):
             gather_output=False,
             # init_method=init_method,
             skip_bias_add=True,
-            # use_cpu_initialization=use_cpu_initialization,
+            use_cpu_initialization=use_cpu_initialization,
             bias=True,
             sequence_parallel_enabled=sequence_parallel_enabled,
             no_async_tensor_model_parallel_allreduce=True,
@@ -112,7 +113,7 @@ class ToyParallelMLP(nn.Module):
             input_is_parallel=True,
             # init_method=output_layer_init_method,
             skip_bias_add=False,
-            # use_cpu_initialization=use_cpu_initialization,
+            use_cpu_initialization=use_cpu_initialization,
             bias=True,
             sequence_parallel_enabled=sequence_parallel_enabled,
         )
@@ -170,6 +171,7 @@ def mlp_provider_func(
     add_encoder: bool = False,
     add_decoder: bool = False,
     sequence_parallel_enabled: bool = False,
+    use_cpu_initialization: bool = False,
 ) -> ToyParallelMLP:
     return ToyParallelMLP(
         hidden_size,
@@ -178,6 +180,7 @@ def mlp_provider_func(
         add_encoder=add_encoder,
         add_decoder=add_decoder,
         sequence_parallel_enabled=sequence_parallel_enabled,
+        use_cpu_initialization=use_cpu_initialization,
     )
 
 
@@ -34,11 +34,16 @@ class DistributedTestBase(common_distributed.MultiProcessTestCase):
 
     def setUp(self) -> None:
         super().setUp()
+        # `_spawn_processes` sets the start method of the whole process to "spawn", which breaks
+        # tests that later run in the same process and rely on the default one, e.g. with local
+        # objects passed to `DataLoader` workers.
+        self._prev_start_method = torch.multiprocessing.get_start_method(allow_none=True)
         self._setup_pre_spawn()
         self._spawn_processes()
 
     def tearDown(self) -> None:
         super().tearDown()
+        torch.multiprocessing.set_start_method(self._prev_start_method, force=True)
 
     @property
     def world_size(self) -> int:
@@ -56,8 +61,11 @@ class DistributedTestBase(common_distributed.MultiProcessTestCase):
     @classmethod
     def _run(cls, rank, test_name, file_name, pipe, **kwargs):
         self = cls(test_name)
-        self.assertTrue(torch.cuda.is_available())
         self.assertTrue(hasattr(self, "DISTRIBUTED_BACKEND"))
+        # gloo runs on CPU
+        use_cuda = self.DISTRIBUTED_BACKEND != "gloo"
+        if use_cuda:
+            self.assertTrue(torch.cuda.is_available())
         self.rank = rank
         self.file_name = file_name
 
@@ -76,7 +84,8 @@ class DistributedTestBase(common_distributed.MultiProcessTestCase):
                 sys.exit(0)
             raise
 
-        torch.cuda.set_device(self.rank % torch.cuda.device_count())
+        if use_cuda:
+            torch.cuda.set_device(self.rank % torch.cuda.device_count())
 
         dist.barrier()
         self.run_test(test_name, pipe)
@@ -94,6 +103,15 @@ class NcclDistributedTestBase(DistributedTestBase):
     DISTRIBUTED_BACKEND = "nccl"
 
 
+class GlooDistributedTestBase(DistributedTestBase):
+
+    DISTRIBUTED_BACKEND = "gloo"
+
+    @property
+    def world_size(self) -> int:
+        return 4
+
+
 @unittest.skipUnless(
     HAS_TORCH_UCC,
     "Requires [`torch_ucc`](https://github.com/facebookresearch/torch_ucc)",
@@ -259,6 +259,20 @@ class CoreAttention(MegatronModule):
         # different outputs on different number of parallel partitions but
         # on average it should not be partition dependent.
         self.attention_dropout = torch.nn.Dropout(args.attention_dropout)
+        self.recompute_softmax = args.recompute_granularity == "selective_softmax"
+
+    def _softmax_dropout(self, attention_scores, attention_mask):
+        # attention scores and attention mask [b, np, sq, sk]
+        attention_probs = self.scale_mask_softmax(attention_scores, attention_mask)
+
+        # This is actually dropping out entire tokens to attend to, which might
+        # seem a bit unusual, but is taken from the original Transformer paper.
+        if not self.sequence_parallel:
+            with tensor_parallel.get_cuda_rng_tracker().fork():
+                attention_probs = self.attention_dropout(attention_probs)
+        else:
+            attention_probs = self.attention_dropout(attention_probs)
+        return attention_probs
 
     def forward(self, query_layer, key_layer, value_layer, attention_mask):
         # ===================================
@@ -301,16 +315,16 @@ class CoreAttention(MegatronModule):
         # ===========================
         # Attention probs and dropout
         # ===========================
-        # attention scores and attention mask [b, np, sq, sk]
-        attention_probs = self.scale_mask_softmax(attention_scores, attention_mask)
-
-        # This is actually dropping out entire tokens to attend to, which might
-        # seem a bit unusual, but is taken from the original Transformer paper.
-        if not self.sequence_parallel:
-            with tensor_parallel.get_cuda_rng_tracker().fork():
-                attention_probs = self.attention_dropout(attention_probs)
+        if self.recompute_softmax:
+            attention_probs = tensor_parallel.recompute(
+                self._softmax_dropout,
+                attention_scores,
+                attention_mask,
+                name=f"core_attention.{self.layer_number}",
+                sequence_parallel_enabled=self.sequence_parallel,
+            )
         else:
-            attention_probs = self.attention_dropout(attention_probs)
+            attention_probs = self._softmax_dropout(attention_scores, attention_mask)
 
         # =========================
         # Context layer. [sq, b, hp]
@@ -37,7 +37,7 @@ def gather_split_1d_tensor(tensor):
     gathered = torch.empty(
         numel_gathered,
         dtype=tensor.dtype,
-        device=torch.cuda.current_device(),
+        device=tensor.device,
         requires_grad=False,
     )
     torch.distributed._all_gather_base(
@@ -27,6 +27,11 @@ void multi_tensor_axpby_cuda(
   float b,
   int arg_to_check);
 
+void multi_tensor_mask_cuda(
+  int chunk_size,
+  at::Tensor noop_flag,
+  std::vector<std::vector<at::Tensor>> tensor_lists);
+
 std::tuple<at::Tensor, at::Tensor> multi_tensor_l2norm_cuda(
   int chunk_size,
   at::Tensor noop_flag,
@@ -196,6 +201,8 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
         "Fused SGD optimizer for list of contiguous tensors");
   m.def("multi_tensor_axpby", &multi_tensor_axpby_cuda,
         "out = a*x + b*y for a list of contiguous tensors");
+  m.def("multi_tensor_mask", &multi_tensor_mask_cuda,
+        "x = x * mask for a list of contiguous tensors and their bool masks");
   m.def("multi_tensor_l2norm", &multi_tensor_l2norm_cuda,
         "Computes L2 norm for a list of contiguous tensors");
   m.def("multi_tensor_l2norm_mp", &multi_tensor_l2norm_mp_cuda,
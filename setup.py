@@ -309,6 +309,7 @@ if "--cuda_ext" in sys.argv:
                 'csrc/multi_tensor_sgd_kernel.cu',
                 'csrc/multi_tensor_scale_kernel.cu',
                 'csrc/multi_tensor_axpby_kernel.cu',
+                'csrc/multi_tensor_mask_kernel.cu',
                 'csrc/multi_tensor_l2norm_kernel.cu',
                 'csrc/multi_tensor_l2norm_kernel_mp.cu',
                 'csrc/multi_tensor_l2norm_scale_kernel.cu',
@@ -137,13 +137,13 @@ def fwd_step_func(batch, model):
 
 
 def train(
-    model, optim, virtual_pipeline_model_parallel_size, pipeline_model_parallel_size, async_comm
+    model, optim, virtual_pipeline_model_parallel_size, pipeline_model_parallel_size, async_comm, split_backward=False
 ):
     sequence_len = global_vars.get_args().seq_length
     micro_batch_size = global_vars.get_args().micro_batch_size
     hidden_size = global_vars.get_args().hidden_size
     forward_backward_func = get_forward_backward_func(
-        virtual_pipeline_model_parallel_size, pipeline_model_parallel_size
+        virtual_pipeline_model_parallel_size, pipeline_model_parallel_size, split_backward=split_backward
     )
     tensor_shape = (args.seq_length, args.micro_batch_size, args.hidden_size)
     for _ in range(16):
@@ -186,12 +186,15 @@ if __name__ == "__main__":
     failure = None
     init = True
     try:
-        virtual_pipeline_model_parallel_sizes = (None, 2,)
+        schedule_configs = ((None, False), (2, False),)
         if HAS_TORCH_UCC:
             # Deliberately skipping test with interleaved schedule for BERT model.
             # It deadlocks on hybrid UCC/NCCL backend.
-            virtual_pipeline_model_parallel_sizes = (None,)
-        for virtual_pipeline_model_parallel_size in virtual_pipeline_model_parallel_sizes:
+            schedule_configs = ((None, False),)
+        # The deferred weight gradients of the split backward schedule bypass DDP's gradient hooks.
+        if global_vars.get_args().data_parallel_size == 1:
+            schedule_configs += ((None, True),)
+        for virtual_pipeline_model_parallel_size, split_backward in schedule_configs:
             args = global_vars.get_args()
             async_comm = not args.sequence_parallel and virtual_pipeline_model_parallel_size is None
             data_idx = 0
@@ -246,6 +249,7 @@ if __name__ == "__main__":
                 virtual_pipeline_model_parallel_size,
                 args.pipeline_model_parallel_size,
                 async_comm,
+                split_backward,
             )
     except Exception as e:
         failure = str(e)
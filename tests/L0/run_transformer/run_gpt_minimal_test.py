@@ -27,6 +27,9 @@ from apex.transformer.pipeline_parallel.schedules.common import (
 from apex.transformer.pipeline_parallel.schedules.fwd_bwd_pipelining_without_interleaving import (
     forward_backward_pipelining_without_interleaving,
 )
+from apex.transformer.pipeline_parallel.schedules.fwd_bwd_pipelining_with_split_backward import (
+    forward_backward_pipelining_with_split_backward,
+)
 from apex.transformer.testing.standalone_gpt import gpt_model_provider
 from apex.transformer.testing import global_vars
 from apex.transformer.testing.commons import TEST_SUCCESS_MESSAGE
@@ -113,11 +116,14 @@ def fwd_step_func(batch, model):
     return output_tensor, partial(loss_func, loss_mask)
 
 
-def train(model, optim, pipeline_model_parallel_size, async_comm):
+def train(model, optim, pipeline_model_parallel_size, async_comm, split_backward=False):
     sequence_len = global_vars.get_args().seq_length
     micro_batch_size = global_vars.get_args().micro_batch_size
     hidden_size = global_vars.get_args().hidden_size
-    fwd_bwd_func = forward_backward_pipelining_without_interleaving
+    if split_backward:
+        fwd_bwd_func = forward_backward_pipelining_with_split_backward
+    else:
+        fwd_bwd_func = forward_backward_pipelining_without_interleaving
 
     tensor_shape = (args.seq_length, args.micro_batch_size, args.hidden_size)
     runtime = 0
@@ -163,7 +169,11 @@ def train(model, optim, pipeline_model_parallel_size, async_comm):
 if __name__ == "__main__":
     init = True
     global_vars.set_global_variables()
-    for async_comm in (False,) if global_vars.get_args().sequence_parallel else (False, True):
+    schedule_configs = [(False, False)] if global_vars.get_args().sequence_parallel else [(False, False), (True, False)]
+    # The deferred weight gradients of the split backward schedule bypass DDP's gradient hooks.
+    if global_vars.get_args().data_parallel_size == 1:
+        schedule_configs.append((False, True))
+    for async_comm, split_backward in schedule_configs:
         global fancy_data
         global effective_length
 
@@ -214,7 +224,7 @@ if __name__ == "__main__":
         assert isinstance(model, list), model
         _param_groups = _get_params_for_weight_decay_optimization(model)
         optim = torch.optim.Adam(_param_groups)
-        runtime = train(model, optim, args.pipeline_model_parallel_size, async_comm)
+        runtime = train(model, optim, args.pipeline_model_parallel_size, async_comm, split_backward)
 
         parallel_state.destroy_model_parallel()
     torch.distributed.barrier()
@@ -0,0 +1,179 @@
+import logging
+
+import torch
+from torch.testing._internal import common_utils
+
+logging.getLogger("torch").setLevel(logging.WARNING)
+
+from apex.transformer import parallel_state
+from apex.transformer.pipeline_parallel import utils as pp_utils
+from apex.transformer.pipeline_parallel.activation_offload import ActivationOffloadManager
+from apex.transformer.pipeline_parallel.schedules.fwd_bwd_pipelining_without_interleaving import (
+    forward_backward_pipelining_without_interleaving,
+)
+from apex.transformer.testing.distributed_test_base import GlooDistributedTestBase
+from apex.transformer.testing import commons as testing_utils
+
+logging.getLogger("apex").setLevel(logging.WARNING)
+
+
+class ActivationOffloadManagerTest(common_utils.TestCase):
+
+    num_microbatches = 4
+    shape = (8, 16)
+
+    def setUp(self):
+        super().setUp()
+        torch.manual_seed(42)
+        self.model = torch.nn.Sequential(torch.nn.Linear(16, 32), torch.nn.GELU(), torch.nn.Linear(32, 16))
+        self.inputs = [torch.randn(self.shape) for _ in range(self.num_microbatches)]
+
+    def _run(self, manager):
+        """Run all the forwards, then all the backwards in the same order as the warmup and cooldown of 1F1B."""
+        self.model.zero_grad(set_to_none=True)
+        input_tensors, losses = [], []
+        for x in self.inputs:
+            input_tensor = x.clone().requires_grad_()
+            with manager.stash(input_tensor):
+                losses.append(self.model(input_tensor).pow(2).sum())
+            input_tensors.append(input_tensor)
+        input_grads = []
+        for input_tensor, loss in zip(input_tensors, losses):
+            with manager.restore():
+                loss.backward()
+            input_grads.append(input_tensor.grad)
+        return input_grads, [p.grad for p in self.model.parameters()]
+
+    def _run_reference(self):
+        self.model.zero_grad(set_to_none=True)
+        input_grads = []
+        for x in self.inputs:
+            input_tensor = x.clone().requires_grad_()
+            self.model(input_tensor).pow(2).sum().backward()
+            input_grads.append(input_tensor.grad)
+        return input_grads, [p.grad for p in self.model.parameters()]
+
+    def test_offload_all(self):
+        manager = ActivationOffloadManager(min_offload_numel=0)
+        input_grads, param_grads = self._run(manager)
+        ref_input_grads, ref_param_grads = self._run_reference()
+        self.assertEqual(input_grads, ref_input_grads)
+        self.assertEqual(param_grads, ref_param_grads)
+
+        stats = manager.stats()
+        self.assertEqual(stats["stashed"], 0)
+        self.assertEqual(stats["resident_bytes"], 0)
+        self.assertGreater(stats["offloaded_bytes"], 0)
+        self.assertEqual(stats["reloaded_bytes"], stats["offloaded_bytes"])
+
+    def test_memory_budget(self):
+        # Measure the activations of one microbatch.
+        manager = ActivationOffloadManager(memory_budget=float("inf"), min_offload_numel=0)
+        with manager.stash(self.inputs[0].clone().requires_grad_()):
+            self.model(self.inputs[0]).sum()
+        microbatch_bytes = manager.resident_bytes
+        self.assertGreater(microbatch_bytes, 0)
+
+        budget = 2 * microbatch_bytes
+        manager = ActivationOffloadManager(memory_budget=budget, prefetch_distance=0, min_offload_numel=0)
+        input_grads, param_grads = self._run(manager)
+        ref_input_grads, ref_param_grads = self._run_reference()
+        self.assertEqual(input_grads, ref_input_grads)
+        self.assertEqual(param_grads, ref_param_grads)
+        # The first two microbatches stay on the device and the last two are offloaded.
+        self.assertEqual(manager.offloaded_bytes, 2 * microbatch_bytes)
+        self.assertLessEqual(manager.peak_resident_bytes, budget)
+
+    def test_prefetch_distance(self):
+        manager = ActivationOffloadManager(prefetch_distance=2, min_offload_numel=0)
+        input_tensors, losses = [], []
+        for x in self.inputs:
+            input_tensor = x.clone().requires_grad_()
+            with manager.stash(input_tensor):
+                losses.append(self.model(input_tensor).sum())
+            input_tensors.append(input_tensor)
+        # Inputs are offloaded by releasing their data.
+        self.assertEqual([t.numel() for t in input_tensors], [0] * self.num_microbatches)
+        microbatch_bytes = manager.offloaded_bytes // self.num_microbatches
+        with manager.restore():
+            self.assertEqual(input_tensors[0].shape, self.shape)
+            # The microbatch about to run backward and the next two are copied back to the device.
+            self.assertEqual(manager.reloaded_bytes, 3 * microbatch_bytes)
+            losses[0].backward()
+        self.assertEqual(len(manager), self.num_microbatches - 1)
+        self.assertIsNotNone(input_tensors[0].grad)
+
+    def test_restore_without_stash(self):
+        manager = ActivationOffloadManager()
+        with self.assertRaisesRegex(RuntimeError, "no stashed activations"):
+            with manager.restore():
+                pass
+
+    def test_invalid_prefetch_distance(self):
+        with self.assertRaisesRegex(ValueError, "prefetch_distance"):
+            ActivationOffloadManager(prefetch_distance=-1)
+
+
+class GlooActivationOffloadPipelineTest(GlooDistributedTestBase):
+
+    GLOBAL_BATCH_SIZE = 16
+    MICRO_BATCH_SIZE = 2
+    SEQUENCE_LENGTH = 8
+    HIDDEN_SIZE = 16
+
+    def _run_schedule(self, model, batch, activation_offload_manager=None):
+        for param in model.parameters():
+            param.grad = None
+        losses = forward_backward_pipelining_without_interleaving(
+            testing_utils.ToyParallelMLPFwdBwdStepFunc(False),
+            batch,
+            model,
+            forward_only=False,
+            tensor_shape=(self.SEQUENCE_LENGTH, self.MICRO_BATCH_SIZE, self.HIDDEN_SIZE),
+            dtype=torch.float32,
+            deallocate_pipeline_outputs=activation_offload_manager is not None,
+            activation_offload_manager=activation_offload_manager,
+        )
+        return losses, {name: param.grad for name, param in model.named_parameters()}
+
+    def test_activation_offload(self):
+        parallel_state.initialize_model_parallel(
+            tensor_model_parallel_size_=1,
+            pipeline_model_parallel_size_=self.world_size,
+        )
+        pp_utils._reconfigure_microbatch_calculator(
+            rank=parallel_state.get_tensor_model_parallel_rank(),
+            rampup_batch_size=None,
+            global_batch_size=self.GLOBAL_BATCH_SIZE,
+            micro_batch_size=self.MICRO_BATCH_SIZE,
+            data_parallel_size=parallel_state.get_data_parallel_world_size(),
+        )
+        torch.manual_seed(42)
+        model = testing_utils.mlp_provider_func(
+            self.HIDDEN_SIZE,
+            pre_process=parallel_state.is_pipeline_first_stage(),
+            post_process=parallel_state.is_pipeline_last_stage(),
+            use_cpu_initialization=True,
+        )
+        batch = None
+        if parallel_state.is_pipeline_first_stage():
+            batch = (torch.randn(self.GLOBAL_BATCH_SIZE, self.SEQUENCE_LENGTH, self.HIDDEN_SIZE),)
+
+        ref_losses, ref_grads = self._run_schedule(model, batch)
+        manager = ActivationOffloadManager(min_offload_numel=0)
+        losses, grads = self._run_schedule(model, batch, manager)
+
+        self.assertEqual(len(losses), len(ref_losses))
+        for loss, ref_loss in zip(losses, ref_losses):
+            self.assertEqual(loss["avg"], ref_loss["avg"])
+        for name, ref_grad in ref_grads.items():
+            self.assertIsNotNone(grads[name], msg=name)
+            self.assertEqual(grads[name], ref_grad, msg=name)
+        self.assertEqual(len(manager), 0)
+        self.assertGreater(manager.offloaded_bytes, 0)
+
+        parallel_state.destroy_model_parallel()
+
+
+if __name__ == "__main__":
+    common_utils.run_tests()
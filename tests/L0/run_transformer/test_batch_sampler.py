@@ -7,6 +7,7 @@ from torch.utils.data import RandomSampler
 from torch.utils.data import BatchSampler
 from torch.utils.data import DataLoader
 
+from apex.transformer import _data
 from apex.transformer.pipeline_parallel.utils import _split_batch_into_microbatch as split_batch_into_microbatch
 
 
@@ -138,5 +139,146 @@ class TestBatchSamplerBehavior(common_utils.TestCase):
             self.assertEqual(len(microbatches[0][0]), _micro_batch_size)
 
 
+
+class TestSortBySequenceLength(common_utils.TestCase):
+
+    total_samples = 64
+    local_minibatch_size = 8
+    data_parallel_size = 2
+
+    def _check(self, sampler_cls):
+        sequence_lengths = [(idx * 7) % 13 + 1 for idx in range(self.total_samples)]
+        for data_parallel_rank in range(self.data_parallel_size):
+            args = (self.total_samples, 0, self.local_minibatch_size, data_parallel_rank, self.data_parallel_size)
+            batches = list(sampler_cls(*args))
+            sorted_batches = list(sampler_cls(*args, sequence_lengths=sequence_lengths))
+            self.assertEqual(len(sorted_batches), len(batches))
+            for batch, sorted_batch in zip(batches, sorted_batches):
+                self.assertEqual(sorted(sorted_batch), sorted(batch))
+                lengths = [sequence_lengths[idx] for idx in sorted_batch]
+                self.assertEqual(lengths, sorted(lengths, reverse=True))
+
+    def test_pretraining_sampler(self):
+        self._check(_data.MegatronPretrainingSampler)
+
+    def test_pretraining_random_sampler(self):
+        self._check(_data.MegatronPretrainingRandomSampler)
+
+
+class TestVectorizedRandomSampler(common_utils.TestCase):
+
+    total_samples = 100
+    local_minibatch_size = 4
+    data_parallel_size = 2
+
+    def _batches(self, consumed_samples, data_parallel_rank, **kwargs):
+        sampler = _data.MegatronPretrainingRandomSampler(
+            self.total_samples, consumed_samples, self.local_minibatch_size,
+            data_parallel_rank, self.data_parallel_size, **kwargs,
+        )
+        return list(sampler)
+
+    def test_same_order_as_lists(self):
+        for data_parallel_rank in range(self.data_parallel_size):
+            for consumed_samples in (0, 40, 3 * 96 + 16):
+                batches = self._batches(consumed_samples, data_parallel_rank)
+                vectorized_batches = self._batches(consumed_samples, data_parallel_rank, vectorized=True)
+                self.assertTrue(all(isinstance(batch, torch.Tensor) for batch in vectorized_batches))
+                self.assertEqual([batch.tolist() for batch in vectorized_batches], batches)
+
+    def test_chunked_permutation(self):
+        chunk_size = 7
+        bucket_size = (self.total_samples // (self.local_minibatch_size * self.data_parallel_size)) * self.local_minibatch_size
+        for data_parallel_rank in range(self.data_parallel_size):
+            batches = self._batches(0, data_parallel_rank, vectorized=True, permutation_chunk_size=chunk_size)
+            indices = torch.cat(batches)
+            start_idx = data_parallel_rank * bucket_size
+            self.assertEqual(sorted(indices.tolist()), list(range(start_idx, start_idx + bucket_size)))
+            self.assertNotEqual(indices.tolist(), sorted(indices.tolist()))
+            # Resuming skips ahead to the same batches, including from the middle of a chunk.
+            for num_batches in (1, 5, len(batches) - 1):
+                consumed_samples = num_batches * self.local_minibatch_size * self.data_parallel_size
+                resumed_batches = self._batches(
+                    consumed_samples, data_parallel_rank, vectorized=True, permutation_chunk_size=chunk_size
+                )
+                self.assertEqual(resumed_batches, batches[num_batches:])
+            # A new epoch has a new order.
+            consumed_samples = 2 * len(batches) * self.local_minibatch_size * self.data_parallel_size
+            next_epoch_batches = self._batches(
+                consumed_samples, data_parallel_rank, vectorized=True, permutation_chunk_size=chunk_size
+            )
+            self.assertNotEqual(torch.cat(next_epoch_batches).tolist(), indices.tolist())
+
+    def test_sort_by_sequence_length(self):
+        sequence_lengths = [(idx * 7) % 13 + 1 for idx in range(self.total_samples)]
+        batches = self._batches(0, 0, sequence_lengths=sequence_lengths)
+        vectorized_batches = self._batches(0, 0, vectorized=True, sequence_lengths=sequence_lengths)
+        self.assertEqual([batch.tolist() for batch in vectorized_batches], batches)
+
+
+class TestBucketedSampler(common_utils.TestCase):
+
+    total_samples = 200
+    local_minibatch_size = 4
+    data_parallel_size = 2
+    bucket_boundaries = (16, 64, 256)
+
+    def setUp(self):
+        super().setUp()
+        g = torch.Generator()
+        g.manual_seed(0)
+        self.sequence_lengths = torch.randint(1, 512, (self.total_samples,), generator=g).tolist()
+
+    def _batches(self, consumed_samples, data_parallel_rank, **kwargs):
+        kwargs.setdefault("bucket_boundaries", self.bucket_boundaries)
+        sampler = _data.MegatronPretrainingBucketedSampler(
+            self.total_samples, consumed_samples, self.local_minibatch_size,
+            data_parallel_rank, self.data_parallel_size, self.sequence_lengths, **kwargs,
+        )
+        return list(sampler)
+
+    def _bucket(self, idx):
+        return sum(self.sequence_lengths[idx] >= boundary for boundary in self.bucket_boundaries)
+
+    def test_sharding(self):
+        global_batch_size = self.local_minibatch_size * self.data_parallel_size
+        num_batches = self.total_samples // global_batch_size
+        rank_batches = [self._batches(0, rank) for rank in range(self.data_parallel_size)]
+        indices = [idx for batches in rank_batches for batch in batches for idx in batch]
+        self.assertEqual(len(indices), num_batches * global_batch_size)
+        self.assertEqual(len(set(indices)), len(indices))
+        for batches in rank_batches:
+            self.assertEqual(len(batches), num_batches)
+            for batch in batches:
+                lengths = [self.sequence_lengths[idx] for idx in batch]
+                self.assertEqual(lengths, sorted(lengths, reverse=True))
+        # All but the global batches made of the samples left over by the buckets hold a single bucket.
+        mixed = 0
+        for global_batch in zip(*rank_batches):
+            mixed += len({self._bucket(idx) for batch in global_batch for idx in batch}) > 1
+        self.assertLess(mixed, len(self.bucket_boundaries) + 1)
+
+    def test_resume(self):
+        global_batch_size = self.local_minibatch_size * self.data_parallel_size
+        for rank in range(self.data_parallel_size):
+            batches = self._batches(0, rank)
+            for num_batches in (1, 10, len(batches) - 1):
+                self.assertEqual(self._batches(num_batches * global_batch_size, rank), batches[num_batches:])
+            next_epoch_batches = self._batches(len(batches) * global_batch_size, rank)
+            self.assertEqual(len(next_epoch_batches), len(batches))
+            self.assertNotEqual(next_epoch_batches, batches)
+            self.assertEqual(self._batches(len(batches) * global_batch_size, rank), next_epoch_batches)
+
+    def test_num_buckets(self):
+        sampler = _data.MegatronPretrainingBucketedSampler(
+            self.total_samples, 0, self.local_minibatch_size, 0, self.data_parallel_size,
+            torch.tensor(self.sequence_lengths), num_buckets=5,
+        )
+        self.assertEqual(len(sampler.buckets), 5)
+        self.assertEqual(sum(bucket.numel() for bucket in sampler.buckets), self.total_samples)
+        for bucket in sampler.buckets:
+            self.assertEqual(bucket.numel(), self.total_samples // 5)
+
+
 if __name__ == "__main__":
     common_utils.run_tests()
@@ -11,6 +11,7 @@ from apex.transformer import parallel_state
 from apex.transformer import tensor_parallel
 from apex.transformer.tensor_parallel import cross_entropy
 from apex.transformer.testing.commons import set_random_seed, IdentityLayer
+from apex.transformer.testing.distributed_test_base import GlooDistributedTestBase
 from apex.transformer.testing.distributed_test_base import NcclDistributedTestBase
 from apex.transformer.testing.distributed_test_base import UccDistributedTestBase
 
@@ -85,6 +86,199 @@ class VocabParallelCrossEntropyTestBase:
 
                 parallel_state.destroy_model_parallel()
 
+    def test_chunked_cross_entropy_peak_memory(self):
+        parallel_state.initialize_model_parallel()
+        num_tokens, hidden_size, vocab_size = 4096, 64, 8192
+        torch.manual_seed(1234)
+        hidden = torch.randn(num_tokens, hidden_size, device="cuda", requires_grad=True)
+        weight = torch.randn(vocab_size, hidden_size, device="cuda", requires_grad=True)
+        target = torch.randint(0, vocab_size, (num_tokens,), device="cuda")
+
+        def peak_memory(**kwargs):
+            hidden.grad, weight.grad = None, None
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            allocated = torch.cuda.memory_allocated()
+            cross_entropy.vocab_parallel_cross_entropy(F.linear(hidden, weight), target, **kwargs).sum().backward()
+            torch.cuda.synchronize()
+            return torch.cuda.max_memory_allocated() - allocated
+
+        logits_bytes = num_tokens * vocab_size * 4
+        # The softmax of the unchunked loss doubles the memory of the logits, the chunks only add a fraction.
+        self.assertLessEqual(peak_memory(chunk_size=256, inplace_backward=True) + logits_bytes // 2, peak_memory())
+
+        parallel_state.destroy_model_parallel()
+
+
+class GlooChunkedVocabParallelCrossEntropyTest(GlooDistributedTestBase):
+
+    batch_size, sequence_length, vocab_size_per_partition = 13, 17, 11
+
+    def _check(self, tensor_model_parallel_world_size, label_smoothing, chunk_size):
+        parallel_state.initialize_model_parallel(tensor_model_parallel_size_=tensor_model_parallel_world_size)
+        rank = parallel_state.get_tensor_model_parallel_rank()
+        vocab_size = self.vocab_size_per_partition * tensor_model_parallel_world_size
+        torch.manual_seed(1234)
+        logits = torch.randn(self.batch_size, self.sequence_length, vocab_size) * 10.0
+        target = torch.randint(0, vocab_size, (self.batch_size, self.sequence_length))
+        grad_output = torch.rand(self.batch_size, self.sequence_length)
+
+        logits.requires_grad_()
+        loss_torch = F.cross_entropy(
+            logits.view(-1, vocab_size), target.view(-1), reduction="none", label_smoothing=label_smoothing,
+        ).view_as(target)
+        loss_torch.backward(grad_output)
+
+        start = rank * self.vocab_size_per_partition
+        logits_parallel = logits.detach()[..., start:start + self.vocab_size_per_partition].clone().requires_grad_()
+        logits_parallel_ = logits_parallel.detach().clone()
+        loss = cross_entropy.vocab_parallel_cross_entropy(
+            logits_parallel, target, label_smoothing, chunk_size=chunk_size,
+        )
+        loss.backward(grad_output)
+        # check for mutation
+        self.assertEqual(logits_parallel.detach(), logits_parallel_)
+        self.assertEqual(loss, loss_torch)
+        self.assertEqual(logits_parallel.grad, logits.grad[..., start:start + self.vocab_size_per_partition])
+
+        parallel_state.destroy_model_parallel()
+
+    def test_chunked_cross_entropy(self):
+        for tensor_model_parallel_world_size in (1, 2, 4):
+            for label_smoothing, chunk_size in ((0.0, 16), (0.1, 16), (0.1, None), (0.0, 1000)):
+                with self.subTest(
+                    tensor_model_parallel_world_size=tensor_model_parallel_world_size,
+                    label_smoothing=label_smoothing,
+                    chunk_size=chunk_size,
+                ):
+                    self._check(tensor_model_parallel_world_size, label_smoothing, chunk_size)
+
+    def test_unchunked_cross_entropy(self):
+        self._check(self.world_size, 0.0, None)
+
+    def _forward_backward(self, hidden, weight, target, **kwargs):
+        hidden = hidden.detach().requires_grad_()
+        weight = weight.detach().requires_grad_()
+        logits = F.linear(hidden, weight)
+        logits_grads = []
+        logits.register_hook(logits_grads.append)
+
+        # The bytes saved for backward besides the logits.
+        saved_storages = {}
+
+        def pack(tensor):
+            storage = tensor.untyped_storage()
+            if storage.data_ptr() != logits.untyped_storage().data_ptr():
+                saved_storages[storage.data_ptr()] = storage.nbytes()
+            return tensor
+
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            loss = cross_entropy.vocab_parallel_cross_entropy(logits, target, **kwargs)
+        loss.sum().backward()
+        grad_in_place = logits_grads[0].untyped_storage().data_ptr() == logits.untyped_storage().data_ptr()
+        return loss, hidden.grad, weight.grad, sum(saved_storages.values()), grad_in_place
+
+    def test_chunked_cross_entropy_memory(self):
+        parallel_state.initialize_model_parallel(tensor_model_parallel_size_=self.world_size)
+        vocab_size_per_partition, hidden_size = 64, 8
+        torch.manual_seed(1234)
+        hidden = torch.randn(self.sequence_length, self.batch_size, hidden_size)
+        weight = torch.randn(vocab_size_per_partition, hidden_size)
+        target = torch.randint(0, vocab_size_per_partition * self.world_size, (self.sequence_length, self.batch_size))
+        logits_bytes = self.sequence_length * self.batch_size * vocab_size_per_partition * 4
+
+        loss, hidden_grad, weight_grad, saved_bytes, grad_in_place = self._forward_backward(hidden, weight, target)
+        for inplace_backward in (False, True):
+            with self.subTest(inplace_backward=inplace_backward):
+                (
+                    chunked_loss, chunked_hidden_grad, chunked_weight_grad, chunked_saved_bytes, chunked_grad_in_place,
+                ) = self._forward_backward(hidden, weight, target, chunk_size=16, inplace_backward=inplace_backward)
+
+                # The unchunked loss allocates and keeps the softmax, the chunked one only statistics of each token.
+                self.assertGreaterEqual(saved_bytes, logits_bytes)
+                self.assertLess(chunked_saved_bytes, logits_bytes // 4)
+                # Only `inplace_backward` builds the gradient of the logits in place of them.
+                self.assertFalse(grad_in_place)
+                self.assertEqual(chunked_grad_in_place, inplace_backward)
+                self.assertEqual(chunked_loss, loss)
+                self.assertEqual(chunked_hidden_grad, hidden_grad)
+                self.assertEqual(chunked_weight_grad, weight_grad)
+
+        parallel_state.destroy_model_parallel()
+
+    def test_chunked_cross_entropy_keeps_logits(self):
+        parallel_state.initialize_model_parallel(tensor_model_parallel_size_=self.world_size)
+        torch.manual_seed(1234)
+        x = torch.randn(self.batch_size, self.sequence_length, self.vocab_size_per_partition, requires_grad=True)
+        target = torch.randint(0, self.vocab_size_per_partition * self.world_size, (self.batch_size, self.sequence_length))
+
+        # The backward of tanh needs its output, i.e. the logits.
+        logits = torch.tanh(x)
+        logits.retain_grad()
+        logits_ = logits.detach().clone()
+        cross_entropy.vocab_parallel_cross_entropy(logits, target, 0.1).sum().backward()
+        self.assertEqual(logits.detach(), logits_)
+        self.assertEqual(x.grad, (1.0 - logits_ ** 2) * logits.grad)
+        # Overwriting the logits is only allowed when asked for, and autograd catches it here.
+        with self.assertRaisesRegex(RuntimeError, "inplace operation"):
+            cross_entropy.vocab_parallel_cross_entropy(
+                torch.tanh(x), target, 0.1, inplace_backward=True,
+            ).sum().backward()
+
+        parallel_state.destroy_model_parallel()
+
+        parallel_state.destroy_model_parallel()
+
+
+class GlooVocabParallelLinearCrossEntropyTest(GlooDistributedTestBase):
+
+    sequence_length, batch_size, hidden_size, vocab_size_per_partition = 17, 3, 8, 11
+
+    def _check(self, tensor_model_parallel_world_size, label_smoothing, use_bias):
+        parallel_state.initialize_model_parallel(tensor_model_parallel_size_=tensor_model_parallel_world_size)
+        rank = parallel_state.get_tensor_model_parallel_rank()
+        vocab_size = self.vocab_size_per_partition * tensor_model_parallel_world_size
+        torch.manual_seed(1234)
+        input = torch.randn(self.sequence_length, self.batch_size, self.hidden_size, requires_grad=True)
+        weight = torch.randn(vocab_size, self.hidden_size, requires_grad=True)
+        bias = torch.randn(vocab_size, requires_grad=True) if use_bias else None
+        target = torch.randint(0, vocab_size, (self.sequence_length, self.batch_size))
+        grad_output = torch.rand(self.sequence_length, self.batch_size)
+
+        # Reference: the full logits followed by the cross entropy.
+        logits = F.linear(input, weight, bias)
+        loss_torch = F.cross_entropy(
+            logits.view(-1, vocab_size), target.view(-1), reduction="none", label_smoothing=label_smoothing,
+        ).view_as(target)
+        loss_torch.backward(grad_output)
+
+        partition = slice(rank * self.vocab_size_per_partition, (rank + 1) * self.vocab_size_per_partition)
+        input_ = input.detach().clone().requires_grad_()
+        weight_parallel = weight.detach()[partition].clone().requires_grad_()
+        bias_parallel = bias.detach()[partition].clone().requires_grad_() if use_bias else None
+        loss = tensor_parallel.vocab_parallel_linear_cross_entropy(
+            input_, weight_parallel, target, bias_parallel, label_smoothing, chunk_size=16, vocab_chunk_size=4,
+        )
+        loss.backward(grad_output)
+
+        self.assertEqual(loss, loss_torch)
+        self.assertEqual(input_.grad, input.grad)
+        self.assertEqual(weight_parallel.grad, weight.grad[partition])
+        if use_bias:
+            self.assertEqual(bias_parallel.grad, bias.grad[partition])
+
+        parallel_state.destroy_model_parallel()
+
+    def test_vocab_parallel_linear_cross_entropy(self):
+        for tensor_model_parallel_world_size in (1, 2, 4):
+            for label_smoothing, use_bias in ((0.0, False), (0.1, True)):
+                with self.subTest(
+                    tensor_model_parallel_world_size=tensor_model_parallel_world_size,
+                    label_smoothing=label_smoothing,
+                    use_bias=use_bias,
+                ):
+                    self._check(tensor_model_parallel_world_size, label_smoothing, use_bias)
+
 
 class NcclVocabParallelCrossEntropyTest(VocabParallelCrossEntropyTestBase, NcclDistributedTestBase): pass
 class UccVocabParallelCrossEntropyTest(VocabParallelCrossEntropyTestBase, UccDistributedTestBase): pass
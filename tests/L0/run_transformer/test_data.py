@@ -7,6 +7,7 @@ logging.getLogger("torch").setLevel(logging.WARNING)
 
 from apex.transformer import parallel_state
 from apex.transformer.tensor_parallel import data as data_utils
+from apex.transformer.testing.distributed_test_base import GlooDistributedTestBase
 from apex.transformer.testing.distributed_test_base import NcclDistributedTestBase
 from apex.transformer.testing.distributed_test_base import UccDistributedTestBase
 
@@ -51,11 +52,34 @@ class BroadcastDataTestBase:
 
         broadcasted_data = data_utils.broadcast_data(keys, data, torch.int64)
         for key in keys:
-            self.assertEqual(broadcasted_data[key], data_t[key].cuda())
+            self.assertEqual(broadcasted_data[key], data_t[key].to(broadcasted_data[key].device))
 
         parallel_state.destroy_model_parallel()
 
+    def test_broadcast_data_static_shapes(self):
+        parallel_state.initialize_model_parallel(tensor_model_parallel_size_=self.world_size)
+        data_utils.clear_broadcast_data_cache()
+
+        keys = ["tokens", "labels"]
+        for step in range(3):
+            data = {
+                "tokens": torch.full((2, 8), step, dtype=torch.int64),
+                "labels": torch.arange(16, dtype=torch.int64).view(2, 8) + step,
+            }
+            data_t = {key: value.clone() for key, value in data.items()}
+            if parallel_state.get_tensor_model_parallel_rank() != 0:
+                data = None
+            broadcasted_data = data_utils.broadcast_data(keys, data, torch.int64, static_shapes=True)
+            for key in keys:
+                self.assertEqual(broadcasted_data[key], data_t[key].to(broadcasted_data[key].device))
+            # The sizes are broadcast on the first call only.
+            self.assertEqual(len(data_utils._KEY_SIZE_NUMEL_CACHE), 1)
+
+        data_utils.clear_broadcast_data_cache()
+        parallel_state.destroy_model_parallel()
+
 
+class GlooBroadcastDataTest(BroadcastDataTestBase, GlooDistributedTestBase): pass
 class NcclBroadcastDataTest(BroadcastDataTestBase, NcclDistributedTestBase): pass
 class UccBroadcastDataTest(BroadcastDataTestBase, UccDistributedTestBase): pass
 
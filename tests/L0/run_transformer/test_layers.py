@@ -9,6 +9,7 @@ from torch.testing._internal import common_utils
 from apex.transformer import parallel_state
 from apex.transformer.tensor_parallel import layers
 from apex.transformer.testing.commons import set_random_seed
+from apex.transformer.testing.distributed_test_base import GlooDistributedTestBase
 from apex.transformer.testing.distributed_test_base import NcclDistributedTestBase
 from apex.transformer.testing.distributed_test_base import UccDistributedTestBase
 
@@ -548,6 +549,114 @@ class TensorParallelLayerTestBase:
                 parallel_state.destroy_model_parallel()
 
 
+class GlooCollectiveMatmulTest(GlooDistributedTestBase):
+
+    SEQUENCE_LENGTH: int = 16
+    BATCH_SIZE: int = 3
+    INPUT_SIZE: int = 8
+    OUTPUT_SIZE: int = 12
+    SEED: int = 123456
+
+    def _reference(self, master_weight, bias):
+        """Return the input, output gradient, and the output and gradients of the serial linear layer."""
+        torch.manual_seed(self.SEED)
+        input = torch.randn(self.SEQUENCE_LENGTH, self.BATCH_SIZE, self.INPUT_SIZE, requires_grad=True)
+        grad_output = torch.randn(self.SEQUENCE_LENGTH, self.BATCH_SIZE, self.OUTPUT_SIZE)
+        weight = master_weight.clone().requires_grad_()
+        bias = bias.detach().clone().requires_grad_()
+        output = nn.functional.linear(input, weight, bias)
+        output.backward(grad_output)
+        return input.detach(), grad_output, output.detach(), input.grad, weight.grad, bias.grad
+
+    def _test_column_parallel_linear(self, defer_weight_grad: bool) -> None:
+        for tensor_model_parallel_world_size in (2, 4):
+            with self.subTest(tensor_model_parallel_world_size=tensor_model_parallel_world_size):
+                parallel_state.initialize_model_parallel(tensor_model_parallel_size_=tensor_model_parallel_world_size)
+                rank = parallel_state.get_tensor_model_parallel_rank()
+                torch.manual_seed(self.SEED)
+                linear = layers.ColumnParallelLinear(
+                    self.INPUT_SIZE,
+                    self.OUTPUT_SIZE,
+                    gather_output=False,
+                    keep_master_weight_for_test=True,
+                    use_cpu_initialization=True,
+                    no_async_tensor_model_parallel_allreduce=True,
+                    sequence_parallel_enabled=True,
+                    collective_matmul=True,
+                )
+                with torch.no_grad():
+                    linear.bias.uniform_()
+                # Every rank initializes the same bias partition as they are seeded the same.
+                bias = linear.bias.detach().repeat(tensor_model_parallel_world_size)
+                input, grad_output, ref_output, ref_grad_input, ref_grad_weight, ref_grad_bias = self._reference(
+                    linear.master_weight, bias
+                )
+                sequence_chunk = slice(
+                    rank * self.SEQUENCE_LENGTH // tensor_model_parallel_world_size,
+                    (rank + 1) * self.SEQUENCE_LENGTH // tensor_model_parallel_world_size,
+                )
+                output_partition = slice(rank * linear.output_size_per_partition, (rank + 1) * linear.output_size_per_partition)
+
+                input_chunk = input[sequence_chunk].clone().requires_grad_()
+                output, _ = linear(input_chunk)
+                if defer_weight_grad:
+                    with layers.WeightGradStore.defer():
+                        output.backward(grad_output[..., output_partition])
+                    self.assertIsNone(linear.weight.grad)
+                    layers.WeightGradStore.pop()
+                else:
+                    output.backward(grad_output[..., output_partition])
+
+                self.assertEqual(output, ref_output[..., output_partition])
+                self.assertEqual(input_chunk.grad, ref_grad_input[sequence_chunk])
+                self.assertEqual(linear.weight.grad, ref_grad_weight[output_partition])
+                self.assertEqual(linear.bias.grad, ref_grad_bias[output_partition])
+
+                parallel_state.destroy_model_parallel()
+
+    def test_column_parallel_linear(self) -> None:
+        self._test_column_parallel_linear(defer_weight_grad=False)
+
+    def test_column_parallel_linear_deferred_weight_grad(self) -> None:
+        self._test_column_parallel_linear(defer_weight_grad=True)
+
+    def test_row_parallel_linear(self) -> None:
+        for tensor_model_parallel_world_size in (2, 4):
+            with self.subTest(tensor_model_parallel_world_size=tensor_model_parallel_world_size):
+                parallel_state.initialize_model_parallel(tensor_model_parallel_size_=tensor_model_parallel_world_size)
+                rank = parallel_state.get_tensor_model_parallel_rank()
+                torch.manual_seed(self.SEED)
+                linear = layers.RowParallelLinear(
+                    self.INPUT_SIZE,
+                    self.OUTPUT_SIZE,
+                    input_is_parallel=True,
+                    keep_master_weight_for_test=True,
+                    use_cpu_initialization=True,
+                    sequence_parallel_enabled=True,
+                    collective_matmul=True,
+                )
+                with torch.no_grad():
+                    linear.bias.uniform_()
+                input, grad_output, ref_output, ref_grad_input, ref_grad_weight, ref_grad_bias = self._reference(
+                    linear.master_weight, linear.bias
+                )
+                sequence_chunk = slice(
+                    rank * self.SEQUENCE_LENGTH // tensor_model_parallel_world_size,
+                    (rank + 1) * self.SEQUENCE_LENGTH // tensor_model_parallel_world_size,
+                )
+                input_partition = slice(rank * linear.input_size_per_partition, (rank + 1) * linear.input_size_per_partition)
+
+                input_parallel = input[..., input_partition].clone().requires_grad_()
+                output, _ = linear(input_parallel)
+                output.backward(grad_output[sequence_chunk])
+
+                self.assertEqual(output, ref_output[sequence_chunk])
+                self.assertEqual(input_parallel.grad, ref_grad_input[..., input_partition])
+                self.assertEqual(linear.weight.grad, ref_grad_weight[:, input_partition])
+
+                parallel_state.destroy_model_parallel()
+
+
 class NcclTensorParallelLayerTest(TensorParallelLayerTestBase, NcclDistributedTestBase):
     pass
 
@@ -1,18 +1,26 @@
 import logging
 from typing import List, Optional
 
+import torch
 from torch.testing._internal import common_utils
 
 logging.getLogger("torch").setLevel(logging.WARNING)
 
 from apex.transformer import parallel_state
+from apex.transformer.microbatches import TokenBudgetNumMicroBatches
+from apex.transformer.pipeline_parallel.schedules.fwd_bwd_pipelining_without_interleaving import (
+    forward_backward_pipelining_without_interleaving,
+)
 from apex.transformer.pipeline_parallel.utils import (
     _reconfigure_microbatch_calculator,
+    get_kth_microbatch,
     get_micro_batch_size,
     get_num_microbatches,
     get_current_global_batch_size,
     update_num_microbatches,
 )
+from apex.transformer.testing import commons as testing_utils
+from apex.transformer.testing.distributed_test_base import GlooDistributedTestBase
 from apex.transformer.testing.distributed_test_base import NcclDistributedTestBase
 from apex.transformer.testing.distributed_test_base import UccDistributedTestBase
 
@@ -81,5 +89,158 @@ class NcclMicrobatchCalculatorTest(MicrobatchCalculatorTestBase, NcclDistributed
 class UccMicrobatchCalculatorTest(MicrobatchCalculatorTestBase, UccDistributedTestBase): pass
 
 
+class TokenBudgetNumMicroBatchesTest(common_utils.TestCase):
+
+    def _check_microbatches(self, calculator, sequence_lengths):
+        ranges = [calculator.get_microbatch_range(k) for k in range(calculator.get())]
+        self.assertEqual([start for start, _ in ranges], [0] + [end for _, end in ranges[:-1]])
+        self.assertEqual(ranges[-1][1], len(sequence_lengths))
+        for start, end in ranges:
+            self.assertLessEqual(end - start, calculator.micro_batch_size)
+            if end - start > 1:
+                self.assertLessEqual((end - start) * max(sequence_lengths[start:end]), calculator.max_tokens_per_microbatch)
+        return ranges
+
+    def test_before_update(self):
+        calculator = TokenBudgetNumMicroBatches(16, 4, 2, max_tokens_per_microbatch=64)
+        self.assertEqual(calculator.get(), 2)
+        self.assertEqual(calculator.get_microbatch_range(1), (4, 8))
+        self.assertEqual(calculator.get_current_global_batch_size(), 16)
+
+    def test_pack(self):
+        calculator = TokenBudgetNumMicroBatches(8, 4, 1, max_tokens_per_microbatch=64)
+        sequence_lengths = [32, 30, 20, 16, 16, 8, 4, 2]
+        calculator.update(0, True, sequence_lengths=sequence_lengths)
+        ranges = self._check_microbatches(calculator, sequence_lengths)
+        self.assertEqual(ranges, [(0, 2), (2, 5), (5, 8)])
+        self.assertEqual(calculator.num_tokens, sum(sequence_lengths))
+        self.assertEqual(calculator.num_padded_tokens, 64 + 60 + 24)
+        self.assertAlmostEqual(calculator.padding_ratio, 1 - 128 / 148)
+        # The losses are weighted by the share of samples of each micro-batch.
+        self.assertEqual([calculator.get_loss_divisor(k) for k in range(3)], [4, 8 / 3, 8 / 3])
+
+        # Keep the previous micro-batches if no sequence lengths are given.
+        calculator.update(8, True)
+        self.assertEqual(calculator.get(), 3)
+
+    def test_sample_longer_than_budget(self):
+        calculator = TokenBudgetNumMicroBatches(4, 4, 1, max_tokens_per_microbatch=64)
+        sequence_lengths = [8, 128, 8, 8]
+        calculator.update(0, True, sequence_lengths=sequence_lengths)
+        self.assertEqual(self._check_microbatches(calculator, sequence_lengths), [(0, 1), (1, 2), (2, 4)])
+
+    def test_consistency_check(self):
+        calculator = TokenBudgetNumMicroBatches(8, 4, 1, max_tokens_per_microbatch=64)
+        with self.assertRaisesRegex(AssertionError, "sequence lengths of 8 samples"):
+            calculator.update(0, True, sequence_lengths=[4] * 4)
+
+
+class GlooTokenBudgetMicrobatchCalculatorTest(GlooDistributedTestBase):
+
+    GLOBAL_BATCH_SIZE = 32
+    MICRO_BATCH_SIZE = 4
+    MAX_TOKENS_PER_MICROBATCH = 32
+    PIPELINE_BATCH_SIZE = 8
+    SEQUENCE_LENGTH = 4
+    HIDDEN_SIZE = 8
+
+    def test_token_budget_microbatch_calculator(self):
+        parallel_state.initialize_model_parallel()
+        data_parallel_size = parallel_state.get_data_parallel_world_size()
+        _reconfigure_microbatch_calculator(
+            self.rank,
+            None,
+            self.GLOBAL_BATCH_SIZE,
+            self.MICRO_BATCH_SIZE,
+            data_parallel_size,
+            max_tokens_per_microbatch=self.MAX_TOKENS_PER_MICROBATCH,
+        )
+        local_minibatch_size = self.GLOBAL_BATCH_SIZE // data_parallel_size
+        self.assertEqual(get_num_microbatches(), local_minibatch_size // self.MICRO_BATCH_SIZE)
+
+        # Rank 0 has the shortest samples and would need fewer micro-batches than the others.
+        sequence_lengths = [1 if self.rank == 0 else 16 - i % 3 for i in range(local_minibatch_size)]
+        update_num_microbatches(0, sequence_lengths=sequence_lengths)
+
+        num_microbatches = get_num_microbatches()
+        all_num_microbatches = [None] * self.world_size
+        torch.distributed.all_gather_object(all_num_microbatches, num_microbatches)
+        self.assertEqual(all_num_microbatches, [num_microbatches] * self.world_size)
+        self.assertGreater(num_microbatches, local_minibatch_size // self.MICRO_BATCH_SIZE)
+
+        batch = [torch.tensor(sequence_lengths)]
+        microbatches = [get_kth_microbatch(batch, k)[0] for k in range(num_microbatches)]
+        self.assertEqual(torch.cat(microbatches), batch[0])
+        for microbatch in microbatches:
+            self.assertGreater(microbatch.numel(), 0)
+            self.assertLessEqual(microbatch.numel(), self.MICRO_BATCH_SIZE)
+            if microbatch.numel() > 1:
+                self.assertLessEqual(microbatch.numel() * microbatch.max().item(), self.MAX_TOKENS_PER_MICROBATCH)
+
+        parallel_state.destroy_model_parallel()
+
+    def _run_pipeline(self, model, batch, micro_batch_size, max_tokens_per_microbatch=None, sequence_lengths=None):
+        _reconfigure_microbatch_calculator(
+            self.rank,
+            None,
+            self.PIPELINE_BATCH_SIZE,
+            micro_batch_size,
+            parallel_state.get_data_parallel_world_size(),
+            max_tokens_per_microbatch=max_tokens_per_microbatch,
+        )
+        if sequence_lengths is not None:
+            update_num_microbatches(0, sequence_lengths=sequence_lengths)
+
+        def fwd_step_func(batch, model):
+            x = batch[0].transpose(0, 1).contiguous() if batch is not None else None
+            y = model(x)
+
+            def loss_func(y):
+                # The mean over the samples of the micro-batch.
+                loss = y.mean()
+                return loss, {"avg": loss.detach()}
+
+            return y, loss_func
+
+        for param in model.parameters():
+            param.grad = None
+        forward_backward_pipelining_without_interleaving(
+            fwd_step_func,
+            batch,
+            model,
+            forward_only=False,
+            tensor_shape=(self.SEQUENCE_LENGTH, micro_batch_size, self.HIDDEN_SIZE),
+            dtype=torch.float32,
+            variable_seq_lengths=max_tokens_per_microbatch is not None,
+        )
+        return get_num_microbatches(), [param.grad.clone() for param in model.parameters()]
+
+    def test_pipeline_schedule_with_token_budget(self):
+        parallel_state.initialize_model_parallel(pipeline_model_parallel_size_=self.world_size)
+        torch.manual_seed(42)
+        model = testing_utils.mlp_provider_func(
+            self.HIDDEN_SIZE,
+            pre_process=parallel_state.is_pipeline_first_stage(),
+            post_process=parallel_state.is_pipeline_last_stage(),
+            use_cpu_initialization=True,
+        )
+        batch = None
+        if parallel_state.is_pipeline_first_stage():
+            batch = [torch.randn(self.PIPELINE_BATCH_SIZE, self.SEQUENCE_LENGTH, self.HIDDEN_SIZE)]
+
+        # One sample per micro-batch gives the gradient of the mean loss over the minibatch.
+        _, ref_grads = self._run_pipeline(model, batch, micro_batch_size=1)
+        # Micro-batches of 2, 3, and 3 samples, which the pipeline stages exchange the shapes of.
+        num_microbatches, grads = self._run_pipeline(
+            model, batch, micro_batch_size=4, max_tokens_per_microbatch=64,
+            sequence_lengths=[32, 30, 20, 16, 16, 8, 4, 2],
+        )
+        self.assertEqual(num_microbatches, 3)
+        for grad, ref_grad in zip(grads, ref_grads):
+            self.assertEqual(grad, ref_grad)
+
+        parallel_state.destroy_model_parallel()
+
+
 if __name__ == "__main__":
     common_utils.run_tests()
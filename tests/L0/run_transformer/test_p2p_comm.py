@@ -8,6 +8,7 @@ logging.getLogger("torch").setLevel(logging.WARNING)
 
 from apex.transformer import parallel_state
 from apex.transformer.pipeline_parallel import p2p_communication
+from apex.transformer.testing.distributed_test_base import GlooDistributedTestBase
 from apex.transformer.testing.distributed_test_base import NcclDistributedTestBase
 from apex.transformer.testing.distributed_test_base import UccDistributedTestBase
 
@@ -114,9 +115,118 @@ class P2PCommTestBase:
             self.assertEqual(next_tensor, expected_next_tensor)
 
 
+    # Brief: test `send_forward_recv_backward` & `send_backward_recv_forward` with shapes exchanged on the fly.
+    def test_variable_seq_lengths(self):
+        self._init_model_parallel()
+        device = self.create_tensor(0).device
+        for seq_length in (1, 3, 2):
+            # Gradients travel back with a different sequence length to make sure the directions are not mixed up.
+            fwd_shape, bwd_shape = (seq_length, 2, 2), (seq_length + 1, 2, 2)
+            if parallel_state.is_pipeline_first_stage():
+                received = p2p_communication.send_forward_recv_backward(
+                    torch.full(fwd_shape, self.rank, dtype=self.dtype, device=device),
+                    tensor_shape=self.shape + (2,),
+                    dtype=self.dtype,
+                    variable_seq_lengths=True,
+                )
+                expected = torch.full(bwd_shape, self.rank + 1, dtype=self.dtype, device=device)
+            else:
+                received = p2p_communication.send_backward_recv_forward(
+                    torch.full(bwd_shape, self.rank, dtype=self.dtype, device=device),
+                    tensor_shape=self.shape + (2,),
+                    dtype=self.dtype,
+                    variable_seq_lengths=True,
+                )
+                expected = torch.full(fwd_shape, self.rank - 1, dtype=self.dtype, device=device)
+            self.assertEqual(received, expected)
+
+    # Brief: test that a released receive buffer is reused by the next receive of the same shape.
+    def test_recv_buffer_reuse(self):
+        self._init_model_parallel()
+        pool = p2p_communication.get_p2p_buffer_pool()
+        pool.clear()
+        for i in range(3):
+            if parallel_state.is_pipeline_first_stage():
+                p2p_communication.send_forward(
+                    output_tensor=self.create_tensor(i), tensor_shape=self.shape, dtype=self.dtype)
+            else:
+                input_tensor = p2p_communication.recv_forward(tensor_shape=self.shape, dtype=self.dtype)
+                self.assertEqual(input_tensor, self.create_tensor(i))
+                p2p_communication.release_recv_buffers(input_tensor)
+        if not parallel_state.is_pipeline_first_stage():
+            self.assertEqual(pool.stats()["misses"], 1)
+            self.assertEqual(pool.stats()["hits"], 2)
+
+
 # n.b.(mkozuki): Intentionally skip NCCL backend tests as I trust pytorch/pytorch repo.
 class UccP2PCommTest(P2PCommTestBase, UccDistributedTestBase): pass
 
 
+class GlooP2PCommTest(P2PCommTestBase, GlooDistributedTestBase):
+
+    @property
+    def world_size(self):
+        return 2
+
+    def create_tensor(self, value: int = None):
+        return torch.tensor([value] * self.numel, dtype=self.dtype).view(self.shape)
+
+
+class P2PBufferPoolTest(common_utils.TestCase):
+
+    shape = (4, 2, 8)
+
+    def test_release_and_reuse(self):
+        pool = p2p_communication.P2PBufferPool()
+        tensor = pool.acquire(self.shape, torch.float32, "prev", torch.device("cpu"), True)
+        tensor.sum().backward()
+        pool.release(tensor)
+        reused = pool.acquire(self.shape, torch.float32, "prev", torch.device("cpu"), True)
+        self.assertIs(reused, tensor)
+        self.assertIsNone(reused.grad)
+        self.assertTrue(reused.requires_grad)
+        self.assertEqual(pool.stats(), {"hits": 1, "misses": 1, "cached": 0, "in_use": 1})
+
+    def test_key(self):
+        pool = p2p_communication.P2PBufferPool()
+        tensor = pool.acquire(self.shape, torch.float32, "prev", torch.device("cpu"), True)
+        pool.release(tensor)
+        self.assertIsNot(pool.acquire(self.shape, torch.float32, "next", torch.device("cpu"), True), tensor)
+        self.assertIsNot(pool.acquire(self.shape, torch.float16, "prev", torch.device("cpu"), True), tensor)
+        self.assertIsNot(pool.acquire((2, 2, 8), torch.float32, "prev", torch.device("cpu"), True), tensor)
+        self.assertEqual(pool.hits, 0)
+        self.assertEqual(pool.misses, 4)
+
+    def test_variable_shapes(self):
+        pool = p2p_communication.P2PBufferPool(max_cached_buffers=2)
+        tensors = {
+            seq_length: pool.acquire((seq_length, 2, 8), torch.float32, "prev", torch.device("cpu"), False)
+            for seq_length in (4, 8, 16)
+        }
+        for tensor in tensors.values():
+            pool.release(tensor)
+        # The buffer of the least recently released shape is evicted.
+        self.assertEqual(pool.stats()["cached"], 2)
+        self.assertIsNot(pool.acquire((4, 2, 8), torch.float32, "prev", torch.device("cpu"), False), tensors[4])
+        self.assertIs(pool.acquire((8, 2, 8), torch.float32, "prev", torch.device("cpu"), False), tensors[8])
+        self.assertIs(pool.acquire((16, 2, 8), torch.float32, "prev", torch.device("cpu"), False), tensors[16])
+
+    def test_release_ignores_foreign_tensors(self):
+        pool = p2p_communication.P2PBufferPool()
+        tensor = pool.acquire(self.shape, torch.float32, "prev", torch.device("cpu"), False)
+        pool.release(torch.empty(self.shape))
+        pool.release(None)
+        pool.release(tensor)
+        pool.release(tensor)
+        self.assertEqual(pool.stats()["cached"], 1)
+
+    def test_unreleased_buffers_are_garbage_collected(self):
+        pool = p2p_communication.P2PBufferPool()
+        tensor = pool.acquire(self.shape, torch.float32, "prev", torch.device("cpu"), False)
+        self.assertEqual(pool.stats()["in_use"], 1)
+        del tensor
+        self.assertEqual(pool.stats()["in_use"], 0)
+
+
 if __name__ == "__main__":
     common_utils.run_tests()
@@ -1,11 +1,19 @@
+import contextlib
+import io
 import logging
 import os
+import tempfile
 
+import torch
 from torch.testing._internal import common_utils
 
 logging.getLogger("torch").setLevel(logging.WARNING)
 
 from apex.transformer import parallel_state
+from apex.transformer.rank_mapping import RankMapper
+from apex.transformer.rank_mapping import TopologyAwareRankMapper
+from apex.transformer.rank_mapping import build_rank_layout
+from apex.transformer.testing.distributed_test_base import GlooDistributedTestBase
 from apex.transformer.testing.distributed_test_base import NcclDistributedTestBase
 from apex.transformer.testing.distributed_test_base import UccDistributedTestBase
 
@@ -181,5 +189,146 @@ class NcclParallelStateTest(ParallelStateTestBase, NcclDistributedTestBase): pas
 class UccParallelStateTest(ParallelStateTestBase, UccDistributedTestBase): pass
 
 
+class RankLayoutTest(common_utils.TestCase):
+    def test_default_layout(self) -> None:
+        # The example of the docstring of `initialize_model_parallel`.
+        layout = build_rank_layout(16, 2, 4)
+        self.assertEqual(layout.order, "tp-dp-pp")
+        self.assertEqual(
+            layout.data_parallel_groups,
+            [[0, 2], [1, 3], [4, 6], [5, 7], [8, 10], [9, 11], [12, 14], [13, 15]],
+        )
+        self.assertEqual(
+            layout.tensor_model_parallel_groups,
+            [[0, 1], [2, 3], [4, 5], [6, 7], [8, 9], [10, 11], [12, 13], [14, 15]],
+        )
+        self.assertEqual(
+            layout.pipeline_model_parallel_groups,
+            [[0, 4, 8, 12], [1, 5, 9, 13], [2, 6, 10, 14], [3, 7, 11, 15]],
+        )
+        self.assertEqual(
+            layout.model_parallel_groups,
+            [[0, 1, 4, 5, 8, 9, 12, 13], [2, 3, 6, 7, 10, 11, 14, 15]],
+        )
+
+    def test_tp_pp_dp_order(self) -> None:
+        layout = build_rank_layout(16, 2, 4, order="tp-pp-dp")
+        self.assertEqual(
+            layout.pipeline_model_parallel_groups,
+            [[0, 2, 4, 6], [1, 3, 5, 7], [8, 10, 12, 14], [9, 11, 13, 15]],
+        )
+        self.assertEqual(
+            layout.data_parallel_groups,
+            [[0, 8], [1, 9], [2, 10], [3, 11], [4, 12], [5, 13], [6, 14], [7, 15]],
+        )
+        self.assertEqual(layout.model_parallel_groups, [list(range(8)), list(range(8, 16))])
+
+    def test_invalid_order(self) -> None:
+        with self.assertRaisesRegex(ValueError, "order"):
+            build_rank_layout(8, 2, 2, order="pp-tp-dp")
+
+    def test_topology_aware_rank_mapper(self) -> None:
+        # Two nodes of 8 ranks whose ranks are assigned round robin by the launcher.
+        mapper = TopologyAwareRankMapper({rank: f"node{rank % 2}" for rank in range(16)})
+        layout = build_rank_layout(16, 2, 4, rank_mapper=mapper)
+        for ranks in layout.tensor_model_parallel_groups:
+            self.assertEqual(len({rank % 2 for rank in ranks}), 1)
+        # Whole pipelines fit in a node with "tp-pp-dp" while every pipeline crosses nodes once with "tp-dp-pp".
+        self.assertEqual(layout.order, "tp-pp-dp")
+        self.assertEqual(mapper.cross_node_pipeline_hops(layout), 0)
+        self.assertEqual(
+            mapper.cross_node_pipeline_hops(build_rank_layout(16, 2, 4, order="tp-dp-pp", rank_mapper=mapper)),
+            4,
+        )
+        self.assertEqual(layout.pipeline_model_parallel_groups[0], [0, 4, 8, 12])
+
+    def test_topology_aware_rank_mapper_sorts_groups(self) -> None:
+        # Hosts assigned round robin with a pipeline spanning both nodes: only the pipeline keeps its stage order.
+        mapper = TopologyAwareRankMapper(["A", "B", "A", "B"])
+        layout = build_rank_layout(4, 1, 4, rank_mapper=mapper)
+        self.assertEqual(layout.pipeline_model_parallel_groups, [[0, 2, 1, 3]])
+        self.assertEqual(layout.tensor_model_parallel_groups, [[0], [2], [1], [3]])
+        # The positions of the data parallel group hold ranks 0, 3, 1, and 2.
+        layout = build_rank_layout(4, 1, 1, rank_mapper=TopologyAwareRankMapper(["B", "A", "A", "B"]))
+        self.assertEqual(layout.data_parallel_groups, [[0, 1, 2, 3]])
+
+    def test_topology_aware_rank_mapper_splits_tensor_model_parallel_group(self) -> None:
+        mapper = TopologyAwareRankMapper(["node0"] * 3 + ["node1"] * 5)
+        with self.assertRaisesRegex(ValueError, "not a multiple of tensor_model_parallel_size"):
+            build_rank_layout(8, 2, 1, rank_mapper=mapper)
+
+    def test_from_hostfile(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "hostfile")
+            with open(path, "w") as f:
+                f.write("# two nodes\nnode0 slots=2\nnode1:1\nnode1\n")
+            mapper = TopologyAwareRankMapper.from_hostfile(path)
+        self.assertEqual(mapper.rank_to_node, ["node0", "node0", "node1", "node1"])
+        self.assertEqual(mapper.world_size, 4)
+
+    def test_dry_run(self) -> None:
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            layout = parallel_state.initialize_model_parallel(
+                2, 2, order="tp-pp-dp", rank_mapper=RankMapper(world_size=8), dry_run=True,
+            )
+        self.assertEqual(layout.tensor_model_parallel_groups, [[0, 1], [4, 5], [2, 3], [6, 7]])
+        self.assertIn("4 pipeline model parallel groups", stdout.getvalue())
+        self.assertFalse(parallel_state.model_parallel_is_initialized())
+
+
+class GlooRankMappingTest(GlooDistributedTestBase):
+    def test_initialize_model_parallel_with_order(self) -> None:
+        # The pipelines are [0, 1] and [2, 3] instead of [0, 2] and [1, 3].
+        parallel_state.initialize_model_parallel(1, 2, order="tp-pp-dp")
+        self.assertEqual(parallel_state.get_pipeline_model_parallel_rank(), self.rank % 2)
+        self.assertEqual(parallel_state.get_pipeline_model_parallel_first_rank(), self.rank // 2 * 2)
+        self.assertEqual(parallel_state.get_data_parallel_src_rank(), self.rank % 2)
+        self.assertEqual(parallel_state.get_tensor_model_parallel_src_rank(), self.rank)
+        parallel_state.destroy_model_parallel()
+
+    def test_initialize_model_parallel_with_rank_mapper(self) -> None:
+        # Ranks 0 and 2 are on one node, ranks 1 and 3 on the other.
+        mapper = TopologyAwareRankMapper([rank % 2 for rank in range(self.world_size)])
+        parallel_state.initialize_model_parallel(2, 1, rank_mapper=mapper)
+        self.assertEqual(parallel_state.get_tensor_model_parallel_global_ranks(), [self.rank % 2, self.rank % 2 + 2])
+        self.assertEqual(parallel_state.get_tensor_model_parallel_src_rank(), self.rank % 2)
+        self.assertEqual(parallel_state.get_data_parallel_src_rank(), self.rank // 2 * 2)
+
+        tensor = torch.tensor([float(self.rank)])
+        torch.distributed.all_reduce(tensor, group=parallel_state.get_tensor_model_parallel_group())
+        self.assertEqual(tensor.item(), 2 * (self.rank % 2) + 2)
+        parallel_state.destroy_model_parallel()
+
+    def test_pipeline_spanning_nodes_out_of_rank_order(self) -> None:
+        # Ranks 0 and 2 are on one node, ranks 1 and 3 on the other, so the stages are ranks 0, 2, 1, and 3.
+        mapper = TopologyAwareRankMapper([rank % 2 for rank in range(self.world_size)])
+        parallel_state.initialize_model_parallel(1, self.world_size, rank_mapper=mapper)
+        stages = [0, 2, 1, 3]
+        stage = stages.index(self.rank)
+        self.assertEqual(parallel_state.get_pipeline_model_parallel_rank(), stage)
+        self.assertEqual(parallel_state.get_pipeline_model_parallel_next_rank(), stages[(stage + 1) % 4])
+        self.assertEqual(parallel_state.get_pipeline_model_parallel_prev_rank(), stages[(stage - 1) % 4])
+        self.assertEqual(parallel_state.is_pipeline_first_stage(), stage == 0)
+        self.assertEqual(parallel_state.is_pipeline_last_stage(), stage == 3)
+
+        # Every stage receives the stage number of the previous one.
+        group = parallel_state.get_pipeline_model_parallel_group()
+        received = torch.empty(1)
+        ops = [
+            torch.distributed.P2POp(
+                torch.distributed.isend, torch.tensor([float(stage)]),
+                parallel_state.get_pipeline_model_parallel_next_rank(), group,
+            ),
+            torch.distributed.P2POp(
+                torch.distributed.irecv, received, parallel_state.get_pipeline_model_parallel_prev_rank(), group,
+            ),
+        ]
+        for req in torch.distributed.batch_isend_irecv(ops):
+            req.wait()
+        self.assertEqual(received.item(), float((stage - 1) % 4))
+        parallel_state.destroy_model_parallel()
+
+
 if __name__ == "__main__":
     common_utils.run_tests()
@@ -0,0 +1,177 @@
+import logging
+from unittest import mock
+
+import torch
+from torch.testing._internal import common_utils
+
+logging.getLogger("torch").setLevel(logging.WARNING)
+
+from apex.transformer import parallel_state
+from apex.transformer.pipeline_parallel import p2p_communication
+from apex.transformer.pipeline_parallel import utils as pp_utils
+from apex.transformer.pipeline_parallel.schedules import get_forward_backward_func
+from apex.transformer.pipeline_parallel.schedules.fwd_bwd_pipelining_with_split_backward import (
+    forward_backward_pipelining_with_split_backward,
+)
+from apex.transformer.pipeline_parallel.schedules.fwd_bwd_pipelining_without_interleaving import (
+    forward_backward_pipelining_without_interleaving,
+)
+from apex.transformer.tensor_parallel import WeightGradStore
+from apex.transformer.testing.distributed_test_base import GlooDistributedTestBase
+from apex.transformer.testing import commons as testing_utils
+
+logging.getLogger("apex").setLevel(logging.WARNING)
+
+
+class GlooSplitBackwardPipelineTest(GlooDistributedTestBase):
+
+    GLOBAL_BATCH_SIZE = 16
+    MICRO_BATCH_SIZE = 2
+    SEQUENCE_LENGTH = 8
+    HIDDEN_SIZE = 16
+
+    def _run_schedule(self, fwd_bwd_func, model, batch, forward_only=False):
+        for param in model.parameters():
+            param.grad = None
+        losses = fwd_bwd_func(
+            testing_utils.ToyParallelMLPFwdBwdStepFunc(False),
+            batch,
+            model,
+            forward_only=forward_only,
+            tensor_shape=(self.SEQUENCE_LENGTH, self.MICRO_BATCH_SIZE, self.HIDDEN_SIZE),
+            dtype=torch.float32,
+        )
+        return losses, {name: param.grad for name, param in model.named_parameters()}
+
+    def _test_split_backward(self, tensor_model_parallel_size: int) -> None:
+        parallel_state.initialize_model_parallel(
+            tensor_model_parallel_size_=tensor_model_parallel_size,
+            pipeline_model_parallel_size_=self.world_size // tensor_model_parallel_size,
+        )
+        pp_utils._reconfigure_microbatch_calculator(
+            rank=parallel_state.get_tensor_model_parallel_rank(),
+            rampup_batch_size=None,
+            global_batch_size=self.GLOBAL_BATCH_SIZE,
+            micro_batch_size=self.MICRO_BATCH_SIZE,
+            data_parallel_size=parallel_state.get_data_parallel_world_size(),
+        )
+        self.assertIs(
+            get_forward_backward_func(None, parallel_state.get_pipeline_model_parallel_world_size(), split_backward=True),
+            forward_backward_pipelining_with_split_backward,
+        )
+
+        torch.manual_seed(42)
+        model = testing_utils.mlp_provider_func(
+            self.HIDDEN_SIZE,
+            pre_process=parallel_state.is_pipeline_first_stage(),
+            post_process=parallel_state.is_pipeline_last_stage(),
+            use_cpu_initialization=True,
+        )
+        batch = None
+        if parallel_state.is_pipeline_first_stage():
+            batch = (torch.randn(self.GLOBAL_BATCH_SIZE, self.SEQUENCE_LENGTH, self.HIDDEN_SIZE),)
+
+        ref_losses, ref_grads = self._run_schedule(forward_backward_pipelining_without_interleaving, model, batch)
+        losses, grads = self._run_schedule(forward_backward_pipelining_with_split_backward, model, batch)
+
+        self.assertEqual(WeightGradStore.size(), 0)
+        # Receive buffers are reused across microbatches once the schedules have consumed them.
+        self.assertGreater(p2p_communication.get_p2p_buffer_pool().hits, 0)
+        self.assertEqual(len(losses), len(ref_losses))
+        for loss, ref_loss in zip(losses, ref_losses):
+            self.assertEqual(loss["avg"], ref_loss["avg"])
+        for name, ref_grad in ref_grads.items():
+            self.assertIsNotNone(grads[name], msg=name)
+            self.assertEqual(grads[name], ref_grad, msg=name)
+
+        inference_losses, _ = self._run_schedule(
+            forward_backward_pipelining_with_split_backward, model, batch, forward_only=True
+        )
+        self.assertEqual(len(inference_losses), len(ref_losses))
+
+        parallel_state.destroy_model_parallel()
+
+    def test_weight_grad_overlaps_receive(self):
+        parallel_state.initialize_model_parallel(pipeline_model_parallel_size_=self.world_size)
+        pp_utils._reconfigure_microbatch_calculator(
+            rank=parallel_state.get_tensor_model_parallel_rank(),
+            rampup_batch_size=None,
+            global_batch_size=self.GLOBAL_BATCH_SIZE,
+            micro_batch_size=self.MICRO_BATCH_SIZE,
+            data_parallel_size=parallel_state.get_data_parallel_world_size(),
+        )
+        torch.manual_seed(42)
+        model = testing_utils.mlp_provider_func(
+            self.HIDDEN_SIZE,
+            pre_process=parallel_state.is_pipeline_first_stage(),
+            post_process=parallel_state.is_pipeline_last_stage(),
+            use_cpu_initialization=True,
+        )
+        batch = None
+        if parallel_state.is_pipeline_first_stage():
+            batch = (torch.randn(self.GLOBAL_BATCH_SIZE, self.SEQUENCE_LENGTH, self.HIDDEN_SIZE),)
+
+        # Record whether a received tensor is still in flight whenever the deferred weight gradients run.
+        pending = set()
+        pops_with_pending_recv = []
+        future_init, future_get, weight_grad_pop = (
+            p2p_communication.FutureTensor.__init__, p2p_communication.FutureTensor.get, WeightGradStore.pop.__func__
+        )
+
+        def init(future, tensor, waitfunc):
+            future_init(future, tensor, waitfunc)
+            if waitfunc is not None:
+                pending.add(id(future))
+
+        def get(future):
+            pending.discard(id(future))
+            return future_get(future)
+
+        def pop(cls):
+            pops_with_pending_recv.append(bool(pending))
+            weight_grad_pop(cls)
+
+        with mock.patch.object(p2p_communication.FutureTensor, "__init__", init), \
+                mock.patch.object(p2p_communication.FutureTensor, "get", get), \
+                mock.patch.object(WeightGradStore, "pop", classmethod(pop)):
+            self._run_schedule(forward_backward_pipelining_with_split_backward, model, batch)
+
+        if parallel_state.is_pipeline_first_stage():
+            self.assertFalse(any(pops_with_pending_recv))
+        else:
+            # Every steady phase iteration but the last one runs its weight gradient during the receive.
+            num_steady = pp_utils.get_num_microbatches() - (self.world_size - parallel_state.get_pipeline_model_parallel_rank() - 1)
+            self.assertEqual(sum(pops_with_pending_recv), num_steady - 1)
+        parallel_state.destroy_model_parallel()
+
+    def test_ddp_model_is_rejected(self):
+        parallel_state.initialize_model_parallel(pipeline_model_parallel_size_=self.world_size)
+        pp_utils._reconfigure_microbatch_calculator(
+            rank=parallel_state.get_tensor_model_parallel_rank(),
+            rampup_batch_size=None,
+            global_batch_size=self.GLOBAL_BATCH_SIZE,
+            micro_batch_size=self.MICRO_BATCH_SIZE,
+            data_parallel_size=parallel_state.get_data_parallel_world_size(),
+        )
+        model = torch.nn.parallel.DistributedDataParallel(
+            testing_utils.mlp_provider_func(
+                self.HIDDEN_SIZE,
+                pre_process=parallel_state.is_pipeline_first_stage(),
+                post_process=parallel_state.is_pipeline_last_stage(),
+                use_cpu_initialization=True,
+            ),
+            process_group=parallel_state.get_data_parallel_group(),
+        )
+        with self.assertRaisesRegex(RuntimeError, "DistributedDataParallel"):
+            self._run_schedule(forward_backward_pipelining_with_split_backward, model, None)
+        parallel_state.destroy_model_parallel()
+
+    def test_split_backward(self):
+        self._test_split_backward(tensor_model_parallel_size=1)
+
+    def test_split_backward_with_tensor_parallel(self):
+        self._test_split_backward(tensor_model_parallel_size=2)
+
+
+if __name__ == "__main__":
+    common_utils.run_tests()
@@ -0,0 +1,114 @@
+import logging
+
+import torch
+from torch.testing._internal import common_utils
+
+logging.getLogger("torch").setLevel(logging.WARNING)
+
+from apex.transformer import parallel_state
+from apex.transformer.pipeline_parallel import utils as pp_utils
+from apex.transformer.pipeline_parallel.schedules.fwd_bwd_pipelining_without_interleaving import (
+    forward_backward_pipelining_without_interleaving,
+)
+from apex.transformer.pipeline_parallel.utils import average_losses_across_data_parallel_group
+from apex.transformer.testing.distributed_test_base import GlooDistributedTestBase
+from apex.transformer.testing import commons as testing_utils
+
+logging.getLogger("apex").setLevel(logging.WARNING)
+
+
+class VariableLengthFwdStepFunc:
+    """Run ToyParallelMLP on microbatches of ``(x, lengths)`` and count the received activations.
+
+    If ``truncate`` is :obj:`False`, microbatches are kept padded to the maximum sequence length and
+    the loss ignores the padded positions, which gives the same losses and gradients.
+    """
+
+    def __init__(self, truncate: bool) -> None:
+        self.truncate = truncate
+        self.received_numel = 0
+
+    def __call__(self, batch, model):
+        x, lengths = batch
+        seq_length = int(lengths[0])
+        # [b, s, h] -> [s, b, h]
+        x = x.transpose(0, 1).contiguous()
+        if self.truncate:
+            x = x[:seq_length]
+        if model.input_tensor is not None:
+            self.received_numel += model.input_tensor.numel()
+        y = model(x)
+
+        def loss_func(y):
+            loss = torch.sum(y[:seq_length])
+            averaged_loss = average_losses_across_data_parallel_group([loss])
+            return loss, {"avg": averaged_loss}
+
+        return y, loss_func
+
+
+class GlooVariableSeqLengthsPipelineTest(GlooDistributedTestBase):
+
+    GLOBAL_BATCH_SIZE = 16
+    MICRO_BATCH_SIZE = 2
+    SEQUENCE_LENGTHS = (8, 3, 5, 1, 8, 2, 7, 4)
+    HIDDEN_SIZE = 16
+
+    def _run_schedule(self, model, batch, variable_seq_lengths):
+        for param in model.parameters():
+            param.grad = None
+        fwd_step_func = VariableLengthFwdStepFunc(truncate=variable_seq_lengths)
+        losses = forward_backward_pipelining_without_interleaving(
+            fwd_step_func,
+            batch,
+            model,
+            forward_only=False,
+            tensor_shape=(max(self.SEQUENCE_LENGTHS), self.MICRO_BATCH_SIZE, self.HIDDEN_SIZE),
+            dtype=torch.float32,
+            variable_seq_lengths=variable_seq_lengths,
+        )
+        grads = {name: param.grad for name, param in model.named_parameters()}
+        return losses, grads, fwd_step_func.received_numel
+
+    def test_variable_seq_lengths(self):
+        parallel_state.initialize_model_parallel(
+            tensor_model_parallel_size_=1,
+            pipeline_model_parallel_size_=self.world_size,
+        )
+        pp_utils._reconfigure_microbatch_calculator(
+            rank=parallel_state.get_tensor_model_parallel_rank(),
+            rampup_batch_size=None,
+            global_batch_size=self.GLOBAL_BATCH_SIZE,
+            micro_batch_size=self.MICRO_BATCH_SIZE,
+            data_parallel_size=parallel_state.get_data_parallel_world_size(),
+        )
+        torch.manual_seed(42)
+        model = testing_utils.mlp_provider_func(
+            self.HIDDEN_SIZE,
+            pre_process=parallel_state.is_pipeline_first_stage(),
+            post_process=parallel_state.is_pipeline_last_stage(),
+            use_cpu_initialization=True,
+        )
+        x = torch.randn(self.GLOBAL_BATCH_SIZE, max(self.SEQUENCE_LENGTHS), self.HIDDEN_SIZE)
+        lengths = torch.tensor(self.SEQUENCE_LENGTHS).repeat_interleave(self.MICRO_BATCH_SIZE)
+        batch = (x, lengths)
+
+        ref_losses, ref_grads, padded_numel = self._run_schedule(model, batch, variable_seq_lengths=False)
+        losses, grads, received_numel = self._run_schedule(model, batch, variable_seq_lengths=True)
+
+        self.assertEqual(len(losses), len(ref_losses))
+        for loss, ref_loss in zip(losses, ref_losses):
+            self.assertEqual(loss["avg"], ref_loss["avg"])
+        for name, ref_grad in ref_grads.items():
+            self.assertEqual(grads[name], ref_grad, msg=name)
+
+        if not parallel_state.is_pipeline_first_stage():
+            numel_per_token = self.MICRO_BATCH_SIZE * self.HIDDEN_SIZE
+            self.assertEqual(padded_numel, len(self.SEQUENCE_LENGTHS) * max(self.SEQUENCE_LENGTHS) * numel_per_token)
+            self.assertEqual(received_numel, sum(self.SEQUENCE_LENGTHS) * numel_per_token)
+
+        parallel_state.destroy_model_parallel()
+
+
+if __name__ == "__main__":
+    common_utils.run_tests()
@@ -0,0 +1,122 @@
+import json
+import os
+import tempfile
+
+from torch.testing._internal import common_utils
+
+from apex.transformer.pipeline_parallel.schedules.simulator import simulate_pipeline_schedule
+
+
+class PipelineScheduleSimulatorTest(common_utils.TestCase):
+
+    FORWARD_COST: float = 1.0
+    BACKWARD_COST: float = 2.0
+
+    def test_no_pipelining(self):
+        result = simulate_pipeline_schedule(1, 4, self.FORWARD_COST, self.BACKWARD_COST)
+        self.assertEqual(result.schedule, "forward_backward_no_pipelining")
+        self.assertEqual(result.makespan, 4 * (self.FORWARD_COST + self.BACKWARD_COST))
+        self.assertEqual(result.bubble_fraction, 0.0)
+        self.assertEqual(result.peak_activations_in_flight, [1])
+
+    def test_pipelining_without_interleaving(self):
+        for pipeline_model_parallel_size, num_microbatches in ((2, 2), (4, 8), (4, 2), (8, 16)):
+            with self.subTest(pipeline_model_parallel_size=pipeline_model_parallel_size, num_microbatches=num_microbatches):
+                result = simulate_pipeline_schedule(
+                    pipeline_model_parallel_size, num_microbatches, self.FORWARD_COST, self.BACKWARD_COST)
+                self.assertEqual(result.schedule, "forward_backward_pipelining_without_interleaving")
+                # 1F1B: (num_microbatches + pipeline_model_parallel_size - 1) * (forward + backward)
+                self.assertEqual(
+                    result.makespan,
+                    (num_microbatches + pipeline_model_parallel_size - 1) * (self.FORWARD_COST + self.BACKWARD_COST),
+                )
+                self.assertAlmostEqual(
+                    result.bubble_fraction,
+                    (pipeline_model_parallel_size - 1) / (num_microbatches + pipeline_model_parallel_size - 1),
+                )
+                self.assertEqual(
+                    result.peak_activations_in_flight,
+                    [min(pipeline_model_parallel_size - rank, num_microbatches) for rank in range(pipeline_model_parallel_size)],
+                )
+                for rank, timeline in enumerate(result.timelines):
+                    backward_microbatches = [event.microbatch for event in timeline if event.name == "backward_step"]
+                    self.assertEqual(backward_microbatches, list(range(num_microbatches)))
+
+    def test_pipelining_with_interleaving(self):
+        for pipeline_model_parallel_size, num_microbatches, virtual_pipeline_model_parallel_size in (
+            (2, 4, 2), (4, 4, 2), (4, 8, 2), (4, 12, 3),
+        ):
+            with self.subTest(
+                pipeline_model_parallel_size=pipeline_model_parallel_size,
+                num_microbatches=num_microbatches,
+                virtual_pipeline_model_parallel_size=virtual_pipeline_model_parallel_size,
+            ):
+                result = simulate_pipeline_schedule(
+                    pipeline_model_parallel_size,
+                    num_microbatches,
+                    self.FORWARD_COST,
+                    self.BACKWARD_COST,
+                    virtual_pipeline_model_parallel_size=virtual_pipeline_model_parallel_size,
+                )
+                self.assertEqual(result.schedule, "_forward_backward_pipelining_with_interleaving")
+                # the bubble shrinks by the number of model chunks compared to the non-interleaved schedule
+                step_time = self.FORWARD_COST + self.BACKWARD_COST
+                self.assertEqual(
+                    result.makespan,
+                    (num_microbatches * virtual_pipeline_model_parallel_size + pipeline_model_parallel_size - 1) * step_time,
+                )
+                for timeline in result.timelines:
+                    computed = sorted(
+                        (event.name, event.model_chunk, event.microbatch) for event in timeline if event.category == "compute")
+                    expected = sorted(
+                        (name, model_chunk, microbatch)
+                        for name in ("backward_step", "forward_step")
+                        for model_chunk in range(virtual_pipeline_model_parallel_size)
+                        for microbatch in range(num_microbatches)
+                    )
+                    self.assertEqual(computed, expected)
+
+    def test_interleaving_requires_divisible_microbatches(self):
+        with self.assertRaisesRegex(RuntimeError, "not divisible"):
+            simulate_pipeline_schedule(4, 6, 1.0, 2.0, virtual_pipeline_model_parallel_size=2)
+
+    def test_forward_only(self):
+        result = simulate_pipeline_schedule(4, 8, self.FORWARD_COST, self.BACKWARD_COST, forward_only=True)
+        self.assertEqual(result.makespan, (8 + 4 - 1) * self.FORWARD_COST)
+        self.assertEqual(result.peak_activations_in_flight, [0, 0, 0, 0])
+        for timeline in result.timelines:
+            self.assertFalse(any(event.name == "backward_step" for event in timeline))
+
+    def test_p2p_cost(self):
+        no_comm = simulate_pipeline_schedule(4, 8, self.FORWARD_COST, self.BACKWARD_COST)
+        latency_only = simulate_pipeline_schedule(4, 8, self.FORWARD_COST, self.BACKWARD_COST, p2p_latency=0.1)
+        with_bandwidth = simulate_pipeline_schedule(
+            4, 8, self.FORWARD_COST, self.BACKWARD_COST, p2p_latency=0.1, p2p_bandwidth=10.0, tensor_bytes=10 ** 6)
+        self.assertGreater(latency_only.makespan, no_comm.makespan)
+        self.assertGreater(with_bandwidth.makespan, latency_only.makespan)
+        self.assertGreater(with_bandwidth.bubble_fraction, no_comm.bubble_fraction)
+
+    def test_per_stage_costs(self):
+        # the slowest stage dictates the steady state
+        result = simulate_pipeline_schedule(4, 8, [1.0, 1.0, 2.0, 1.0], [2.0, 2.0, 4.0, 2.0])
+        self.assertGreaterEqual(result.makespan, 8 * 6.0)
+        self.assertEqual(min(range(4), key=lambda rank: result.rank_bubble_fractions[rank]), 2)
+        with self.assertRaisesRegex(ValueError, "one entry per pipeline stage"):
+            simulate_pipeline_schedule(4, 8, [1.0, 1.0], 2.0)
+
+    def test_chrome_trace(self):
+        result = simulate_pipeline_schedule(
+            2, 4, self.FORWARD_COST, self.BACKWARD_COST, virtual_pipeline_model_parallel_size=2, p2p_latency=0.1)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "trace.json")
+            result.save_chrome_trace(path)
+            with open(path) as f:
+                trace = json.load(f)
+        events = [event for event in trace["traceEvents"] if event["ph"] == "X"]
+        self.assertEqual(len(events), sum(len(timeline) for timeline in result.timelines))
+        self.assertEqual({event["tid"] for event in events}, {0, 1})
+        self.assertEqual({event["cat"] for event in events}, {"compute", "p2p"})
+
+
+if __name__ == "__main__":
+    common_utils.run_tests()
@@ -7,6 +7,7 @@ logging.getLogger("torch").setLevel(logging.WARNING)
 
 from apex.transformer import parallel_state
 from apex.transformer import tensor_parallel
+from apex.transformer.testing.distributed_test_base import GlooDistributedTestBase
 from apex.transformer.testing.distributed_test_base import NcclDistributedTestBase
 from apex.transformer.testing.distributed_test_base import UccDistributedTestBase
 
@@ -112,6 +113,100 @@ class TransformerRandomTestBase:
                 parallel_state.destroy_model_parallel()
 
 
+class SelectiveRecomputeTestBase:
+
+    shape = (4, 8, 16)
+
+    def _forward_backward(self, use_recompute, seed=1234, **kwargs):
+        torch.manual_seed(seed)
+        weight = torch.randn(self.shape[-1], self.shape[-1], requires_grad=True)
+        x = torch.randn(*self.shape, requires_grad=True)
+
+        def softmax_dropout(scores, scale):
+            return torch.nn.functional.dropout(torch.softmax(scores * scale, dim=-1), p=0.5)
+
+        scores = x @ weight
+        if use_recompute:
+            probs = tensor_parallel.recompute(softmax_dropout, scores, 0.5, **kwargs)
+        else:
+            probs = softmax_dropout(scores, 0.5)
+        # The random numbers drawn after the recomputed sub-block must not be affected by its recomputation.
+        (probs @ weight).mul(torch.rand(self.shape)).sum().backward()
+        return probs.detach(), x.grad, weight.grad, torch.rand(3)
+
+    def _check_recompute(self, seed=1234, **kwargs):
+        for tensor, ref_tensor in zip(
+            self._forward_backward(True, seed, **kwargs), self._forward_backward(False, seed)
+        ):
+            self.assertEqual(tensor, ref_tensor)
+
+
+class SelectiveRecomputeTest(SelectiveRecomputeTestBase, common_utils.TestCase):
+
+    def tearDown(self):
+        tensor_parallel.enable_recompute_stats(False)
+        tensor_parallel.reset_recompute_stats()
+        super().tearDown()
+
+    def test_recompute(self):
+        self._check_recompute()
+
+    def test_recompute_stats(self):
+        tensor_parallel.enable_recompute_stats()
+        for _ in range(2):
+            self._forward_backward(True, name="layer.0")
+        tensor_parallel.recompute(lambda x: (x @ x).sum(), torch.ones(4, 4, requires_grad=True), name="layer.1").backward()
+
+        stats = tensor_parallel.get_recompute_stats()
+        self.assertEqual(stats["layer.0"].num_recomputes, 2)
+        # The softmax output and the dropout mask are not kept.
+        self.assertGreaterEqual(stats["layer.0"].saved_bytes, 2 * 2 * torch.Size(self.shape).numel())
+        self.assertEqual(stats["layer.0"].distributed_bytes, 0)
+        # The FLOP counter does not see softmax and dropout, the measured time does.
+        self.assertGreater(stats["layer.0"].recompute_time, 0.0)
+        self.assertEqual(stats["layer.0"].recompute_flops, 0)
+        self.assertGreater(stats["layer.1"].recompute_time, 0.0)
+        self.assertEqual(stats["layer.1"].recompute_flops, 2 * 4 * 4 * 4)
+
+        tensor_parallel.reset_recompute_stats()
+        self.assertEqual(tensor_parallel.get_recompute_stats(), {})
+
+
+class GlooSelectiveRecomputeTest(SelectiveRecomputeTestBase, GlooDistributedTestBase):
+
+    def test_distribute_saved_activations(self):
+        parallel_state.initialize_model_parallel(tensor_model_parallel_size_=self.world_size)
+        tensor_parallel.enable_recompute_stats()
+
+        self._check_recompute(distribute_saved_activations=True, name="layer.0")
+        stats = tensor_parallel.get_recompute_stats()["layer.0"]
+        numel = torch.Size(self.shape).numel()
+        self.assertEqual(stats.distributed_bytes, numel * 4 * (self.world_size - 1) // self.world_size)
+
+        tensor_parallel.enable_recompute_stats(False)
+        tensor_parallel.reset_recompute_stats()
+        parallel_state.destroy_model_parallel()
+
+    def test_distribute_saved_activations_of_per_rank_inputs(self):
+        parallel_state.initialize_model_parallel(tensor_model_parallel_size_=self.world_size)
+        tensor_parallel.enable_recompute_stats()
+
+        # Each rank has its own scores, like the attention scores of its heads: they are kept whole,
+        # and the gradients are the same with and without distribution.
+        seed = 1234 + self.rank
+        for tensor, ref_tensor in zip(
+            self._forward_backward(True, seed, distribute_saved_activations=True, name="layer.0"),
+            self._forward_backward(True, seed, distribute_saved_activations=False),
+        ):
+            self.assertEqual(tensor, ref_tensor)
+        self._check_recompute(seed, distribute_saved_activations=True)
+        self.assertEqual(tensor_parallel.get_recompute_stats()["layer.0"].distributed_bytes, 0)
+
+        tensor_parallel.enable_recompute_stats(False)
+        tensor_parallel.reset_recompute_stats()
+        parallel_state.destroy_model_parallel()
+
+
 class NcclTransformerRandomTest(TransformerRandomTestBase, NcclDistributedTestBase): pass
 class UccTransformerRandomTest(TransformerRandomTestBase, UccDistributedTestBase): pass
 
@@ -0,0 +1,102 @@
+import contextlib
+import io
+import logging
+import time
+
+import torch
+from torch.testing._internal import common_utils
+
+logging.getLogger("torch").setLevel(logging.WARNING)
+
+from apex.transformer.pipeline_parallel._timers import _DummyTimer
+from apex.transformer.pipeline_parallel._timers import _EventTimer
+from apex.transformer.pipeline_parallel._timers import _Timers
+from apex.transformer.testing.distributed_test_base import GlooDistributedTestBase
+
+logging.getLogger("apex").setLevel(logging.WARNING)
+
+
+class _ScalarWriter:
+    def __init__(self):
+        self.scalars = {}
+
+    def add_scalar(self, name, value, iteration):
+        self.scalars[name] = value
+
+
+class EventTimerTest(common_utils.TestCase):
+    def test_elapsed(self):
+        timer = _EventTimer("test")
+        for _ in range(2):
+            timer.start()
+            time.sleep(0.01)
+            timer.stop()
+        self.assertGreaterEqual(timer.elapsed(reset=False), 0.02)
+        self.assertGreaterEqual(timer.elapsed(), 0.02)
+        self.assertEqual(timer.elapsed(), 0.0)
+
+    def test_elapsed_while_started(self):
+        timer = _EventTimer("test")
+        timer.start()
+        time.sleep(0.01)
+        self.assertGreaterEqual(timer.elapsed(), 0.01)
+        self.assertTrue(timer.started_)
+        timer.stop()
+
+    def test_cuda_events(self):
+        if not torch.cuda.is_available():
+            self.skipTest("requires CUDA")
+        torch.cuda.init()
+        timer = _EventTimer("test", max_pending=2)
+        x = torch.randn(1024, 1024, device="cuda")
+        for _ in range(4):
+            timer.start()
+            x = x @ x.t() / 1024
+            timer.stop()
+        # Intervals the device completed are resolved once more than `max_pending` are queued.
+        self.assertLessEqual(len(timer._pending), 3)
+        self.assertGreater(timer.elapsed(), 0.0)
+        self.assertEqual(len(timer._pending), 0)
+
+    def test_disabled_timers(self):
+        timers = _Timers(use_events=True, enabled=False)
+        self.assertIsInstance(timers("test"), _DummyTimer)
+        timers("test").start()
+        timers("test").stop()
+        self.assertEqual(timers.timers, {})
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            timers.log(["test"])
+        self.assertEqual(stdout.getvalue(), "")
+
+        timers.enabled = True
+        self.assertIsInstance(timers("test"), _EventTimer)
+
+
+class GlooTimersTest(GlooDistributedTestBase):
+    def test_aggregate(self):
+        timers = _Timers(use_events=True)
+        timers("test").elapsed_ = float(self.rank + 1)
+        if self.rank == 0:
+            timers("first-rank").elapsed_ = 5.0
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            timers.log(["test", "first-rank"], aggregate=True, reset=False)
+        if self.rank == self.world_size - 1:
+            mean = 1000.0 * (self.world_size + 1) / 2
+            self.assertIn(
+                "test: {:.2f} (min 1000.00, max {:.2f})".format(mean, 1000.0 * self.world_size), stdout.getvalue()
+            )
+            self.assertIn("first-rank: 5000.00 (min 5000.00, max 5000.00)", stdout.getvalue())
+        else:
+            self.assertEqual(stdout.getvalue(), "")
+
+        writer = _ScalarWriter() if self.rank == 0 else None
+        timers.write(["test"], writer, 0, aggregate=True)
+        if writer is not None:
+            self.assertEqual(writer.scalars["test-time-min"], 1.0)
+            self.assertEqual(writer.scalars["test-time-max"], float(self.world_size))
+
+
+if __name__ == "__main__":
+    common_utils.run_tests()
@@ -0,0 +1,123 @@
+"""Compare the memory and time of the output projection followed by the vocab parallel cross entropy
+against `vocab_parallel_linear_cross_entropy`.
+
+On CUDA, the peak memory allocated by the forward and backward is reported. On CPU, the growth of the
+peak resident set size of the process is reported instead, which requires Linux.
+
+    python vocab_parallel_linear_cross_entropy_benchmark.py --vocab-size 32768 65536 131072
+"""
+import argparse
+import multiprocessing
+import re
+import tempfile
+import time
+
+import torch
+import torch.nn.functional as F
+
+from apex.transformer import parallel_state
+from apex.transformer import tensor_parallel
+
+
+def _read_status_bytes(field: str) -> int:
+    with open("/proc/self/status") as f:
+        return int(re.search(rf"{field}:\s+(\d+) kB", f.read()).group(1)) * 1024
+
+
+def _reset_peak_rss() -> None:
+    # Writing 5 to `clear_refs` resets the peak resident set size, i.e. `VmHWM`.
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def _make_inputs(args, vocab_size, device):
+    torch.manual_seed(args.seed)
+    dtype = getattr(torch, args.dtype)
+    input = torch.randn(args.sequence_length, args.micro_batch_size, args.hidden_size, device=device, dtype=dtype)
+    weight = torch.randn(vocab_size, args.hidden_size, device=device, dtype=dtype) * 0.02
+    target = torch.randint(0, vocab_size, (args.sequence_length, args.micro_batch_size), device=device)
+    return input.requires_grad_(), weight.requires_grad_(), target
+
+
+def _step(args, variant, input, weight, target):
+    if variant == "linear+cross_entropy":
+        logits = F.linear(input, weight)
+        loss = tensor_parallel.vocab_parallel_cross_entropy(logits, target)
+    else:
+        loss = tensor_parallel.vocab_parallel_linear_cross_entropy(
+            input, weight, target, chunk_size=args.chunk_size, vocab_chunk_size=args.vocab_chunk_size,
+        )
+    loss.mean().backward()
+
+
+def _run(args, variant, vocab_size, device):
+    """Return the peak memory in bytes on top of the inputs and the time of one forward and backward."""
+    input, weight, target = _make_inputs(args, vocab_size, device)
+    # Warm up, which also allocates the gradients of the inputs.
+    _step(args, variant, input, weight, target)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        memory_before = torch.cuda.memory_allocated()
+    else:
+        _reset_peak_rss()
+        memory_before = _read_status_bytes("VmRSS")
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        _step(args, variant, input, weight, target)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        peak_memory = torch.cuda.max_memory_allocated() - memory_before
+    else:
+        peak_memory = _read_status_bytes("VmHWM") - memory_before
+    return peak_memory, (time.perf_counter() - start) / args.repeats
+
+
+def _worker(args, variant, vocab_size, queue):
+    device = torch.device("cuda", 0) if args.device == "cuda" else torch.device("cpu")
+    with tempfile.TemporaryDirectory() as init_dir:
+        torch.distributed.init_process_group(
+            backend="nccl" if device.type == "cuda" else "gloo",
+            init_method=f"file://{init_dir}/init",
+            rank=0,
+            world_size=1,
+        )
+        parallel_state.initialize_model_parallel()
+        queue.put(_run(args, variant, vocab_size, device))
+        parallel_state.destroy_model_parallel()
+        torch.distributed.destroy_process_group()
+
+
+def main(args):
+    # Every measurement runs in its own process so that the peak resident set sizes are independent.
+    context = multiprocessing.get_context("spawn")
+    print(
+        "{:>8} {:>24} {:>16} {:>12}".format("vocab", "variant", "peak memory (MB)", "time (ms)")
+    )
+    for vocab_size in args.vocab_size:
+        for variant in ("linear+cross_entropy", "linear_cross_entropy"):
+            queue = context.Queue()
+            process = context.Process(target=_worker, args=(args, variant, vocab_size, queue))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(f"the measurement of {variant} with a vocab of {vocab_size} failed")
+            peak_memory, elapsed = queue.get()
+            print(
+                "{:>8} {:>24} {:>16.1f} {:>12.2f}".format(vocab_size, variant, peak_memory / 2 ** 20, elapsed * 1000)
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vocab-size", type=int, nargs="+", default=[8192, 32768])
+    parser.add_argument("--sequence-length", type=int, default=1024)
+    parser.add_argument("--micro-batch-size", type=int, default=1)
+    parser.add_argument("--hidden-size", type=int, default=512)
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--vocab-chunk-size", type=int, default=4096)
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", choices=["cuda", "cpu"])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1234)
+    main(parser.parse_args())